@@ -0,0 +1,285 @@
+import argparse
+import asyncio
+import ipaddress
+import multiprocessing
+import os
+import random
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+
+from dns_resolver import DNSResolverProtocol, QueryLog, get_qclass, parse_dns_query
+from zone import Zone, encode_name
+
+
+class LegacyProtocol(DNSResolverProtocol):
+    '''
+    The query path before the answer table: a task per datagram, the name
+    walked twice, and the answer rebuilt byte by byte for every query.
+    '''
+
+    def __init__(self, loop, hosts, log_queries=True):
+        self.loop = loop
+        self.hosts = hosts
+        self.log_queries = log_queries
+        self.transport = None
+
+    def create_dns_response(self, query_domain, transaction_id):
+        ip_address = self.hosts.get(query_domain, "0.0.0.0")
+
+        response = bytearray()
+        response.extend(transaction_id.to_bytes(2, byteorder='big'))
+        response.extend(b'\x81\x80')
+        response.extend(b'\x00\x01')
+        response.extend(b'\x00\x01')
+        response.extend(b'\x00\x00')
+        response.extend(b'\x00\x00')
+
+        for part in query_domain.split('.'):
+            response.append(len(part))
+            response.extend(part.encode())
+
+        response.extend(b'\x00')
+        response.extend(b'\x00\x01')
+        response.extend(b'\x00\x01')
+        response.extend(b'\xc0\x0c')
+        response.extend(b'\x00\x01')
+        response.extend(b'\x00\x01')
+        response.extend(b'\x00\x00\x00\x10')
+        response.extend(b'\x00\x04')
+        response.extend(socket.inet_aton(str(ip_address)))
+        return response
+
+    def datagram_received(self, data, addr):
+        if self.log_queries:
+            print(f"query has received from {addr}")
+        asyncio.create_task(self.handle_legacy_query(data, addr))
+
+    async def handle_legacy_query(self, data, addr):
+        query_domain, transaction_id = parse_dns_query(data)
+        qc = get_qclass(data)
+        if qc == 1 and query_domain in self.hosts:
+            self.transport.sendto(self.create_dns_response(query_domain, transaction_id), addr)
+        else:
+            self.transport.sendto(self.send_error_response(transaction_id, 3, None), addr)
+
+
+def table_protocol(loop, hosts, log_queries=True):
+    zone = Zone()
+    for domain, ip_address in hosts.items():
+        zone.add_host(ip_address.packed, [domain])
+    return DNSResolverProtocol(loop, zone.compile(), QueryLog() if log_queries else None)
+
+
+PROTOCOLS = {'legacy': LegacyProtocol, 'table': table_protocol}
+
+
+def make_hosts(count):
+    return {f"host{i}.bench.example": ipaddress.ip_address(f"10.{i >> 16 & 255}.{i >> 8 & 255}.{i & 255}")
+            for i in range(count)}
+
+
+def make_queries(hosts, count):
+    names = list(hosts)
+    return [struct.pack('!HHHHHH', random.getrandbits(16), 0x0100, 1, 0, 0, 0)
+            + encode_name(random.choice(names)) + b'\x00\x01\x00\x01' for _ in range(count)]
+
+
+class NullTransport:
+    def __init__(self):
+        self.sent = 0
+
+    def sendto(self, data, addr):
+        self.sent += 1
+
+
+def bench_handler(name, hosts, queries, number):
+    '''
+    CPU cost of answering one query inside the process, without sockets.
+    '''
+    loop = asyncio.new_event_loop()
+    protocol = PROTOCOLS[name](loop, hosts, log_queries=False)
+    protocol.connection_made(NullTransport())
+    addr = ('127.0.0.1', 40000)
+
+    if name == 'legacy':
+        async def run():
+            for data in queries:
+                await protocol.handle_legacy_query(data, addr)
+        call = lambda: loop.run_until_complete(run())
+    else:
+        def call():
+            for data in queries:
+                protocol.datagram_received(data, addr)
+    seconds = min(timeit.repeat(call, number=number, repeat=3)) / number
+    loop.close()
+    return len(queries) / seconds
+
+
+def run_server(ready, name, hosts):
+    sys.stdout = open(os.devnull, 'w')
+
+    async def serve():
+        loop = asyncio.get_running_loop()
+        transport, _ = await loop.create_datagram_endpoint(
+            lambda: PROTOCOLS[name](loop, hosts, log_queries=False), local_addr=('127.0.0.1', 0))
+        ready.send(transport.get_extra_info('sockname')[1])
+        await asyncio.Event().wait()
+
+    asyncio.run(serve())
+
+
+class LoadProtocol(asyncio.DatagramProtocol):
+    def __init__(self, queries, total, window):
+        self.queries = queries
+        self.total = total
+        self.window = window
+        self.sent = 0
+        self.received = 0
+        self.done = asyncio.get_running_loop().create_future()
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        for _ in range(self.window):
+            self.send()
+
+    def send(self):
+        if self.sent < self.total:
+            self.transport.sendto(self.queries[self.sent % len(self.queries)])
+            self.sent += 1
+
+    def datagram_received(self, data, addr):
+        self.received += 1
+        if self.received >= self.total and not self.done.done():
+            self.done.set_result(None)
+        else:
+            self.send()
+
+
+async def blast(port, queries, total, window, timeout):
+    loop = asyncio.get_running_loop()
+    started = time.perf_counter()
+    transport, protocol = await loop.create_datagram_endpoint(
+        lambda: LoadProtocol(queries, total, window), remote_addr=('127.0.0.1', port))
+    try:
+        await asyncio.wait_for(asyncio.shield(protocol.done), timeout)
+    except asyncio.TimeoutError:
+        pass
+    transport.close()
+    return protocol.received / (time.perf_counter() - started), protocol.received
+
+
+def start_resolver(hosts_file, workers, io, extra_args=()):
+    '''
+    Runs dns_resolver.py as its own process tree and waits until it answers.
+    '''
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as probe:
+        probe.bind(('127.0.0.1', 0))
+        port = probe.getsockname()[1]
+    command = [sys.executable, 'dns_resolver.py', '--host', '127.0.0.1', '--port', str(port),
+               '--hosts-file', hosts_file, '--reload-interval', '0', '--quiet',
+               '--workers', str(workers), '--io', io] + list(extra_args)
+    process = subprocess.Popen(command, cwd=os.path.dirname(os.path.abspath(__file__)),
+                               stdout=subprocess.DEVNULL)
+    query = make_queries({'host0.bench.example': None}, 1)[0]
+    deadline = time.monotonic() + 30
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as probe:
+        probe.settimeout(0.2)
+        while True:
+            try:
+                probe.sendto(query, ('127.0.0.1', port))
+                probe.recv(512)
+                return process, port
+            except OSError:
+                if process.poll() is not None or time.monotonic() > deadline:
+                    process.kill()
+                    raise RuntimeError("resolver did not start")
+
+
+def run_client(result, port, queries, total, window):
+    result.send(asyncio.run(blast(port, queries, total, window, 60)))
+
+
+def bench_scaling(args, hosts, queries):
+    '''
+    Aggregate queries per second of dns_resolver.py with 1, 2, 4... worker
+    processes, loaded by args.clients client processes at once.
+    '''
+    with tempfile.NamedTemporaryFile('w', suffix='.hosts') as hosts_file:
+        for domain, ip_address in hosts.items():
+            hosts_file.write(f"{ip_address} {domain}\n")
+        hosts_file.flush()
+
+        print(f"dns_resolver.py, {args.clients} client processes with {args.window} queries in flight each "
+              f"({os.cpu_count()} CPUs):")
+        for io in args.io:
+            for workers in args.workers:
+                resolver, port = start_resolver(hosts_file.name, workers, io)
+                try:
+                    pipes = []
+                    clients = []
+                    for _ in range(args.clients):
+                        parent, child = multiprocessing.Pipe()
+                        client = multiprocessing.Process(
+                            target=run_client, args=(child, port, queries, args.queries // args.clients, args.window))
+                        client.start()
+                        pipes.append(parent)
+                        clients.append(client)
+                    results = [pipe.recv() for pipe in pipes]
+                    for client in clients:
+                        client.join()
+                finally:
+                    resolver.terminate()
+                    resolver.wait()
+                qps = sum(qps for qps, _ in results)
+                received = sum(received for _, received in results)
+                sent = args.queries // args.clients * args.clients
+                lost = f"  ({sent - received} unanswered)" if received < sent else ""
+                print(f"{io:>8} workers={workers:<3}: {qps:12.0f} queries/s{lost}", flush=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Queries per second of the DNS resolver, before and after the answer table.")
+    parser.add_argument('--hosts', type=int, default=10000, help="names in the generated hosts table")
+    parser.add_argument('--queries', type=int, default=100000, help="queries sent to each server")
+    parser.add_argument('--window', type=int, default=64, help="queries in flight at once")
+    parser.add_argument('--scale', action='store_true',
+                        help="measure dns_resolver.py itself with each --workers count and --io mode instead")
+    parser.add_argument('--workers', nargs='+', type=int, default=[1, 2, 4])
+    parser.add_argument('--io', nargs='+', choices=('asyncio', 'batch'), default=['asyncio', 'batch'])
+    parser.add_argument('--clients', type=int, default=4, help="load generator processes for --scale")
+    args = parser.parse_args()
+
+    multiprocessing.set_start_method('fork')
+    hosts = make_hosts(args.hosts)
+    queries = make_queries(hosts, 10000)
+
+    if args.scale:
+        bench_scaling(args, hosts, queries)
+        return
+
+    print("in-process handler (no sockets):")
+    for name in PROTOCOLS:
+        print(f"{name:>8}: {bench_handler(name, hosts, queries, 3):12.0f} queries/s")
+
+    print(f"over UDP, {args.window} queries in flight:")
+    for name in PROTOCOLS:
+        parent, child = multiprocessing.Pipe()
+        server = multiprocessing.Process(target=run_server, args=(child, name, hosts), daemon=True)
+        server.start()
+        port = parent.recv()
+        try:
+            qps, received = asyncio.run(blast(port, queries, args.queries, args.window, 60))
+        finally:
+            server.terminate()
+        lost = f"  ({args.queries - received} unanswered)" if received < args.queries else ""
+        print(f"{name:>8}: {qps:12.0f} queries/s{lost}")
+
+
+if __name__ == '__main__':
+    main()
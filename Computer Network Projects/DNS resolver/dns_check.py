@@ -0,0 +1,190 @@
+import socket
+import struct
+
+from zone import TYPES
+
+TYPE_NAMES = {rtype: name for name, rtype in TYPES.items()}
+TYPE_NAMES.update({6: 'SOA', 41: 'OPT', 255: 'ANY'})
+RCODES = {0: 'NOERROR', 1: 'FORMERR', 2: 'SERVFAIL', 3: 'NXDOMAIN', 4: 'NOTIMP', 5: 'REFUSED'}
+
+TYPE_CNAME = TYPES['CNAME']
+NAME_RDATA = (TYPES['NS'], TYPES['CNAME'], TYPES['PTR'])
+
+
+class WireError(Exception):
+    pass
+
+
+def decode_name(data, index):
+    '''
+    Reads the name at index, following compression pointers, and returns
+    (name, index just past it). Pointers must point backwards, labels must
+    be at most 63 bytes and the name at most 255 bytes.
+    '''
+    labels = []
+    end = None
+    length_total = 1
+    position = index
+    while True:
+        if position >= len(data):
+            raise WireError(f"name at offset {index} runs past the end of the message")
+        length = data[position]
+        if length & 0xC0 == 0xC0:
+            if position + 1 >= len(data):
+                raise WireError(f"compression pointer at offset {position} is cut off")
+            target = (length & 0x3F) << 8 | data[position + 1]
+            if target >= position:
+                raise WireError(f"compression pointer at offset {position} does not point backwards")
+            if end is None:
+                end = position + 2
+            position = target
+            continue
+        if length & 0xC0:
+            raise WireError(f"unsupported label type 0x{length:02x} at offset {position}")
+        if length == 0:
+            break
+        label = data[position + 1:position + 1 + length]
+        if len(label) < length:
+            raise WireError(f"label at offset {position} runs past the end of the message")
+        labels.append(label.decode('ascii', 'backslashreplace'))
+        length_total += length + 1
+        if length_total > 255:
+            raise WireError(f"name at offset {index} is longer than 255 bytes")
+        position += length + 1
+    return '.'.join(labels) + '.', end if end is not None else position + 1
+
+
+def decode_rdata(data, rtype, start, rdlength):
+    end = start + rdlength
+    if rtype == TYPES['A']:
+        if rdlength != 4:
+            raise WireError(f"A record with {rdlength} bytes of data")
+        return socket.inet_ntop(socket.AF_INET, data[start:end])
+    if rtype == TYPES['AAAA']:
+        if rdlength != 16:
+            raise WireError(f"AAAA record with {rdlength} bytes of data")
+        return socket.inet_ntop(socket.AF_INET6, data[start:end])
+    if rtype in NAME_RDATA:
+        name, index = decode_name(data, start)
+        if index != end:
+            raise WireError(f"{TYPE_NAMES[rtype]} name does not fill its RDLENGTH")
+        return name
+    if rtype == TYPES['MX']:
+        if rdlength < 3:
+            raise WireError("MX record too short")
+        name, index = decode_name(data, start + 2)
+        if index != end:
+            raise WireError("MX exchange does not fill its RDLENGTH")
+        return f"{struct.unpack_from('!H', data, start)[0]} {name}"
+    if rtype == TYPES['TXT']:
+        strings = []
+        index = start
+        while index < end:
+            length = data[index]
+            if index + 1 + length > end:
+                raise WireError("TXT string runs past its RDLENGTH")
+            strings.append(data[index + 1:index + 1 + length])
+            index += 1 + length
+        if not strings:
+            raise WireError("TXT record without strings")
+        return strings
+    return data[start:end]
+
+
+def decode_message(data):
+    '''
+    Decodes a whole DNS message and returns it as a dict: id, flags, rcode,
+    question (a list of (name, type, class)) and answer, authority and
+    additional (lists of (name, type, class, ttl, data)). Raises WireError if
+    any part of it is malformed, including trailing bytes.
+    '''
+    if len(data) < 12:
+        raise WireError(f"message of {len(data)} bytes is shorter than a header")
+    message_id, flags, qdcount, ancount, nscount, arcount = struct.unpack_from('!HHHHHH', data)
+    message = {'id': message_id, 'flags': flags, 'rcode': flags & 0x0F, 'question': []}
+    index = 12
+    for _ in range(qdcount):
+        name, index = decode_name(data, index)
+        if index + 4 > len(data):
+            raise WireError("question runs past the end of the message")
+        message['question'].append((name,) + struct.unpack_from('!HH', data, index))
+        index += 4
+    for section, count in (('answer', ancount), ('authority', nscount), ('additional', arcount)):
+        records = message[section] = []
+        for _ in range(count):
+            name, index = decode_name(data, index)
+            if index + 10 > len(data):
+                raise WireError(f"{section} record header runs past the end of the message")
+            rtype, rclass, ttl, rdlength = struct.unpack_from('!HHIH', data, index)
+            index += 10
+            if index + rdlength > len(data):
+                raise WireError(f"{section} record data runs past the end of the message")
+            if ttl & 0x80000000:
+                raise WireError(f"{section} record for {name} has a negative TTL")
+            records.append((name, rtype, rclass, ttl, decode_rdata(data, rtype, index, rdlength)))
+            index += rdlength
+    if index != len(data):
+        raise WireError(f"{len(data) - index} bytes after the last record")
+    return message
+
+
+def validate_response(query, response):
+    '''
+    Checks a response against the query it answers and returns a list of
+    problems, empty when the response is valid: it must decode, match the
+    query's ID, opcode and RD bit, echo the question (the name compared
+    without regard to case), and carry answers that belong to the question:
+    records of the type asked for, reached from the name through CNAMEs.
+    '''
+    try:
+        message = decode_message(response)
+    except WireError as e:
+        return [str(e)]
+
+    problems = []
+    flags = message['flags']
+    query_id, query_flags = struct.unpack_from('!HH', query)
+    if message['id'] != query_id:
+        problems.append(f"ID {message['id']} does not match the query's {query_id}")
+    if not flags & 0x8000:
+        problems.append("QR bit not set")
+    if flags & 0x7800 != query_flags & 0x7800:
+        problems.append("opcode differs from the query's")
+    if flags & 0x0100 != query_flags & 0x0100:
+        problems.append("RD bit not copied from the query")
+    if len(response) > 512 and query[10:12] == b'\x00\x00':
+        problems.append(f"{len(response)}-byte UDP response to a query without EDNS")
+
+    rcode = message['rcode']
+    questions = message['question']
+    if not questions:
+        # Allowed only when the question could not be read.
+        if rcode not in (1, 4):
+            problems.append(f"{RCODES.get(rcode, rcode)} without the question section")
+        if message['answer']:
+            problems.append("answers without a question")
+        return problems
+    if len(questions) != 1:
+        problems.append(f"{len(questions)} questions")
+    try:
+        asked = decode_message(query)['question'][0]
+    except (WireError, IndexError):
+        return problems + ["the query itself does not decode"]
+    name, rtype, rclass = questions[0]
+    if name.lower() != asked[0].lower() or (rtype, rclass) != asked[1:]:
+        problems.append(f"question {questions[0]} does not echo {asked}")
+
+    owners = {asked[0].lower()}
+    for owner, record_type, record_class, _, data in message['answer']:
+        if owner.lower() not in owners:
+            problems.append(f"answer for {owner}, which is not the question or a CNAME target")
+        if record_class != asked[2]:
+            problems.append(f"answer for {owner} has class {record_class}")
+        if record_type == TYPE_CNAME and asked[1] != TYPE_CNAME:
+            owners.add(data.lower())
+        elif record_type != asked[1] and asked[1] != 255:
+            problems.append(f"{TYPE_NAMES.get(record_type, record_type)} answer to a "
+                            f"{TYPE_NAMES.get(asked[1], asked[1])} question")
+        elif rcode:
+            problems.append(f"{RCODES.get(rcode, rcode)} response with a non-CNAME answer")
+    return problems
@@ -0,0 +1,396 @@
+import asyncio
+import functools
+import random
+import struct
+import time
+from collections import OrderedDict
+
+TYPE_SOA = 6
+TYPE_OPT = 41
+
+# Per-entry bookkeeping (dict slot, CachedAnswer, key) counted on top of the
+# response bytes when enforcing max_bytes.
+ENTRY_OVERHEAD = 200
+
+
+def skip_name(data, index):
+    '''
+    Returns the index just past the (possibly compressed) name at index.
+    '''
+    while True:
+        length = data[index]
+        if length == 0:
+            return index + 1
+        if length & 0xC0 == 0xC0:
+            return index + 2
+        index += length + 1
+
+
+def question_end(data):
+    return skip_name(data, 12) + 4
+
+
+def walk_records(data):
+    '''
+    Yields (type, ttl offset, rdata offset, rdlength) for every record in the
+    answer, authority and additional sections of a message.
+    '''
+    qdcount, ancount, nscount, arcount = struct.unpack_from('!HHHH', data, 4)
+    index = 12
+    for _ in range(qdcount):
+        index = skip_name(data, index) + 4
+    for _ in range(ancount + nscount + arcount):
+        index = skip_name(data, index)
+        rtype, _, _, rdlength = struct.unpack_from('!HHIH', data, index)
+        yield rtype, index + 4, index + 10, rdlength
+        index += 10 + rdlength
+    if index > len(data):
+        raise IndexError("record runs past the end of the message")
+
+
+def udp_payload_size(query):
+    '''
+    The largest UDP response the client accepts: 512 bytes, or what it
+    advertised in an EDNS OPT record.
+    '''
+    if not query[10] and not query[11]:
+        return 512
+    try:
+        for rtype, ttl_offset, _, _ in walk_records(query):
+            if rtype == TYPE_OPT:
+                return max(512, struct.unpack_from('!H', query, ttl_offset - 2)[0])
+    except (IndexError, struct.error):
+        pass
+    return 512
+
+
+def error_response(query, rcode):
+    end = question_end(query)
+    return query[:2] + struct.pack('!HHHHH', 0x8180 | rcode, 1, 0, 0, 0) + query[12:end]
+
+
+def truncated_response(response, query):
+    '''
+    Header and question only, with the TC bit set, for a response that does
+    not fit in the client's UDP payload size; the client retries over TCP.
+    '''
+    end = question_end(query)
+    flags = struct.unpack_from('!H', response, 2)[0] | 0x0200
+    return query[:2] + struct.pack('!HHHHH', flags, 1, 0, 0, 0) + query[12:end]
+
+
+class CachedAnswer:
+    __slots__ = ('response', 'ttl_offsets', 'ttl', 'stored_at', 'expires_at', 'hits', 'size')
+
+    def __init__(self, response, ttl_offsets, ttl, now):
+        self.response = response
+        self.ttl_offsets = ttl_offsets
+        self.ttl = ttl
+        self.stored_at = now
+        self.expires_at = now + ttl
+        self.hits = 0
+        self.size = len(response) + ENTRY_OVERHEAD
+
+    def render(self, query, now):
+        '''
+        The cached response for query: its transaction ID, the question as
+        the client spelled it, and every TTL reduced by the entry's age.
+        '''
+        response = bytearray(self.response)
+        end = question_end(query)
+        response[:2] = query[:2]
+        response[12:end] = query[12:end]
+        age = int(now - self.stored_at)
+        if age:
+            for offset, ttl in self.ttl_offsets:
+                struct.pack_into('!I', response, offset, max(ttl - age, 0))
+        return bytes(response)
+
+
+class UpstreamProtocol(asyncio.DatagramProtocol):
+    def __init__(self):
+        self.transport = None
+        self.waiters = {}
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        if len(data) < 12:
+            return
+        waiter = self.waiters.pop(data[0] << 8 | data[1], None)
+        if waiter is not None and not waiter.done():
+            waiter.set_result(data)
+
+    def error_received(self, exc):
+        for waiter in self.waiters.values():
+            if not waiter.done():
+                waiter.set_exception(exc)
+        self.waiters.clear()
+
+
+class Upstream:
+    '''
+    Sends a question to the upstream servers over UDP with a fresh random
+    transaction ID, trying the servers in turn, and repeats it over TCP when
+    the UDP answer comes back truncated.
+    '''
+
+    def __init__(self, servers, timeout=2.0, attempts=3):
+        self.servers = servers
+        self.timeout = timeout
+        self.attempts = attempts
+        self.protocols = {}
+        self.timeouts = 0
+        self.tcp_fallbacks = 0
+
+    async def connect(self, server):
+        protocol = self.protocols.get(server)
+        if protocol is None or protocol.transport.is_closing():
+            loop = asyncio.get_running_loop()
+            _, protocol = await loop.create_datagram_endpoint(UpstreamProtocol, remote_addr=server)
+            self.protocols[server] = protocol
+        return protocol
+
+    async def query(self, question):
+        '''
+        The upstream response to question (name, QTYPE and QCLASS in wire
+        format), sent as given.
+        '''
+        loop = asyncio.get_running_loop()
+        for attempt in range(self.attempts):
+            server = self.servers[attempt % len(self.servers)]
+            protocol = await self.connect(server)
+            transaction_id = random.getrandbits(16)
+            while transaction_id in protocol.waiters:
+                transaction_id = random.getrandbits(16)
+            query = struct.pack('!HHHHHH', transaction_id, 0x0100, 1, 0, 0, 0) + question
+
+            waiter = loop.create_future()
+            protocol.waiters[transaction_id] = waiter
+            protocol.transport.sendto(query)
+            try:
+                response = await asyncio.wait_for(waiter, self.timeout)
+            except asyncio.TimeoutError:
+                protocol.waiters.pop(transaction_id, None)
+                self.timeouts += 1
+                continue
+            except OSError as e:
+                print(f"Upstream {server[0]}:{server[1]} failed:", e)
+                continue
+
+            # Only accept an answer to the question that was asked, spelled
+            # the way it was asked.
+            if response[12:12 + len(question)] != question:
+                continue
+            if response[2] & 0x02:
+                self.tcp_fallbacks += 1
+                try:
+                    return await asyncio.wait_for(self.query_tcp(server, query), self.timeout)
+                except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError) as e:
+                    print(f"TCP query to {server[0]}:{server[1]} failed:", e)
+                    continue
+            return response
+        raise asyncio.TimeoutError("no answer from the upstream servers")
+
+    async def query_tcp(self, server, query):
+        reader, writer = await asyncio.open_connection(*server)
+        try:
+            writer.write(len(query).to_bytes(2, byteorder='big') + query)
+            await writer.drain()
+            length = int.from_bytes(await reader.readexactly(2), byteorder='big')
+            return await reader.readexactly(length)
+        finally:
+            writer.close()
+
+    def close(self):
+        for protocol in self.protocols.values():
+            protocol.transport.close()
+        self.protocols.clear()
+
+
+class Forwarder:
+    '''
+    Answers the queries the hosts file does not cover by forwarding them to
+    upstream servers. Answers are cached for their TTL (clamped to
+    min_ttl..max_ttl); NXDOMAIN and empty answers are cached too, for the
+    SOA minimum when the upstream sent one and negative_ttl otherwise. The
+    cache holds at most max_bytes, least recently used first out. Identical
+    queries in flight share one upstream query, and entries asked for at
+    least prefetch_hits times are refreshed in the background once less than
+    prefetch_fraction of their TTL is left, so popular names never expire.
+    '''
+
+    def __init__(self, upstream, max_bytes=32 * 1024 * 1024, min_ttl=0, max_ttl=86400, negative_ttl=60,
+                 max_negative_ttl=3600, prefetch_hits=3, prefetch_fraction=0.1):
+        self.upstream = upstream
+        self.max_bytes = max_bytes
+        self.min_ttl = min_ttl
+        self.max_ttl = max_ttl
+        self.negative_ttl = negative_ttl
+        self.max_negative_ttl = max_negative_ttl
+        self.prefetch_hits = prefetch_hits
+        self.prefetch_fraction = prefetch_fraction
+
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.pending = {}
+        self.tasks = set()
+
+        self.hits = 0
+        self.misses = 0
+        self.collapsed = 0
+        self.prefetches = 0
+        self.evictions = 0
+        self.failures = 0
+
+    def answer(self, data, key, addr, transport):
+        '''
+        Sends the answer to a UDP query: straight away from the cache, or
+        once the upstream servers answered.
+        '''
+        response = self.cached(data, key)
+        if response is not None:
+            transport.sendto(self.fit(response, data), addr)
+            return
+        task = asyncio.ensure_future(self.answer_later(data, key, addr, transport))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def answer_later(self, data, key, addr, transport):
+        response = await self.resolve(data, key)
+        if not transport.is_closing():
+            transport.sendto(self.fit(response, data), addr)
+
+    def fit(self, response, query):
+        if len(response) > udp_payload_size(query):
+            return truncated_response(response, query)
+        return response
+
+    async def resolve(self, data, key):
+        '''
+        Returns the response to query data (over TCP nothing needs to fit in
+        a datagram), or SERVFAIL when no upstream server answered.
+        '''
+        response = self.cached(data, key)
+        if response is not None:
+            return response
+        task = self.pending.get(key)
+        if task is None:
+            self.misses += 1
+            task = self.start_lookup(key, data[12:12 + len(key)])
+        else:
+            self.collapsed += 1
+        try:
+            entry = await asyncio.shield(task)
+        except (OSError, asyncio.TimeoutError, IndexError, struct.error) as e:
+            print("Forwarding failed:", e)
+            return error_response(data, 2)
+        return entry.render(data, time.monotonic())
+
+    def cached(self, data, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        now = time.monotonic()
+        if now >= entry.expires_at:
+            self.remove(key)
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        entry.hits += 1
+        if (entry.hits >= self.prefetch_hits and key not in self.pending
+                and entry.expires_at - now < entry.ttl * self.prefetch_fraction):
+            self.prefetches += 1
+            self.start_lookup(key, data[12:12 + len(key)])
+        return entry.render(data, now)
+
+    def start_lookup(self, key, question):
+        '''
+        Asks the upstream servers question, the client's question as it
+        spelled it, and caches the answer under key, the same question
+        with the name lowercased.
+        '''
+        task = asyncio.ensure_future(self.lookup(key, question))
+        self.pending[key] = task
+        task.add_done_callback(functools.partial(self.lookup_done, key))
+        return task
+
+    def lookup_done(self, key, task):
+        if self.pending.get(key) is task:
+            del self.pending[key]
+        if not task.cancelled() and task.exception() is not None:
+            self.failures += 1
+
+    async def lookup(self, key, question):
+        response = await self.upstream.query(question)
+        ttl, ttl_offsets = self.response_ttl(response)
+        entry = CachedAnswer(response, ttl_offsets, ttl, time.monotonic())
+        if ttl > 0:
+            self.store(key, entry)
+        return entry
+
+    def response_ttl(self, response):
+        '''
+        Returns (seconds the response may be cached, [(ttl offset, ttl)] of
+        the records whose TTL counts down while it is).
+        '''
+        rcode = response[3] & 0x0F
+        ancount = struct.unpack_from('!H', response, 6)[0]
+        ttl_offsets = []
+        answer_ttl = None
+        soa_ttl = None
+        for position, (rtype, offset, rdata, rdlength) in enumerate(walk_records(response)):
+            if rtype == TYPE_OPT:
+                continue
+            ttl = struct.unpack_from('!I', response, offset)[0]
+            ttl_offsets.append((offset, ttl))
+            if position < ancount:
+                answer_ttl = ttl if answer_ttl is None else min(answer_ttl, ttl)
+            elif rtype == TYPE_SOA:
+                minimum = struct.unpack_from('!I', response, skip_name(response, skip_name(response, rdata)) + 16)[0]
+                soa_ttl = min(ttl, minimum)
+
+        if rcode == 0 and answer_ttl is not None:
+            return min(max(answer_ttl, self.min_ttl), self.max_ttl), ttl_offsets
+        if rcode in (0, 3):
+            return min(soa_ttl if soa_ttl is not None else self.negative_ttl, self.max_negative_ttl), ttl_offsets
+        # SERVFAIL, REFUSED and friends are passed on but not cached.
+        return 0, ttl_offsets
+
+    def store(self, key, entry):
+        if key in self.entries:
+            self.remove(key)
+        if entry.size > self.max_bytes:
+            return
+        self.entries[key] = entry
+        self.bytes += entry.size
+        while self.bytes > self.max_bytes:
+            oldest = next(iter(self.entries))
+            self.remove(oldest)
+            self.evictions += 1
+
+    def remove(self, key):
+        entry = self.entries.pop(key)
+        self.bytes -= entry.size
+
+    def close(self):
+        for task in self.tasks | set(self.pending.values()):
+            task.cancel()
+        self.upstream.close()
+
+    def stats(self):
+        lookups = self.hits + self.misses + self.collapsed
+        return {
+            'entries': len(self.entries),
+            'bytes': self.bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'collapsed': self.collapsed,
+            'hit_ratio': self.hits / lookups if lookups else 0.0,
+            'prefetches': self.prefetches,
+            'evictions': self.evictions,
+            'failures': self.failures,
+            'upstream_timeouts': self.upstream.timeouts,
+            'tcp_fallbacks': self.upstream.tcp_fallbacks,
+        }
@@ -0,0 +1,396 @@
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import random
+import struct
+import sys
+import tempfile
+import time
+from collections import Counter
+
+from bench_dns import start_resolver
+from dns_check import RCODES, TYPE_NAMES, decode_message, validate_response
+from zone import TYPES, encode_name
+
+QUERY_TYPES = dict(TYPES, SOA=6, ANY=255)
+
+
+def parse_type(text):
+    text = text.upper()
+    if text.startswith('TYPE') and text[4:].isdigit():
+        return int(text[4:])
+    return QUERY_TYPES[text]
+
+
+def read_queries(lines):
+    '''
+    Reads a dnsperf-style query file: one "name [type]" per line, A when the
+    type is left out. Returns the queries in wire format with a zero ID.
+    '''
+    queries = []
+    for number, line in enumerate(lines, 1):
+        fields = line.split()
+        if not fields or fields[0].startswith('#'):
+            continue
+        try:
+            rtype = parse_type(fields[1]) if len(fields) > 1 else TYPES['A']
+            queries.append(struct.pack('!HHHHHH', 0, 0x0100, 1, 0, 0, 0)
+                           + encode_name(fields[0]) + struct.pack('!HH', rtype, 1))
+        except (KeyError, IndexError, UnicodeError):
+            print(f"Skipping line {number} of the query file: {line.strip()}")
+    return queries
+
+
+def percentile(ordered, fraction):
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+class ClientProtocol(asyncio.DatagramProtocol):
+    '''
+    Keeps window queries in flight, each with its own transaction ID, and
+    sends the next one from the mix as soon as one is answered or times out.
+    '''
+
+    def __init__(self, queries, deadline, max_queries, window, timeout, validate):
+        self.queries = queries
+        self.deadline = deadline
+        self.max_queries = max_queries
+        self.window = window
+        self.timeout = timeout
+        self.validate = validate
+        self.next_id = random.getrandbits(16)
+        self.position = random.randrange(len(queries))
+        self.outstanding = {}
+        self.sent = 0
+        self.latencies = []
+        self.rcodes = Counter()
+        self.timeouts = 0
+        self.invalid = 0
+        self.unexpected = 0
+        self.problems = Counter()
+        self.done = asyncio.get_running_loop().create_future()
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        for _ in range(self.window):
+            self.send()
+
+    def send(self):
+        if self.sent >= self.max_queries or time.perf_counter() >= self.deadline:
+            if not self.outstanding and not self.done.done():
+                self.done.set_result(None)
+            return
+        query_id = self.next_id
+        while query_id in self.outstanding:
+            query_id = (query_id + 1) & 0xFFFF
+        self.next_id = (query_id + 1) & 0xFFFF
+        query = self.queries[self.position]
+        self.position = (self.position + 1) % len(self.queries)
+        query = struct.pack('!H', query_id) + query[2:]
+        self.outstanding[query_id] = (query, time.perf_counter())
+        self.sent += 1
+        self.transport.sendto(query)
+
+    def datagram_received(self, data, addr):
+        received = time.perf_counter()
+        if len(data) < 12:
+            self.unexpected += 1
+            return
+        entry = self.outstanding.pop(data[0] << 8 | data[1], None)
+        if entry is None:
+            # Late answer to a query that already timed out.
+            self.unexpected += 1
+            return
+        query, sent = entry
+        self.latencies.append(received - sent)
+        self.rcodes[data[3] & 0x0F] += 1
+        if self.validate:
+            problems = validate_response(query, data)
+            if problems:
+                self.invalid += 1
+                self.problems.update(problems)
+        self.send()
+
+    def error_received(self, exc):
+        self.problems[f"socket error: {exc}"] += 1
+
+    def expire(self):
+        cutoff = time.perf_counter() - self.timeout
+        expired = [query_id for query_id, (_, sent) in self.outstanding.items() if sent < cutoff]
+        for query_id in expired:
+            del self.outstanding[query_id]
+            self.timeouts += 1
+        for _ in expired:
+            self.send()
+        if not self.outstanding and not self.done.done() and (
+                self.sent >= self.max_queries or time.perf_counter() >= self.deadline):
+            self.done.set_result(None)
+
+
+async def run_client(server, queries, duration, max_queries, window, timeout, validate):
+    loop = asyncio.get_running_loop()
+    started = time.perf_counter()
+    transport, protocol = await loop.create_datagram_endpoint(
+        lambda: ClientProtocol(queries, started + duration, max_queries, window, timeout, validate),
+        remote_addr=server)
+    while not protocol.done.done():
+        await asyncio.wait([protocol.done], timeout=min(0.1, timeout / 4))
+        protocol.expire()
+    transport.close()
+    return {
+        'seconds': time.perf_counter() - started,
+        'sent': protocol.sent,
+        'latencies': protocol.latencies,
+        'rcodes': dict(protocol.rcodes),
+        'timeouts': protocol.timeouts,
+        'invalid': protocol.invalid,
+        'unexpected': protocol.unexpected,
+        'problems': dict(protocol.problems),
+    }
+
+
+def client_process(result, *client_args):
+    result.send(asyncio.run(run_client(*client_args)))
+
+
+def run_load(args, server, queries):
+    '''
+    Runs args.clients load generator processes at once and merges their
+    results.
+    '''
+    per_client = max(1, args.max_queries // args.clients) if args.max_queries else float('inf')
+    pipes = []
+    for _ in range(args.clients):
+        parent, child = multiprocessing.Pipe()
+        multiprocessing.Process(target=client_process, daemon=True, args=(
+            child, server, queries, args.duration, per_client, args.window, args.timeout,
+            not args.no_validate)).start()
+        pipes.append(parent)
+    results = [pipe.recv() for pipe in pipes]
+
+    latencies = sorted(latency for result in results for latency in result['latencies'])
+    seconds = max(result['seconds'] for result in results)
+    sent = sum(result['sent'] for result in results)
+    rcodes = Counter()
+    problems = Counter()
+    for result in results:
+        rcodes.update(result['rcodes'])
+        problems.update(result['problems'])
+    timeouts = sum(result['timeouts'] for result in results)
+    invalid = sum(result['invalid'] for result in results)
+
+    def milliseconds(fraction):
+        value = percentile(latencies, fraction)
+        return None if value is None else round(1000 * value, 3)
+
+    return {
+        'server': f"{server[0]}:{server[1]}",
+        'clients': args.clients,
+        'window': args.window,
+        'seconds': round(seconds, 3),
+        'sent': sent,
+        'answered': len(latencies),
+        'qps': round(len(latencies) / seconds, 1),
+        'p50_ms': milliseconds(0.50),
+        'p90_ms': milliseconds(0.90),
+        'p99_ms': milliseconds(0.99),
+        'p999_ms': milliseconds(0.999),
+        'max_ms': round(1000 * latencies[-1], 3) if latencies else None,
+        'timeouts': timeouts,
+        'timeout_rate': round(timeouts / sent, 6) if sent else 0,
+        'rcodes': {RCODES.get(rcode, str(rcode)): count for rcode, count in sorted(rcodes.items())},
+        'invalid': invalid,
+        'invalid_rate': round(invalid / len(latencies), 6) if latencies else 0,
+        'unexpected': sum(result['unexpected'] for result in results),
+        'problems': dict(problems.most_common(10)),
+    }
+
+
+def report(result):
+    print(f"Queries sent:      {result['sent']} by {result['clients']} clients, "
+          f"{result['window']} in flight each, in {result['seconds']:.2f}s")
+    print(f"Queries answered:  {result['answered']}  ({result['qps']:.1f} queries/s)")
+    print(f"Latency (ms):      p50 {result['p50_ms']}  p90 {result['p90_ms']}  p99 {result['p99_ms']}  "
+          f"p99.9 {result['p999_ms']}  max {result['max_ms']}")
+    print(f"Timeouts:          {result['timeouts']}  ({100 * result['timeout_rate']:.3f}%)")
+    print("Response codes:    " + ", ".join(f"{name} {count}" for name, count in result['rcodes'].items()))
+    print(f"Invalid responses: {result['invalid']}  ({100 * result['invalid_rate']:.3f}%)")
+    if result['unexpected']:
+        print(f"Late or unknown:   {result['unexpected']}")
+    for problem, count in result['problems'].items():
+        print(f"  {count:8}  {problem}")
+
+
+CONFORMANCE_HOSTS = """\
+10.0.0.1 host.test.example alias-target.test.example
+2001:db8::1 host.test.example
+www.test.example CNAME alias.test.example
+alias.test.example CNAME alias-target.test.example
+test.example MX 10 mail.test.example
+test.example TXT "v=spf1 -all" "second string"
+*.wild.test.example A 10.0.0.9
+"""
+
+
+def conformance_cases():
+    '''
+    (description, query, expected rcode or None for no response at all).
+    '''
+    def query(name, rtype='A', flags=0x0100, qclass=1, qdcount=1):
+        return (struct.pack('!HHHHHH', 0, flags, qdcount, 0, 0, 0) + encode_name(name)
+                + struct.pack('!HH', parse_type(rtype), qclass))
+
+    header = struct.pack('!HHHHHH', 0, 0x0100, 1, 0, 0, 0)
+    return [
+        ("A record", query('host.test.example'), 0),
+        ("A record, mixed-case name", query('HoSt.TeSt.ExAmPlE'), 0),
+        ("A record without RD", query('host.test.example', flags=0), 0),
+        ("AAAA record", query('host.test.example', 'AAAA'), 0),
+        ("CNAME chain to an A record", query('www.test.example'), 0),
+        ("CNAME chain, AAAA asked", query('www.test.example', 'AAAA'), 0),
+        ("CNAME record itself", query('www.test.example', 'CNAME'), 0),
+        ("MX record", query('test.example', 'MX'), 0),
+        ("TXT record", query('test.example', 'TXT'), 0),
+        ("automatic PTR record", query('1.0.0.10.in-addr.arpa', 'PTR'), 0),
+        ("existing name, no records of the type", query('test.example', 'A'), 0),
+        ("wildcard", query('anything.wild.test.example'), 0),
+        ("unknown name", query('missing.test.example'), 3),
+        ("unknown name, mixed case", query('MISSING.test.example', 'AAAA'), 3),
+        ("class CH", query('host.test.example', qclass=3), 4),
+        ("compressed question name", header + b'\xc0\x0c' + b'\x00\x01\x00\x01', 1),
+        ("no question", query('host.test.example', qdcount=0), 1),
+        ("two questions", query('host.test.example', qdcount=2), 1),
+        ("opcode STATUS", query('host.test.example', flags=0x1100), 4),
+        ("a response instead of a query", query('host.test.example', flags=0x8100), None),
+        ("truncated question", query('host.test.example')[:20], None),
+        ("shorter than a header", b'\x00\x00\x01', None),
+    ]
+
+
+async def run_conformance(server, timeout):
+    loop = asyncio.get_running_loop()
+    failures = 0
+    for description, query, expected in conformance_cases():
+        query = struct.pack('!H', random.getrandbits(16)) + query[2:]
+        answered = loop.create_future()
+
+        class Protocol(asyncio.DatagramProtocol):
+            def datagram_received(self, data, addr):
+                if not answered.done():
+                    answered.set_result(data)
+
+        transport, _ = await loop.create_datagram_endpoint(Protocol, remote_addr=server)
+        transport.sendto(query)
+        try:
+            response = await asyncio.wait_for(answered, timeout)
+        except asyncio.TimeoutError:
+            response = None
+        transport.close()
+
+        if response is None:
+            problems = [] if expected is None else ["no response"]
+            outcome = "no response"
+        else:
+            problems = validate_response(query, response) if len(query) >= 12 else []
+            if expected is None:
+                problems.append("answered a message that should be dropped")
+            elif response[3] & 0x0F != expected:
+                problems.append(f"{RCODES.get(response[3] & 0x0F)} instead of {RCODES[expected]}")
+            try:
+                message = decode_message(response)
+                outcome = RCODES.get(message['rcode'], message['rcode']) + "".join(
+                    f"  {TYPE_NAMES.get(rtype, rtype)} {data}" for _, rtype, _, _, data in message['answer'])
+            except Exception:
+                outcome = "undecodable"
+        failures += bool(problems)
+        print(f"{'FAIL' if problems else 'ok':>4}  {description:<40} {outcome}")
+        for problem in problems:
+            print(f"        {problem}")
+    return failures
+
+
+def parse_server(text):
+    host, _, port = text.rpartition(':')
+    return host.strip('[]'), int(port)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Load generator and conformance check for the DNS resolver: replays a query mix "
+                    "from several processes, reports queries/s, latency percentiles, timeouts and "
+                    "response codes, and decodes every response to check its wire format.")
+    parser.add_argument('--server', type=parse_server, default=None, metavar='HOST:PORT',
+                        help="resolver to query; by default dns_resolver.py is started locally")
+    parser.add_argument('--hosts-file', default=None,
+                        help="hosts file for the local resolver (default: one made up from the query file)")
+    parser.add_argument('--resolver-args', default='', help="extra dns_resolver.py arguments, e.g. \"--io batch\"")
+    parser.add_argument('--queries', default=None, help="query file, one \"name [type]\" per line")
+    parser.add_argument('--clients', type=int, default=2, help="load generator processes")
+    parser.add_argument('--window', type=int, default=64, help="queries in flight per client")
+    parser.add_argument('--duration', type=float, default=10.0, help="seconds to run")
+    parser.add_argument('--max-queries', type=int, default=0, help="stop after this many queries (0: no limit)")
+    parser.add_argument('--timeout', type=float, default=1.0, help="seconds before a query counts as lost")
+    parser.add_argument('--no-validate', action='store_true', help="do not decode and check every response")
+    parser.add_argument('--conformance', action='store_true',
+                        help="run the wire-format conformance cases against a local resolver instead")
+    parser.add_argument('--json', default=None, help="write the results as JSON to this file ('-' for stdout)")
+    args = parser.parse_args()
+
+    multiprocessing.set_start_method('fork')
+    with tempfile.TemporaryDirectory() as directory:
+        hosts_file = args.hosts_file
+        if args.conformance:
+            hosts_file = os.path.join(directory, 'hosts')
+            with open(hosts_file, 'w') as output:
+                output.write(CONFORMANCE_HOSTS)
+        elif args.queries is None:
+            parser.error("--queries is required for a load run")
+        else:
+            with open(args.queries) as lines:
+                queries = read_queries(lines)
+            if not queries:
+                parser.error(f"no queries in {args.queries}")
+
+        resolver = None
+        server = args.server
+        if server is None:
+            if hosts_file is None:
+                # Every name in the query file gets an address, so the run
+                # measures answers rather than NXDOMAINs.
+                hosts_file = os.path.join(directory, 'hosts')
+                with open(hosts_file, 'w') as output:
+                    for index, query in enumerate(queries):
+                        name = decode_message(query)['question'][0][0]
+                        output.write(f"10.{index >> 16 & 255}.{index >> 8 & 255}.{index & 255} {name}\n")
+            resolver, port = start_resolver(hosts_file, 1, 'asyncio', args.resolver_args.split())
+            server = ('127.0.0.1', port)
+
+        try:
+            if args.conformance:
+                failures = asyncio.run(run_conformance(server, args.timeout))
+                print(f"{failures} of {len(conformance_cases())} cases failed")
+                sys.exit(1 if failures else 0)
+            result = run_load(args, server, queries)
+        finally:
+            if resolver is not None:
+                resolver.terminate()
+                resolver.wait()
+
+    report(result)
+    if args.json is not None:
+        if args.json == '-':
+            print(json.dumps(result, indent=2))
+        else:
+            with open(args.json, 'w') as output:
+                json.dump(result, output, indent=2)
+    if result['invalid']:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
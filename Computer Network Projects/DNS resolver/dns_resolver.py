@@ -1,140 +1,386 @@
-# -*- coding: utf-8 -*-
-"""
-Created on Mon Nov 13 18:08:32 2023
-
-@author: avacy
-"""
-import asyncio
-import socket
-import ipaddress
-
-def read_myhosts(file_path):
-    hosts = {}
-    with open(file_path, 'r') as file:
-        for line in file:
-            if line.strip() and not line.startswith("#"):
-                parts = line.split()
-                ip_address_str, *domains = parts
-                ip_address = ipaddress.ip_address(ip_address_str)
-                for domain in domains:
-                    hosts[domain] = ip_address
-    return hosts
-
-def get_transaction_id(data):
-    return data[0] << 8 | data[1]
-
-def get_qclass(data):
-    index = 12
-    while data[index] != 0:
-        label_length = data[index]
-        index += 1
-        index += label_length
-    index += 1
-    index += 2
-    qclass = int.from_bytes(data[index:index + 2], byteorder='big')
-
-    return qclass
-
-
-def parse_dns_query(data):
-    query_domain = ""
-    index = 12
-    transaction_id = get_transaction_id(data)
-    while data[index] != 0:
-        label_length = data[index]
-        index += 1
-        query_domain += data[index:index + label_length].decode("utf-8") + "."
-        index += label_length
-    return query_domain.rstrip("."), transaction_id
-
-class DNSResolverProtocol(asyncio.DatagramProtocol):
-    def __init__(self, loop, hosts):
-        self.loop = loop
-        self.hosts = hosts
-        
-    def send_error_response(self, transaction_id, error_code, ip_address):
-        response = bytearray()
-        response.extend(transaction_id.to_bytes(2, byteorder='big'))  # transaction ID
-        response.extend((0x8000 | error_code).to_bytes(2, byteorder='big'))  # flags with error code
-        response.extend(b'\x00\x01')  # questions
-        response.extend(b'\x00\x01')  # answer 
-        response.extend(b'\x00\x00')  # authority
-        response.extend(b'\x00\x00')  # additional 
-        
-        return response      
-    
-    def create_dns_response(self, query_domain, transaction_id):
-        ip_address = self.hosts.get(query_domain, "0.0.0.0")
-
-        response = bytearray()
-        response.extend(transaction_id.to_bytes(2, byteorder='big'))  # transaction ID
-        response.extend(b'\x81\x80')  # flags
-        response.extend(b'\x00\x01')  # questions
-        response.extend(b'\x00\x01')  # answer 
-        response.extend(b'\x00\x00')  # authority 
-        response.extend(b'\x00\x00')  # additional 
-
-        for part in query_domain.split('.'):
-            response.append(len(part))
-            response.extend(part.encode())
-
-        response.extend(b'\x00')  # end of domain
-        response.extend(b'\x00\x01')  # type (A record)
-        response.extend(b'\x00\x01')  # class (IN)
-        response.extend(b'\xc0\x0c')  # name pointer to domain
-        response.extend(b'\x00\x01')  # type (A record)
-        response.extend(b'\x00\x01')  # class (IN)
-        response.extend(b'\x00\x00\x00\x10')  # TTL (16 seconds)
-        response.extend(b'\x00\x04')  
-        response.extend(socket.inet_aton(str(ip_address)))
-
-        return response
-    
-    def connection_made(self, transport):
-        self.transport = transport
-
-    def datagram_received(self, data, addr):
-        print(f"query has received from {addr}")
-        asyncio.create_task(self.handle_dns_query(data, addr))
-
-    async def handle_dns_query(self, data, addr):
-        query_domain, transaction_id = parse_dns_query(data)
-        qc = get_qclass(data)
-        
-        if qc == 1:
-             if query_domain in self.hosts:
-                 response_data = self.create_dns_response(query_domain, transaction_id)
-                 ip_address = self.hosts[query_domain]
-                 self.transport.sendto(response_data, addr)
-                 print(f"Response has been sent to {addr}")
-             else:
-                 error_response = self.send_error_response(transaction_id, 3, ipaddress.ip_address("0.0.0.0"))
-                 self.transport.sendto(error_response, addr)
-                 print("The domain does not exist")
-        else:
-            print("Not Implemented")
-            error_response = self.send_error_response(transaction_id, 4, ipaddress.ip_address("0.0.0.0"))
-            self.transport.sendto(error_response, addr)
-
-
-
-async def main():
-    HOST = '::'
-    PORT = 5353
-
-    hosts = read_myhosts('/etc/myhosts')
-
-    loop = asyncio.get_running_loop()
-    transport, protocol = await loop.create_datagram_endpoint(
-        lambda: DNSResolverProtocol(loop, hosts),
-        local_addr=(HOST, PORT))
-
-    print(f"DNS resolver is listening on {HOST}:{PORT}...")
-
-    try:
-        await asyncio.sleep(3600) 
-    finally:
-        transport.close()
-
-if __name__ == "__main__":
-    asyncio.run(main())
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Nov 13 18:08:32 2023
+
+@author: avacy
+"""
+import argparse
+import asyncio
+import signal
+import socket
+import ipaddress
+import time
+
+from dns_forwarder import Forwarder, Upstream
+from workers import BatchReceiver, create_udp_socket, supervise
+from zone import file_stamp, load_zone
+
+def read_myhosts(file_path, snapshot=None):
+    return load_zone(file_path, snapshot)
+
+def get_transaction_id(data):
+    return data[0] << 8 | data[1]
+
+def question_key(data):
+    '''
+    Returns the question section of a query (name, QTYPE and QCLASS in wire
+    format) with the name lowercased, which is the key of the answer table. Raises
+    IndexError for a truncated packet or one that is not a query (those are
+    dropped), and ValueError for a query the resolver cannot parse: more or
+    less than one question, an opcode other than QUERY, or a compressed name.
+    '''
+    if data[2] & 0xF8 or data[4] or data[5] != 1:
+        if data[2] & 0x80:
+            raise IndexError("not a query")
+        raise ValueError("unsupported opcode or question count")
+    index = 12
+    length = data[index]
+    while length:
+        if length > 63:
+            # A compression pointer can only point back into the header.
+            raise ValueError("compressed or extended label in the question")
+        index += length + 1
+        length = data[index]
+    if len(data) < index + 5:
+        raise IndexError("truncated question")
+    # Only the name: lowercasing QTYPE 65 (HTTPS) would make it 97.
+    return data[12:index + 1].lower() + data[index + 1:index + 5]
+
+def match_query(answer, data, key):
+    '''
+    A compiled answer carries the question lowercased and the RD bit set;
+    clients that mix the case of the name (0x20 encoding) expect it back as
+    they sent it, and RD is copied from the query.
+    '''
+    question = data[12:12 + len(key)]
+    if question != key:
+        answer = answer[:10] + question + answer[10 + len(key):]
+    if not data[2] & 0x01:
+        answer = bytes((answer[0] & 0xFE,)) + answer[1:]
+    return answer
+
+def header_error(data):
+    '''
+    FORMERR, or NOTIMP for an opcode other than QUERY, for a query whose
+    question cannot be read: header only, with no question echoed.
+    '''
+    rcode = 4 if data[2] & 0x78 else 1
+    flags = 0x8000 | (data[2] & 0x79) << 8 | rcode
+    return data[:2] + flags.to_bytes(2, byteorder='big') + bytes(8)
+
+def parse_question(data):
+    '''
+    Walks the question once and returns (domain, qtype, qclass).
+    '''
+    labels = []
+    index = 12
+    while data[index] != 0:
+        label_length = data[index]
+        index += 1
+        labels.append(data[index:index + label_length].decode("utf-8"))
+        index += label_length
+    index += 1
+    qtype = int.from_bytes(data[index:index + 2], byteorder='big')
+    qclass = int.from_bytes(data[index + 2:index + 4], byteorder='big')
+    return ".".join(labels), qtype, qclass
+
+def get_qclass(data):
+    return parse_question(data)[2]
+
+
+def parse_dns_query(data):
+    return parse_question(data)[0], get_transaction_id(data)
+
+RCODE_NAMES = {0: 'answered', 1: 'FORMERR', 2: 'SERVFAIL', 3: 'NXDOMAIN', 4: 'NOTIMP'}
+
+class QueryLog:
+    '''
+    Sampled, rate-limited query logging: prints one in every `every` queries
+    and at most max_per_second lines a second, so logging costs a counter
+    increment per query however busy the resolver is. How many queries
+    were left out is printed with the next line.
+    '''
+
+    def __init__(self, every=1, max_per_second=10):
+        self.every = every
+        self.max_per_second = max_per_second
+        self.count = 0
+        self.skipped = 0
+        self.second = 0
+        self.printed = 0
+
+    def query(self, addr, outcome):
+        self.count += 1
+        if self.count % self.every:
+            self.skipped += 1
+            return
+        second = int(time.monotonic())
+        if second != self.second:
+            self.second = second
+            self.printed = 0
+        if self.printed >= self.max_per_second:
+            self.skipped += 1
+            return
+        self.printed += 1
+        if self.skipped:
+            print(f"({self.skipped} queries not logged)")
+            self.skipped = 0
+        print(f"query has received from {addr}: {outcome}")
+
+class DNSResolverProtocol(asyncio.DatagramProtocol):
+    def __init__(self, loop, zone, log=None, forwarder=None):
+        self.loop = loop
+        self.set_zone(zone)
+        self.log = log
+        self.forwarder = forwarder
+        self.transport = None
+
+    def send_error_response(self, transaction_id, error_code, ip_address, question=b''):
+        response = bytearray()
+        response.extend(transaction_id.to_bytes(2, byteorder='big'))  # transaction ID
+        response.extend((0x8180 | error_code).to_bytes(2, byteorder='big'))  # flags with error code
+        response.extend(b'\x00\x01' if question else b'\x00\x00')  # questions
+        response.extend(b'\x00\x00')  # answer
+        response.extend(b'\x00\x00')  # authority
+        response.extend(b'\x00\x00')  # additional
+        response.extend(question)  # the question, as the client spelled it
+        return bytes(response)
+
+    def set_zone(self, zone):
+        # Both attributes change between two datagrams, never while one is
+        # being answered.
+        self.zone = zone
+        self.answers = zone.answers
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        # Answered synchronously: a table lookup and the transaction ID copied
+        # from the query. Everything else takes the slower handle_dns_query.
+        try:
+            key = question_key(data)
+        except IndexError:
+            return
+        except ValueError:
+            response = header_error(data)
+            self.transport.sendto(response, addr)
+            if self.log is not None:
+                self.log.query(addr, RCODE_NAMES[response[3] & 0x0F])
+            return
+        answer = self.answers.get(key)
+        if answer is not None:
+            self.transport.sendto(data[:2] + match_query(answer, data, key), addr)
+            if self.log is not None:
+                self.log.query(addr, 'answered')
+            return
+        try:
+            self.handle_dns_query(data, key, addr)
+        except (IndexError, UnicodeDecodeError):
+            pass
+
+    def handle_dns_query(self, data, key, addr):
+        response = self.local_response(data, key)
+        if response is None:
+            self.forwarder.answer(data, key, addr, self.transport)
+        else:
+            self.transport.sendto(response, addr)
+        if self.log is not None:
+            self.log.query(addr, 'forwarded' if response is None else RCODE_NAMES.get(response[3] & 0x0F, 'error'))
+
+    def local_response(self, data, key):
+        '''
+        Returns the response to a query with no ready-made answer, or None
+        if it should be forwarded upstream instead.
+        '''
+        # Built from the zone's records, which keeps it for the next query.
+        response = self.zone.answer(data, key)
+        if response is None:
+            if self.forwarder is not None:
+                return None
+            transaction_id = get_transaction_id(data)
+            question = data[12:12 + len(key)]
+            if key[-2:] == b'\x00\x01':
+                response = self.send_error_response(transaction_id, 3, ipaddress.ip_address("0.0.0.0"), question)
+            else:
+                response = self.send_error_response(transaction_id, 4, ipaddress.ip_address("0.0.0.0"), question)
+        if not data[2] & 0x01:
+            response = response[:2] + bytes((response[2] & 0xFE,)) + response[3:]
+        return response
+
+    async def handle_tcp_client(self, reader, writer):
+        '''
+        Serves DNS over TCP (each message prefixed with its 2-byte length), for
+        clients retrying a forwarded answer that was too big for UDP.
+        '''
+        try:
+            while True:
+                length = int.from_bytes(await reader.readexactly(2), byteorder='big')
+                data = await reader.readexactly(length)
+                try:
+                    key = question_key(data)
+                    answer = self.answers.get(key)
+                except ValueError:
+                    key = answer = None
+                if key is None:
+                    response = header_error(data)
+                elif answer is not None:
+                    response = data[:2] + match_query(answer, data, key)
+                else:
+                    response = self.local_response(data, key)
+                    if response is None:
+                        response = await self.forwarder.resolve(data, key)
+                writer.write(len(response).to_bytes(2, byteorder='big') + response)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError, IndexError, UnicodeDecodeError):
+            pass
+        finally:
+            writer.close()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="DNS resolver for the names in a hosts file")
+    parser.add_argument('--host', default='::')
+    parser.add_argument('--port', type=int, default=5353)
+    parser.add_argument('--hosts-file', default='/etc/myhosts')
+    parser.add_argument('--forward', nargs='+', default=None, metavar='SERVER',
+                        help="forward queries for other names to these servers (host or host:port)")
+    parser.add_argument('--cache-size', type=int, default=32 * 1024 * 1024,
+                        help="bytes of forwarded answers to cache")
+    parser.add_argument('--quiet', action='store_true', help="do not log queries")
+    parser.add_argument('--log-every', type=int, default=1, help="log one in every N queries")
+    parser.add_argument('--log-rate', type=int, default=10, help="log at most this many queries a second")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="worker processes sharing the port through SO_REUSEPORT")
+    parser.add_argument('--io', choices=('asyncio', 'batch'), default='asyncio',
+                        help="asyncio's datagram transport, or batched recvfrom_into() on a non-blocking socket")
+    parser.add_argument('--batch-size', type=int, default=64,
+                        help="datagrams read per readiness event with --io batch")
+    parser.add_argument('--reload-interval', type=float, default=2.0,
+                        help="seconds between checks of the hosts file for changes (0: only reload on SIGHUP)")
+    parser.add_argument('--snapshot', default=None,
+                        help="cache the compiled hosts file here and load it from there while it is up to date")
+    return parser.parse_args(argv)
+
+
+def parse_server(server):
+    host, separator, port = server.rpartition(':')
+    if not separator or (']' not in server and host.count(':')):
+        return server.strip('[]'), 53
+    return host.strip('[]'), int(port)
+
+
+def reload_zone(args, current, forced=False):
+    '''
+    The hosts file compiled again if it changed since current was loaded,
+    or forced (SIGHUP), else None. If the new file cannot be loaded the
+    current zone stays.
+    '''
+    try:
+        if not forced and file_stamp(args.hosts_file) == current.stamp:
+            return None
+        started = time.perf_counter()
+        zone = read_myhosts(args.hosts_file, args.snapshot)
+    except Exception as e:
+        print(f"Reloading {args.hosts_file} failed, keeping the current records:", e)
+        return None
+    print(f"Reloaded {args.hosts_file}: {zone.records} records in {time.perf_counter() - started:.3f}s")
+    return zone
+
+
+async def watch_hosts(args, protocol, reload_now):
+    '''
+    Checks the hosts file every args.reload_interval seconds, or when
+    reload_now is set (SIGHUP), and when it changed compiles it again in a
+    worker thread while the old zone keeps answering, then swaps the new one
+    in.
+    '''
+    loop = asyncio.get_running_loop()
+    while True:
+        try:
+            await asyncio.wait_for(reload_now.wait(), args.reload_interval or None)
+        except asyncio.TimeoutError:
+            pass
+        forced = reload_now.is_set()
+        reload_now.clear()
+        zone = await loop.run_in_executor(None, reload_zone, args, protocol.zone, forced)
+        if zone is not None:
+            protocol.set_zone(zone)
+
+
+async def main(args, zone=None):
+    '''
+    Serves queries until SIGTERM or SIGINT. A worker is handed the zone the
+    supervisor loaded and leaves reloading it to the supervisor; otherwise
+    the hosts file is loaded here and watched for changes.
+    '''
+    HOST = args.host
+    PORT = args.port
+
+    watching = zone is None
+    if watching:
+        started = time.perf_counter()
+        zone = read_myhosts(args.hosts_file, args.snapshot)
+        print(f"Loaded {zone.records} records from {args.hosts_file} "
+              f"in {time.perf_counter() - started:.3f}s")
+
+    forwarder = None
+    if args.forward:
+        upstream = Upstream([parse_server(server) for server in args.forward])
+        forwarder = Forwarder(upstream, max_bytes=args.cache_size)
+
+    log = None if args.quiet else QueryLog(args.log_every, args.log_rate)
+    reuse_port = args.workers > 1
+    loop = asyncio.get_running_loop()
+    protocol = DNSResolverProtocol(loop, zone, log, forwarder)
+    sock = create_udp_socket(HOST, PORT, reuse_port)
+    if args.io == 'batch':
+        transport = BatchReceiver(loop, sock, protocol, args.batch_size)
+        transport.start()
+    else:
+        transport, _ = await loop.create_datagram_endpoint(lambda: protocol, sock=sock)
+    tcp_server = None
+    if forwarder is not None:
+        tcp_server = await asyncio.start_server(protocol.handle_tcp_client, HOST, PORT, reuse_port=reuse_port)
+
+    print(f"DNS resolver is listening on {HOST}:{PORT}...")
+
+    stop = asyncio.Event()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop.set)
+    watcher = None
+    if watching:
+        reload_now = asyncio.Event()
+        loop.add_signal_handler(signal.SIGHUP, reload_now.set)
+        watcher = asyncio.create_task(watch_hosts(args, protocol, reload_now))
+
+    try:
+        await stop.wait()
+    finally:
+        if watcher is not None:
+            watcher.cancel()
+        transport.close()
+        if tcp_server is not None:
+            tcp_server.close()
+            forwarder.close()
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.workers > 1:
+        # Loaded once here and shared copy-on-write by the workers. When the
+        # hosts file changes it is loaded here again and the workers are
+        # replaced by ones forked with the new zone.
+        started = time.perf_counter()
+        zones = [read_myhosts(args.hosts_file, args.snapshot)]
+        print(f"Loaded {zones[0].records} records from {args.hosts_file} "
+              f"in {time.perf_counter() - started:.3f}s")
+
+        def reload(forced):
+            zone = reload_zone(args, zones[0], forced)
+            if zone is not None:
+                zones[0] = zone
+            return zone is not None
+
+        supervise(lambda worker_index: asyncio.run(main(args, zones[0])), args.workers, reload, args.reload_interval)
+    else:
+        asyncio.run(main(args))
@@ -0,0 +1,112 @@
+import asyncio
+import contextlib
+import io
+import struct
+import unittest
+
+from dns_check import WireError, decode_message, decode_name, validate_response
+from dns_load import CONFORMANCE_HOSTS, conformance_cases, read_queries, run_client, run_conformance
+from dns_resolver import DNSResolverProtocol
+from zone import Zone, encode_name
+
+HEADER = struct.pack('!HHHHHH', 0x1234, 0x0100, 1, 0, 0, 0)
+
+
+def query(name, rtype=1):
+    return HEADER + encode_name(name) + struct.pack('!HH', rtype, 1)
+
+
+def response(query, *answers, rcode=0):
+    '''
+    A response to query with the given (type, RDATA) answers, each owned by
+    a pointer to the question name.
+    '''
+    flags = 0x8000 | struct.unpack_from('!H', query, 2)[0] | rcode
+    return (query[:2] + struct.pack('!HHHHH', flags, 1, len(answers), 0, 0) + query[12:]
+            + b''.join(b'\xc0\x0c' + struct.pack('!HHIH', rtype, 1, 60, len(rdata)) + rdata
+                       for rtype, rdata in answers))
+
+
+class DecodeTest(unittest.TestCase):
+
+    def test_names_follow_compression_pointers(self):
+        data = HEADER + encode_name('www.example.com') + b'\x04mail\xc0\x10'
+        self.assertEqual(decode_name(data, 12), ('www.example.com.', 29))
+        self.assertEqual(decode_name(data, 29), ('mail.example.com.', 36))
+
+    def test_malformed_names(self):
+        for data, index in ((HEADER + b'\xc0\x0c', 12), (HEADER + b'\x05ab', 12), (HEADER + b'\x40', 12),
+                            (HEADER + b'\x3f' + b'a' * 63 + b'\x3f' + b'a' * 63 + b'\x3f' + b'a' * 63
+                             + b'\x3f' + b'a' * 63 + b'\x00', 12)):
+            with self.assertRaises(WireError, msg=data):
+                decode_name(data, index)
+
+    def test_message(self):
+        data = query('example.com', 15)
+        message = decode_message(response(data, (15, b'\x00\x0a\x04mail\xc0\x0c'), (1, bytes([10, 0, 0, 1]))))
+        self.assertEqual(message['question'], [('example.com.', 15, 1)])
+        self.assertEqual(message['answer'], [('example.com.', 15, 1, 60, '10 mail.example.com.'),
+                                             ('example.com.', 1, 1, 60, '10.0.0.1')])
+
+    def test_malformed_messages(self):
+        data = query('example.com')
+        for message in (data[:11], data[:-1], response(data, (1, b'\x0a\x00\x00')),
+                        response(data, (1, bytes(4)))[:-1], response(data) + b'\x00'):
+            with self.assertRaises(WireError, msg=message):
+                decode_message(message)
+
+
+class ValidateTest(unittest.TestCase):
+
+    def test_valid_answer_through_a_cname(self):
+        data = query('www.example.com')
+        answer = response(data, (5, encode_name('Host.example.com')))
+        answer = answer[:7] + b'\x02' + answer[8:] + encode_name('host.example.com') + struct.pack(
+            '!HHIH', 1, 1, 60, 4) + bytes([10, 0, 0, 1])
+        self.assertEqual(validate_response(data, answer), [])
+
+    def test_problems(self):
+        data = query('www.example.com')
+        self.assertEqual(validate_response(data, b'\x00'), ["message of 1 bytes is shorter than a header"])
+        wrong_id = b'\x00\x00' + response(data)[2:]
+        self.assertIn("ID 0 does not match the query's 4660", validate_response(data, wrong_id))
+        no_rd = response(data)[:2] + b'\x80\x00' + response(data)[4:]
+        self.assertEqual(validate_response(data, no_rd), ["RD bit not copied from the query"])
+        self.assertEqual(validate_response(data, response(data, (28, bytes(16)))), ["AAAA answer to a A question"])
+        other = response(query('www.example.org'))
+        self.assertEqual(len(validate_response(data, other)), 1)
+        self.assertEqual(validate_response(data, response(data, (1, bytes(4)), rcode=3)),
+                         ["NXDOMAIN response with a non-CNAME answer"])
+
+
+class LoadTest(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        zone = Zone().load(CONFORMANCE_HOSTS.splitlines()).compile()
+        loop = asyncio.get_running_loop()
+        transport, _ = await loop.create_datagram_endpoint(lambda: DNSResolverProtocol(loop, zone),
+                                                           local_addr=('127.0.0.1', 0))
+        self.addCleanup(transport.close)
+        self.server = transport.get_extra_info('sockname')
+
+    async def test_resolver_passes_the_conformance_cases(self):
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            failures = await run_conformance(self.server, 0.2)
+        self.assertEqual(failures, 0, output.getvalue())
+        self.assertEqual(output.getvalue().count('\n'), len(conformance_cases()))
+
+    async def test_client_keeps_its_window_full(self):
+        with contextlib.redirect_stdout(io.StringIO()):
+            queries = read_queries(['host.test.example', 'host.test.example AAAA', '# comment', '',
+                                    'missing.test.example TYPE1', 'bad.example NOSUCHTYPE'])
+        self.assertEqual(len(queries), 3)
+        result = await run_client(self.server, queries, 10, 300, 8, 1.0, True)
+        self.assertEqual(result['sent'], 300)
+        self.assertEqual(len(result['latencies']), 300)
+        self.assertEqual((result['timeouts'], result['invalid'], result['problems']), (0, 0, {}))
+        self.assertEqual(result['rcodes'], {0: 200, 3: 100})
+
+
+if __name__ == '__main__':
+    unittest.main()
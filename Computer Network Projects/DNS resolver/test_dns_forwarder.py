@@ -0,0 +1,94 @@
+import asyncio
+import socket
+import struct
+import unittest
+
+from dns_forwarder import Forwarder, Upstream
+from dns_resolver import question_key
+from zone import encode_name
+
+
+def query(name, rtype=1, transaction_id=0x1234):
+    return struct.pack('!HHHHHH', transaction_id, 0x0100, 1, 0, 0, 0) + encode_name(name) + struct.pack('!HH', rtype, 1)
+
+
+class StubServer(asyncio.DatagramProtocol):
+    '''
+    An upstream server answering every A question with 192.0.2.1 and a TTL
+    of 300 seconds, remembering the questions it was sent.
+    '''
+
+    def __init__(self):
+        self.questions = []
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        question = data[12:]
+        self.questions.append(question)
+        answer = b'\xc0\x0c' + struct.pack('!HHIH', 1, 1, 300, 4) + bytes([192, 0, 2, 1])
+        self.transport.sendto(data[:2] + struct.pack('!HHHHH', 0x8180, 1, 1, 0, 0) + question + answer, addr)
+
+
+class ForwarderTest(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        loop = asyncio.get_running_loop()
+        transport, self.server = await loop.create_datagram_endpoint(StubServer, local_addr=('127.0.0.1', 0))
+        self.addCleanup(transport.close)
+        self.forwarder = Forwarder(Upstream([transport.get_extra_info('sockname')], timeout=0.2, attempts=2))
+        self.addCleanup(self.forwarder.close)
+
+    async def resolve(self, name, rtype=1):
+        data = query(name, rtype)
+        return await self.forwarder.resolve(data, question_key(data))
+
+    async def test_question_is_forwarded_as_the_client_spelled_it(self):
+        response = await self.resolve('WWW.Example.COM')
+        self.assertEqual(self.server.questions, [encode_name('WWW.Example.COM') + b'\x00\x01\x00\x01'])
+        self.assertEqual(response[:2], b'\x12\x34')
+        self.assertEqual(response[-4:], bytes([192, 0, 2, 1]))
+
+    async def test_type_is_forwarded_unchanged(self):
+        await self.resolve('example.com', 65)
+        self.assertEqual(self.server.questions[0][-4:], struct.pack('!HH', 65, 1))
+
+    async def test_cached_within_the_ttl_and_fetched_again_after(self):
+        await self.resolve('www.example.com')
+        response = await self.resolve('WWW.example.com')
+        self.assertEqual(len(self.server.questions), 1)
+        self.assertEqual(self.forwarder.hits, 1)
+        # The cached copy carries this client's spelling of the name.
+        self.assertEqual(response[12:12 + 17], encode_name('WWW.example.com'))
+
+        entry = next(iter(self.forwarder.entries.values()))
+        entry.stored_at -= 300
+        entry.expires_at -= 300
+        await self.resolve('www.example.com')
+        self.assertEqual(len(self.server.questions), 2)
+        self.assertEqual(self.forwarder.misses, 2)
+
+    async def test_remaining_ttl_counts_down(self):
+        await self.resolve('www.example.com')
+        entry = next(iter(self.forwarder.entries.values()))
+        entry.stored_at -= 100
+        response = await self.resolve('www.example.com')
+        self.assertEqual(struct.unpack_from('!I', response, len(response) - 10)[0], 200)
+
+    async def test_servfail_when_the_upstream_times_out(self):
+        silent = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        silent.bind(('127.0.0.1', 0))
+        self.addCleanup(silent.close)
+        forwarder = Forwarder(Upstream([silent.getsockname()], timeout=0.05, attempts=2))
+        self.addCleanup(forwarder.close)
+        data = query('www.example.com')
+        response = await forwarder.resolve(data, question_key(data))
+        self.assertEqual(response[3] & 0x0F, 2)
+        self.assertEqual(response[12:], data[12:])
+        self.assertEqual(forwarder.upstream.timeouts, 2)
+        self.assertFalse(forwarder.entries)
+
+
+if __name__ == '__main__':
+    unittest.main()
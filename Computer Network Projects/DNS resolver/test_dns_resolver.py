@@ -0,0 +1,155 @@
+import asyncio
+import contextlib
+import io
+import os
+import struct
+import tempfile
+import types
+import unittest
+
+from dns_resolver import DNSResolverProtocol, question_key, watch_hosts
+from zone import Zone, encode_name, load_zone
+
+TYPE_HTTPS = 65
+
+
+def query(name, rtype, transaction_id=0x1234, flags=0x0100):
+    return struct.pack('!HHHHHH', transaction_id, flags, 1, 0, 0, 0) + encode_name(name) + struct.pack('!HH', rtype, 1)
+
+
+class Transport:
+
+    def __init__(self):
+        self.sent = []
+
+    def sendto(self, data, addr):
+        self.sent.append((data, addr))
+
+
+class QuestionKeyTest(unittest.TestCase):
+
+    def test_name_is_lowercased(self):
+        self.assertEqual(question_key(query('WWW.Example.COM', 1)), encode_name('www.example.com') + b'\x00\x01\x00\x01')
+
+    def test_type_and_class_are_kept(self):
+        # 65 is 'A' in ASCII: lowercasing it would turn HTTPS into type 97.
+        key = question_key(query('Example.com', TYPE_HTTPS))
+        self.assertEqual(key[-4:], struct.pack('!HH', TYPE_HTTPS, 1))
+        key = question_key(query('example.com', 1)[:-2] + struct.pack('!H', 0x4e))
+        self.assertEqual(key[-2:], b'\x00\x4e')
+
+    def test_malformed_questions(self):
+        with self.assertRaises(IndexError):
+            question_key(query('example.com', 1)[:-3])
+        with self.assertRaises(ValueError):
+            question_key(struct.pack('!HHHHHH', 1, 0x0100, 2, 0, 0, 0) + encode_name('example.com') + b'\x00\x01\x00\x01')
+
+
+class ResolverTest(unittest.TestCase):
+
+    def setUp(self):
+        self.zone = Zone().load(['10.0.0.1 www.example.com', 'alias.example.com CNAME www.example.com']).compile()
+        self.protocol = DNSResolverProtocol(asyncio.new_event_loop(), self.zone)
+        self.transport = Transport()
+        self.protocol.connection_made(self.transport)
+
+    def tearDown(self):
+        self.protocol.loop.close()
+
+    def ask(self, name, rtype, flags=0x0100):
+        self.protocol.datagram_received(query(name, rtype, flags=flags), ('127.0.0.1', 5300))
+        return self.transport.sent.pop()[0]
+
+    def test_answer_echoes_the_question_as_sent(self):
+        response = self.ask('WwW.ExAmple.com', 1)
+        self.assertEqual(response[:2], b'\x12\x34')
+        self.assertEqual(response[12:12 + len(encode_name('www.example.com'))], encode_name('WwW.ExAmple.com'))
+        self.assertEqual(response[6:8], b'\x00\x01')
+        self.assertEqual(response[-4:], bytes([10, 0, 0, 1]))
+
+    def test_recursion_desired_is_copied(self):
+        self.assertTrue(self.ask('www.example.com', 1)[2] & 0x01)
+        self.assertFalse(self.ask('www.example.com', 1, flags=0)[2] & 0x01)
+
+    def test_other_type_of_existing_name_is_empty(self):
+        response = self.ask('www.example.com', TYPE_HTTPS)
+        self.assertEqual(response[3] & 0x0F, 0)
+        self.assertEqual(response[6:8], b'\x00\x00')
+        self.assertEqual(response[-4:-2], struct.pack('!H', TYPE_HTTPS))
+
+    def test_cname_is_followed(self):
+        response = self.ask('alias.example.com', 1)
+        self.assertEqual(response[6:8], b'\x00\x02')
+        self.assertEqual(response[-4:], bytes([10, 0, 0, 1]))
+
+    def test_unknown_name(self):
+        self.assertEqual(self.ask('nowhere.example.com', 1)[3] & 0x0F, 3)
+
+
+class WatchHostsTest(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.hosts = os.path.join(directory.name, 'hosts')
+        self.write('10.0.0.1 www.example.com\n')
+        self.protocol = DNSResolverProtocol(asyncio.get_running_loop(), load_zone(self.hosts))
+        self.protocol.connection_made(Transport())
+        self.reload_now = asyncio.Event()
+        args = types.SimpleNamespace(hosts_file=self.hosts, snapshot=None, reload_interval=0.02)
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.watcher = asyncio.create_task(watch_hosts(args, self.protocol, self.reload_now))
+        self.addCleanup(self.watcher.cancel)
+
+    def write(self, text):
+        # A new file (new inode), as editors and deployment tools do.
+        with open(self.hosts + '.new', 'w') as file:
+            file.write(text)
+        os.replace(self.hosts + '.new', self.hosts)
+
+    def address(self, name):
+        self.protocol.datagram_received(query(name, 1), ('127.0.0.1', 5300))
+        response = self.protocol.transport.sent.pop()[0]
+        return response[-4:] if response[3] & 0x0F == 0 else None
+
+    async def wait_for_zone(self, old):
+        for _ in range(200):
+            if self.protocol.zone is not old:
+                return
+            await asyncio.sleep(0.01)
+        self.fail("the zone was not reloaded")
+
+    async def test_changed_file_is_swapped_in(self):
+        old = self.protocol.zone
+        await asyncio.sleep(0.05)
+        self.assertIs(self.protocol.zone, old)
+        self.write('10.0.0.2 www.example.com\n10.0.0.3 new.example.com\n')
+        with contextlib.redirect_stdout(io.StringIO()):
+            await self.wait_for_zone(old)
+        self.assertEqual(self.address('www.example.com'), bytes([10, 0, 0, 2]))
+        self.assertEqual(self.address('new.example.com'), bytes([10, 0, 0, 3]))
+
+    async def test_reload_is_forced(self):
+        self.watcher.cancel()
+        args = types.SimpleNamespace(hosts_file=self.hosts, snapshot=None, reload_interval=0)
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.watcher = asyncio.create_task(watch_hosts(args, self.protocol, self.reload_now))
+            old = self.protocol.zone
+            self.reload_now.set()
+            await self.wait_for_zone(old)
+        self.assertEqual(self.address('www.example.com'), bytes([10, 0, 0, 1]))
+
+    async def test_unreadable_file_keeps_the_old_zone(self):
+        old = self.protocol.zone
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            os.remove(self.hosts)
+            await asyncio.sleep(0.1)
+        self.assertIs(self.protocol.zone, old)
+        self.assertIn("keeping the current records", output.getvalue())
+        self.assertEqual(self.address('www.example.com'), bytes([10, 0, 0, 1]))
+        self.assertFalse(self.watcher.done())
+
+
+if __name__ == '__main__':
+    unittest.main()
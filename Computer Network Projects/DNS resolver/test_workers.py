@@ -0,0 +1,120 @@
+import asyncio
+import os
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import textwrap
+import time
+import unittest
+
+from workers import BatchReceiver, create_udp_socket
+
+
+class Collector(asyncio.DatagramProtocol):
+
+    def __init__(self):
+        self.datagrams = []
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        self.datagrams.append(data)
+        self.transport.sendto(data.upper(), addr)
+
+
+class BatchReceiverTest(unittest.TestCase):
+
+    def test_reads_a_batch_per_readiness_event(self):
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        sock = create_udp_socket('127.0.0.1', 0, False)
+        protocol = Collector()
+        receiver = BatchReceiver(loop, sock, protocol, batch=4)
+        client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.addCleanup(client.close)
+        client.settimeout(5)
+        protocol.connection_made(receiver.transport)
+        for i in range(10):
+            client.sendto(b'query %d' % i, sock.getsockname())
+        time.sleep(0.1)
+
+        receiver.drain()
+        self.assertEqual(protocol.datagrams, [b'query %d' % i for i in range(4)])
+        receiver.drain()
+        receiver.drain()
+        receiver.drain()
+        self.assertEqual(receiver.received, 10)
+        self.assertEqual(client.recv(64), b'QUERY 0')
+        receiver.sock.close()
+
+
+SUPERVISED = textwrap.dedent('''
+    import os, sys, time
+    from workers import supervise
+
+    log = sys.argv[1]
+    generation = [0]
+
+    def run(index):
+        with open(log, 'a') as file:
+            file.write(f"{generation[0]} {index} {os.getpid()}\\n")
+        if generation[0] == 0 and index == 0 and not os.path.exists(log + '.crashed'):
+            open(log + '.crashed', 'w').close()
+            raise RuntimeError("first start")
+        time.sleep(60)
+
+    def reload(forced):
+        if forced:
+            generation[0] += 1
+        return forced
+
+    supervise(run, 2, reload, 0.1)
+''')
+
+
+class SuperviseTest(unittest.TestCase):
+
+    def starts(self, path, count):
+        deadline = time.monotonic() + 10
+        while time.monotonic() < deadline:
+            with open(path) as file:
+                lines = [line.split() for line in file]
+            if len(lines) >= count:
+                return lines
+            time.sleep(0.05)
+        self.fail(f"only {len(lines)} workers started")
+
+    def test_restarts_reloads_and_stops(self):
+        with tempfile.TemporaryDirectory() as directory:
+            log = os.path.join(directory, 'starts')
+            open(log, 'w').close()
+            supervisor = subprocess.Popen([sys.executable, '-c', SUPERVISED, log],
+                                          cwd=os.path.dirname(os.path.abspath(__file__)),
+                                          stdout=subprocess.DEVNULL)
+            try:
+                # Worker 0 crashes once and is started again.
+                lines = self.starts(log, 3)
+                self.assertEqual(sorted(index for _, index, _ in lines), ['0', '0', '1'])
+                # A reload that loaded something replaces both workers.
+                supervisor.send_signal(signal.SIGHUP)
+                lines = self.starts(log, 5)
+                self.assertEqual(sorted((generation, index) for generation, index, _ in lines[3:]),
+                                 [('1', '0'), ('1', '1')])
+                time.sleep(0.5)
+                self.assertEqual(len(self.starts(log, 5)), 5)
+                # The replaced workers were stopped and reaped.
+                for _, _, pid in lines[1:3]:
+                    with self.assertRaises(ProcessLookupError):
+                        os.kill(int(pid), 0)
+                supervisor.send_signal(signal.SIGTERM)
+                self.assertEqual(supervisor.wait(10), 0)
+            finally:
+                if supervisor.poll() is None:
+                    supervisor.kill()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,133 @@
+import os
+import struct
+import tempfile
+import unittest
+
+from zone import TYPES, Zone, encode_name, file_stamp, load_zone
+
+
+def query(name, rtype):
+    data = struct.pack('!HHHHHH', 0x4242, 0x0100, 1, 0, 0, 0) + encode_name(name) + struct.pack('!HH', rtype, 1)
+    return data, encode_name(name).lower() + struct.pack('!HH', rtype, 1)
+
+
+def records(response):
+    '''
+    (type, TTL, RDATA) of every answer record of a response whose records
+    all have a compressed owner name.
+    '''
+    index = 12
+    while response[index]:
+        index += response[index] + 1
+    index += 5
+    found = []
+    for _ in range(struct.unpack_from('!H', response, 6)[0]):
+        rtype, _, ttl, length = struct.unpack_from('!HHIH', response, index + 2)
+        found.append((rtype, ttl, response[index + 12:index + 12 + length]))
+        index += 12 + length
+    return found
+
+
+class ZoneTest(unittest.TestCase):
+
+    def ask(self, zone, name, rtype):
+        data, key = query(name, rtype)
+        response = zone.answer(data, key)
+        return None if response is None else records(response)
+
+    def test_hosts_lines_and_reverse_records(self):
+        zone = Zone().load(['$TTL 300', '10.0.0.1 www.example.com web.example.com', '2001:db8::1 www.example.com'])
+        self.assertEqual(self.ask(zone, 'WEB.example.com', TYPES['A']), [(1, 300, bytes([10, 0, 0, 1]))])
+        self.assertEqual(self.ask(zone, 'www.example.com', TYPES['AAAA'])[0][2][-1], 1)
+        self.assertEqual(self.ask(zone, '1.0.0.10.in-addr.arpa', TYPES['PTR']),
+                         [(12, 300, encode_name('www.example.com'))])
+        reverse = '.'.join('1' + '0' * 23 + '8bd01002') + '.ip6.arpa'
+        self.assertEqual(self.ask(zone, reverse, TYPES['PTR'])[0][2], encode_name('www.example.com'))
+
+    def test_ptr_record_replaces_the_automatic_one(self):
+        for lines in (['10.0.0.1 host.example.com', '1.0.0.10.in-addr.arpa PTR name.example.com'],
+                      ['1.0.0.10.in-addr.arpa PTR name.example.com', '10.0.0.1 host.example.com']):
+            zone = Zone().load(lines)
+            self.assertEqual(self.ask(zone, '1.0.0.10.in-addr.arpa', TYPES['PTR']),
+                             [(12, 16, encode_name('name.example.com'))])
+        # The first line of an address names it.
+        zone = Zone().load(['10.0.0.1 first.example.com', '10.0.0.1 second.example.com'])
+        self.assertEqual(self.ask(zone, '1.0.0.10.in-addr.arpa', TYPES['PTR']),
+                         [(12, 16, encode_name('first.example.com'))])
+
+    def test_rrsets_keep_their_order_and_ttls(self):
+        zone = Zone().load(['example.com 60 MX 10 a.example.com', 'example.com MX 20 b.example.com',
+                            'example.com TXT "two words" more'])
+        self.assertEqual(self.ask(zone, 'example.com', TYPES['MX']),
+                         [(15, 60, b'\x00\x0a' + encode_name('a.example.com')),
+                          (15, 16, b'\x00\x14' + encode_name('b.example.com'))])
+        self.assertEqual(self.ask(zone, 'example.com', TYPES['TXT']), [(16, 16, b'\x09two words\x04more')])
+        self.assertEqual(zone.stats()['records'], 3)
+        self.assertEqual(zone.stats()['rrsets'], 2)
+
+    def test_cname_chains_are_followed(self):
+        zone = Zone().load(['10.0.0.1 target.example.com', 'b.example.com CNAME target.example.com',
+                            'a.example.com CNAME B.example.com'])
+        answer = self.ask(zone, 'a.example.com', TYPES['A'])
+        self.assertEqual([rtype for rtype, _, _ in answer], [5, 5, 1])
+        self.assertEqual(self.ask(zone, 'a.example.com', TYPES['CNAME']), [(5, 16, encode_name('B.example.com'))])
+
+    def test_name_without_the_type_is_empty_and_unknown_name_is_none(self):
+        zone = Zone().load(['10.0.0.1 www.example.com'])
+        self.assertEqual(self.ask(zone, 'www.example.com', TYPES['MX']), [])
+        self.assertIsNone(self.ask(zone, 'mail.example.com', TYPES['A']))
+
+    def test_wildcards(self):
+        zone = Zone().load(['*.example.com A 10.0.0.1', '*.dev.example.com A 10.0.0.2',
+                            '10.0.0.3 www.example.com', '*.example.com MX 10 mail.example.com'])
+        self.assertEqual(self.ask(zone, 'anything.example.com', TYPES['A']), [(1, 16, bytes([10, 0, 0, 1]))])
+        self.assertEqual(self.ask(zone, 'a.b.example.com', TYPES['A']), [(1, 16, bytes([10, 0, 0, 1]))])
+        # The most specific wildcard wins, and names of their own are not wildcards.
+        self.assertEqual(self.ask(zone, 'x.dev.example.com', TYPES['A']), [(1, 16, bytes([10, 0, 0, 2]))])
+        self.assertEqual(self.ask(zone, 'www.example.com', TYPES['A']), [(1, 16, bytes([10, 0, 0, 3]))])
+        self.assertEqual(self.ask(zone, 'other.example.com', TYPES['MX'])[0][0], 15)
+        # A wildcard does not cover the name it is under.
+        self.assertIsNone(self.ask(zone, 'example.com', TYPES['A']))
+        self.assertIsNone(self.ask(zone, 'example.org', TYPES['A']))
+
+    def test_answer_echoes_the_question(self):
+        zone = Zone().load(['10.0.0.1 www.example.com'])
+        data, key = query('WWW.Example.com', TYPES['A'])
+        response = zone.answer(data, key)
+        self.assertEqual(response[:2], b'\x42\x42')
+        self.assertEqual(response[12:12 + len(key)], data[12:])
+
+    def test_hot_answers_are_bounded(self):
+        zone = Zone(hot_answers=2).load([f'10.0.0.{i} host{i}.example.com' for i in range(1, 5)])
+        for i in range(1, 5):
+            self.ask(zone, f'host{i}.example.com', TYPES['A'])
+        self.assertEqual(list(zone.answers), [query(f'host{i}.example.com', 1)[1] for i in (3, 4)])
+        self.assertEqual(self.ask(zone, 'host1.example.com', TYPES['A']), [(1, 16, bytes([10, 0, 0, 1]))])
+
+    def test_table_grows(self):
+        zone = Zone().load([f'10.{i >> 8}.{i & 255}.1 host{i}.example.com' for i in range(5000)])
+        self.assertEqual(zone.stats()['rrsets'], 10000)
+        for i in range(0, 5000, 97):
+            self.assertEqual(self.ask(zone, f'host{i}.example.com', TYPES['A'])[0][2], bytes([10, i >> 8, i & 255, 1]))
+
+    def test_overlong_names_are_skipped(self):
+        zone = Zone().load(['10.0.0.1 ' + '.'.join(['a' * 60] * 5), '10.0.0.2 ok.example.com'])
+        self.assertEqual(zone.stats()['records'], 1)
+
+    def test_snapshot(self):
+        with tempfile.TemporaryDirectory() as directory:
+            hosts = os.path.join(directory, 'hosts')
+            snapshot = os.path.join(directory, 'snapshot')
+            with open(hosts, 'w') as file:
+                file.write('10.0.0.1 www.example.com\n*.example.com A 10.0.0.9\nexample.com MX 10 mail.example.com\n')
+            zone = load_zone(hosts, snapshot)
+            loaded = Zone.from_snapshot(snapshot, file_stamp(hosts))
+            self.assertIsNotNone(loaded)
+            for name, rtype in (('www.example.com', 1), ('1.0.0.10.in-addr.arpa', 12), ('x.example.com', 1),
+                                ('example.com', 15), ('nothing.example.org', 1)):
+                self.assertEqual(self.ask(loaded, name, rtype), self.ask(zone, name, rtype))
+            self.assertIsNone(Zone.from_snapshot(snapshot, (0, 0, 0)))
+
+
+if __name__ == '__main__':
+    unittest.main()
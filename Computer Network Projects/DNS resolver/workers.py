@@ -0,0 +1,215 @@
+import gc
+import os
+import select
+import signal
+import socket
+import time
+
+
+def create_udp_socket(host, port, reuse_port):
+    family = socket.AF_INET6 if ':' in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_DGRAM)
+    if reuse_port:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    if family == socket.AF_INET6:
+        # '::' answers IPv4 clients too, as it always has.
+        sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 0)
+    sock.bind((host, port))
+    sock.setblocking(False)
+    return sock
+
+
+class SocketTransport:
+    '''
+    The part of the datagram transport interface the resolver uses, on top
+    of a plain non-blocking socket. A response that does not fit in the
+    socket's send buffer is dropped, as it would be on the network; the
+    client asks again.
+    '''
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.dropped = 0
+        self.closed = False
+
+    def sendto(self, data, addr):
+        try:
+            self.sock.sendto(data, addr)
+        except OSError:
+            self.dropped += 1
+
+    def is_closing(self):
+        return self.closed
+
+    def get_extra_info(self, name, default=None):
+        if name == 'socket':
+            return self.sock
+        if name == 'sockname':
+            return self.sock.getsockname()
+        return default
+
+    def close(self):
+        self.closed = True
+
+
+class BatchReceiver:
+    '''
+    Feeds a DatagramProtocol from a socket without asyncio's datagram
+    transport: when the socket becomes readable it drains up to batch
+    datagrams in one go with recvfrom_into() into one preallocated buffer,
+    instead of one event loop callback and one 256 KiB recvfrom() buffer
+    per datagram.
+    '''
+
+    def __init__(self, loop, sock, protocol, batch=64, buffer_size=4096):
+        self.loop = loop
+        self.sock = sock
+        self.protocol = protocol
+        self.batch = batch
+        self.buffer = bytearray(buffer_size)
+        self.view = memoryview(self.buffer)
+        self.transport = SocketTransport(sock)
+        self.received = 0
+
+    def start(self):
+        self.protocol.connection_made(self.transport)
+        self.loop.add_reader(self.sock.fileno(), self.drain)
+
+    def drain(self):
+        receive = self.sock.recvfrom_into
+        buffer = self.buffer
+        view = self.view
+        handle = self.protocol.datagram_received
+        for _ in range(self.batch):
+            try:
+                count, addr = receive(buffer)
+            except (BlockingIOError, InterruptedError):
+                break
+            except OSError:
+                # ICMP errors for earlier responses show up here on Linux.
+                continue
+            self.received += 1
+            handle(bytes(view[:count]), addr)
+
+    def close(self):
+        self.loop.remove_reader(self.sock.fileno())
+        self.transport.close()
+        self.sock.close()
+
+
+def spawn_worker(run, worker_index):
+    pid = os.fork()
+    if pid:
+        return pid
+
+    signal.set_wakeup_fd(-1)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+    # Reloading is the supervisor's job.
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    code = 0
+    try:
+        run(worker_index)
+    except SystemExit as e:
+        code = e.code if isinstance(e.code, int) else 1
+    except BaseException as e:
+        print(f"Worker {os.getpid()} crashed:", e)
+        code = 1
+    finally:
+        os._exit(code)
+
+
+def supervise(run, count, reload=None, interval=0):
+    '''
+    Runs count worker processes, each calling run(worker_index), and
+    restarts any that exit. Every worker binds its own SO_REUSEPORT socket
+    so the kernel spreads queries between them. SIGTERM and SIGINT stop the
+    workers.
+
+    The workers share what was loaded before they were forked, the zone
+    above all, copy-on-write, and gc.freeze() keeps the garbage collector
+    from writing to it. So the hosts file is reloaded here once rather
+    than in every worker: reload(forced) is called on SIGHUP (forced) and
+    every interval seconds, and when it returns true every worker is
+    replaced by a new one forked after the reload. Each new worker is
+    started before the one it replaces is stopped.
+    '''
+    shutting_down = False
+    reload_requested = False
+    workers = {}
+
+    def stop(pid):
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+
+    def request_shutdown(signum, frame):
+        nonlocal shutting_down
+        shutting_down = True
+        for pid in workers:
+            stop(pid)
+
+    def request_reload(signum, frame):
+        nonlocal reload_requested
+        reload_requested = True
+
+    def start(index):
+        gc.freeze()
+        workers[spawn_worker(run, index)] = (index, time.monotonic())
+
+    # Signals wake the select() below through this pipe.
+    wakeup, wakeup_writer = os.pipe()
+    os.set_blocking(wakeup, False)
+    os.set_blocking(wakeup_writer, False)
+    signal.set_wakeup_fd(wakeup_writer)
+    signal.signal(signal.SIGTERM, request_shutdown)
+    signal.signal(signal.SIGINT, request_shutdown)
+    signal.signal(signal.SIGHUP, request_reload)
+    signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+
+    for index in range(count):
+        start(index)
+    print(f"Supervisor {os.getpid()} started {count} workers")
+
+    next_check = time.monotonic() + interval
+    while workers:
+        timeout = max(next_check - time.monotonic(), 0) if reload is not None and interval else None
+        select.select([wakeup], [], [], timeout)
+        try:
+            os.read(wakeup, 512)
+        except BlockingIOError:
+            pass
+
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if not pid:
+                break
+            # Workers stopped by a reload are no longer in workers.
+            worker = workers.pop(pid, None)
+            if worker is None or shutting_down:
+                continue
+            index, started = worker
+
+            print(f"Worker {pid} exited with status {os.waitstatus_to_exitcode(status)}, restarting")
+            if time.monotonic() - started < 1.0:
+                # Crashing straight after start: do not fork in a tight loop.
+                time.sleep(1.0)
+            if not shutting_down:
+                start(index)
+
+        if reload is None or shutting_down:
+            continue
+        forced = reload_requested
+        if forced or (interval and time.monotonic() >= next_check):
+            reload_requested = False
+            if reload(forced):
+                for pid, (index, _) in list(workers.items()):
+                    del workers[pid]
+                    start(index)
+                    stop(pid)
+            next_check = time.monotonic() + interval
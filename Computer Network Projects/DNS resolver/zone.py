@@ -0,0 +1,482 @@
+import marshal
+import os
+import shlex
+import socket
+import struct
+import zlib
+from array import array
+
+TYPES = {'A': 1, 'NS': 2, 'CNAME': 5, 'PTR': 12, 'MX': 15, 'TXT': 16, 'AAAA': 28}
+TYPE_A = 1
+TYPE_CNAME = 5
+TYPE_PTR = 12
+TYPE_AAAA = 28
+
+CLASS_IN = b'\x00\x01'
+FLAGS = b'\x81\x80'
+PTR_KEY = struct.pack('!H', TYPE_PTR) + CLASS_IN
+CNAME_KEY = struct.pack('!H', TYPE_CNAME) + CLASS_IN
+DEFAULT_TTL = 16
+MAX_CNAME_CHAIN = 8
+SNAPSHOT_VERSION = 2
+HOT_ANSWERS = 65536
+INITIAL_SLOTS = 1024
+
+# An entry: offset of the next record of the rrset, flags, TTL, RDLENGTH.
+ENTRY = struct.Struct('!IBIH')
+OFFSET = struct.Struct('!I')
+# Flags: a PTR made from an address line, which a PTR record of the file
+# replaces; RDATA that is the offset of the entry whose name it stands for.
+AUTO_PTR = 0x01
+NAME_REF = 0x02
+
+
+LENGTH_BYTES = [bytes((length,)) for length in range(64)]
+NAME_LENGTH = [bytes((length,)) for length in range(256)]
+
+
+def encode_name(domain):
+    # Labels over 63 bytes raise IndexError.
+    return b''.join([LENGTH_BYTES[len(label)] + label for label in domain.rstrip('.').encode().split(b'.')]) + b'\x00'
+
+
+def name_labels(wire):
+    '''
+    The labels of an uncompressed wire-format name, last label first.
+    '''
+    labels = []
+    index = 0
+    length = wire[0]
+    while length:
+        labels.append(wire[index + 1:index + 1 + length])
+        index += length + 1
+        length = wire[index]
+    labels.reverse()
+    return labels
+
+
+def reverse_name(packed):
+    if len(packed) == 4:
+        return '%d.%d.%d.%d.in-addr.arpa' % (packed[3], packed[2], packed[1], packed[0])
+    return '.'.join(reversed(packed.hex())) + '.ip6.arpa'
+
+
+def parse_address(text):
+    '''
+    Returns (record type, packed address), or None if text is not an IP
+    address. inet_pton is much faster than ipaddress for large files.
+    '''
+    try:
+        return TYPE_A, socket.inet_pton(socket.AF_INET, text)
+    except OSError:
+        pass
+    try:
+        return TYPE_AAAA, socket.inet_pton(socket.AF_INET6, text)
+    except OSError:
+        return None
+
+
+def encode_rdata(rtype, fields, rest):
+    if rtype == TYPE_A:
+        return socket.inet_pton(socket.AF_INET, fields[0])
+    if rtype == TYPE_AAAA:
+        return socket.inet_pton(socket.AF_INET6, fields[0])
+    if rtype == TYPES['MX']:
+        return struct.pack('!H', int(fields[0])) + encode_name(fields[1])
+    if rtype == TYPES['TXT']:
+        rdata = bytearray()
+        for text in shlex.split(rest):
+            encoded = text.encode()
+            for start in range(0, max(len(encoded), 1), 255):
+                chunk = encoded[start:start + 255]
+                rdata.append(len(chunk))
+                rdata.extend(chunk)
+        return bytes(rdata)
+    if rtype in (TYPE_CNAME, TYPE_PTR, TYPES['NS']):
+        return encode_name(fields[0])
+    raise ValueError(f"records of type {rtype} are not supported")
+
+
+def rebase(section, count, owner):
+    '''
+    Replaces the 2-byte owner name pointer of each of the count records in
+    an answer section, so the records of one response can be copied into
+    another one.
+    '''
+    out = bytearray(section)
+    index = 0
+    for _ in range(count):
+        out[index:index + 2] = owner
+        rdlength = out[index + 10] << 8 | out[index + 11]
+        index += 12 + rdlength
+    return bytes(out)
+
+
+class Zone:
+    '''
+    The records of a hosts file, indexed for answering queries.
+
+    The records are kept in one bytearray rather than as Python objects.
+    Each record is an entry: the length of its name, the question it
+    answers (lowercased name, QTYPE and QCLASS in wire format, the
+    same key question_key() derives from a query), then the offset of the
+    next record of the same rrset, flags, TTL, RDLENGTH and RDATA. An
+    open-addressing hash table of two arrays, the offset of the first entry
+    of every rrset and the CRC-32 of its question, finds an rrset in one
+    probe sequence whatever the size of the zone. A record costs its wire
+    bytes plus a few bytes of table, and the whole zone is three buffers
+    that forked workers share copy-on-write. An automatic PTR record holds
+    the offset of the entry of the name it points at, not another copy of
+    the name.
+
+    Responses are built from the entries the first time a question is
+    asked, and the last hot_answers of them are kept in answers, which the
+    resolver looks up before anything else. Names with a CNAME answer A
+    and AAAA questions with the records of the target too. Wildcard names
+    (*.example.com) live in a small trie of reversed labels, walked one
+    label at a time.
+    '''
+
+    def __init__(self, hot_answers=HOT_ANSWERS):
+        # Offset 0 stands for no entry, in the table and in the chains.
+        self.entries = bytearray(1)
+        self.slots = array('I', bytes(4 * INITIAL_SLOTS))
+        self.hashes = array('I', bytes(4 * INITIAL_SLOTS))
+        self.rrset_count = 0
+        self.answers = {}
+        self.hot_answers = hot_answers
+        self.wildcards = {}
+        self.records = 0
+        self.cnames = 0
+        self.stamp = None
+
+    def add(self, name, rtype, ttl, rdata):
+        self.add_wire(encode_name(name).lower(), rtype, ttl, rdata)
+
+    def add_wire(self, name, rtype, ttl, rdata):
+        '''
+        Adds a record for the lowercased wire-format name. Returns the offset
+        of the first entry of its rrset, or None for a wildcard name.
+        '''
+        if name.startswith(b'\x01*'):
+            node = self.wildcards
+            for label in name_labels(name)[:-1]:
+                node = node.setdefault(label, {})
+            rrsets = node.setdefault(b'*', {})
+            count, section = rrsets.get(rtype, (0, b''))
+            rrsets[rtype] = (count + 1, section + b'\xc0\x0c' + struct.pack('!HHIH', rtype, 1, ttl, len(rdata)) + rdata)
+            self.records += 1
+            return None
+        rrset_count = self.rrset_count
+        head = self.insert(name + struct.pack('!H', rtype) + CLASS_IN, 0, ttl, rdata)
+        if rtype == TYPE_CNAME and self.rrset_count > rrset_count:
+            self.cnames += 1
+        self.records += 1
+        return head
+
+    def add_host(self, packed, names, ttl=DEFAULT_TTL):
+        rtype = TYPE_A if len(packed) == 4 else TYPE_AAAA
+        wires = [encode_name(name).lower() for name in names]
+        heads = [self.add_wire(wire, rtype, ttl, packed) for wire in wires]
+        question = encode_name(reverse_name(packed)) + PTR_KEY
+        if heads[0] is not None:
+            self.insert(question, AUTO_PTR | NAME_REF, ttl, OFFSET.pack(heads[0]))
+        else:
+            self.insert(question, AUTO_PTR, ttl, wires[0])
+
+    def load(self, lines):
+        '''
+        Reads hosts file lines. Besides the usual "address name..." lines it
+        accepts "$TTL seconds", which sets the TTL of the lines that follow,
+        and records written as "name [ttl] [IN] TYPE data", for example
+        "www.example.com 300 CNAME example.com" or
+        "*.example.com MX 10 mail.example.com".
+        '''
+        ttl = DEFAULT_TTL
+        for number, line in enumerate(lines, 1):
+            if not line.strip() or line.startswith("#"):
+                continue
+            fields = line.split()
+            try:
+                if fields[0] == '$TTL':
+                    ttl = int(fields[1])
+                    continue
+                address = parse_address(fields[0])
+                if address is not None:
+                    self.add_host(address[1], fields[1:], ttl)
+                    continue
+
+                name, index, record_ttl = fields[0], 1, ttl
+                if fields[index].isdigit():
+                    record_ttl = int(fields[index])
+                    index += 1
+                if fields[index].upper() == 'IN':
+                    index += 1
+                rtype = TYPES[fields[index].upper()]
+                rest = line.split(None, index + 1)[index + 1] if len(fields) > index + 1 else ''
+                self.add(name, rtype, record_ttl, encode_rdata(rtype, fields[index + 1:], rest))
+            except (IndexError, KeyError, ValueError, OSError) as e:
+                print(f"Skipping line {number} of the hosts file: {line.strip()!r} ({e!r})")
+        return self
+
+    def insert(self, question, flags, ttl, rdata):
+        '''
+        Appends an entry for question and links it into the table, or at the
+        end of the rrset already there. An automatic PTR is only added to a
+        name with no PTR yet, and the first PTR of the file replaces it.
+        Returns the offset of the first entry of the rrset.
+        '''
+        crc = zlib.crc32(question)
+        index = self.find(question, crc)
+        head = self.slots[index]
+        if not head or (self.entries[head + len(question) + 5] & AUTO_PTR and not flags & AUTO_PTR):
+            offset = self.append(question, flags, ttl, rdata)
+            self.slots[index] = offset
+            if not head:
+                self.hashes[index] = crc
+                self.rrset_count += 1
+                if 2 * self.rrset_count > len(self.slots):
+                    self.grow()
+            return offset
+        if flags & AUTO_PTR:
+            return head
+
+        entries = self.entries
+        position = head + 1 + len(question)
+        following = OFFSET.unpack_from(entries, position)[0]
+        while following:
+            position = following + 1 + len(question)
+            following = OFFSET.unpack_from(entries, position)[0]
+        OFFSET.pack_into(entries, position, self.append(question, flags, ttl, rdata))
+        return head
+
+    def append(self, question, flags, ttl, rdata):
+        # Names over 255 bytes raise IndexError.
+        offset = len(self.entries)
+        self.entries += NAME_LENGTH[len(question) - 4] + question + ENTRY.pack(0, flags, ttl, len(rdata)) + rdata
+        return offset
+
+    def find(self, question, crc):
+        '''
+        The table slot of question: the one holding the offset of its first
+        entry, or the empty slot where that would go.
+        '''
+        entries, slots, hashes = self.entries, self.slots, self.hashes
+        mask = len(slots) - 1
+        index = crc & mask
+        length = len(question)
+        while True:
+            offset = slots[index]
+            if not offset or (hashes[index] == crc and entries[offset] == length - 4
+                              and entries.startswith(question, offset + 1)):
+                return index
+            index = (index + 1) & mask
+
+    def grow(self):
+        # The hashes are kept, so the questions need not be hashed again.
+        size = 2 * len(self.slots)
+        mask = size - 1
+        slots = array('I', bytes(4 * size))
+        hashes = array('I', bytes(4 * size))
+        for offset, crc in zip(self.slots, self.hashes):
+            if offset:
+                index = crc & mask
+                while slots[index]:
+                    index = (index + 1) & mask
+                slots[index] = offset
+                hashes[index] = crc
+        self.slots, self.hashes = slots, hashes
+
+    def rrset(self, question):
+        '''
+        The records answering question as (count, section), the section with
+        every owner name a pointer to the question, or None.
+        '''
+        offset = self.slots[self.find(question, zlib.crc32(question))]
+        if not offset:
+            return None
+        entries = self.entries
+        start = 1 + len(question)
+        header = b'\xc0\x0c' + question[-4:]
+        count = 0
+        section = bytearray()
+        while offset:
+            position = offset + start
+            offset, flags, ttl, length = ENTRY.unpack_from(entries, position)
+            position += ENTRY.size
+            rdata = entries[position:position + length]
+            if flags & NAME_REF:
+                target = OFFSET.unpack(rdata)[0]
+                rdata = entries[target + 1:target + 1 + entries[target]]
+            section += header + struct.pack('!IH', ttl, len(rdata)) + rdata
+            count += 1
+        return count, bytes(section)
+
+    def compile(self):
+        '''
+        Finishes loading. Records are indexed as they are added, so there is
+        nothing left to build; the zone is read-only afterwards.
+        '''
+        return self
+
+    def exists(self, name):
+        for rtype in TYPES.values():
+            question = name + struct.pack('!H', rtype) + CLASS_IN
+            if self.slots[self.find(question, zlib.crc32(question))]:
+                return True
+        return False
+
+    def wildcard(self, name):
+        '''
+        The records of the most specific wildcard covering name, or None.
+        '''
+        node = self.wildcards
+        found = None
+        labels = name_labels(name)
+        for label in labels[:-1]:
+            node = node.get(label)
+            if node is None:
+                break
+            found = node.get(b'*', found)
+        return found
+
+    def build_response(self, question, rrsets):
+        '''
+        Builds a response (minus the transaction ID) from the rrsets of the
+        question's name, following a CNAME through the zone.
+        '''
+        rtype = struct.unpack_from('!H', question, len(question) - 4)[0]
+        count, section = 0, b''
+        owner = b'\xc0\x0c'
+        for _ in range(MAX_CNAME_CHAIN):
+            rrset = rrsets.get(rtype)
+            if rrset is not None:
+                count += rrset[0]
+                section += rebase(rrset[1], rrset[0], owner)
+                break
+            cname = rrsets.get(TYPE_CNAME)
+            if cname is None or rtype == TYPE_CNAME:
+                break
+            # The target is written out in full in the CNAME's data, 12 bytes
+            # after the start of the record: point the next owner at it.
+            offset = 12 + len(question) + len(section) + 12
+            count += 1
+            section += rebase(cname[1], 1, owner)
+            owner = struct.pack('!H', 0xC000 | offset)
+            rrsets = self.rrsets(cname[1][12:].lower(), rtype)
+        return FLAGS + struct.pack('!HHHH', 1, count, 0, 0) + question + section
+
+    def rrsets(self, name, rtype):
+        '''
+        The rrsets of name needed to answer rtype, as {type: (count,
+        section)}: its CNAME if it has one, else its records of type rtype.
+        '''
+        rrset = self.rrset(name + CNAME_KEY)
+        if rrset is not None:
+            return {TYPE_CNAME: rrset}
+        rrset = self.rrset(name + struct.pack('!H', rtype) + CLASS_IN)
+        return {} if rrset is None else {rtype: rrset}
+
+    def answer(self, data, key):
+        '''
+        The response to query data: the records of the question, following
+        a CNAME for another type, an empty answer for a name that exists
+        without records of that type, or a wildcard match. Returns None when
+        the zone has no such name.
+        '''
+        if key[-2:] != CLASS_IN:
+            return None
+        response = self.answers.get(key)
+        if response is None:
+            name = key[:-4]
+            rtype = struct.unpack_from('!H', key, len(key) - 4)[0]
+            rrsets = self.rrsets(name, rtype)
+            if rrsets:
+                response = self.build_response(key, rrsets)
+            elif self.exists(name):
+                response = FLAGS + struct.pack('!HHHH', 1, 0, 0, 0) + key
+            else:
+                rrsets = self.wildcard(name)
+                if rrsets is None:
+                    return None
+                response = self.build_response(key, rrsets)
+            answers = self.answers
+            if len(answers) >= self.hot_answers:
+                # The oldest answer out: hot names are built again at once.
+                del answers[next(iter(answers))]
+            answers[key] = response
+        question = data[12:12 + len(key)]
+        return data[:2] + response[:10] + question + response[10 + len(key):]
+
+    def stats(self):
+        return {
+            'records': self.records,
+            'rrsets': self.rrset_count,
+            'cnames': self.cnames,
+            'bytes': len(self.entries) + self.slots.itemsize * len(self.slots) * 2,
+            'hot_answers': len(self.answers),
+        }
+
+    def save(self, path):
+        '''
+        Writes the tables to a snapshot file, replaced atomically.
+        '''
+        data = marshal.dumps((SNAPSHOT_VERSION, self.stamp, self.records, self.cnames, self.rrset_count,
+                              self.entries, self.slots.tobytes(), self.hashes.tobytes(), self.wildcards))
+        temporary = f"{path}.{os.getpid()}.tmp"
+        with open(temporary, 'wb') as file:
+            file.write(data)
+        os.replace(temporary, path)
+
+    @classmethod
+    def from_snapshot(cls, path, stamp):
+        '''
+        Returns the zone saved in the snapshot at path if it was compiled
+        from the hosts file as it is now (same stamp), else None.
+        '''
+        try:
+            with open(path, 'rb') as file:
+                saved = marshal.loads(file.read())
+        except (OSError, EOFError, ValueError, TypeError):
+            return None
+        if saved[0] != SNAPSHOT_VERSION or saved[1] != stamp:
+            return None
+        zone = cls()
+        _, zone.stamp, zone.records, zone.cnames, zone.rrset_count, zone.entries, slots, hashes, zone.wildcards = saved
+        zone.slots = array('I')
+        zone.slots.frombytes(slots)
+        zone.hashes = array('I')
+        zone.hashes.frombytes(hashes)
+        return zone
+
+
+def file_stamp(file_path):
+    '''
+    Identifies one version of a file: a changed mtime, size or inode (the
+    file was replaced) means it has to be read again.
+    '''
+    stat = os.stat(file_path)
+    return stat.st_mtime_ns, stat.st_size, stat.st_ino
+
+
+def load_zone(file_path, snapshot=None):
+    '''
+    Reads and compiles the hosts file at file_path. With a snapshot path the
+    compiled tables are loaded from there instead when the snapshot is up to
+    date, which takes a fraction of the time, and saved there otherwise.
+    '''
+    stamp = file_stamp(file_path)
+    if snapshot is not None:
+        zone = Zone.from_snapshot(snapshot, stamp)
+        if zone is not None:
+            return zone
+
+    with open(file_path, 'r') as file:
+        zone = Zone().load(file).compile()
+    zone.stamp = stamp
+    if snapshot is not None:
+        try:
+            zone.save(snapshot)
+        except OSError as e:
+            print(f"Could not write the snapshot {snapshot}:", e)
+    return zone
@@ -0,0 +1,277 @@
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import socket
+import struct
+import subprocess
+import sys
+import time
+
+from bench_tunnel import run_sink, start
+from http_parser import parse_head, read_body, read_head, response_body_framing
+
+SCENARIOS = ('small', 'large', 'slow', 'tunnel')
+
+
+def run_origin(ready, large_size, drip_chunks, drip_delay):
+    '''
+    Local stand-in origin server with keep-alive. /small answers 128 bytes,
+    /large large_size bytes and /slow drips drip_chunks chunks of a chunked
+    body, drip_delay seconds apart.
+    '''
+    small = b'x' * 128
+    large = b'x' * large_size
+
+    async def handle(reader, writer):
+        try:
+            while True:
+                head = await read_head(reader)
+                if not head:
+                    break
+                path = head.split(b' ', 2)[1]
+                if path.endswith(b'/slow'):
+                    writer.write(b"HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n")
+                    for _ in range(drip_chunks):
+                        await asyncio.sleep(drip_delay)
+                        writer.write(b"10\r\n" + small[:16] + b"\r\n")
+                        await writer.drain()
+                    writer.write(b"0\r\n\r\n")
+                else:
+                    body = large if path.endswith(b'/large') else small
+                    writer.write(b"HTTP/1.1 200 OK\r\nContent-Length: " + str(len(body)).encode() + b"\r\n\r\n")
+                    writer.write(body)
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve():
+        server = await asyncio.start_server(handle, '127.0.0.1', 0, backlog=4096)
+        ready.send(server.sockets[0].getsockname()[1])
+        await server.serve_forever()
+
+    asyncio.run(serve())
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_proxy(extra_args):
+    '''
+    Runs main.py as its own process, so its memory and file descriptors can
+    be read from /proc while the load generator runs.
+    '''
+    port = free_port()
+    command = [sys.executable, 'main.py', '--port', str(port), '--backlog', '4096'] + extra_args
+    process = subprocess.Popen(command, cwd=os.path.dirname(os.path.abspath(__file__)),
+                               stdout=subprocess.DEVNULL)
+    deadline = time.monotonic() + 10
+    while True:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return process, port
+        except OSError:
+            if process.poll() is not None or time.monotonic() > deadline:
+                process.kill()
+                raise RuntimeError("proxy did not start")
+            time.sleep(0.05)
+
+
+def process_usage(pid):
+    '''
+    Returns (resident memory in KiB, open file descriptors) of a process,
+    or (None, None) where /proc is not available.
+    '''
+    try:
+        with open(f'/proc/{pid}/status') as status:
+            rss = next(int(line.split()[1]) for line in status if line.startswith('VmRSS:'))
+        return rss, len(os.listdir(f'/proc/{pid}/fd'))
+    except (OSError, StopIteration):
+        return None, None
+
+
+class Usage:
+    '''
+    Samples the proxy process every interval seconds and keeps the peaks.
+    '''
+
+    def __init__(self, pid, interval=0.1):
+        self.pid = pid
+        self.interval = interval
+        self.peak_rss_kib = None
+        self.peak_fds = None
+
+    async def run(self):
+        while True:
+            rss, fds = process_usage(self.pid)
+            if rss is not None:
+                self.peak_rss_kib = max(rss, self.peak_rss_kib or 0)
+                self.peak_fds = max(fds, self.peak_fds or 0)
+            await asyncio.sleep(self.interval)
+
+
+def percentile(ordered, fraction):
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+async def http_client(proxy_port, url, deadline, latencies, errors):
+    request = f"GET {url} HTTP/1.1\r\nHost: {url.split('/')[2]}\r\n\r\n".encode()
+    reader = writer = None
+    while time.perf_counter() < deadline:
+        try:
+            if writer is None:
+                reader, writer = await asyncio.open_connection('127.0.0.1', proxy_port, limit=1 << 20)
+            started = time.perf_counter()
+            writer.write(request)
+            head = await read_head(reader)
+            if not head:
+                raise ConnectionError("proxy closed the connection")
+            status_line, headers = parse_head(head)
+            status = int(status_line.split(' ')[1])
+            framing = response_body_framing('GET', status, headers)
+            await read_body(reader, framing)
+            if status != 200:
+                raise ConnectionError(status_line)
+            latencies.append(time.perf_counter() - started)
+            if framing is None:
+                writer.close()
+                writer = None
+        except (OSError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ValueError):
+            errors.append(1)
+            if writer is not None:
+                writer.close()
+                writer = None
+            await asyncio.sleep(0.01)
+    if writer is not None:
+        writer.close()
+
+
+async def tunnel_client(proxy_port, sink_port, size, latencies, errors):
+    try:
+        reader, writer = await asyncio.open_connection('127.0.0.1', proxy_port)
+        started = time.perf_counter()
+        writer.write(f"CONNECT 127.0.0.1:{sink_port} HTTP/1.1\r\nHost: 127.0.0.1:{sink_port}\r\n\r\n".encode())
+        head = await read_head(reader)
+        if not head.startswith(b'HTTP/1.1 200'):
+            raise ConnectionError(head.split(b'\r\n', 1)[0].decode(errors='replace'))
+        writer.write(struct.pack('!Q', size))
+        payload = memoryview(bytearray(1 << 20))
+        sent = 0
+        while sent < size:
+            count = min(len(payload), size - sent)
+            writer.write(payload[:count])
+            sent += count
+            await writer.drain()
+        if await reader.readexactly(2) != b'ok':
+            raise ConnectionError("sink did not acknowledge")
+        latencies.append(time.perf_counter() - started)
+        writer.close()
+    except (OSError, asyncio.IncompleteReadError) as e:
+        print("Tunnel client failed:", e)
+        errors.append(1)
+
+
+async def run_level(scenario, concurrency, args, proxy, origin_port, sink_port):
+    latencies = []
+    errors = []
+    usage = Usage(proxy.pid)
+    usage_task = asyncio.create_task(usage.run())
+    started = time.perf_counter()
+    if scenario == 'tunnel':
+        size = args.tunnel_megabytes * 1024 * 1024
+        await asyncio.gather(*(tunnel_client(args.proxy_port, sink_port, size, latencies, errors)
+                               for _ in range(concurrency)))
+    else:
+        url = f"http://127.0.0.1:{origin_port}/{scenario}"
+        deadline = started + args.duration
+        await asyncio.gather(*(http_client(args.proxy_port, url, deadline, latencies, errors)
+                               for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    usage_task.cancel()
+    rss_after, fds_after = process_usage(proxy.pid)
+
+    ordered = sorted(latencies)
+    result = {
+        'scenario': scenario,
+        'concurrency': concurrency,
+        'seconds': round(elapsed, 3),
+        'completed': len(latencies),
+        'errors': len(errors),
+        'rps': round(len(latencies) / elapsed, 1),
+        'p50_ms': round(1000 * percentile(ordered, 0.50), 3) if ordered else None,
+        'p99_ms': round(1000 * percentile(ordered, 0.99), 3) if ordered else None,
+        'peak_rss_kib': usage.peak_rss_kib,
+        'peak_fds': usage.peak_fds,
+        'rss_after_kib': rss_after,
+        'fds_after': fds_after,
+    }
+    if scenario == 'tunnel':
+        result['tunnel_mb_s'] = round(len(latencies) * args.tunnel_megabytes * 1024 * 1024 / elapsed / 1e6, 1)
+    return result
+
+
+def report(result):
+    line = (f"{result['scenario']:>7} c={result['concurrency']:<5} {result['rps']:>9.1f} req/s"
+            f"  p50 {result['p50_ms'] or 0:8.2f} ms  p99 {result['p99_ms'] or 0:8.2f} ms"
+            f"  errors {result['errors']:<4} rss {result['peak_rss_kib'] or 0:>7} KiB  fds {result['peak_fds'] or 0}")
+    if 'tunnel_mb_s' in result:
+        line += f"  {result['tunnel_mb_s']:.1f} MB/s"
+    print(line, flush=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Load test for the proxy: local origin servers, an asyncio load generator and "
+                    "requests/sec, latency, tunnel throughput and memory/FD usage per concurrency level.")
+    parser.add_argument('--scenarios', nargs='+', choices=SCENARIOS, default=list(SCENARIOS))
+    parser.add_argument('--concurrency', nargs='+', type=int, default=[1, 10, 100])
+    parser.add_argument('--duration', type=float, default=5.0, help="seconds per HTTP scenario and level")
+    parser.add_argument('--large-size', type=int, default=1024 * 1024, help="body size of /large")
+    parser.add_argument('--drip-chunks', type=int, default=10, help="chunks sent by /slow")
+    parser.add_argument('--drip-delay', type=float, default=0.01, help="seconds between /slow chunks")
+    parser.add_argument('--tunnel-megabytes', type=int, default=64, help="data pushed by each tunnel client")
+    parser.add_argument('--proxy-args', default='', help="extra main.py arguments, e.g. \"--relay splice\"")
+    parser.add_argument('--json', default=None, help="write the results as JSON to this file ('-' for stdout)")
+    args = parser.parse_args()
+
+    multiprocessing.set_start_method('fork')
+    origin, origin_port = start(run_origin, args.large_size, args.drip_chunks, args.drip_delay)
+    sink, sink_port = start(run_sink)
+    proxy, args.proxy_port = start_proxy(args.proxy_args.split())
+
+    results = []
+    try:
+        for scenario in args.scenarios:
+            for concurrency in args.concurrency:
+                result = asyncio.run(run_level(scenario, concurrency, args, proxy, origin_port, sink_port))
+                results.append(result)
+                report(result)
+    finally:
+        proxy.terminate()
+        proxy.wait()
+        origin.terminate()
+        sink.terminate()
+
+    if args.json is not None:
+        document = {
+            'proxy_args': args.proxy_args,
+            'python': sys.version.split()[0],
+            'results': results,
+        }
+        if args.json == '-':
+            print(json.dumps(document, indent=2))
+        else:
+            with open(args.json, 'w') as output:
+                json.dump(document, output, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+import argparse
+import timeit
+
+from http_parser import parse_head, parse_request_head
+
+
+REQUESTS = [
+    b"GET http://example.com/index.html HTTP/1.1\r\n"
+    b"Host: example.com\r\n"
+    b"User-Agent: Mozilla/5.0 (X11; Linux x86_64; rv:120.0) Gecko/20100101 Firefox/120.0\r\n"
+    b"Accept: text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8\r\n"
+    b"Accept-Language: en-US,en;q=0.5\r\n"
+    b"Accept-Encoding: gzip, deflate\r\n"
+    b"Connection: keep-alive\r\n"
+    b"Upgrade-Insecure-Requests: 1\r\n\r\n",
+
+    b"GET http://static.example.com:8080/assets/app.js?v=1234 HTTP/1.1\r\n"
+    b"Host: static.example.com:8080\r\n"
+    b"Accept: */*\r\n"
+    b"Referer: http://example.com/index.html\r\n"
+    b"Cookie: session=abcdef0123456789; theme=dark\r\n\r\n",
+
+    b"CONNECT www.example.org:443 HTTP/1.1\r\n"
+    b"Host: www.example.org:443\r\n"
+    b"Proxy-Connection: keep-alive\r\n\r\n",
+]
+
+
+def legacy_parse(data):
+    '''
+    The string slicing MyProxy used before parse_request_head: handle_request
+    splits out the method, handle_https / handle_http split the first line
+    again to find host and port, and parse_head splits the headers.
+    '''
+    first_line = data.split(b'\n')[0].decode()
+    method = first_line.split(' ')[0]
+
+    if method == "CONNECT":
+        host, port = data.split(b' ')[1].split(b':')
+        return method, host.decode(), int(port), parse_head(data)[1]
+
+    first_line = data.split(b'\n')[0].decode()
+    url = first_line.split(' ')[1]
+    http_pos = url.find('://')
+    if http_pos == -1:
+        temp = url
+    else:
+        temp = url[http_pos + 3:]
+
+    port_pos = temp.find(":")
+    web_server_pos = temp.find("/")
+    if web_server_pos == -1:
+        web_server_pos = len(temp)
+
+    if port_pos == -1 or web_server_pos < port_pos:
+        port = 80
+        web_server = temp[:web_server_pos]
+    else:
+        port = int((temp[port_pos + 1:])[:web_server_pos - port_pos - 1])
+        web_server = temp[:port_pos]
+
+    request_line, headers = parse_head(data)
+    return method, web_server, port, headers
+
+
+def new_parse(data):
+    request = parse_request_head(data)
+    return request.method, request.host, request.port, request.headers
+
+
+def bench(func, number):
+    def run():
+        for data in REQUESTS:
+            func(data)
+
+    best = min(timeit.repeat(run, number=number, repeat=5))
+    return number * len(REQUESTS) / best
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Microbenchmark of MyProxy request head parsing.")
+    parser.add_argument('--number', type=int, default=20000, help="iterations over the sample requests per run")
+    args = parser.parse_args()
+
+    for data in REQUESTS:
+        legacy = legacy_parse(data)
+        new = new_parse(data)
+        assert legacy[:3] == new[:3], (legacy, new)
+
+    legacy_rate = bench(legacy_parse, args.number)
+    new_rate = bench(new_parse, args.number)
+
+    print(f"legacy slicing:     {legacy_rate:12,.0f} requests/sec")
+    print(f"parse_request_head: {new_rate:12,.0f} requests/sec")
+    print(f"speedup:            {new_rate / legacy_rate:12.2f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+import argparse
+import asyncio
+import multiprocessing
+import socket
+import struct
+import time
+
+from proxy import MyProxy
+from relay import ENGINES, SPLICE_AVAILABLE, TunnelRelay
+
+
+def run_sink(ready):
+    '''
+    Local stand-in for the far end of a tunnel: reads an 8-byte length, then
+    discards that many bytes and answers b'ok'.
+    '''
+    async def handle(reader, writer):
+        size = struct.unpack('!Q', await reader.readexactly(8))[0]
+        while size:
+            data = await reader.read(min(size, 1 << 20))
+            if not data:
+                break
+            size -= len(data)
+        writer.write(b'ok')
+        await writer.drain()
+        writer.close()
+
+    async def serve():
+        server = await asyncio.start_server(handle, '127.0.0.1', 0)
+        ready.send(server.sockets[0].getsockname()[1])
+        await server.serve_forever()
+
+    asyncio.run(serve())
+
+
+def run_proxy(ready, engine, buffer_size):
+    tunnel = TunnelRelay(engine, buffer_size) if engine != 'stream' else None
+
+    async def handle(reader, writer):
+        await MyProxy(reader, writer, tunnel=tunnel).serve()
+
+    async def serve():
+        server = await asyncio.start_server(handle, '127.0.0.1', 0)
+        ready.send(server.sockets[0].getsockname()[1])
+        await server.serve_forever()
+
+    asyncio.run(serve())
+
+
+def start(target, *args):
+    parent, child = multiprocessing.Pipe()
+    process = multiprocessing.Process(target=target, args=(child,) + args, daemon=True)
+    process.start()
+    return process, parent.recv()
+
+
+def push(proxy_port, sink_port, total, chunk):
+    sock = socket.create_connection(('127.0.0.1', proxy_port))
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    sock.sendall(f"CONNECT 127.0.0.1:{sink_port} HTTP/1.1\r\nHost: 127.0.0.1:{sink_port}\r\n\r\n".encode())
+    response = b''
+    while not response.endswith(b'\r\n\r\n'):
+        response += sock.recv(1024)
+
+    payload = memoryview(bytearray(chunk))
+    start_time = time.perf_counter()
+    sock.sendall(struct.pack('!Q', total))
+    sent = 0
+    while sent < total:
+        count = min(chunk, total - sent)
+        sock.sendall(payload[:count])
+        sent += count
+    assert sock.recv(2) == b'ok'
+    elapsed = time.perf_counter() - start_time
+    sock.close()
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Throughput of MyProxy CONNECT tunnels for each relay engine.")
+    parser.add_argument('--megabytes', type=int, default=512, help="data pushed through each tunnel")
+    parser.add_argument('--runs', type=int, default=3)
+    parser.add_argument('--buffer-size', type=int, default=256 * 1024, help="relay buffer / pipe size")
+    parser.add_argument('--engines', nargs='+', choices=ENGINES, default=list(ENGINES))
+    args = parser.parse_args()
+
+    multiprocessing.set_start_method('fork')
+    total = args.megabytes * 1024 * 1024
+    sink, sink_port = start(run_sink)
+
+    if 'splice' in args.engines and not SPLICE_AVAILABLE:
+        print("os.splice is not available here; 'splice' falls back to 'buffer'")
+
+    try:
+        for engine in args.engines:
+            proxy, proxy_port = start(run_proxy, engine, args.buffer_size)
+            try:
+                best = min(push(proxy_port, sink_port, total, 1 << 20) for _ in range(args.runs))
+            finally:
+                proxy.terminate()
+            print(f"{engine:>7}: {total / best / 1e6:10.1f} MB/s  ({args.megabytes} MiB in {best:.3f}s)")
+    finally:
+        sink.terminate()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,282 @@
+import asyncio
+import time
+from collections import OrderedDict
+from email.utils import parsedate_to_datetime
+
+from http_parser import HOP_BY_HOP_HEADERS, header_value
+
+
+CACHEABLE_STATUSES = {200, 203, 300, 301, 404, 410}
+
+
+def parse_http_date(value):
+    try:
+        return parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError, IndexError):
+        return None
+
+
+def parse_cache_control(value):
+    directives = {}
+    if not value:
+        return directives
+    for part in value.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        name, _, arg = part.partition('=')
+        directives[name.strip().lower()] = arg.strip().strip('"')
+    return directives
+
+
+class CacheEntry:
+    __slots__ = ('status_line', 'headers', 'body', 'stored_at', 'initial_age',
+                 'lifetime', 'must_revalidate', 'etag', 'last_modified', 'size')
+
+    def __init__(self, status_line, headers, body, now):
+        self.status_line = status_line
+        self.headers = headers
+        self.body = body
+        self.size = len(status_line) + len(body) + sum(len(k) + len(v) + 4 for k, v in headers)
+        self.refresh(headers, now)
+
+    def refresh(self, headers, now):
+        '''
+        Recomputes freshness from a set of response headers. Used both when the
+        entry is first stored and when a 304 revalidation hands us new headers.
+        '''
+        cache_control = parse_cache_control(header_value(headers, 'cache-control'))
+        self.etag = header_value(headers, 'etag')
+        self.last_modified = header_value(headers, 'last-modified')
+        self.stored_at = now
+
+        try:
+            self.initial_age = max(0, int(header_value(headers, 'age') or 0))
+        except ValueError:
+            self.initial_age = 0
+
+        self.must_revalidate = 'no-cache' in cache_control
+        self.lifetime = freshness_lifetime(headers, cache_control, now)
+
+    def age(self, now):
+        return self.initial_age + max(0.0, now - self.stored_at)
+
+    def is_fresh(self, now):
+        return not self.must_revalidate and self.age(now) < self.lifetime
+
+    def can_revalidate(self):
+        return self.etag is not None or self.last_modified is not None
+
+
+def freshness_lifetime(headers, cache_control, now):
+    for directive in ('s-maxage', 'max-age'):
+        if directive in cache_control:
+            try:
+                return max(0, int(cache_control[directive]))
+            except ValueError:
+                return 0
+
+    date = parse_http_date(header_value(headers, 'date')) or now
+    expires = header_value(headers, 'expires')
+    if expires is not None:
+        expires_at = parse_http_date(expires)
+        return max(0.0, expires_at - date) if expires_at is not None else 0
+
+    # RFC 7234 section 4.2.2: heuristic freshness of 10% of the time since the
+    # object was last modified, capped so stale content does not linger for days.
+    last_modified = parse_http_date(header_value(headers, 'last-modified'))
+    if last_modified is not None and date > last_modified:
+        return min(0.1 * (date - last_modified), 86400)
+    return 0
+
+
+def is_storable(status, headers):
+    if status not in CACHEABLE_STATUSES:
+        return False
+
+    cache_control = parse_cache_control(header_value(headers, 'cache-control'))
+    if 'no-store' in cache_control or 'private' in cache_control:
+        return False
+    if header_value(headers, 'vary') is not None:
+        return False
+
+    explicit = ('max-age' in cache_control or 's-maxage' in cache_control
+                or header_value(headers, 'expires') is not None)
+    validators = (header_value(headers, 'etag') is not None
+                  or header_value(headers, 'last-modified') is not None)
+    return explicit or validators
+
+
+def request_bypasses_cache(headers):
+    if header_value(headers, 'authorization') is not None:
+        return True
+    cache_control = parse_cache_control(header_value(headers, 'cache-control'))
+    return 'no-store' in cache_control
+
+
+def request_forces_revalidation(headers):
+    cache_control = parse_cache_control(header_value(headers, 'cache-control'))
+    if 'no-cache' in cache_control or cache_control.get('max-age') == '0':
+        return True
+    pragma = header_value(headers, 'pragma')
+    return pragma is not None and 'no-cache' in pragma.lower()
+
+
+class HttpCache:
+    '''
+    In-memory response cache shared by every client connection of the proxy.
+    Entries are kept in an OrderedDict in least-recently-used order and evicted
+    once the total stored size goes over max_bytes. Concurrent misses for the
+    same key wait on a single upstream fetch instead of each opening their own.
+    '''
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, max_entry_bytes=None):
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes if max_entry_bytes is not None else max_bytes // 8
+        self.entries = OrderedDict()
+        self.pending = {}
+        self.current_bytes = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.revalidated = 0
+        self.collapsed = 0
+        self.stores = 0
+        self.oversized = 0
+        self.evictions = 0
+        self.bytes_served = 0
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.entries.move_to_end(key)
+        return entry
+
+    def store(self, key, entry):
+        if entry.size > self.max_entry_bytes:
+            self.remove(key)
+            return False
+
+        self.remove(key)
+        self.entries[key] = entry
+        self.current_bytes += entry.size
+        self.stores += 1
+
+        while self.current_bytes > self.max_bytes and self.entries:
+            _, evicted = self.entries.popitem(last=False)
+            self.current_bytes -= evicted.size
+            self.evictions += 1
+        return True
+
+    def remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.current_bytes -= entry.size
+
+    async def fetch(self, key, fetch_upstream, stream, revalidate=False):
+        '''
+        Returns (entry, from_cache) for key. When from_cache is true the
+        caller sends entry; otherwise the response has already gone to the
+        client through stream, and entry is what was stored, if anything.
+
+        On a miss or stale hit fetch_upstream(entry) is awaited and must
+        return (status, status_line, headers, body), body an async iterator
+        of the pieces of the response body; when entry is not None it should
+        send a conditional request built from the entry's validators. Unless
+        the answer is a 304 for that entry, stream(status, status_line,
+        headers, body) is awaited to pass the response on to the client
+        while the cache keeps a copy of the body, for as long as the
+        response is storable and no bigger than max_entry_bytes.
+        '''
+        now = time.time()
+        entry = self.get(key)
+        if entry is not None and not revalidate and entry.is_fresh(now):
+            self.hits += 1
+            self.bytes_served += len(entry.body)
+            return entry, True
+
+        pending = self.pending.get(key)
+        if pending is not None:
+            self.collapsed += 1
+            result = await asyncio.shield(pending)
+            if result is not None:
+                self.bytes_served += len(result.body)
+                return result, True
+
+        future = asyncio.get_running_loop().create_future()
+        self.pending[key] = future
+        result = None
+        try:
+            validator_entry = entry if entry is not None and entry.can_revalidate() else None
+            status, status_line, headers, body = await fetch_upstream(validator_entry)
+            now = time.time()
+
+            if status == 304 and validator_entry is not None:
+                merged = dict((k.lower(), (k, v)) for k, v in entry.headers)
+                for k, v in headers:
+                    if k.lower() not in HOP_BY_HOP_HEADERS and k.lower() != 'content-length':
+                        merged[k.lower()] = (k, v)
+                entry.headers = list(merged.values())
+                entry.refresh(entry.headers, now)
+                if key not in self.entries:
+                    self.store(key, entry)
+                self.revalidated += 1
+                self.bytes_served += len(entry.body)
+                result = entry
+                return entry, True
+
+            self.misses += 1
+            stored_headers = [(k, v) for k, v in headers
+                              if k.lower() not in HOP_BY_HOP_HEADERS and k.lower() != 'content-length']
+            copy = bytearray() if is_storable(status, stored_headers) else None
+            try:
+                if copy is not None and int(header_value(headers, 'content-length') or 0) > self.max_entry_bytes:
+                    copy = None
+                    self.oversized += 1
+            except ValueError:
+                pass
+
+            async def tee():
+                nonlocal copy
+                async for data in body:
+                    if copy is not None:
+                        copy += data
+                        if len(copy) > self.max_entry_bytes:
+                            # Too big to keep: stop copying and just pass it on.
+                            copy = None
+                            self.oversized += 1
+                    yield data
+
+            await stream(status, status_line, headers, tee())
+            if copy is not None:
+                stored_headers.append(("Content-Length", str(len(copy))))
+                result = CacheEntry(status_line, stored_headers, bytes(copy), now)
+                if self.store(key, result):
+                    return result, False
+
+            # Not shareable: waiters must not be handed another client's response.
+            self.remove(key)
+            result = None
+            return None, False
+        finally:
+            if self.pending.get(key) is future:
+                del self.pending[key]
+            # Waiters fall back to their own upstream fetch when this one failed.
+            future.set_result(result)
+
+    def stats(self):
+        lookups = self.hits + self.misses + self.revalidated
+        return {
+            'entries': len(self.entries),
+            'bytes': self.current_bytes,
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'revalidated': self.revalidated,
+            'collapsed': self.collapsed,
+            'stores': self.stores,
+            'oversized': self.oversized,
+            'evictions': self.evictions,
+            'bytes_served': self.bytes_served,
+            'hit_ratio': (self.hits + self.revalidated) / lookups if lookups else 0.0,
+        }
@@ -0,0 +1,268 @@
+import asyncio
+import functools
+import ipaddress
+import random
+import socket
+import struct
+import time
+from collections import OrderedDict
+
+
+class NameNotFound(OSError):
+    pass
+
+
+class SystemBackend:
+    '''
+    Resolves through getaddrinfo in the event loop's default executor. The
+    system resolver does not report TTLs, so every answer gets default_ttl.
+    '''
+
+    def __init__(self, default_ttl=60):
+        self.default_ttl = default_ttl
+
+    async def lookup(self, host):
+        loop = asyncio.get_running_loop()
+        try:
+            infos = await loop.getaddrinfo(host, None, type=socket.SOCK_STREAM)
+        except socket.gaierror as e:
+            if e.errno in (socket.EAI_NONAME, getattr(socket, 'EAI_NODATA', socket.EAI_NONAME)):
+                raise NameNotFound(f"{host} not found") from e
+            raise
+        addresses = []
+        for family, _, _, _, sockaddr in infos:
+            if sockaddr[0] not in addresses:
+                addresses.append(sockaddr[0])
+        return addresses, self.default_ttl
+
+
+class DnsClientProtocol(asyncio.DatagramProtocol):
+    def __init__(self):
+        self.transport = None
+        self.waiters = {}
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        if len(data) < 12:
+            return
+        waiter = self.waiters.pop(data[0] << 8 | data[1], None)
+        if waiter is not None and not waiter.done():
+            waiter.set_result(data)
+
+    def error_received(self, exc):
+        for waiter in self.waiters.values():
+            if not waiter.done():
+                waiter.set_exception(exc)
+        self.waiters.clear()
+
+
+def build_query(transaction_id, host, qtype=1):
+    query = bytearray(struct.pack('!HHHHHH', transaction_id, 0x0100, 1, 0, 0, 0))
+    for label in host.rstrip('.').split('.'):
+        encoded = label.encode('idna')
+        query.append(len(encoded))
+        query.extend(encoded)
+    query.extend(b'\x00')
+    query.extend(struct.pack('!HH', qtype, 1))
+    return bytes(query)
+
+
+def skip_name(data, index):
+    while True:
+        length = data[index]
+        if length == 0:
+            return index + 1
+        if length & 0xC0 == 0xC0:
+            return index + 2
+        index += length + 1
+
+
+def parse_answers(data):
+    '''
+    Returns (rcode, [(address, ttl), ...]) for the A and AAAA records in a
+    DNS response; compressed names are skipped, not followed.
+    '''
+    flags, qdcount, ancount = struct.unpack_from('!HHH', data, 2)
+    rcode = flags & 0x000F
+    if rcode:
+        return rcode, []
+
+    index = 12
+    for _ in range(qdcount):
+        index = skip_name(data, index) + 4
+
+    answers = []
+    for _ in range(ancount):
+        index = skip_name(data, index)
+        rtype, rclass, ttl, rdlength = struct.unpack_from('!HHIH', data, index)
+        index += 10
+        rdata = data[index:index + rdlength]
+        index += rdlength
+        if rtype == 1 and rdlength == 4:
+            answers.append((socket.inet_ntop(socket.AF_INET, rdata), ttl))
+        elif rtype == 28 and rdlength == 16:
+            answers.append((socket.inet_ntop(socket.AF_INET6, rdata), ttl))
+    return rcode, answers
+
+
+class UdpBackend:
+    '''
+    Sends A queries over UDP to a DNS server, for example the project's own
+    DNS resolver/dns_resolver.py, instead of using the system resolver.
+    '''
+
+    def __init__(self, server=('127.0.0.1', 5353), timeout=2.0, attempts=2):
+        self.server = server
+        self.timeout = timeout
+        self.attempts = attempts
+        self.protocol = None
+
+    async def connect(self):
+        if self.protocol is None or self.protocol.transport.is_closing():
+            loop = asyncio.get_running_loop()
+            _, self.protocol = await loop.create_datagram_endpoint(DnsClientProtocol, remote_addr=self.server)
+        return self.protocol
+
+    async def lookup(self, host):
+        protocol = await self.connect()
+        loop = asyncio.get_running_loop()
+        for attempt in range(self.attempts):
+            transaction_id = random.getrandbits(16)
+            while transaction_id in protocol.waiters:
+                transaction_id = random.getrandbits(16)
+
+            waiter = loop.create_future()
+            protocol.waiters[transaction_id] = waiter
+            protocol.transport.sendto(build_query(transaction_id, host))
+            try:
+                response = await asyncio.wait_for(waiter, self.timeout)
+            except asyncio.TimeoutError:
+                protocol.waiters.pop(transaction_id, None)
+                continue
+
+            rcode, answers = parse_answers(response)
+            if rcode == 3 or (rcode == 0 and not answers):
+                raise NameNotFound(f"{host} not found")
+            if rcode:
+                raise OSError(f"DNS server answered rcode {rcode} for {host}")
+            return [address for address, _ in answers], min(ttl for _, ttl in answers)
+        raise asyncio.TimeoutError(f"no DNS answer for {host} from {self.server[0]}:{self.server[1]}")
+
+
+class DnsCache:
+    '''
+    Caches host name lookups for the proxy. Answers are kept for their TTL
+    (clamped to min_ttl..max_ttl), names that do not exist for negative_ttl,
+    and at most max_entries names are kept, least recently used first out.
+    Concurrent lookups of the same name share one backend query.
+    '''
+
+    def __init__(self, backend=None, max_entries=4096, min_ttl=1, max_ttl=3600, negative_ttl=10):
+        self.backend = backend if backend is not None else SystemBackend()
+        self.max_entries = max_entries
+        self.min_ttl = min_ttl
+        self.max_ttl = max_ttl
+        self.negative_ttl = negative_ttl
+        self.entries = OrderedDict()
+        self.pending = {}
+
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.collapsed = 0
+        self.errors = 0
+        self.lookup_count = 0
+        self.lookup_seconds = 0.0
+        self.lookup_max_seconds = 0.0
+
+    async def resolve(self, host):
+        try:
+            ipaddress.ip_address(host)
+            return [host]
+        except ValueError:
+            pass
+
+        key = host.lower()
+        entry = self.entries.get(key)
+        if entry is not None:
+            addresses, expires_at = entry
+            if time.monotonic() < expires_at:
+                self.entries.move_to_end(key)
+                if addresses is None:
+                    self.negative_hits += 1
+                    raise NameNotFound(f"{host} not found (cached)")
+                self.hits += 1
+                return addresses
+            del self.entries[key]
+
+        task = self.pending.get(key)
+        if task is None:
+            self.misses += 1
+            task = asyncio.ensure_future(self.lookup(key))
+            self.pending[key] = task
+            task.add_done_callback(functools.partial(self.lookup_done, key))
+        else:
+            self.collapsed += 1
+        return await asyncio.shield(task)
+
+    def lookup_done(self, key, task):
+        if self.pending.get(key) is task:
+            del self.pending[key]
+        if not task.cancelled():
+            # Mark the exception as retrieved even if every waiter went away.
+            task.exception()
+
+    async def lookup(self, key):
+        started = time.perf_counter()
+        try:
+            addresses, ttl = await self.backend.lookup(key)
+        except NameNotFound:
+            self.store(key, None, self.negative_ttl)
+            raise
+        except Exception:
+            self.errors += 1
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            self.lookup_count += 1
+            self.lookup_seconds += elapsed
+            self.lookup_max_seconds = max(self.lookup_max_seconds, elapsed)
+
+        self.store(key, addresses, min(max(ttl, self.min_ttl), self.max_ttl))
+        return addresses
+
+    def store(self, key, addresses, ttl):
+        self.entries[key] = (addresses, time.monotonic() + ttl)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    async def open_connection(self, host, port, **kwargs):
+        '''
+        asyncio.open_connection with the name resolved through the cache;
+        the addresses are tried in order until one accepts.
+        '''
+        error = None
+        for address in await self.resolve(host):
+            try:
+                return await asyncio.open_connection(address, port, **kwargs)
+            except OSError as e:
+                error = e
+        raise error if error is not None else NameNotFound(f"{host} has no addresses")
+
+    def stats(self):
+        lookups = self.hits + self.negative_hits + self.misses + self.collapsed
+        return {
+            'entries': len(self.entries),
+            'hits': self.hits,
+            'negative_hits': self.negative_hits,
+            'misses': self.misses,
+            'collapsed': self.collapsed,
+            'errors': self.errors,
+            'hit_ratio': (self.hits + self.negative_hits) / lookups if lookups else 0.0,
+            'backend_lookups': self.lookup_count,
+            'avg_lookup_ms': 1000 * self.lookup_seconds / self.lookup_count if self.lookup_count else 0.0,
+            'max_lookup_ms': 1000 * self.lookup_max_seconds,
+        }
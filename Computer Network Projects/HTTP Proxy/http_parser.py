@@ -0,0 +1,319 @@
+import asyncio
+
+
+HOP_BY_HOP_HEADERS = {
+    'connection', 'keep-alive', 'proxy-connection', 'proxy-authenticate',
+    'proxy-authorization', 'te', 'trailer', 'transfer-encoding', 'upgrade',
+}
+
+CHUNK_SIZE = 65536
+
+
+def parse_head(data):
+    head = data.partition(b'\r\n\r\n')[0].decode('latin-1')
+    lines = head.split('\r\n')
+    headers = []
+    for line in lines[1:]:
+        name, sep, value = line.partition(':')
+        if sep:
+            headers.append((name.strip(), value.strip()))
+    return lines[0], headers
+
+
+class RequestHead:
+    '''
+    A parsed request line and header block. host, port and path are resolved
+    once from whichever request-target form the client used: absolute-form
+    (GET http://host:port/path), origin-form plus a Host header (GET /path) or
+    authority-form (CONNECT host:port).
+    '''
+    __slots__ = ('method', 'target', 'version', 'headers', 'form', 'host', 'port', 'path')
+
+    def header(self, name):
+        return header_value(self.headers, name)
+
+    @property
+    def url(self):
+        host = f"[{self.host}]" if ':' in self.host else self.host
+        authority = host if self.port == 80 else f"{host}:{self.port}"
+        return f"http://{authority}{self.path}"
+
+    @property
+    def origin_line(self):
+        return f"{self.method} {self.path} {self.version}"
+
+
+def split_authority(authority, default_port):
+    if authority.startswith('['):
+        end = authority.index(']')
+        host, rest = authority[1:end], authority[end + 1:]
+        return host, int(rest[1:]) if rest.startswith(':') else default_port
+    host, sep, port = authority.partition(':')
+    if not host:
+        raise ValueError(f"missing host in {authority!r}")
+    return host, int(port) if sep and port else default_port
+
+
+def parse_request_head(data):
+    '''
+    Parses a complete request head (request line, headers and the blank line)
+    from bytes or a bytearray. The head is decoded once and every line is
+    split exactly once; raises ValueError on malformed input.
+    '''
+    end = data.find(b'\r\n\r\n')
+    text = str(data[:end if end != -1 else len(data)], 'latin-1')
+    lines = text.split('\r\n')
+
+    request = RequestHead()
+    parts = lines[0].split(' ')
+    if len(parts) != 3 or not parts[2].startswith('HTTP/'):
+        raise ValueError(f"malformed request line {lines[0]!r}")
+    request.method, request.target, request.version = parts
+
+    headers = []
+    host_header = None
+    for line in lines[1:]:
+        name, sep, value = line.partition(':')
+        if not sep:
+            raise ValueError(f"malformed header line {line!r}")
+        value = value.strip()
+        headers.append((name, value))
+        if host_header is None and len(name) == 4 and name.lower() == 'host':
+            host_header = value
+    request.headers = headers
+
+    target = request.target
+    if request.method == 'CONNECT':
+        request.form = 'authority'
+        request.host, request.port = split_authority(target, 443)
+        request.path = ''
+    elif target.startswith('/') or target == '*':
+        if host_header is None:
+            raise ValueError("origin-form request without a Host header")
+        request.form = 'origin'
+        request.host, request.port = split_authority(host_header, 80)
+        request.path = target
+    else:
+        scheme, sep, rest = target.partition('://')
+        if not sep or scheme.lower() != 'http':
+            raise ValueError(f"unsupported request target {target!r}")
+        request.form = 'absolute'
+        slash = rest.find('/')
+        authority, request.path = (rest, '/') if slash == -1 else (rest[:slash], rest[slash:])
+        request.host, request.port = split_authority(authority, 80)
+    return request
+
+
+def header_value(headers, name):
+    for key, value in headers:
+        if key.lower() == name:
+            return value
+    return None
+
+
+def connection_tokens(headers):
+    tokens = set()
+    for key, value in headers:
+        if key.lower() in ('connection', 'proxy-connection'):
+            tokens.update(token.strip().lower() for token in value.split(','))
+    return tokens
+
+
+def strip_hop_by_hop(headers):
+    '''
+    Drops the headers that only apply to a single connection, including any
+    extra names the sender listed in its Connection header.
+    '''
+    drop = HOP_BY_HOP_HEADERS | connection_tokens(headers)
+    return [(key, value) for key, value in headers if key.lower() not in drop]
+
+
+def serialize_head(first_line, headers):
+    lines = [first_line]
+    lines.extend(f"{key}: {value}" for key, value in headers)
+    return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
+
+
+def wants_keep_alive(version, headers):
+    tokens = connection_tokens(headers)
+    if version == 'HTTP/1.1':
+        return 'close' not in tokens
+    return 'keep-alive' in tokens
+
+
+def is_chunked(headers):
+    value = header_value(headers, 'transfer-encoding')
+    return value is not None and value.lower().rsplit(',', 1)[-1].strip() == 'chunked'
+
+
+def request_body_framing(headers):
+    '''
+    Returns 'chunked' or the length of a request body. Raises ValueError
+    for framing that cannot be relayed safely (RFC 7230 section 3.3.3): a
+    Transfer-Encoding that does not end in chunked, one together with a
+    Content-Length, or a Content-Length that is not a decimal number or is
+    repeated with different values.
+    '''
+    lengths = {length.strip() for key, value in headers if key.lower() == 'content-length'
+               for length in value.split(',')}
+    if header_value(headers, 'transfer-encoding') is not None:
+        if lengths:
+            raise ValueError("both Transfer-Encoding and Content-Length")
+        if not is_chunked(headers):
+            raise ValueError("request body is not chunked last")
+        return 'chunked'
+    if not lengths:
+        return 0
+    if len(lengths) > 1:
+        raise ValueError("conflicting Content-Length values")
+    length = lengths.pop()
+    if not (length.isascii() and length.isdigit()):
+        raise ValueError(f"bad Content-Length {length!r}")
+    return int(length)
+
+
+def response_body_framing(method, status, headers):
+    '''
+    Returns 'chunked', a byte count, or None when the body runs until the
+    server closes the connection (RFC 7230 section 3.3.3).
+    '''
+    if method == 'HEAD' or status < 200 or status in (204, 304):
+        return 0
+    if is_chunked(headers):
+        return 'chunked'
+    length = header_value(headers, 'content-length')
+    if length is not None:
+        return int(length)
+    return None
+
+
+async def read_head(reader):
+    '''
+    Reads one message head up to and including the blank line, however many
+    TCP segments it arrives in. StreamReader.readuntil keeps the head in its
+    own buffer and resumes the search where the previous read stopped, so a
+    head split across reads is not rescanned from the start.
+    Returns b'' if the peer closed cleanly first.
+    '''
+    try:
+        return await reader.readuntil(b'\r\n\r\n')
+    except asyncio.IncompleteReadError as e:
+        if e.partial.strip():
+            raise
+        return b''
+
+
+async def relay_body(reader, writer, framing, touch=None):
+    '''
+    Copies one message body from reader to writer and returns the number of
+    bytes written, chunk framing included. touch() is called whenever data
+    moves, for idle timeouts.
+    '''
+    if framing == 'chunked':
+        return await relay_chunked(reader, writer, touch)
+
+    relayed = 0
+    if framing is None:
+        while True:
+            data = await reader.read(CHUNK_SIZE)
+            if not data:
+                break
+            relayed += len(data)
+            writer.write(data)
+            if touch is not None:
+                touch()
+            await writer.drain()
+    else:
+        remaining = framing
+        while remaining:
+            data = await reader.read(min(remaining, CHUNK_SIZE))
+            if not data:
+                raise asyncio.IncompleteReadError(b'', remaining)
+            remaining -= len(data)
+            relayed += len(data)
+            writer.write(data)
+            if touch is not None:
+                touch()
+            await writer.drain()
+    return relayed
+
+
+async def relay_chunked(reader, writer, touch=None):
+    relayed = 0
+    while True:
+        line = await reader.readuntil(b'\r\n')
+        relayed += len(line)
+        writer.write(line)
+        size = int(line.split(b';', 1)[0], 16)
+        if size == 0:
+            break
+        remaining = size + 2
+        relayed += remaining
+        while remaining:
+            data = await reader.read(min(remaining, CHUNK_SIZE))
+            if not data:
+                raise asyncio.IncompleteReadError(b'', remaining)
+            remaining -= len(data)
+            writer.write(data)
+        if touch is not None:
+            touch()
+        await writer.drain()
+
+    while True:
+        trailer = await reader.readuntil(b'\r\n')
+        relayed += len(trailer)
+        writer.write(trailer)
+        if trailer == b'\r\n':
+            break
+    await writer.drain()
+    return relayed
+
+
+async def iter_body(reader, framing, touch=None):
+    '''
+    Yields one message body as it arrives, in pieces of at most CHUNK_SIZE
+    bytes and with the chunked transfer coding removed, so a body of any
+    size passes through in bounded memory. touch() is called for every
+    piece, for idle timeouts.
+    '''
+    if framing == 'chunked':
+        while True:
+            line = await reader.readuntil(b'\r\n')
+            remaining = int(line.split(b';', 1)[0], 16)
+            if remaining == 0:
+                break
+            while remaining:
+                data = await reader.read(min(remaining, CHUNK_SIZE))
+                if not data:
+                    raise asyncio.IncompleteReadError(b'', remaining)
+                remaining -= len(data)
+                if touch is not None:
+                    touch()
+                yield data
+            await reader.readexactly(2)
+        while await reader.readuntil(b'\r\n') != b'\r\n':
+            pass
+        return
+
+    remaining = framing
+    while remaining is None or remaining:
+        data = await reader.read(CHUNK_SIZE if remaining is None else min(remaining, CHUNK_SIZE))
+        if not data:
+            if remaining is None:
+                break
+            raise asyncio.IncompleteReadError(b'', remaining)
+        if remaining is not None:
+            remaining -= len(data)
+        if touch is not None:
+            touch()
+        yield data
+
+
+async def read_body(reader, framing):
+    '''
+    Reads a whole body into memory, removing the chunked transfer coding.
+    '''
+    body = bytearray()
+    async for data in iter_body(reader, framing):
+        body += data
+    return bytes(body)
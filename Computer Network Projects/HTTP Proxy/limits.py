@@ -0,0 +1,115 @@
+import asyncio
+
+
+class Limits:
+    '''
+    Per-connection limits applied by MyProxy. Timeouts are in seconds and
+    None disables them: connect_timeout bounds opening an upstream
+    connection, idle_timeout closes a client connection (and its tunnel or
+    upstream) when no data moved in either direction for that long, and
+    total_timeout caps the lifetime of a client connection. The water marks
+    are passed to set_write_buffer_limits on every StreamWriter so a slow
+    reader pauses the relay instead of growing its write buffer.
+    '''
+
+    def __init__(self, connect_timeout=10.0, idle_timeout=300.0, total_timeout=None,
+                 write_high_water=64 * 1024, write_low_water=16 * 1024):
+        self.connect_timeout = connect_timeout
+        self.idle_timeout = idle_timeout
+        self.total_timeout = total_timeout
+        self.write_high_water = write_high_water
+        self.write_low_water = write_low_water
+
+    def apply(self, writer):
+        writer.transport.set_write_buffer_limits(high=self.write_high_water, low=self.write_low_water)
+
+
+class ConnectionLimiter:
+    '''
+    Counts open client connections, globally and per client IP, so that
+    handle_client can turn away connections over the limit before reading
+    anything from them.
+    '''
+
+    def __init__(self, max_connections=None, max_per_ip=None):
+        self.max_connections = max_connections
+        self.max_per_ip = max_per_ip
+        self.active = 0
+        self.per_ip = {}
+        self.rejected = 0
+
+    def try_acquire(self, ip):
+        count = self.per_ip.get(ip, 0)
+        if ((self.max_connections is not None and self.active >= self.max_connections)
+                or (self.max_per_ip is not None and count >= self.max_per_ip)):
+            self.rejected += 1
+            return False
+        self.active += 1
+        self.per_ip[ip] = count + 1
+        return True
+
+    def release(self, ip):
+        self.active -= 1
+        count = self.per_ip[ip] - 1
+        if count:
+            self.per_ip[ip] = count
+        else:
+            del self.per_ip[ip]
+
+    def stats(self):
+        return {
+            'active': self.active,
+            'client_ips': len(self.per_ip),
+            'rejected': self.rejected,
+        }
+
+
+class IdleTimer:
+    '''
+    One timer per client connection instead of a timeout around every read.
+    The relay loops call touch() whenever data moves, which only sets a flag;
+    the timer wakes up once per idle_timeout and calls on_expire('idle') if
+    the flag was not set since the last wake-up, so an idle connection is
+    closed after between one and two idle_timeout periods. on_expire('total')
+    is called once total_timeout has passed regardless of activity.
+    '''
+
+    def __init__(self, idle_timeout, total_timeout, on_expire):
+        self.loop = asyncio.get_running_loop()
+        self.idle_timeout = idle_timeout
+        self.on_expire = on_expire
+        self.deadline = self.loop.time() + total_timeout if total_timeout is not None else None
+        self.busy = False
+        self.expired = None
+        self.handle = None
+        self.schedule(self.loop.time())
+
+    def touch(self):
+        self.busy = True
+
+    def schedule(self, now):
+        when = now + self.idle_timeout if self.idle_timeout is not None else None
+        if self.deadline is not None and (when is None or self.deadline < when):
+            when = self.deadline
+        if when is not None:
+            self.handle = self.loop.call_at(when, self.check)
+
+    def check(self):
+        now = self.loop.time()
+        if self.deadline is not None and now >= self.deadline:
+            self.expire('total')
+        elif self.busy or self.idle_timeout is None:
+            self.busy = False
+            self.schedule(now)
+        else:
+            self.expire('idle')
+
+    def expire(self, reason):
+        self.expired = reason
+        self.handle = None
+        self.on_expire(reason)
+
+    def cancel(self):
+        if self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
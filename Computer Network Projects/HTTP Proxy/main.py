@@ -1,29 +1,263 @@
+import argparse
 import asyncio
+import os
+import signal
+import socket
+import time
 from proxy import MyProxy
+from cache import HttpCache
+from pool import UpstreamPool
+from relay import ENGINES, TunnelRelay
+from dns_cache import DnsCache, SystemBackend, UdpBackend
+from metrics import AccessLog, ProxyMetrics, start_admin_server
+from limits import ConnectionLimiter, Limits
 import sys
 
+cache = HttpCache()
+resolver = DnsCache()
+pool = UpstreamPool(connect=resolver.open_connection)
+tunnel = None
+metrics = ProxyMetrics()
+metrics.registry.add_stats('proxy_cache', cache.stats)
+metrics.registry.add_stats('proxy_pool', pool.stats)
+metrics.registry.add_stats('proxy_dns', resolver.stats)
+access_log = None
+limits = Limits()
+limiter = ConnectionLimiter()
+metrics.registry.add_stats('proxy_limits', limiter.stats)
+active_clients = set()
 
-async def start_connection():
-    host = '127.0.0.1'
-    port = 12345
+SERVICE_UNAVAILABLE = b"HTTP/1.1 503 Service Unavailable\r\nContent-Length: 0\r\nRetry-After: 1\r\nConnection: close\r\n\r\n"
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="HTTP/HTTPS proxy")
+    parser.add_argument('--host', default=os.environ.get('PROXY_HOST', '127.0.0.1'))
+    parser.add_argument('--port', type=int, default=int(os.environ.get('PROXY_PORT', 12345)))
+    parser.add_argument('--workers', type=int, default=int(os.environ.get('PROXY_WORKERS', 1)),
+                        help="number of worker processes; more than 1 starts a supervisor")
+    parser.add_argument('--backlog', type=int, default=1024)
+    parser.add_argument('--relay', choices=ENGINES, default='stream',
+                        help="how CONNECT tunnels move data: asyncio streams, a reusable recv_into buffer, or os.splice")
+    parser.add_argument('--relay-buffer-size', type=int, default=256 * 1024)
+    parser.add_argument('--dns', choices=('system', 'udp'), default='system',
+                        help="resolve upstream names with getaddrinfo or by querying --dns-server over UDP")
+    parser.add_argument('--dns-server', default='127.0.0.1:5353',
+                        help="host:port of the DNS server used by --dns udp, e.g. DNS resolver/dns_resolver.py")
+    parser.add_argument('--dns-cache-size', type=int, default=4096)
+    parser.add_argument('--admin-port', type=int, default=None,
+                        help="serve Prometheus metrics at /metrics on this port (worker N uses admin port + N)")
+    parser.add_argument('--access-log', default=None,
+                        help="write JSON access log lines to this file ('-' for stdout)")
+    parser.add_argument('--drain-timeout', type=float, default=30.0,
+                        help="seconds to wait for in-flight connections on shutdown")
+    parser.add_argument('--connect-timeout', type=float, default=10.0,
+                        help="seconds to wait for an upstream connection before answering 504")
+    parser.add_argument('--idle-timeout', type=float, default=300.0,
+                        help="close client connections and tunnels with no traffic for this many seconds")
+    parser.add_argument('--total-timeout', type=float, default=None,
+                        help="close client connections open for longer than this many seconds")
+    parser.add_argument('--max-connections', type=int, default=None,
+                        help="answer 503 to new clients while this many connections are open")
+    parser.add_argument('--max-connections-per-ip', type=int, default=None,
+                        help="answer 503 to a client IP that already has this many connections open")
+    parser.add_argument('--write-high-water', type=int, default=64 * 1024,
+                        help="pause relaying once this many bytes wait to be written to a peer")
+    parser.add_argument('--write-low-water', type=int, default=16 * 1024)
+    parser.add_argument('--read-buffer', type=int, default=64 * 1024,
+                        help="StreamReader buffer limit per connection, also the largest request head accepted")
+    return parser.parse_args(argv)
+
+
+def create_listening_socket(host, port, backlog, reuse_port):
+    family = socket.AF_INET6 if ':' in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    sock.setblocking(False)
+    return sock
+
+
+async def start_connection(args, sock=None, worker_index=0):
+    host = args.host
+    port = args.port
 
     try:
+        if sock is None:
+            sock = create_listening_socket(host, port, args.backlog, args.workers > 1)
         server = await asyncio.start_server(
-            handle_client, host, port
+            handle_client, sock=sock, limit=args.read_buffer
         )
-
-        async with server:
-            await server.serve_forever()
+        admin = None
+        if args.admin_port is not None:
+            admin = await start_admin_server(metrics.registry, host, args.admin_port + worker_index)
     except Exception as e:
         print("Failed to initialize socket:", e)
         sys.exit(2)
 
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop.set)
+
+    prune_task = asyncio.create_task(pool.prune_forever())
+    print(f"Proxy worker {os.getpid()} listening on {host}:{port}")
+
+    await stop.wait()
+    await drain(server, args.drain_timeout)
+    prune_task.cancel()
+    if admin is not None:
+        admin.close()
+    if access_log is not None:
+        access_log.close()
+
+
+async def drain(server, timeout):
+    '''
+    Stops accepting new clients and gives the ones still connected (open
+    CONNECT tunnels included) up to timeout seconds to finish.
+    '''
+    server.close()
+    if active_clients:
+        print(f"Worker {os.getpid()} draining {len(active_clients)} connections")
+        _, pending = await asyncio.wait(set(active_clients), timeout=timeout)
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+    # From Python 3.12 wait_closed() also waits for every client connection
+    # to close, so it is bounded as well.
+    try:
+        await asyncio.wait_for(server.wait_closed(), timeout)
+    except asyncio.TimeoutError:
+        print(f"Worker {os.getpid()} gave up waiting for connections to close")
+
 
 async def handle_client(reader, writer):
-    data = await reader.read(8192)
-    p = MyProxy(reader, writer, data)
-    await p.handle_request()
+    peer = writer.get_extra_info('peername')
+    ip = peer[0] if peer else None
+    if not limiter.try_acquire(ip):
+        # Turned away before reading anything; close() flushes the answer.
+        writer.write(SERVICE_UNAVAILABLE)
+        writer.close()
+        return
+
+    task = asyncio.current_task()
+    active_clients.add(task)
+    try:
+        p = MyProxy(reader, writer, cache=cache, pool=pool, tunnel=tunnel, resolver=resolver,
+                    metrics=metrics, access_log=access_log, limits=limits)
+        await p.serve()
+    finally:
+        active_clients.discard(task)
+        limiter.release(ip)
+
+
+def spawn_worker(args, sock, worker_index):
+    pid = os.fork()
+    if pid:
+        return pid
+
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    code = 0
+    try:
+        worker_sock = sock if sock is not None else create_listening_socket(args.host, args.port, args.backlog, True)
+        configure_logging(args)
+        asyncio.run(start_connection(args, worker_sock, worker_index))
+    except SystemExit as e:
+        code = e.code if isinstance(e.code, int) else 1
+    except BaseException as e:
+        print(f"Worker {os.getpid()} crashed:", e)
+        code = 1
+    finally:
+        os._exit(code)
+
+
+def supervise(args):
+    '''
+    Runs args.workers worker processes on the same port and restarts any that
+    exit. Each worker binds its own SO_REUSEPORT socket so the kernel spreads
+    new connections between them; where SO_REUSEPORT is missing the workers
+    share one listening socket created here before forking.
+    '''
+    sock = None
+    if not hasattr(socket, 'SO_REUSEPORT'):
+        sock = create_listening_socket(args.host, args.port, args.backlog, False)
+
+    shutting_down = False
+
+    def request_shutdown(signum, frame):
+        nonlocal shutting_down
+        shutting_down = True
+        for pid in workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, request_shutdown)
+    signal.signal(signal.SIGINT, request_shutdown)
+
+    workers = {}
+    for index in range(args.workers):
+        workers[spawn_worker(args, sock, index)] = (index, time.monotonic())
+    print(f"Supervisor {os.getpid()} started {args.workers} workers on {args.host}:{args.port}")
+
+    while workers:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        worker = workers.pop(pid, None)
+        if worker is None or shutting_down:
+            continue
+        index, started = worker
+
+        print(f"Worker {pid} exited with status {os.waitstatus_to_exitcode(status)}, restarting")
+        if time.monotonic() - started < 1.0:
+            # Crashing straight after start: do not fork in a tight loop.
+            time.sleep(1.0)
+        if not shutting_down:
+            workers[spawn_worker(args, sock, index)] = (index, time.monotonic())
+
+
+def configure(args):
+    global tunnel, limits
+    if args.relay != 'stream':
+        tunnel = TunnelRelay(args.relay, args.relay_buffer_size)
+
+    if args.dns == 'udp':
+        dns_host, _, dns_port = args.dns_server.rpartition(':')
+        resolver.backend = UdpBackend((dns_host.strip('[]'), int(dns_port)))
+    else:
+        resolver.backend = SystemBackend()
+    resolver.max_entries = args.dns_cache_size
+
+    limits = Limits(args.connect_timeout, args.idle_timeout, args.total_timeout,
+                    args.write_high_water, args.write_low_water)
+    pool.connect_timeout = args.connect_timeout
+    limiter.max_connections = args.max_connections
+    limiter.max_per_ip = args.max_connections_per_ip
+
+
+def configure_logging(args):
+    '''
+    Starts the access log writer thread. Called in each worker after the
+    fork, since threads do not survive it.
+    '''
+    global access_log
+    if args.access_log is not None:
+        access_log = AccessLog(args.access_log)
 
 
 if __name__ == '__main__':
-    asyncio.run(start_connection())
+    args = parse_args()
+    configure(args)
+    if args.workers > 1:
+        supervise(args)
+    else:
+        configure_logging(args)
+        asyncio.run(start_connection(args))
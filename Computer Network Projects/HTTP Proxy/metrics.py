@@ -0,0 +1,218 @@
+import asyncio
+import json
+import queue
+import sys
+import threading
+import time
+from bisect import bisect_left
+
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+
+def format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{value}"' for name, value in pairs) + '}'
+
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.values = {}
+
+    def inc(self, amount=1, labels=()):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self):
+        for labels, value in self.values.items():
+            yield f"{self.name}{format_labels(self.labelnames, labels)} {value}"
+
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def set(self, value, labels=()):
+        self.values[labels] = value
+
+    def dec(self, amount=1, labels=()):
+        self.inc(-amount, labels)
+
+
+class Histogram:
+    '''
+    Fixed-bucket histogram: observing a value is a bisect and two additions,
+    cumulative bucket counts are only computed when the metrics are scraped.
+    '''
+    kind = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.buckets = buckets
+        self.values = {}
+
+    def observe(self, value, labels=()):
+        series = self.values.get(labels)
+        if series is None:
+            series = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def render(self):
+        for labels, (counts, total) in self.values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                yield f"{self.name}_bucket{format_labels(self.labelnames, labels, [('le', bound)])} {cumulative}"
+            cumulative += counts[-1]
+            yield f"{self.name}_bucket{format_labels(self.labelnames, labels, [('le', '+Inf')])} {cumulative}"
+            yield f"{self.name}_sum{format_labels(self.labelnames, labels)} {total}"
+            yield f"{self.name}_count{format_labels(self.labelnames, labels)} {cumulative}"
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+        self.collectors = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def add_stats(self, prefix, stats):
+        '''
+        Exports a stats() callable (HttpCache, UpstreamPool, DnsCache) as one
+        gauge per key, read at scrape time.
+        '''
+        self.collectors.append((prefix, stats))
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.render())
+        for prefix, stats in self.collectors:
+            for key, value in stats().items():
+                lines.append(f"# TYPE {prefix}_{key} gauge")
+                lines.append(f"{prefix}_{key} {value}")
+        return '\n'.join(lines) + '\n'
+
+
+class RequestStats:
+    '''
+    Filled in by MyProxy while it handles one request; phases that did not
+    happen (no upstream connection for a cache hit, say) stay None.
+    '''
+    __slots__ = ('client', 'kind', 'method', 'host', 'port', 'path', 'status', 'cache',
+                 'bytes_up', 'bytes_down', 'started', 'client_read', 'upstream_connect',
+                 'ttfb', 'relay', 'duration', 'error')
+
+    def __init__(self, client):
+        self.client = client
+        self.kind = self.method = self.host = self.port = self.path = None
+        self.status = self.cache = self.error = None
+        self.bytes_up = self.bytes_down = 0
+        self.started = time.perf_counter()
+        self.client_read = self.upstream_connect = self.ttfb = self.relay = self.duration = None
+
+    def as_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__ if name != 'started'}
+
+
+class ProxyMetrics:
+    PHASES = ('client_read', 'upstream_connect', 'ttfb', 'relay')
+
+    def __init__(self, registry=None):
+        self.registry = registry if registry is not None else Registry()
+        register = self.registry.register
+        self.requests = register(Counter('proxy_requests_total', "Requests handled", ('kind', 'status')))
+        self.errors = register(Counter('proxy_errors_total', "Requests that failed with an exception", ('kind',)))
+        self.bytes = register(Counter('proxy_bytes_total', "Payload bytes relayed", ('direction',)))
+        self.phases = register(Histogram('proxy_phase_seconds', "Time spent in each request phase", ('phase',)))
+        self.durations = register(Histogram('proxy_request_duration_seconds', "Total request duration", ('kind',)))
+        self.connections = register(Gauge('proxy_client_connections', "Open client connections"))
+        self.tunnels = register(Gauge('proxy_open_tunnels', "Open CONNECT tunnels"))
+
+    def record(self, stats):
+        kind = stats.kind or 'unknown'
+        self.requests.inc(1, (kind, str(stats.status) if stats.status is not None else 'none'))
+        if stats.error is not None:
+            self.errors.inc(1, (kind,))
+        self.bytes.inc(stats.bytes_up, ('upstream',))
+        self.bytes.inc(stats.bytes_down, ('downstream',))
+        for phase in self.PHASES:
+            value = getattr(stats, phase)
+            if value is not None:
+                self.phases.observe(value, (phase,))
+        if stats.duration is not None:
+            self.durations.observe(stats.duration, (kind,))
+
+
+class AccessLog:
+    '''
+    Structured (JSON lines) access log. write() only puts the record on a
+    queue; a background thread serializes it and does the blocking file I/O,
+    so logging never stalls the event loop.
+    '''
+
+    def __init__(self, path='-'):
+        self.path = path
+        self.queue = queue.SimpleQueue()
+        self.thread = threading.Thread(target=self.run, name='access-log', daemon=True)
+        self.thread.start()
+
+    def write(self, stats):
+        self.queue.put(stats.as_dict())
+
+    def run(self):
+        stream = sys.stdout if self.path == '-' else open(self.path, 'a', buffering=1)
+        try:
+            while True:
+                record = self.queue.get()
+                if record is None:
+                    break
+                stream.write(json.dumps(record) + '\n')
+        finally:
+            if stream is not sys.stdout:
+                stream.close()
+            else:
+                stream.flush()
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+
+
+async def start_admin_server(registry, host, port):
+    '''
+    Serves the registry in the Prometheus text format at GET /metrics.
+    '''
+    async def handle(reader, writer):
+        try:
+            head = await reader.readuntil(b'\r\n\r\n')
+            parts = head.split(b' ', 2)
+            if len(parts) >= 2 and parts[0] == b'GET' and parts[1].split(b'?')[0] == b'/metrics':
+                body = registry.render().encode()
+                status = b"200 OK"
+                content_type = b"text/plain; version=0.0.4"
+            else:
+                body = b"not found\n"
+                status = b"404 Not Found"
+                content_type = b"text/plain"
+            writer.write(b"HTTP/1.1 " + status + b"\r\nContent-Type: " + content_type +
+                         b"\r\nContent-Length: " + str(len(body)).encode() + b"\r\nConnection: close\r\n\r\n" + body)
+            await writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(handle, host, port)
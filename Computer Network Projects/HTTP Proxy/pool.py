@@ -0,0 +1,159 @@
+import asyncio
+import time
+from collections import deque
+
+
+class PooledConnection:
+    __slots__ = ('key', 'reader', 'writer', 'idle_since', 'uses')
+
+    def __init__(self, key, reader, writer):
+        self.key = key
+        self.reader = reader
+        self.writer = writer
+        self.idle_since = 0.0
+        self.uses = 0
+
+    def is_usable(self):
+        return not self.writer.is_closing() and not self.reader.at_eof()
+
+
+class UpstreamPool:
+    '''
+    Keeps idle keep-alive connections to upstream servers, keyed by
+    (host, port). max_per_host caps the connections open to one server at a
+    time (busy and idle), max_idle_per_host and max_idle cap how many idle
+    ones are kept around, and connections idle for longer than idle_timeout
+    are closed instead of being reused. New connections are opened with
+    connect(host, port), asyncio.open_connection by default, and given up
+    on with asyncio.TimeoutError after connect_timeout seconds.
+    '''
+
+    def __init__(self, max_per_host=32, max_idle_per_host=8, max_idle=256, idle_timeout=30.0, connect=None,
+                 connect_timeout=None):
+        self.connect = connect if connect is not None else asyncio.open_connection
+        self.connect_timeout = connect_timeout
+        self.max_per_host = max_per_host
+        self.max_idle_per_host = max_idle_per_host
+        self.max_idle = max_idle
+        self.idle_timeout = idle_timeout
+
+        self.idle = {}
+        self.open_count = {}
+        self.waiters = {}
+        self.idle_count = 0
+
+        self.opened = 0
+        self.reused = 0
+        self.closed = 0
+
+    async def acquire(self, host, port):
+        key = (host, port)
+        while True:
+            conn = self.pop_idle(key)
+            if conn is not None:
+                conn.uses += 1
+                self.reused += 1
+                return conn
+
+            if self.open_count.get(key, 0) < self.max_per_host:
+                self.open_count[key] = self.open_count.get(key, 0) + 1
+                try:
+                    reader, writer = await asyncio.wait_for(self.connect(host, port), self.connect_timeout)
+                except BaseException:
+                    self.forget(key)
+                    raise
+                self.opened += 1
+                conn = PooledConnection(key, reader, writer)
+                conn.uses = 1
+                return conn
+
+            waiter = asyncio.get_running_loop().create_future()
+            self.waiters.setdefault(key, deque()).append(waiter)
+            try:
+                await waiter
+            finally:
+                waiters = self.waiters.get(key)
+                if waiters is not None and waiter in waiters:
+                    waiters.remove(waiter)
+
+    def release(self, conn, reusable):
+        key = conn.key
+        idle = self.idle.setdefault(key, deque())
+        if reusable and conn.is_usable() and len(idle) < self.max_idle_per_host:
+            if self.idle_count >= self.max_idle:
+                self.evict_oldest()
+            conn.idle_since = time.monotonic()
+            idle.append(conn)
+            self.idle_count += 1
+            self.wake(key)
+        else:
+            self.close(conn)
+
+    def pop_idle(self, key):
+        idle = self.idle.get(key)
+        now = time.monotonic()
+        while idle:
+            # Most recently used first: it is the least likely to have been
+            # closed by the server in the meantime.
+            conn = idle.pop()
+            self.idle_count -= 1
+            if conn.is_usable() and now - conn.idle_since < self.idle_timeout:
+                return conn
+            self.close(conn)
+        return None
+
+    def evict_oldest(self):
+        oldest = None
+        for idle in self.idle.values():
+            if idle and (oldest is None or idle[0].idle_since < oldest.idle_since):
+                oldest = idle[0]
+        if oldest is not None:
+            self.idle[oldest.key].popleft()
+            self.idle_count -= 1
+            self.close(oldest)
+
+    def close(self, conn):
+        if not conn.writer.is_closing():
+            conn.writer.close()
+        self.closed += 1
+        self.forget(conn.key)
+
+    def forget(self, key):
+        self.open_count[key] -= 1
+        if not self.open_count[key]:
+            del self.open_count[key]
+            if not self.idle.get(key):
+                self.idle.pop(key, None)
+        self.wake(key)
+
+    def wake(self, key):
+        waiters = self.waiters.get(key)
+        while waiters:
+            waiter = waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                break
+        if not waiters:
+            self.waiters.pop(key, None)
+
+    def prune(self):
+        now = time.monotonic()
+        for key in list(self.idle):
+            idle = self.idle[key]
+            while idle and (now - idle[0].idle_since >= self.idle_timeout or not idle[0].is_usable()):
+                self.idle_count -= 1
+                self.close(idle.popleft())
+
+    async def prune_forever(self, interval=5.0):
+        while True:
+            await asyncio.sleep(interval)
+            self.prune()
+
+    def stats(self):
+        return {
+            'open': sum(self.open_count.values()),
+            'idle': self.idle_count,
+            'opened': self.opened,
+            'reused': self.reused,
+            'closed': self.closed,
+        }
@@ -1,91 +1,454 @@
 import asyncio
 import socket
+import time
+
+from cache import request_bypasses_cache, request_forces_revalidation
+from limits import IdleTimer, Limits
+from metrics import RequestStats
+from http_parser import (iter_body, parse_head, parse_request_head, read_head, relay_body,
+                         serialize_head, strip_hop_by_hop, wants_keep_alive, request_body_framing, response_body_framing)
+
+CONDITIONAL_HEADERS = {'if-none-match', 'if-modified-since', 'if-match', 'if-unmodified-since', 'if-range'}
+
+RETRYABLE_METHODS = {'GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'}
 
 
 class MyProxy:
-    def __init__(self, reader, writer, data):
+    def __init__(self, reader, writer, data=b'', cache=None, pool=None, tunnel=None, resolver=None,
+                 metrics=None, access_log=None, limits=None):
         self.reader = reader
         self.writer = writer
         self.data = data
+        self.request = None
+        self.cache = cache
+        self.pool = pool
+        self.tunnel = tunnel
+        self.resolver = resolver
+        self.metrics = metrics
+        self.access_log = access_log
+        self.limits = limits if limits is not None else Limits()
+        self.timer = None
+        self.peer = writer.get_extra_info('peername')
+        self.stats = RequestStats(self.peer)
 
-    async def handle_request(self):
+    async def serve(self):
+        '''
+        Handles the requests of one client connection in turn for as long as
+        both sides keep the connection alive, or until the connection has
+        been idle or open for longer than the limits allow.
+        '''
+        if self.metrics is not None:
+            self.metrics.connections.inc()
+        self.limits.apply(self.writer)
+        task = asyncio.current_task()
+        self.timer = IdleTimer(self.limits.idle_timeout, self.limits.total_timeout, lambda reason: task.cancel())
+        served = 0
         try:
-            first_line = self.data.split(b'\n')[0].decode()
-            method = first_line.split(' ')[0]
+            while True:
+                self.stats = stats = RequestStats(self.peer)
+                if not self.data:
+                    self.data = await read_head(self.reader)
+                    if not self.data:
+                        break
+                self.touch()
+                if served:
+                    # Time spent waiting on an idle keep-alive connection is
+                    # not part of the request.
+                    stats.started = time.perf_counter()
+                else:
+                    stats.client_read = time.perf_counter() - stats.started
+                served += 1
+
+                try:
+                    self.request = parse_request_head(self.data)
+                except ValueError as e:
+                    print("Malformed client request:", e)
+                    self.writer.write(b"HTTP/1.1 400 Bad Request\r\nContent-Length: 0\r\nConnection: close\r\n\r\n")
+                    await self.writer.drain()
+                    break
+
+                keep_alive = await self.handle_request()
+                self.finish_request(stats)
+                self.data = b''
+                if not keep_alive:
+                    break
+        except asyncio.LimitOverrunError:
+            self.writer.write(b"HTTP/1.1 431 Request Header Fields Too Large\r\nContent-Length: 0\r\nConnection: close\r\n\r\n")
+        except asyncio.CancelledError:
+            if self.timer.expired is None:
+                raise
+            print(f"Closing client connection {self.peer}: {self.timer.expired} timeout")
+            if self.stats.kind is not None:
+                self.stats.error = f"{self.timer.expired} timeout"
+                self.finish_request(self.stats)
+        except Exception as e:
+            print("Error reading client request:", e)
+        finally:
+            self.timer.cancel()
+            if self.metrics is not None:
+                self.metrics.connections.dec()
+            if not self.writer.is_closing():
+                self.writer.close()
+
+    def finish_request(self, stats):
+        stats.duration = time.perf_counter() - stats.started
+        if self.metrics is not None:
+            self.metrics.record(stats)
+        if self.access_log is not None:
+            self.access_log.write(stats)
 
-            if method == "CONNECT":
+    def touch(self):
+        if self.timer is not None:
+            self.timer.touch()
+
+    async def send_upstream_error(self, error):
+        '''
+        Answers 504 if the upstream server timed out and 502 if it failed
+        otherwise, provided nothing of a response was sent to the client yet.
+        '''
+        self.stats.error = str(error) or type(error).__name__
+        if self.stats.status is not None:
+            return
+        if isinstance(error, asyncio.TimeoutError):
+            self.stats.status = 504
+            response = b"HTTP/1.1 504 Gateway Timeout\r\n"
+        else:
+            self.stats.status = 502
+            response = b"HTTP/1.1 502 Bad Gateway\r\n"
+        try:
+            self.writer.write(response + b"Content-Length: 0\r\nConnection: close\r\n\r\n")
+            await self.writer.drain()
+        except ConnectionError:
+            pass
+
+    async def handle_request(self):
+        stats = self.stats
+        stats.method, stats.host, stats.port = self.request.method, self.request.host, self.request.port
+        stats.path = self.request.path
+        try:
+            if self.request.method == "CONNECT":
+                stats.kind = 'connect'
                 await self.handle_https()
+                return False
             else:
-                await self.handle_http()
+                stats.kind = 'http'
+                return await self.handle_http()
 
         except Exception as e:
             print("Error handling request:", e)
+            stats.error = str(e)
+            return False
 
     async def handle_https(self):
+        stats = self.stats
         try:
 
-            host, port = self.data.split(b' ')[1].split(b':')
-            port = int(port)
-
-            reader, writer = await asyncio.open_connection(host.decode(), port)
+            started = time.perf_counter()
+            try:
+                reader, writer = await self.open_upstream(self.request.host, self.request.port)
+            except (OSError, asyncio.TimeoutError) as e:
+                print("Error connecting to upstream:", e)
+                await self.send_upstream_error(e)
+                return
+            stats.upstream_connect = time.perf_counter() - started
+            self.limits.apply(writer)
 
             response = b"HTTP/1.1 200 Connection established\r\n\r\n"
             self.writer.write(response)
             await self.writer.drain()
+            stats.status = 200
 
-            await asyncio.gather(
-                self.relay_data(self.reader, writer),
-                self.relay_data(reader, self.writer)
-            )
+            started = time.perf_counter()
+            if self.metrics is not None:
+                self.metrics.tunnels.inc()
+            try:
+                relayed = None
+                if self.tunnel is not None:
+                    relayed = await self.tunnel.run(self.reader, self.writer, reader, writer, self.touch)
+                if relayed is None:
+                    relayed = await asyncio.gather(
+                        self.relay_data(self.reader, writer),
+                        self.relay_data(reader, self.writer)
+                    )
+                stats.bytes_up, stats.bytes_down = relayed
+            finally:
+                writer.close()
+                stats.relay = time.perf_counter() - started
+                if self.metrics is not None:
+                    self.metrics.tunnels.dec()
 
         except Exception as e:
             print("Error handling HTTPS request:", e)
+            stats.error = str(e)
+
+    async def open_upstream(self, host, port):
+        if self.resolver is not None:
+            connect = self.resolver.open_connection(host, port)
+        else:
+            connect = asyncio.open_connection(host, port)
+        return await asyncio.wait_for(connect, self.limits.connect_timeout)
+
+    async def acquire_upstream(self, host, port):
+        conn = await self.pool.acquire(host, port)
+        if conn.uses == 1:
+            self.limits.apply(conn.writer)
+        return conn
 
     async def handle_http(self):
         try:
-            first_line = self.data.split(b'\n')[0].decode()
-            url = first_line.split(' ')[1]
-            http_pos = url.find('://')
-            if http_pos == -1:
-                temp = url
-            else:
-                temp = url[http_pos + 3:]
-
-            port_pos = temp.find(":")
-            web_server_pos = temp.find("/")
-            if web_server_pos == -1:
-                web_server_pos = len(temp)
-
-            web_server = ""
-            port = -1
-            if port_pos == -1 or web_server_pos < port_pos:
-                port = 80
-                web_server = temp[:web_server_pos]
-            else:
-                port = int((temp[port_pos + 1:])[:web_server_pos - port_pos - 1])
-                web_server = temp[:port_pos]
+            request = self.request
+            keep_alive = wants_keep_alive(request.version, request.headers)
+
+            headers = request.headers
+            if request.form == 'absolute' and request.header('host') is None:
+                headers = headers + [("Host", request.target.partition('://')[2].partition('/')[0])]
 
-            reader, writer = await asyncio.open_connection(web_server, port)
+            try:
+                request_framing = request_body_framing(headers)
+            except ValueError as e:
+                # Where the body ends is unclear, so neither this connection
+                # nor the upstream one can be used for another request.
+                print("Malformed client request:", e)
+                self.stats.status = 400
+                self.writer.write(b"HTTP/1.1 400 Bad Request\r\nContent-Length: 0\r\nConnection: close\r\n\r\n")
+                await self.writer.drain()
+                return False
 
-            writer.write(self.data)
-            await writer.drain()
+            # The cache never reads a request body, so a GET with one goes
+            # straight upstream.
+            if self.cache is not None and request.method == 'GET' and not request_framing:
+                handled = await self.handle_cached_get(request, headers, keep_alive)
+                if handled is not None:
+                    return handled
 
-            await asyncio.gather(
-                self.relay_data(reader, self.writer),
-                self.relay_data(self.reader, writer)
-            )
+            return await self.forward(request, headers, keep_alive, request_framing)
 
+        except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError) as e:
+            print("Error handling HTTP request:", e)
+            await self.send_upstream_error(e)
+            return False
         except Exception as e:
             print("Error handling HTTP request:", e)
+            self.stats.error = str(e)
+            return False
+
+    async def forward(self, request, headers, keep_alive, request_framing):
+        method, web_server, port = request.method, request.host, request.port
+        request_headers = strip_hop_by_hop(headers)
+        if request_framing == 'chunked':
+            # The chunks are relayed as they are, so the upstream server has
+            # to be told the body is chunked again.
+            request_headers.append(("Transfer-Encoding", "chunked"))
+        request_head = serialize_head(request.origin_line, request_headers + [("Connection", "keep-alive")])
+        stats = self.stats
+
+        started = time.perf_counter()
+        conn = await self.acquire_upstream(web_server, port)
+        stats.upstream_connect = time.perf_counter() - started
+        body_task = None
+        try:
+            try:
+                started = time.perf_counter()
+                stats.bytes_up = len(request_head)
+                conn.writer.write(request_head)
+                if request_framing:
+                    body_task = asyncio.create_task(relay_body(self.reader, conn.writer, request_framing, self.touch))
+                else:
+                    await conn.writer.drain()
+                status, status_line, response_headers = await self.read_response_head(conn.reader)
+            except (ConnectionError, asyncio.IncompleteReadError):
+                # A pooled connection can be closed by the server between two
+                # requests; retry once on a fresh one if nothing was sent yet.
+                if conn.uses == 1 or request_framing or method not in RETRYABLE_METHODS:
+                    raise
+                self.pool.release(conn, False)
+                conn = await self.acquire_upstream(web_server, port)
+                while conn.uses > 1:
+                    self.pool.release(conn, False)
+                    conn = await self.acquire_upstream(web_server, port)
+                started = time.perf_counter()
+                conn.writer.write(request_head)
+                await conn.writer.drain()
+                status, status_line, response_headers = await self.read_response_head(conn.reader)
+            stats.ttfb = time.perf_counter() - started
+            stats.status = status
+
+            if status == 101:
+                self.writer.write(serialize_head(status_line, response_headers))
+                await self.writer.drain()
+                started = time.perf_counter()
+                up, down = await asyncio.gather(
+                    self.relay_data(self.reader, conn.writer),
+                    self.relay_data(conn.reader, self.writer)
+                )
+                stats.relay = time.perf_counter() - started
+                stats.bytes_up += up
+                stats.bytes_down += down
+                self.pool.release(conn, False)
+                return False
+
+            framing = response_body_framing(method, status, response_headers)
+            upstream_keep_alive = framing is not None and wants_keep_alive(status_line.split(' ', 1)[0], response_headers)
+            keep_alive = keep_alive and framing is not None
+
+            client_headers = strip_hop_by_hop(response_headers)
+            if framing == 'chunked':
+                client_headers.append(("Transfer-Encoding", "chunked"))
+            client_headers.append(("Connection", "keep-alive" if keep_alive else "close"))
+            response_head = serialize_head(status_line, client_headers)
+            self.writer.write(response_head)
+
+            started = time.perf_counter()
+            stats.bytes_down = len(response_head) + await relay_body(conn.reader, self.writer, framing, self.touch)
+            await self.writer.drain()
+            if body_task is not None:
+                stats.bytes_up += await body_task
+            stats.relay = time.perf_counter() - started
+        except BaseException:
+            if body_task is not None:
+                body_task.cancel()
+            self.pool.release(conn, False)
+            raise
+
+        self.pool.release(conn, upstream_keep_alive)
+        return keep_alive
+
+    async def read_response_head(self, reader):
+        while True:
+            head = await read_head(reader)
+            if not head:
+                raise asyncio.IncompleteReadError(b'', None)
+            status_line, headers = parse_head(head)
+            status = int(status_line.split(' ')[1])
+            if 100 <= status < 200 and status != 101:
+                self.writer.write(head)
+                continue
+            return status, status_line, headers
+
+    async def handle_cached_get(self, request, headers, keep_alive):
+        '''
+        Serves a GET through the cache. Returns whether the client connection
+        stays open, or None if the request must bypass the cache.
+        '''
+        if request_bypasses_cache(headers):
+            return None
+        upstream = {}
+
+        async def fetch_upstream(entry):
+            conn, status, status_line, response_headers, framing = await self.fetch_response_head(
+                request.host, request.port, request.origin_line, headers, entry)
+            upstream.update(conn=conn, framing=framing, complete=framing == 0,
+                            reusable=framing is not None and wants_keep_alive(status_line.split(' ', 1)[0],
+                                                                              response_headers))
+            return status, status_line, response_headers, iter_body(conn.reader, framing, self.touch)
+
+        async def stream(status, status_line, response_headers, body):
+            nonlocal keep_alive
+            self.stats.status = status
+            framing = upstream['framing']
+            client_headers = strip_hop_by_hop(response_headers)
+            if framing == 'chunked':
+                client_headers.append(("Transfer-Encoding", "chunked"))
+            keep_alive = keep_alive and framing is not None
+            client_headers.append(("Connection", "keep-alive" if keep_alive else "close"))
+            response_head = serialize_head(status_line, client_headers)
+            self.writer.write(response_head)
+            self.stats.bytes_down = len(response_head)
+            started = time.perf_counter()
+            async for data in body:
+                if framing == 'chunked':
+                    data = b'%x\r\n%b\r\n' % (len(data), data)
+                self.writer.write(data)
+                self.stats.bytes_down += len(data)
+                await self.writer.drain()
+            if framing == 'chunked':
+                self.writer.write(b'0\r\n\r\n')
+                self.stats.bytes_down += 5
+            await self.writer.drain()
+            self.stats.relay = time.perf_counter() - started
+            upstream['complete'] = True
+
+        try:
+            entry, from_cache = await self.cache.fetch(request.url, fetch_upstream, stream,
+                                                       request_forces_revalidation(headers))
+        finally:
+            if 'conn' in upstream:
+                self.pool.release(upstream['conn'], upstream['complete'] and upstream['reusable'])
+        self.stats.cache = 'hit' if from_cache else 'miss'
+        if not from_cache:
+            return keep_alive
+        self.stats.status = int(entry.status_line.split(' ')[1])
+
+        response = [(name, value) for name, value in entry.headers if name.lower() != 'age']
+        response.append(("Age", str(int(entry.age(time.time())))))
+        response.append(("Connection", "keep-alive" if keep_alive else "close"))
+        response_head = serialize_head(entry.status_line, response)
+        # Two writes rather than one of the two joined, which would copy the
+        # whole body on every hit (as writelines() does before Python 3.12).
+        self.writer.write(response_head)
+        self.writer.write(entry.body)
+        self.stats.bytes_down = len(response_head) + len(entry.body)
+        await self.writer.drain()
+        return keep_alive
+
+    async def fetch_response_head(self, web_server, port, request_line, headers, entry):
+        '''
+        Sends a GET for the cache over a pooled connection, conditional on
+        the validators of entry if there is one, and reads the response
+        head. Returns (connection, status, status line, headers, body
+        framing); the caller reads the body and releases the connection.
+        '''
+        request = []
+        for name, value in strip_hop_by_hop(headers):
+            if name.lower() not in CONDITIONAL_HEADERS:
+                request.append((name, value))
+        if entry is not None:
+            if entry.etag is not None:
+                request.append(("If-None-Match", entry.etag))
+            if entry.last_modified is not None:
+                request.append(("If-Modified-Since", entry.last_modified))
+        request.append(("Connection", "keep-alive"))
+
+        stats = self.stats
+        started = time.perf_counter()
+        conn = await self.acquire_upstream(web_server, port)
+        stats.upstream_connect = time.perf_counter() - started
+        try:
+            started = time.perf_counter()
+            request_head = serialize_head(request_line, request)
+            stats.bytes_up = len(request_head)
+            conn.writer.write(request_head)
+            await conn.writer.drain()
+
+            head = await read_head(conn.reader)
+            if not head:
+                raise asyncio.IncompleteReadError(b'', None)
+            stats.ttfb = time.perf_counter() - started
+            status_line, response_headers = parse_head(head)
+            status = int(status_line.split(' ')[1])
+        except BaseException:
+            self.pool.release(conn, False)
+            raise
+        return conn, status, status_line, response_headers, response_body_framing('GET', status, response_headers)
 
     async def relay_data(self, source, destination):
+        '''
+        Copies source to destination until EOF. A clean EOF is passed on as a
+        half-close so the other direction can still finish; the caller closes
+        both sides once it is done.
+        '''
+        relayed = 0
+        clean = False
         try:
             while True:
                 data = await source.read(8192)
                 if data:
+                    relayed += len(data)
                     destination.write(data)
+                    self.touch()
                     await destination.drain()
                 else:
+                    clean = True
                     break
         except Exception as e:
             print("Error relaying data:", e)
@@ -94,4 +457,8 @@ class MyProxy:
                 source.feed_eof()
 
             if isinstance(destination, asyncio.StreamWriter) and not destination.is_closing():
-                destination.close()
+                if clean and destination.can_write_eof():
+                    destination.write_eof()
+                else:
+                    destination.close()
+        return relayed
@@ -0,0 +1,187 @@
+import asyncio
+import os
+import socket
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+SPLICE_AVAILABLE = hasattr(os, 'splice')
+
+# Linux only; not exported by the fcntl module on every Python version.
+F_SETPIPE_SZ = getattr(fcntl, 'F_SETPIPE_SZ', 1031)
+
+ENGINES = ('stream', 'buffer', 'splice')
+
+
+def detach_socket(reader, writer):
+    '''
+    Takes the socket of an idle StreamReader/StreamWriter pair away from
+    asyncio and returns it as a plain non-blocking socket together with any
+    bytes the StreamReader had already buffered. Returns None when the
+    transport has no plain socket (for example TLS) or still has data
+    waiting to be written.
+    '''
+    transport = writer.transport
+    sock = writer.get_extra_info('socket')
+    if sock is None or transport.get_write_buffer_size():
+        return None
+
+    transport.pause_reading()
+    # StreamReader has no public way to take what it has buffered already.
+    buffered = bytes(getattr(reader, '_buffer', b''))
+    if buffered:
+        reader._buffer.clear()
+
+    raw = socket.socket(sock.family, sock.type, sock.proto, fileno=os.dup(sock.fileno()))
+    raw.setblocking(False)
+    transport.abort()
+    return raw, buffered
+
+
+class TunnelRelay:
+    '''
+    Moves the bytes of an established CONNECT tunnel between the client and
+    upstream sockets without going through StreamReader/StreamWriter.
+
+    'splice' pushes data socket -> pipe -> socket with os.splice so it never
+    enters user space (Linux only). 'buffer' reads with recv_into into one
+    preallocated buffer per direction and sends from a memoryview of it.
+    When splice is not available the relay falls back to 'buffer'.
+    '''
+
+    def __init__(self, engine='splice', buffer_size=256 * 1024):
+        if engine not in ENGINES or engine == 'stream':
+            raise ValueError(f"unknown tunnel relay engine {engine!r}")
+        if engine == 'splice' and not SPLICE_AVAILABLE:
+            engine = 'buffer'
+        self.engine = engine
+        self.buffer_size = buffer_size
+
+    async def run(self, client_reader, client_writer, upstream_reader, upstream_writer, touch=None):
+        '''
+        Returns (bytes client -> upstream, bytes upstream -> client), or None
+        without touching the streams if they cannot be detached, in which case
+        the caller should relay them itself. touch() is called whenever data
+        moves, for idle timeouts.
+        '''
+        client = detach_socket(client_reader, client_writer)
+        if client is None:
+            return None
+        upstream = detach_socket(upstream_reader, upstream_writer)
+        if upstream is None:
+            client[0].close()
+            return None
+
+        client_sock, client_pending = client
+        upstream_sock, upstream_pending = upstream
+        loop = asyncio.get_running_loop()
+        pump = self.splice_pump if self.engine == 'splice' else self.buffer_pump
+        if touch is None:
+            touch = nothing
+        try:
+            if client_pending:
+                await loop.sock_sendall(upstream_sock, client_pending)
+            if upstream_pending:
+                await loop.sock_sendall(client_sock, upstream_pending)
+
+            up, down = await asyncio.gather(
+                pump(loop, client_sock, upstream_sock, touch),
+                pump(loop, upstream_sock, client_sock, touch)
+            )
+        finally:
+            client_sock.close()
+            upstream_sock.close()
+        return up + len(client_pending), down + len(upstream_pending)
+
+    async def buffer_pump(self, loop, source, destination, touch):
+        buffer = bytearray(self.buffer_size)
+        view = memoryview(buffer)
+        relayed = 0
+        try:
+            while True:
+                count = await loop.sock_recv_into(source, buffer)
+                if not count:
+                    break
+                await loop.sock_sendall(destination, view[:count])
+                relayed += count
+                touch()
+        except OSError as e:
+            print("Error relaying tunnel data:", e)
+        finally:
+            half_close(destination)
+        return relayed
+
+    async def splice_pump(self, loop, source, destination, touch):
+        pipe_read, pipe_write = os.pipe()
+        relayed = 0
+        try:
+            if fcntl is not None:
+                try:
+                    fcntl.fcntl(pipe_write, F_SETPIPE_SZ, self.buffer_size)
+                except OSError:
+                    pass
+            os.set_blocking(pipe_read, False)
+            os.set_blocking(pipe_write, False)
+
+            flags = os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK
+            source_fd = source.fileno()
+            destination_fd = destination.fileno()
+            in_pipe = 0
+            while True:
+                if not in_pipe:
+                    try:
+                        count = os.splice(source_fd, pipe_write, self.buffer_size, flags=flags)
+                    except BlockingIOError:
+                        await wait_for_fd(loop, source_fd, readable=True)
+                        continue
+                    if not count:
+                        break
+                    in_pipe = count
+
+                try:
+                    count = os.splice(pipe_read, destination_fd, in_pipe, flags=flags)
+                    in_pipe -= count
+                    relayed += count
+                    touch()
+                except BlockingIOError:
+                    await wait_for_fd(loop, destination_fd, readable=False)
+        except OSError as e:
+            print("Error relaying tunnel data:", e)
+        finally:
+            os.close(pipe_read)
+            os.close(pipe_write)
+            half_close(destination)
+        return relayed
+
+
+def nothing():
+    pass
+
+
+def half_close(sock):
+    try:
+        sock.shutdown(socket.SHUT_WR)
+    except OSError:
+        pass
+
+
+async def wait_for_fd(loop, fd, readable):
+    future = loop.create_future()
+
+    def ready():
+        if not future.done():
+            future.set_result(None)
+
+    if readable:
+        loop.add_reader(fd, ready)
+    else:
+        loop.add_writer(fd, ready)
+    try:
+        await future
+    finally:
+        if readable:
+            loop.remove_reader(fd)
+        else:
+            loop.remove_writer(fd)
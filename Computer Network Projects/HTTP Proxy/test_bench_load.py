@@ -0,0 +1,61 @@
+import asyncio
+import os
+import types
+import unittest
+
+from bench_load import percentile, process_usage, run_level, run_origin, start, start_proxy
+from bench_tunnel import run_sink
+
+
+class HelpersTest(unittest.TestCase):
+
+    def test_percentile(self):
+        ordered = list(range(1, 101))
+        self.assertEqual(percentile(ordered, 0.5), 51)
+        self.assertEqual(percentile(ordered, 0.99), 100)
+        self.assertEqual(percentile([7], 0.99), 7)
+        self.assertIsNone(percentile([], 0.5))
+
+    @unittest.skipUnless(os.path.exists('/proc/self/status'), "no /proc")
+    def test_process_usage(self):
+        rss, fds = process_usage(os.getpid())
+        self.assertGreater(rss, 0)
+        self.assertGreater(fds, 2)
+        self.assertEqual(process_usage(-1), (None, None))
+
+
+class RunLevelTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.origin, cls.origin_port = start(run_origin, 4096, 2, 0.001)
+        cls.sink, cls.sink_port = start(run_sink)
+        cls.proxy, proxy_port = start_proxy([])
+        cls.args = types.SimpleNamespace(proxy_port=proxy_port, duration=0.3, tunnel_megabytes=1)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.proxy.terminate()
+        cls.proxy.wait()
+        cls.origin.terminate()
+        cls.sink.terminate()
+
+    def run_level(self, scenario, concurrency):
+        return asyncio.run(run_level(scenario, concurrency, self.args, self.proxy, self.origin_port,
+                                     self.sink_port))
+
+    def test_http_scenarios(self):
+        for scenario in ('small', 'large', 'slow'):
+            result = self.run_level(scenario, 2)
+            self.assertEqual(result['errors'], 0, scenario)
+            self.assertGreater(result['completed'], 0, scenario)
+            self.assertLessEqual(result['p50_ms'], result['p99_ms'])
+
+    def test_tunnel_scenario(self):
+        result = self.run_level('tunnel', 2)
+        self.assertEqual((result['completed'], result['errors']), (2, 0))
+        self.assertGreater(result['tunnel_mb_s'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
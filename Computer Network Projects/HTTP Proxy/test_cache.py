@@ -0,0 +1,130 @@
+import asyncio
+import unittest
+
+from cache import HttpCache
+from http_parser import parse_head, read_body, read_head, response_body_framing
+from pool import UpstreamPool
+from proxy import MyProxy
+
+
+class Origin:
+    '''
+    A local web server with a few fixed responses, counting the requests
+    for each path.
+    '''
+
+    def __init__(self):
+        self.requests = {}
+        self.release = asyncio.Event()
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, '127.0.0.1', 0)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                head = await read_head(reader)
+                if not head:
+                    break
+                path = head.split(b' ')[1].decode()
+                self.requests[path] = self.requests.get(path, 0) + 1
+                if path == '/small':
+                    writer.write(b"HTTP/1.1 200 OK\r\nCache-Control: max-age=60\r\nContent-Length: 5\r\n\r\nhello")
+                elif path == '/chunked':
+                    writer.write(b"HTTP/1.1 200 OK\r\nCache-Control: max-age=60\r\nTransfer-Encoding: chunked\r\n\r\n"
+                                 b"3\r\nabc\r\n4;ext=1\r\ndefg\r\n0\r\n\r\n")
+                elif path == '/big':
+                    piece = b'x' * 65536
+                    writer.write(b"HTTP/1.1 200 OK\r\nCache-Control: max-age=60\r\nTransfer-Encoding: chunked\r\n\r\n")
+                    for _ in range(32):
+                        writer.write(b'%x\r\n%b\r\n' % (len(piece), piece))
+                        await writer.drain()
+                    writer.write(b'0\r\n\r\n')
+                elif path == '/slow':
+                    # The rest of the body only comes once the client has
+                    # seen the first part.
+                    writer.write(b"HTTP/1.1 200 OK\r\nCache-Control: max-age=60\r\n\r\nfirst ")
+                    await writer.drain()
+                    await self.release.wait()
+                    writer.write(b"second")
+                    await writer.drain()
+                    break
+                await writer.drain()
+        finally:
+            writer.close()
+
+
+class StreamingCacheTest(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.origin = Origin()
+        await self.origin.start()
+        self.cache = HttpCache(max_bytes=1 << 20, max_entry_bytes=256 * 1024)
+        self.pool = UpstreamPool()
+        self.proxy = await asyncio.start_server(
+            lambda reader, writer: MyProxy(reader, writer, cache=self.cache, pool=self.pool).serve(), '127.0.0.1', 0)
+        self.proxy_port = self.proxy.sockets[0].getsockname()[1]
+
+    async def asyncTearDown(self):
+        self.proxy.close()
+        self.origin.server.close()
+
+    async def get(self, path):
+        reader, writer = await asyncio.open_connection('127.0.0.1', self.proxy_port)
+        try:
+            url = f"http://127.0.0.1:{self.origin.port}{path}"
+            writer.write(f"GET {url} HTTP/1.1\r\nHost: 127.0.0.1:{self.origin.port}\r\n\r\n".encode())
+            await writer.drain()
+            status_line, headers = parse_head(await read_head(reader))
+            status = int(status_line.split(' ')[1])
+            body = await read_body(reader, response_body_framing('GET', status, headers))
+            return status, dict((name.lower(), value) for name, value in headers), body
+        finally:
+            writer.close()
+
+    async def test_small_response_is_cached(self):
+        status, headers, body = await self.get('/small')
+        self.assertEqual((status, body), (200, b'hello'))
+        status, headers, body = await self.get('/small')
+        self.assertEqual((status, body), (200, b'hello'))
+        self.assertIn('age', headers)
+        self.assertEqual(self.origin.requests['/small'], 1)
+        self.assertEqual(self.cache.stats()['hits'], 1)
+
+    async def test_chunked_response_is_decoded_and_cached(self):
+        status, headers, body = await self.get('/chunked')
+        self.assertEqual(headers['transfer-encoding'], 'chunked')
+        self.assertEqual(body, b'abcdefg')
+        status, headers, body = await self.get('/chunked')
+        self.assertEqual(headers['content-length'], '7')
+        self.assertEqual(body, b'abcdefg')
+        self.assertEqual(self.origin.requests['/chunked'], 1)
+
+    async def test_oversized_response_is_passed_on_but_not_kept(self):
+        for _ in range(2):
+            status, headers, body = await self.get('/big')
+            self.assertEqual(len(body), 32 * 65536)
+        self.assertEqual(self.origin.requests['/big'], 2)
+        self.assertEqual(self.cache.stats()['oversized'], 2)
+        self.assertEqual(self.cache.current_bytes, 0)
+
+    async def test_body_reaches_the_client_before_it_ends(self):
+        reader, writer = await asyncio.open_connection('127.0.0.1', self.proxy_port)
+        try:
+            writer.write(f"GET http://127.0.0.1:{self.origin.port}/slow HTTP/1.1\r\n\r\n".encode())
+            await writer.drain()
+            status_line, headers = parse_head(await read_head(reader))
+            self.assertIn(("Connection", "close"), headers)
+            self.assertEqual(await asyncio.wait_for(reader.readexactly(6), 5), b'first ')
+            self.origin.release.set()
+            self.assertEqual(await asyncio.wait_for(reader.read(), 5), b'second')
+        finally:
+            writer.close()
+        status, headers, body = await self.get('/slow')
+        self.assertEqual(body, b'first second')
+        self.assertEqual(self.origin.requests['/slow'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
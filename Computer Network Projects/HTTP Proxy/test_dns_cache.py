@@ -0,0 +1,116 @@
+import asyncio
+import struct
+import time
+import unittest
+
+from dns_cache import DnsCache, NameNotFound, UdpBackend, build_query, parse_answers
+
+
+class Backend:
+    '''
+    Answers from a dict of name -> (addresses, ttl), counting the lookups;
+    a lookup takes delay seconds.
+    '''
+
+    def __init__(self, answers, delay=0.0):
+        self.answers = answers
+        self.delay = delay
+        self.lookups = []
+
+    async def lookup(self, host):
+        self.lookups.append(host)
+        await asyncio.sleep(self.delay)
+        if host not in self.answers:
+            raise NameNotFound(host)
+        return self.answers[host]
+
+
+def response(query, rcode=0, addresses=(), ttl=300):
+    answers = b''.join(b'\xc0\x0c' + struct.pack('!HHIH', 1, 1, ttl, 4) + bytes(address) for address in addresses)
+    return query[:2] + struct.pack('!HHHHH', 0x8180 | rcode, 1, len(addresses), 0, 0) + query[12:] + answers
+
+
+class StubServer(asyncio.DatagramProtocol):
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        name = data[13:13 + data[12]]
+        if name == b'www':
+            self.transport.sendto(response(data, addresses=[(192, 0, 2, 1), (192, 0, 2, 2)], ttl=30), addr)
+        elif name == b'missing':
+            self.transport.sendto(response(data, rcode=3), addr)
+
+
+class DnsCacheTest(unittest.IsolatedAsyncioTestCase):
+
+    async def test_answers_are_cached_for_their_ttl(self):
+        backend = Backend({'example.com': (['192.0.2.1'], 60)})
+        cache = DnsCache(backend)
+        self.assertEqual(await cache.resolve('example.com'), ['192.0.2.1'])
+        self.assertEqual(await cache.resolve('EXAMPLE.com'), ['192.0.2.1'])
+        self.assertEqual(backend.lookups, ['example.com'])
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+        addresses, expires_at = cache.entries['example.com']
+        cache.entries['example.com'] = (addresses, expires_at - 61)
+        await cache.resolve('example.com')
+        self.assertEqual(len(backend.lookups), 2)
+
+    async def test_ttl_is_clamped(self):
+        cache = DnsCache(Backend({'short': (['192.0.2.1'], 0), 'long': (['192.0.2.2'], 10 ** 6)}), min_ttl=5,
+                         max_ttl=100)
+        for name in ('short', 'long'):
+            await cache.resolve(name)
+        now = time.monotonic()
+        self.assertAlmostEqual(cache.entries['short'][1] - now, 5, delta=1)
+        self.assertAlmostEqual(cache.entries['long'][1] - now, 100, delta=1)
+
+    async def test_missing_names_are_cached_too(self):
+        backend = Backend({})
+        cache = DnsCache(backend, negative_ttl=10)
+        for _ in range(2):
+            with self.assertRaises(NameNotFound):
+                await cache.resolve('nowhere.example')
+        self.assertEqual(len(backend.lookups), 1)
+        self.assertEqual(cache.negative_hits, 1)
+
+    async def test_concurrent_lookups_share_one_query(self):
+        backend = Backend({'example.com': (['192.0.2.1'], 60)}, delay=0.05)
+        cache = DnsCache(backend)
+        results = await asyncio.gather(*(cache.resolve('example.com') for _ in range(5)))
+        self.assertEqual(results, [['192.0.2.1']] * 5)
+        self.assertEqual(len(backend.lookups), 1)
+        self.assertEqual(cache.collapsed, 4)
+        self.assertFalse(cache.pending)
+
+    async def test_addresses_and_lru(self):
+        backend = Backend({f'host{i}': ([f'192.0.2.{i}'], 60) for i in range(3)})
+        cache = DnsCache(backend, max_entries=2)
+        self.assertEqual(await cache.resolve('198.51.100.7'), ['198.51.100.7'])
+        for name in ('host0', 'host1', 'host0', 'host2'):
+            await cache.resolve(name)
+        self.assertEqual(list(cache.entries), ['host0', 'host2'])
+        self.assertEqual(backend.lookups, ['host0', 'host1', 'host2'])
+
+    async def test_udp_backend(self):
+        transport, _ = await asyncio.get_running_loop().create_datagram_endpoint(
+            StubServer, local_addr=('127.0.0.1', 0))
+        self.addCleanup(transport.close)
+        backend = UdpBackend(transport.get_extra_info('sockname'), timeout=0.1, attempts=2)
+        self.assertEqual(await backend.lookup('www'), (['192.0.2.1', '192.0.2.2'], 30))
+        with self.assertRaises(NameNotFound):
+            await backend.lookup('missing')
+        with self.assertRaises(asyncio.TimeoutError):
+            await backend.lookup('silent')
+        backend.protocol.transport.close()
+
+    def test_parse_answers(self):
+        query = build_query(0x1234, 'www.example.com')
+        self.assertEqual(parse_answers(response(query, addresses=[(10, 0, 0, 1)], ttl=7)), (0, [('10.0.0.1', 7)]))
+        self.assertEqual(parse_answers(response(query, rcode=2)), (2, []))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,121 @@
+import asyncio
+import unittest
+
+from http_parser import (parse_request_head, read_body, read_head, relay_body, request_body_framing,
+                         response_body_framing, strip_hop_by_hop, wants_keep_alive)
+
+
+def feed(data):
+    reader = asyncio.StreamReader()
+    reader.feed_data(data)
+    reader.feed_eof()
+    return reader
+
+
+class Writer:
+
+    def __init__(self):
+        self.data = bytearray()
+
+    def write(self, data):
+        self.data += data
+
+    async def drain(self):
+        pass
+
+
+class RequestHeadTest(unittest.TestCase):
+
+    def test_absolute_form(self):
+        head = parse_request_head(b'GET http://Example.com:8080/a?b=1 HTTP/1.1\r\nHost: other\r\n\r\n')
+        self.assertEqual((head.method, head.form, head.host, head.port, head.path),
+                         ('GET', 'absolute', 'Example.com', 8080, '/a?b=1'))
+        self.assertEqual(head.origin_line, 'GET /a?b=1 HTTP/1.1')
+        self.assertEqual(parse_request_head(b'GET http://example.com HTTP/1.1\r\n\r\n').path, '/')
+
+    def test_origin_form_takes_the_host_header(self):
+        head = parse_request_head(bytearray(b'GET /index.html HTTP/1.1\r\nhost: [::1]:8000\r\nAccept: */*\r\n\r\n'))
+        self.assertEqual((head.form, head.host, head.port), ('origin', '::1', 8000))
+        self.assertEqual(head.header('accept'), '*/*')
+        self.assertEqual(head.url, 'http://[::1]:8000/index.html')
+
+    def test_authority_form(self):
+        head = parse_request_head(b'CONNECT example.com:8443 HTTP/1.1\r\n\r\n')
+        self.assertEqual((head.form, head.host, head.port, head.path), ('authority', 'example.com', 8443, ''))
+        self.assertEqual(parse_request_head(b'CONNECT example.com HTTP/1.1\r\n\r\n').port, 443)
+
+    def test_malformed_heads(self):
+        for data in (b'GET /\r\n\r\n', b'GET / HTTP/1.1\r\n\r\n', b'GET / HTTP/1.1\r\nno colon\r\n\r\n',
+                     b'GET ftp://example.com/ HTTP/1.1\r\n\r\n', b'GET http://:80/ HTTP/1.1\r\n\r\n',
+                     b'GET http://example.com:x/ HTTP/1.1\r\n\r\n'):
+            with self.assertRaises(ValueError, msg=data):
+                parse_request_head(data)
+
+
+class HeaderTest(unittest.TestCase):
+
+    def test_hop_by_hop_headers_and_those_listed_in_connection_are_dropped(self):
+        headers = [('Connection', 'keep-alive, X-Secret'), ('X-Secret', '1'), ('Keep-Alive', 'timeout=5'),
+                   ('Transfer-Encoding', 'chunked'), ('Accept', '*/*')]
+        self.assertEqual(strip_hop_by_hop(headers), [('Accept', '*/*')])
+
+    def test_keep_alive(self):
+        self.assertTrue(wants_keep_alive('HTTP/1.1', []))
+        self.assertFalse(wants_keep_alive('HTTP/1.1', [('Connection', 'close')]))
+        self.assertFalse(wants_keep_alive('HTTP/1.0', []))
+        self.assertTrue(wants_keep_alive('HTTP/1.0', [('Proxy-Connection', 'Keep-Alive')]))
+
+    def test_request_framing(self):
+        self.assertEqual(request_body_framing([]), 0)
+        self.assertEqual(request_body_framing([('Content-Length', ' 12 ')]), 12)
+        self.assertEqual(request_body_framing([('Content-Length', '7'), ('content-length', '7, 7')]), 7)
+        self.assertEqual(request_body_framing([('Transfer-Encoding', 'gzip, chunked')]), 'chunked')
+
+    def test_unsafe_request_framing(self):
+        for headers in ([('Content-Length', '-1')], [('Content-Length', 'abc')], [('Content-Length', '')],
+                        [('Content-Length', '+5')], [('Content-Length', '\u0665')], [('Content-Length', '5, 6')],
+                        [('Content-Length', '5'), ('Content-Length', '6')],
+                        [('Transfer-Encoding', 'chunked'), ('Content-Length', '5')],
+                        [('Transfer-Encoding', 'chunked, gzip')]):
+            with self.assertRaises(ValueError, msg=headers):
+                request_body_framing(headers)
+
+    def test_response_framing(self):
+        self.assertEqual(response_body_framing('HEAD', 200, [('Content-Length', '10')]), 0)
+        self.assertEqual(response_body_framing('GET', 304, []), 0)
+        self.assertEqual(response_body_framing('GET', 200, [('Transfer-Encoding', 'gzip, chunked')]), 'chunked')
+        self.assertEqual(response_body_framing('GET', 200, [('Content-Length', '10')]), 10)
+        self.assertIsNone(response_body_framing('GET', 200, []))
+
+
+class BodyTest(unittest.IsolatedAsyncioTestCase):
+
+    async def test_head_is_read_up_to_the_blank_line(self):
+        reader = feed(b'GET / HTTP/1.1\r\nHost: a\r\n\r\nbody')
+        self.assertEqual(await read_head(reader), b'GET / HTTP/1.1\r\nHost: a\r\n\r\n')
+        self.assertEqual(await reader.read(), b'body')
+        self.assertEqual(await read_head(feed(b'')), b'')
+        with self.assertRaises(asyncio.IncompleteReadError):
+            await read_head(feed(b'GET / HTTP/1.1\r\n'))
+
+    async def test_bodies_are_read_by_their_framing(self):
+        chunked = b'3\r\nabc\r\n4;ext=1\r\ndefg\r\n0\r\nTrailer: x\r\n\r\nnext'
+        reader = feed(chunked)
+        self.assertEqual(await read_body(reader, 'chunked'), b'abcdefg')
+        self.assertEqual(await reader.read(), b'next')
+        self.assertEqual(await read_body(feed(b'hello world'), 5), b'hello')
+        self.assertEqual(await read_body(feed(b'until close'), None), b'until close')
+        with self.assertRaises(asyncio.IncompleteReadError):
+            await read_body(feed(b'short'), 10)
+
+    async def test_relayed_body_keeps_its_chunk_framing(self):
+        chunked = b'3\r\nabc\r\n0\r\n\r\n'
+        writer = Writer()
+        self.assertEqual(await relay_body(feed(chunked + b'next'), writer, 'chunked'), len(chunked))
+        self.assertEqual(bytes(writer.data), chunked)
+        writer = Writer()
+        self.assertEqual(await relay_body(feed(b'x' * 200000), writer, 150000), 150000)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+import asyncio
+import unittest
+
+from limits import ConnectionLimiter, IdleTimer, Limits
+
+
+class Transport:
+
+    def set_write_buffer_limits(self, high=None, low=None):
+        self.limits = (high, low)
+
+
+class Writer:
+
+    def __init__(self):
+        self.transport = Transport()
+
+
+class LimitsTest(unittest.TestCase):
+
+    def test_apply_sets_the_water_marks(self):
+        writer = Writer()
+        Limits(write_high_water=1000, write_low_water=100).apply(writer)
+        self.assertEqual(writer.transport.limits, (1000, 100))
+
+    def test_connection_limiter(self):
+        limiter = ConnectionLimiter(max_connections=3, max_per_ip=2)
+        self.assertTrue(limiter.try_acquire('10.0.0.1'))
+        self.assertTrue(limiter.try_acquire('10.0.0.1'))
+        self.assertFalse(limiter.try_acquire('10.0.0.1'))
+        self.assertTrue(limiter.try_acquire('10.0.0.2'))
+        self.assertFalse(limiter.try_acquire('10.0.0.3'))
+        self.assertEqual(limiter.stats(), {'active': 3, 'client_ips': 2, 'rejected': 2})
+
+        limiter.release('10.0.0.1')
+        limiter.release('10.0.0.2')
+        self.assertTrue(limiter.try_acquire('10.0.0.3'))
+        self.assertEqual(limiter.per_ip, {'10.0.0.1': 1, '10.0.0.3': 1})
+
+    def test_no_limits(self):
+        limiter = ConnectionLimiter()
+        for _ in range(100):
+            self.assertTrue(limiter.try_acquire('10.0.0.1'))
+        self.assertEqual(limiter.rejected, 0)
+
+
+class IdleTimerTest(unittest.IsolatedAsyncioTestCase):
+
+    async def test_idle_connection_expires(self):
+        expired = []
+        timer = IdleTimer(0.05, None, expired.append)
+        self.addCleanup(timer.cancel)
+        await asyncio.sleep(0.15)
+        self.assertEqual(expired, ['idle'])
+        self.assertEqual(timer.expired, 'idle')
+
+    async def test_activity_keeps_the_connection_open(self):
+        expired = []
+        timer = IdleTimer(0.05, None, expired.append)
+        self.addCleanup(timer.cancel)
+        for _ in range(6):
+            timer.touch()
+            await asyncio.sleep(0.025)
+        self.assertEqual(expired, [])
+        await asyncio.sleep(0.15)
+        self.assertEqual(expired, ['idle'])
+
+    async def test_total_timeout_ignores_activity(self):
+        expired = []
+        timer = IdleTimer(0.05, 0.1, expired.append)
+        self.addCleanup(timer.cancel)
+        for _ in range(8):
+            timer.touch()
+            await asyncio.sleep(0.025)
+        self.assertEqual(expired, ['total'])
+
+    async def test_cancel(self):
+        expired = []
+        timer = IdleTimer(0.02, None, expired.append)
+        timer.cancel()
+        await asyncio.sleep(0.06)
+        self.assertEqual(expired, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,27 @@
+import asyncio
+import time
+import unittest
+
+import main
+
+
+class DrainTest(unittest.IsolatedAsyncioTestCase):
+
+    async def test_drain_gives_up_on_idle_clients_after_the_timeout(self):
+        server = await asyncio.start_server(main.handle_client, '127.0.0.1', 0)
+        port = server.sockets[0].getsockname()[1]
+        # A client that connects and never sends a request.
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        while not main.active_clients:
+            await asyncio.sleep(0.01)
+
+        started = time.monotonic()
+        await asyncio.wait_for(main.drain(server, 0.2), 5)
+        self.assertLess(time.monotonic() - started, 2)
+        self.assertFalse(main.active_clients)
+        self.assertEqual(await asyncio.wait_for(reader.read(), 5), b'')
+        writer.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,99 @@
+import asyncio
+import json
+import os
+import tempfile
+import unittest
+
+from metrics import AccessLog, Counter, Histogram, ProxyMetrics, Registry, RequestStats, start_admin_server
+
+
+class MetricTest(unittest.TestCase):
+
+    def test_counter_keeps_one_series_per_label_set(self):
+        counter = Counter('requests_total', "Requests", ('kind', 'status'))
+        counter.inc(1, ('http', '200'))
+        counter.inc(2, ('http', '200'))
+        counter.inc(1, ('tunnel', '200'))
+        self.assertEqual(list(counter.render()), ['requests_total{kind="http",status="200"} 3',
+                                                  'requests_total{kind="tunnel",status="200"} 1'])
+
+    def test_histogram_buckets_are_cumulative(self):
+        histogram = Histogram('latency_seconds', "Latency", buckets=(0.1, 1.0))
+        for value in (0.05, 0.1, 0.5, 5.0):
+            histogram.observe(value)
+        self.assertEqual(list(histogram.render()), ['latency_seconds_bucket{le="0.1"} 2',
+                                                    'latency_seconds_bucket{le="1.0"} 3',
+                                                    'latency_seconds_bucket{le="+Inf"} 4',
+                                                    'latency_seconds_sum 5.65',
+                                                    'latency_seconds_count 4'])
+
+    def test_registry_reads_stats_at_scrape_time(self):
+        registry = Registry()
+        registry.register(Counter('hits_total', "Hits")).inc()
+        stats = {'open': 1}
+        registry.add_stats('pool', lambda: stats)
+        stats['open'] = 3
+        self.assertEqual(registry.render(), '# HELP hits_total Hits\n# TYPE hits_total counter\nhits_total 1\n'
+                                            '# TYPE pool_open gauge\npool_open 3\n')
+
+
+class ProxyMetricsTest(unittest.TestCase):
+
+    def test_record(self):
+        metrics = ProxyMetrics()
+        stats = RequestStats(('127.0.0.1', 5000))
+        stats.kind, stats.status, stats.bytes_up, stats.bytes_down = 'http', 200, 10, 1000
+        stats.ttfb, stats.duration = 0.02, 0.03
+        metrics.record(stats)
+        failed = RequestStats(('127.0.0.1', 5001))
+        failed.error = 'ConnectionResetError'
+        metrics.record(failed)
+
+        self.assertEqual(metrics.requests.values, {('http', '200'): 1, ('unknown', 'none'): 1})
+        self.assertEqual(metrics.errors.values, {('unknown',): 1})
+        self.assertEqual(metrics.bytes.values, {('upstream',): 10, ('downstream',): 1000})
+        # Only the phases that happened are observed.
+        self.assertEqual(list(metrics.phases.values), [('ttfb',)])
+        self.assertEqual(list(metrics.durations.values), [('http',)])
+
+    def test_access_log_writes_json_lines(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = os.path.join(directory.name, 'access.log')
+        log = AccessLog(path)
+        stats = RequestStats(('127.0.0.1', 5000))
+        stats.method, stats.status = 'GET', 200
+        log.write(stats)
+        log.close()
+        with open(path) as file:
+            records = [json.loads(line) for line in file]
+        self.assertEqual(len(records), 1)
+        self.assertEqual((records[0]['method'], records[0]['status'], records[0]['client']),
+                         ('GET', 200, ['127.0.0.1', 5000]))
+        self.assertNotIn('started', records[0])
+
+
+class AdminServerTest(unittest.IsolatedAsyncioTestCase):
+
+    async def get(self, port, path):
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        writer.write(f'GET {path} HTTP/1.1\r\nHost: localhost\r\n\r\n'.encode())
+        response = await reader.read()
+        writer.close()
+        return response
+
+    async def test_metrics_endpoint(self):
+        registry = Registry()
+        registry.register(Counter('hits_total', "Hits")).inc(5)
+        server = await start_admin_server(registry, '127.0.0.1', 0)
+        self.addCleanup(server.close)
+        port = server.sockets[0].getsockname()[1]
+
+        response = await self.get(port, '/metrics?format=text')
+        self.assertTrue(response.startswith(b'HTTP/1.1 200 OK\r\n'))
+        self.assertTrue(response.endswith(b'\r\n\r\n' + registry.render().encode()))
+        self.assertTrue((await self.get(port, '/')).startswith(b'HTTP/1.1 404 Not Found\r\n'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,104 @@
+import asyncio
+import unittest
+
+from pool import UpstreamPool
+
+
+class Reader:
+
+    def __init__(self):
+        self.eof = False
+
+    def at_eof(self):
+        return self.eof
+
+
+class Writer:
+
+    def __init__(self):
+        self.closed = False
+
+    def is_closing(self):
+        return self.closed
+
+    def close(self):
+        self.closed = True
+
+
+class PoolTest(unittest.IsolatedAsyncioTestCase):
+
+    def pool(self, **options):
+        self.connects = []
+
+        async def connect(host, port):
+            self.connects.append((host, port))
+            if host == 'unreachable':
+                raise ConnectionRefusedError()
+            return Reader(), Writer()
+        return UpstreamPool(connect=connect, **options)
+
+    async def test_released_connection_is_reused(self):
+        pool = self.pool()
+        conn = await pool.acquire('example.com', 80)
+        pool.release(conn, True)
+        self.assertIs(await pool.acquire('example.com', 80), conn)
+        self.assertEqual(conn.uses, 2)
+        # Another server gets a connection of its own.
+        other = await pool.acquire('example.org', 80)
+        self.assertIsNot(other, conn)
+        self.assertEqual(pool.stats(), {'open': 2, 'idle': 0, 'opened': 2, 'reused': 1, 'closed': 0})
+
+    async def test_connection_not_reusable_is_closed(self):
+        pool = self.pool()
+        conn = await pool.acquire('example.com', 80)
+        pool.release(conn, False)
+        self.assertTrue(conn.writer.closed)
+        conn = await pool.acquire('example.com', 80)
+        conn.reader.eof = True
+        pool.release(conn, True)
+        self.assertEqual(pool.stats()['closed'], 2)
+        self.assertEqual(pool.stats()['open'], 0)
+
+    async def test_idle_connection_expires(self):
+        pool = self.pool(idle_timeout=10)
+        conn = await pool.acquire('example.com', 80)
+        pool.release(conn, True)
+        conn.idle_since -= 20
+        self.assertIsNot(await pool.acquire('example.com', 80), conn)
+        self.assertTrue(conn.writer.closed)
+
+        fresh = await pool.acquire('example.com', 80)
+        pool.release(fresh, True)
+        fresh.idle_since -= 20
+        pool.prune()
+        self.assertTrue(fresh.writer.closed)
+        self.assertEqual(pool.stats()['idle'], 0)
+
+    async def test_max_per_host_makes_acquire_wait(self):
+        pool = self.pool(max_per_host=1)
+        conn = await pool.acquire('example.com', 80)
+        waiting = asyncio.create_task(pool.acquire('example.com', 80))
+        await asyncio.sleep(0)
+        self.assertFalse(waiting.done())
+        pool.release(conn, True)
+        self.assertIs(await asyncio.wait_for(waiting, 1), conn)
+        self.assertEqual(len(self.connects), 1)
+
+    async def test_max_idle_evicts_the_oldest(self):
+        pool = self.pool(max_idle=2)
+        conns = [await pool.acquire(f'host{i}', 80) for i in range(3)]
+        for conn in conns:
+            pool.release(conn, True)
+        self.assertTrue(conns[0].writer.closed)
+        self.assertEqual(pool.stats()['idle'], 2)
+
+    async def test_failed_connect_frees_its_slot(self):
+        pool = self.pool(max_per_host=1)
+        for _ in range(2):
+            with self.assertRaises(ConnectionRefusedError):
+                await pool.acquire('unreachable', 80)
+        self.assertEqual(pool.stats()['open'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,76 @@
+import asyncio
+import unittest
+
+from http_parser import parse_head, read_head, relay_body, request_body_framing
+from pool import UpstreamPool
+from proxy import MyProxy
+
+
+class Buffer:
+
+    def __init__(self):
+        self.data = b''
+
+    def write(self, data):
+        self.data += data
+
+    async def drain(self):
+        pass
+
+
+class ProxyTest(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.received = []
+
+        async def upstream(reader, writer):
+            # Answers every request with 200 and keeps the exact bytes it
+            # was sent, head and body with its framing.
+            while True:
+                head = await read_head(reader)
+                if not head:
+                    break
+                body = Buffer()
+                await relay_body(reader, body, request_body_framing(parse_head(head)[1]))
+                self.received.append(head + body.data)
+                writer.write(b"HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\nok")
+                await writer.drain()
+            writer.close()
+
+        server = await asyncio.start_server(upstream, '127.0.0.1', 0)
+        self.addCleanup(server.close)
+        self.upstream_port = server.sockets[0].getsockname()[1]
+        pool = UpstreamPool()
+        proxy = await asyncio.start_server(lambda reader, writer: MyProxy(reader, writer, pool=pool).serve(),
+                                           '127.0.0.1', 0)
+        self.addCleanup(proxy.close)
+        self.proxy_port = proxy.sockets[0].getsockname()[1]
+
+    async def exchange(self, request):
+        reader, writer = await asyncio.open_connection('127.0.0.1', self.proxy_port)
+        writer.write(request)
+        response = await asyncio.wait_for(reader.read(), 5)
+        writer.close()
+        return response
+
+    async def test_chunked_request_body_keeps_its_framing(self):
+        response = await self.exchange(
+            b"POST http://127.0.0.1:%d/x HTTP/1.1\r\nHost: 127.0.0.1:%d\r\nTransfer-Encoding: chunked\r\n"
+            b"Connection: close\r\n\r\n5\r\nhello\r\n0\r\n\r\n" % (self.upstream_port, self.upstream_port))
+        self.assertTrue(response.startswith(b"HTTP/1.1 200 OK\r\n"))
+        self.assertEqual(self.received, [
+            b"POST /x HTTP/1.1\r\nHost: 127.0.0.1:%d\r\nTransfer-Encoding: chunked\r\nConnection: keep-alive\r\n\r\n"
+            b"5\r\nhello\r\n0\r\n\r\n" % self.upstream_port])
+
+    async def test_unsafe_request_framing_is_refused(self):
+        for framing in (b"Content-Length: -1", b"Content-Length: ten", b"Content-Length: 5\r\nContent-Length: 6",
+                        b"Transfer-Encoding: chunked\r\nContent-Length: 5"):
+            response = await self.exchange(
+                b"POST http://127.0.0.1:%d/x HTTP/1.1\r\n%b\r\n\r\n5\r\nhello\r\n0\r\n\r\n"
+                b"GET /smuggled HTTP/1.1\r\n\r\n" % (self.upstream_port, framing))
+            self.assertEqual(response, b"HTTP/1.1 400 Bad Request\r\nContent-Length: 0\r\nConnection: close\r\n\r\n")
+        self.assertEqual(self.received, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
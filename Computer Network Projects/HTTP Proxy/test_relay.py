@@ -0,0 +1,62 @@
+import asyncio
+import os
+import unittest
+
+from relay import SPLICE_AVAILABLE, TunnelRelay
+
+
+async def upper_case(reader, writer):
+    '''
+    An upstream server that sends back everything in upper case and closes
+    once the client has.
+    '''
+    while True:
+        data = await reader.read(65536)
+        if not data:
+            break
+        writer.write(data.upper())
+        await writer.drain()
+    writer.close()
+
+
+class TunnelRelayTest(unittest.IsolatedAsyncioTestCase):
+
+    async def relay(self, engine, payload):
+        upstream = await asyncio.start_server(upper_case, '127.0.0.1', 0)
+        self.addCleanup(upstream.close)
+        results = asyncio.get_running_loop().create_future()
+
+        async def tunnel(client_reader, client_writer):
+            # Whatever the client sent before the relay started is still in
+            # the StreamReader's buffer.
+            await client_reader.readexactly(6)
+            upstream_reader, upstream_writer = await asyncio.open_connection(
+                '127.0.0.1', upstream.sockets[0].getsockname()[1])
+            results.set_result(await TunnelRelay(engine, 4096).run(client_reader, client_writer,
+                                                                   upstream_reader, upstream_writer))
+
+        server = await asyncio.start_server(tunnel, '127.0.0.1', 0)
+        self.addCleanup(server.close)
+        reader, writer = await asyncio.open_connection('127.0.0.1', server.sockets[0].getsockname()[1])
+        writer.write(b'HELLO\n' + payload)
+        await writer.drain()
+        received = asyncio.ensure_future(reader.read())
+        writer.write_eof()
+        self.assertEqual(await asyncio.wait_for(received, 10), payload.upper())
+        writer.close()
+        self.assertEqual(await asyncio.wait_for(results, 10), (len(payload), len(payload)))
+
+    async def test_buffer_engine(self):
+        await self.relay('buffer', os.urandom(300000))
+
+    @unittest.skipUnless(SPLICE_AVAILABLE, "no os.splice")
+    async def test_splice_engine(self):
+        await self.relay('splice', os.urandom(300000))
+
+    def test_unknown_engine(self):
+        with self.assertRaises(ValueError):
+            TunnelRelay('stream')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,145 @@
+import argparse
+import asyncio
+import multiprocessing
+import subprocess
+import sys
+import time
+
+from bench_rendezvous import wait_for_port
+from client import PeerDirectory
+from protocol import DATA_PORT, HELLO, SUBSCRIBE, SUBSCRIPTION, FrameReader, encode_frame
+from server import raise_file_limit
+
+
+class Subscriber:
+    '''
+    A peer that registers, subscribes and applies every update to its
+    directory, counting the frames and bytes they took.
+    '''
+
+    def __init__(self):
+        self.directory = PeerDirectory()
+        self.frames = 0
+        self.bytes = 0
+        self.writer = None
+
+    async def run(self, port):
+        reader, self.writer = await asyncio.open_connection('127.0.0.1', port)
+        self.writer.write(encode_frame(HELLO, 1, DATA_PORT.pack(0) + b"subscriber") + encode_frame(SUBSCRIBE, 2, SUBSCRIPTION.pack(0, 0)))
+        frames = FrameReader()
+        while True:
+            data = await reader.read(1 << 16)
+            if not data:
+                return
+            self.bytes += len(data)
+            for kind, request_id, body in frames.feed(data):
+                if request_id == 2:
+                    self.frames += 1
+                    self.directory.apply(kind, body)
+
+
+def churn(pipe, port, count, connecting):
+    '''
+    Registers count peers when the pipe says 'join', closes them all when it
+    says 'leave'.
+    '''
+    raise_file_limit()
+
+    async def run():
+        semaphore = asyncio.Semaphore(connecting)
+
+        async def register():
+            async with semaphore:
+                reader, writer = await asyncio.open_connection('127.0.0.1', port)
+                writer.write(encode_frame(HELLO, 1, DATA_PORT.pack(0) + b"churn"))
+                await reader.read(1024)
+            return writer
+
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, pipe.recv)
+        writers = await asyncio.gather(*(register() for _ in range(count)))
+        pipe.send('joined')
+        await loop.run_in_executor(None, pipe.recv)
+        for writer in writers:
+            writer.close()
+        pipe.send('left')
+
+    asyncio.run(run())
+
+
+async def wait_until(subscribers, size, timeout):
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        if all(len(subscriber.directory.ids) == size for subscriber in subscribers):
+            return True
+        await asyncio.sleep(0.005)
+    return False
+
+
+async def measure(args, interval):
+    server = subprocess.Popen([sys.executable, 'server.py', '--port', str(args.port), '--quiet',
+                               '--presence-interval', str(interval)], stdout=subprocess.DEVNULL)
+    parent, child = multiprocessing.Pipe()
+    churner = multiprocessing.Process(target=churn, args=(child, args.port, args.joins, args.connecting), daemon=True)
+    loop = asyncio.get_running_loop()
+    try:
+        wait_for_port(args.port)
+        churner.start()
+        subscribers = [Subscriber() for _ in range(args.subscribers)]
+        tasks = [asyncio.create_task(subscriber.run(args.port)) for subscriber in subscribers]
+        if not await wait_until(subscribers, args.subscribers, args.timeout):
+            raise RuntimeError("subscribers did not all see each other")
+        before = sum(subscriber.bytes for subscriber in subscribers), sum(s.frames for s in subscribers)
+
+        started = time.perf_counter()
+        parent.send('join')
+        await loop.run_in_executor(None, parent.recv)
+        registered = time.perf_counter() - started
+        joined = await wait_until(subscribers, args.subscribers + args.joins, args.timeout)
+        join_seen = time.perf_counter() - started
+
+        started = time.perf_counter()
+        parent.send('leave')
+        await loop.run_in_executor(None, parent.recv)
+        left = await wait_until(subscribers, args.subscribers, args.timeout)
+        leave_seen = time.perf_counter() - started
+
+        received = sum(subscriber.bytes for subscriber in subscribers) - before[0]
+        frames = sum(subscriber.frames for subscriber in subscribers) - before[1]
+        for subscriber in subscribers:
+            subscriber.writer.close()
+        for task in tasks:
+            task.cancel()
+    finally:
+        server.terminate()
+        server.wait()
+        churner.terminate()
+    per_subscriber = args.subscribers or 1
+    print(f"interval {1000 * interval:4.0f} ms: {args.joins} joins registered in {registered:.2f}s, "
+          f"all subscribers saw them after {join_seen:.2f}s{'' if joined else ' (TIMED OUT)'}, "
+          f"and the leaves after {leave_seen:.2f}s{'' if left else ' (TIMED OUT)'}; "
+          f"{frames / per_subscriber:.1f} frames and {received / per_subscriber / 1024:.1f} KiB per subscriber",
+          flush=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="How fast joins and leaves reach presence subscribers, and what it costs each of them")
+    parser.add_argument('--subscribers', type=int, default=2000)
+    parser.add_argument('--joins', type=int, default=5000, help="peers that join and then leave")
+    parser.add_argument('--intervals', nargs='+', type=float, default=[0.0, 0.02, 0.1],
+                        help="--presence-interval values for the server")
+    parser.add_argument('--connecting', type=int, default=256, help="registrations under way at once")
+    parser.add_argument('--timeout', type=float, default=60.0)
+    parser.add_argument('--port', type=int, default=11113)
+    args = parser.parse_args()
+
+    raise_file_limit()
+    multiprocessing.set_start_method('fork')
+    print(f"{args.subscribers} subscribers, {args.joins} peers joining and leaving")
+    for interval in args.intervals:
+        asyncio.run(measure(args, interval))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,128 @@
+import argparse
+import asyncio
+import multiprocessing
+import random
+import socket
+import subprocess
+import sys
+import time
+
+from protocol import DATA_PORT, HELLO, LOOKUP, FrameReader, encode_frame, encode_ids
+from server import raise_file_limit
+
+
+async def read_frames(reader, frames, count):
+    received = 0
+    while received < count:
+        data = await reader.read(1 << 16)
+        if not data:
+            raise ConnectionError("server closed the connection")
+        received += len(frames.feed(data))
+
+
+async def run_peers(port, count, connecting, highest_id, pipeline, batch, start_barrier, lookup_barrier, duration,
+                    results):
+    '''
+    Registers count peers, no more than connecting of them at a time, holds
+    them all open, and then has each of them look up random IDs for duration
+    seconds: pipeline requests at a time, each for batch IDs.
+    '''
+    start_barrier.wait()
+    started = time.perf_counter()
+    semaphore = asyncio.Semaphore(connecting)
+
+    async def register(index):
+        async with semaphore:
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.write(encode_frame(HELLO, 0, DATA_PORT.pack(0) + f"peer {index}".encode()))
+            frames = FrameReader()
+            await read_frames(reader, frames, 1)
+        return reader, writer, frames
+
+    peers = await asyncio.gather(*(register(index) for index in range(count)))
+    registered = time.perf_counter() - started
+    await asyncio.get_running_loop().run_in_executor(None, lookup_barrier.wait)
+
+    lookups = 0
+    deadline = time.perf_counter() + duration
+    rng = random.Random()
+
+    async def look_up(reader, writer, frames):
+        nonlocal lookups
+        while time.perf_counter() < deadline:
+            writer.write(b''.join(encode_frame(LOOKUP, request_id, encode_ids(
+                [rng.randint(1, highest_id) for _ in range(batch)])) for request_id in range(pipeline)))
+            await read_frames(reader, frames, pipeline)
+            lookups += pipeline * batch
+
+    await asyncio.gather(*(look_up(*peer) for peer in peers))
+    for _, writer, _ in peers:
+        writer.close()
+    results.put((registered, lookups))
+
+
+def client_process(*args):
+    raise_file_limit()
+    asyncio.run(run_peers(*args))
+
+
+def wait_for_port(port, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError(f"server did not start on port {port}")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Concurrent registered peers and lookups per second the rendezvous server sustains")
+    parser.add_argument('--peers', type=int, default=10000, help="peers registered and held open at once")
+    parser.add_argument('--clients', type=int, default=4, help="processes the peers are spread over")
+    parser.add_argument('--connecting', type=int, default=256,
+                        help="registrations each client process has under way at once")
+    parser.add_argument('--workers', nargs='+', type=int, default=[1, 4], help="server worker counts to compare")
+    parser.add_argument('--duration', type=float, default=5.0, help="seconds of lookups")
+    parser.add_argument('--pipeline', type=int, default=1, help="lookups each peer has outstanding at once")
+    parser.add_argument('--batch', type=int, default=1, help="IDs in each lookup")
+    parser.add_argument('--port', type=int, default=11113)
+    args = parser.parse_args()
+
+    raise_file_limit()
+    multiprocessing.set_start_method('fork')
+    for workers in args.workers:
+        server = subprocess.Popen([sys.executable, 'server.py', '--port', str(args.port), '--workers', str(workers),
+                                   '--quiet'], stdout=subprocess.DEVNULL)
+        try:
+            wait_for_port(args.port)
+            # IDs of peers registered on another worker may not have
+            # reached the one asked yet; those lookups are answered too.
+            highest_id = args.peers
+            start_barrier = multiprocessing.Barrier(args.clients + 1)
+            lookup_barrier = multiprocessing.Barrier(args.clients)
+            results = multiprocessing.Queue()
+            share = args.peers // args.clients
+            clients = [multiprocessing.Process(target=client_process, args=(
+                args.port, share, args.connecting, highest_id, args.pipeline, args.batch, start_barrier, lookup_barrier, args.duration, results))
+                       for _ in range(args.clients)]
+            for client in clients:
+                client.start()
+            start_barrier.wait()
+            outcomes = [results.get() for _ in clients]
+            for client in clients:
+                client.join()
+        finally:
+            server.terminate()
+            server.wait()
+        registered = max(seconds for seconds, _ in outcomes)
+        lookups = sum(count for _, count in outcomes)
+        print(f"workers {workers}: {share * args.clients} peers registered in {registered:.2f}s "
+              f"({share * args.clients / registered:,.0f}/s), {lookups / args.duration:,.0f} lookups/s "
+              f"with all of them connected (pipeline {args.pipeline}, batch {args.batch})", flush=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+import argparse
+import hashlib
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+
+from transfer import FileShare, ResumeState, download, open_file
+
+
+def share(directory, port, chunk_size, ready):
+    server = FileShare(('127.0.0.1', port), directory, chunk_size)
+    ready.set()
+    server.serve_forever()
+
+
+def file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        while chunk := file.read(1 << 20):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def interrupted(address, name, destination, connections, fraction):
+    '''
+    Starts a download in another process and kills it once fraction of the
+    chunks are in.
+    '''
+    sock, manifest = open_file(address, name, 10.0)
+    sock.close()
+    fetcher = multiprocessing.Process(target=download, args=(address, name, destination, connections))
+    fetcher.start()
+    state_path = destination + '.part.state'
+    done = 0
+    while fetcher.is_alive() and done < fraction * manifest.count:
+        time.sleep(0.001)
+        try:
+            with open(state_path, 'rb') as file:
+                done = file.read().count(b'\x01', 32)
+        except FileNotFoundError:
+            pass
+    fetcher.kill()
+    fetcher.join()
+    # The state file knows exactly what the killed download left behind.
+    state = ResumeState(state_path, manifest)
+    left = len(state.missing())
+    state.close()
+    return manifest.count - left
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Throughput of a file transfer between two local peers")
+    parser.add_argument('--size', type=int, default=512, help="MiB")
+    parser.add_argument('--chunk-size', type=int, default=1024, help="KiB")
+    parser.add_argument('--connections', nargs='+', type=int, default=[1, 2, 4, 8])
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--port', type=int, default=11114)
+    args = parser.parse_args()
+
+    multiprocessing.set_start_method('fork')
+    work = tempfile.mkdtemp(prefix='bench_transfer')
+    shared = os.path.join(work, 'shared')
+    os.mkdir(shared)
+    source = os.path.join(shared, 'data.bin')
+    with open(source, 'wb') as file:
+        for _ in range(args.size):
+            file.write(os.urandom(1 << 20))
+    expected = file_digest(source)
+    destination = os.path.join(work, 'data.bin')
+    address = ('127.0.0.1', args.port)
+
+    ready = multiprocessing.Event()
+    sharer = multiprocessing.Process(target=share, args=(shared, args.port, args.chunk_size * 1024, ready), daemon=True)
+    sharer.start()
+    try:
+        ready.wait()
+        started = time.perf_counter()
+        open_file(address, 'data.bin', 60.0)[0].close()
+        print(f"{args.size} MiB in {args.chunk_size} KiB chunks; manifest computed in "
+              f"{time.perf_counter() - started:.2f}s")
+
+        for connections in args.connections:
+            rates = []
+            for _ in range(args.repeat):
+                stats = download(address, 'data.bin', destination, connections)
+                if file_digest(destination) != expected:
+                    raise RuntimeError("the copy differs from the original")
+                os.unlink(destination)
+                rates.append(stats['bytes'] / stats['seconds'] / 1e6)
+            print(f"{connections} connection{'s' if connections > 1 else ' '}: "
+                  f"{max(rates):7.0f} MB/s best, {sorted(rates)[len(rates) // 2]:7.0f} MB/s median")
+
+        resumed = interrupted(address, 'data.bin', destination, 4, 0.5)
+        stats = download(address, 'data.bin', destination, 4)
+        if file_digest(destination) != expected:
+            raise RuntimeError("the resumed copy differs from the original")
+        print(f"killed at {resumed} of {stats['chunks']} chunks; resuming fetched the other {stats['fetched']} "
+              f"({stats['bytes'] / 2**20:.0f} MiB) in {stats['seconds']:.2f}s")
+    finally:
+        sharer.terminate()
+        shutil.rmtree(work)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,161 @@
+import argparse
+import os
 import socket
-from datetime import datetime
-import time
+from collections import defaultdict, deque
+
+from protocol import (ADDRESSES, DATA_PORT, DELTA_HEADER, ERROR, HELLO, ID, LAST_PAGE, LIST, LOOKUP, PAGE_FLAGS, PEERS, PRESENCE,
+                      SNAPSHOT, SNAPSHOT_HEADER, SUBSCRIBE, SUBSCRIPTION, WELCOME, FrameReader, ProtocolError,
+                      decode_addresses, decode_ids, encode_frame, encode_ids)
+from transfer import FileShare, download
+
+
+class PeerDirectory:
+    '''
+    The IDs of all peers as a subscription keeps them: apply() the frames
+    it brings. epoch and version say what the server last sent, to
+    subscribe again with after a reconnect and get only what changed.
+    '''
+
+    def __init__(self):
+        self.ids = set()
+        self.epoch = 0
+        self.version = 0
+        self.loading = None
+
+    def ready(self):
+        return self.epoch != 0 and self.loading is None
+
+    def apply(self, kind, body):
+        '''
+        Returns the (joined, left) IDs of a delta; a snapshot counts as
+        nothing changed until its last page has come.
+        '''
+        if kind == SNAPSHOT:
+            epoch, version, flags = SNAPSHOT_HEADER.unpack_from(body)
+            if self.loading is None:
+                self.loading = set()
+            self.loading.update(decode_ids(body, SNAPSHOT_HEADER.size))
+            if not flags & LAST_PAGE:
+                return [], []
+            joined, left = self.loading - self.ids, self.ids - self.loading
+            self.ids, self.loading = self.loading, None
+            self.epoch, self.version = epoch, version
+            return sorted(joined), sorted(left)
+        if kind != PRESENCE:
+            raise ProtocolError(f"unexpected reply type {kind}")
+        _, self.version, count = DELTA_HEADER.unpack_from(body)
+        ids = decode_ids(body, DELTA_HEADER.size)
+        joined, left = ids[:count], ids[count:]
+        self.ids.update(joined)
+        self.ids.difference_update(left)
+        return joined, left
+
+
+class RendezvousClient:
+    '''
+    A blocking client for the server's framed protocol. Every request gets
+    its own request ID, and replies that arrive for other requests than the
+    one waited for are kept until they are asked for, so requests can be
+    sent ahead with send_request() and collected later.
+    '''
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.frames = FrameReader()
+        self.replies = defaultdict(deque)
+        self.next_request = 1
+
+    def send_request(self, kind, body=b''):
+        request_id = self.next_request
+        self.next_request += 1
+        self.sock.sendall(encode_frame(kind, request_id, body))
+        return request_id
+
+    def reply(self, request_id):
+        '''
+        The next (type, body) sent in answer to request_id.
+        '''
+        while not self.replies[request_id]:
+            data = self.sock.recv(65536)
+            if not data:
+                raise ConnectionError("server closed the connection")
+            for kind, reply_id, body in self.frames.feed(data):
+                self.replies[reply_id].append((kind, body))
+        kind, body = self.replies[request_id].popleft()
+        if not self.replies[request_id]:
+            del self.replies[request_id]
+        if kind == ERROR:
+            raise ProtocolError(body.decode('utf-8', 'replace'))
+        return kind, body
+
+    def hello(self, greeting, data_port=0):
+        '''
+        Registers with the server and returns (client ID, public IP). Other
+        peers that look this one up are given data_port, the port of its
+        FileShare, if it has one.
+        '''
+        kind, body = self.reply(self.send_request(HELLO, DATA_PORT.pack(data_port) + greeting.encode('utf-8')))
+        if kind != WELCOME:
+            raise ProtocolError(f"unexpected reply type {kind}")
+        return ID.unpack_from(body)[0], body[ID.size:].decode()
+
+    def peers(self, page=0):
+        '''
+        Yields the IDs of the other peers as the server sends them, page by
+        page.
+        '''
+        request_id = self.send_request(LIST, ID.pack(page))
+        while True:
+            kind, body = self.reply(request_id)
+            if kind != PEERS:
+                raise ProtocolError(f"unexpected reply type {kind}")
+            yield from decode_ids(body, PAGE_FLAGS.size)
+            if PAGE_FLAGS.unpack_from(body)[0] & LAST_PAGE:
+                return
+
+    def subscribe(self, directory):
+        '''
+        Subscribes to joins and leaves, going on from what directory has,
+        and waits until it is up to date. Returns the request ID to pass to
+        updates().
+        '''
+        request_id = self.send_request(SUBSCRIBE, SUBSCRIPTION.pack(directory.epoch, directory.version))
+        while True:
+            directory.apply(*self.reply(request_id))
+            if directory.ready():
+                return request_id
+
+    def updates(self, request_id, directory):
+        '''
+        Applies to directory every update that has arrived, without
+        waiting, and returns the (joined, left) IDs.
+        '''
+        try:
+            while True:
+                data = self.sock.recv(65536, socket.MSG_DONTWAIT)
+                if not data:
+                    raise ConnectionError("server closed the connection")
+                for kind, reply_id, body in self.frames.feed(data):
+                    self.replies[reply_id].append((kind, body))
+        except BlockingIOError:
+            pass
+        joined, left = set(), set()
+        while self.replies.get(request_id):
+            added, removed = directory.apply(*self.reply(request_id))
+            joined.difference_update(removed)
+            left.difference_update(added)
+            joined.update(added)
+            left.update(removed)
+        return sorted(joined), sorted(left)
+
+    def lookup(self, *peer_ids):
+        '''
+        {ID: (host, port) or None if unknown} for the IDs, in one request.
+        '''
+        kind, body = self.reply(self.send_request(LOOKUP, encode_ids(peer_ids)))
+        if kind != ADDRESSES:
+            raise ProtocolError(f"unexpected reply type {kind}")
+        return dict(decode_addresses(body))
 
 
 def main():
@@ -10,50 +165,65 @@ def main():
     the public IP of the client. we also receive other clients IDs and we can choose
     to connect to them.
     after requesting to connect we will receive the requested IP and port
-    thus we can make a direct connection to the client and send the input message
-    to it.
+    thus we can make a direct connection to the client and fetch the files it
+    shares.
     '''
-    server_host = '127.0.0.1'
-    server_port = 11112
+    parser = argparse.ArgumentParser(description="P2P client")
+    parser.add_argument('--server', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=11112)
+    parser.add_argument('--share', help="directory of the files other peers may fetch (nothing is shared without it)")
+    parser.add_argument('--data-port', type=int, default=0, help="port to share them on (any free one by default)")
+    parser.add_argument('--downloads', default='.', help="directory to fetch files into")
+    parser.add_argument('--connections', type=int, default=4, help="parallel connections per file")
+    args = parser.parse_args()
 
     user_input = input("Enter a string: ")
 
     client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    share = None
 
     try:
-        client_socket.connect((server_host, server_port))
-
-        client_socket.send(user_input.encode('utf-8'))
-
-        client_id = int(client_socket.recv(1024).decode('utf-8'))
+        client_socket.connect((args.server, args.port))
+        rendezvous = RendezvousClient(client_socket)
+        if args.share is not None:
+            # Only on the interface the server is reached through, which is
+            # the address other peers are given, not on every interface.
+            share = FileShare((client_socket.getsockname()[0], args.data_port), args.share)
+            share.start()
+
+        client_id, own_ip = rendezvous.hello(user_input, share.port if share is not None else 0)
         print(f"Your ID: {client_id}")
-
-        own_ip = client_socket.recv(1024).decode('utf-8')
         print(f"Your public IP: {own_ip}")
+        if share is not None:
+            print(f"Sharing {args.share} on {share.server_address[0]}:{share.port}")
 
-        other_clients_ids = client_socket.recv(1024).decode('utf-8').split(',')
-        print("Other clients' IDs:", other_clients_ids)
+        directory = PeerDirectory()
+        subscription = rendezvous.subscribe(directory)
+        print("Other clients' IDs:", sorted(directory.ids - {client_id}))
 
         requested_id = int(input("Enter the ID of the client you want to connect to: "))
-        if requested_id in list(map(int, other_clients_ids)):
-            r = f"connect {requested_id}"
-            client_socket.send(r.encode('utf-8'))
-
-            other_ip_and_port = client_socket.recv(1024).decode('utf-8')
-            other_ip, other_port = other_ip_and_port.split(':')
-            other_port = int(other_port)
-
-            direct_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-
-            time.sleep(2)
-            print(other_ip)
-            print(other_port)
-            direct_socket.connect((other_ip, other_port))
-
+        joined, left = rendezvous.updates(subscription, directory)
+        joined = [peer_id for peer_id in joined if peer_id != client_id]
+        if joined or left:
+            print(f"Joined since: {joined}, left since: {left}")
+        other_address = rendezvous.lookup(requested_id)[requested_id]
+        if other_address is not None:
+            print(f"Client {requested_id} is at {other_address[0]}:{other_address[1]}")
             while True:
-                message = f"{user_input} - {datetime.now()}"
-                direct_socket.send(message.encode('utf-8'))
-                print(f"Sent to other client (ID {requested_id}): {message}")
+                name = input("Enter the name of a file to fetch (nothing to quit): ")
+                if not name:
+                    break
+                try:
+                    stats = download(other_address, name, os.path.join(args.downloads, os.path.basename(name)),
+                                     args.connections)
+                except (OSError, ProtocolError) as e:
+                    # What was fetched is kept: asking again resumes.
+                    print(f"Fetching {name} failed: {e}")
+                    continue
+                seconds = max(stats['seconds'], 1e-9)
+                print(f"Fetched {name}: {stats['size']} bytes in {seconds:.2f}s "
+                      f"({stats['bytes'] / seconds / 1e6:.1f} MB/s), {stats['resumed']} of {stats['chunks']} chunks "
+                      f"already there, {stats['corrupt']} fetched again after failing their check")
 
         else:
             print(f"Invalid client ID: {requested_id}")
@@ -63,8 +233,10 @@ def main():
 
     finally:
         client_socket.close()
+        if share is not None:
+            share.shutdown()
+            share.server_close()
 
 
 if __name__ == "__main__":
     main()
-
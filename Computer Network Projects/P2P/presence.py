@@ -0,0 +1,177 @@
+import asyncio
+import os
+from collections import deque
+
+from protocol import (DEFAULT_PAGE, DELTA_HEADER, FRAME, LAST_PAGE, PRESENCE, SNAPSHOT, SNAPSHOT_HEADER, encode_frame,
+                      encode_ids)
+
+
+class Subscriber:
+    __slots__ = ('writer', 'request_id', 'version', 'syncing')
+
+    def __init__(self, writer, request_id, version):
+        self.writer = writer
+        self.request_id = request_id
+        # The version the client has, or None if it needs a snapshot.
+        self.version = version
+        self.syncing = False
+
+
+def merge(changes, peer_id, joined):
+    '''
+    Records in changes (ID -> joined?) that peer_id joined or left. A join
+    and a leave of the same ID cancel out.
+    '''
+    if changes.get(peer_id, joined) != joined:
+        del changes[peer_id]
+        return True
+    changes[peer_id] = joined
+    return False
+
+
+class PresenceHub:
+    '''
+    Tells subscribed clients about peers joining and leaving. Changes are
+    collected for interval seconds and then go out as one delta to every
+    subscriber, and each delta moves the version on by one: a burst of
+    joins costs one frame per subscriber rather than one per join, and a
+    peer that joins and leaves within one batch is not mentioned at all.
+
+    The last history deltas are kept, so a client that subscribes again
+    with the epoch and version it last had gets what changed since in one
+    delta. A version older than that, or the epoch of another server
+    process, gets a snapshot of every ID, streamed in pages, and deltas from
+    then on. A subscriber whose connection has more than high_water bytes
+    unsent is skipped and caught up the same way once it has drained.
+    '''
+
+    def __init__(self, registry, interval=0.02, history=1024, high_water=256 * 1024, page=DEFAULT_PAGE):
+        self.registry = registry
+        self.interval = interval
+        self.high_water = high_water
+        self.page = page
+        # Never 0, which a client uses for "no epoch yet".
+        self.epoch = int.from_bytes(os.urandom(8), 'big') | 1
+        self.version = 0
+        self.changes = {}
+        # (version, joined, left) of the last deltas.
+        self.history = deque(maxlen=history)
+        self.subscribers = set()
+        self.timer = None
+        self.tasks = set()
+        self.stats = {'deltas': 0, 'joins': 0, 'leaves': 0, 'coalesced': 0, 'snapshots': 0, 'catch_ups': 0}
+
+    def changed(self, peer_id, joined):
+        self.stats['joins' if joined else 'leaves'] += 1
+        if merge(self.changes, peer_id, joined):
+            self.stats['coalesced'] += 1
+        if self.timer is None:
+            self.timer = asyncio.get_running_loop().call_later(self.interval, self.flush)
+
+    def flush(self):
+        self.timer = None
+        if not self.changes:
+            return
+        joined = [peer_id for peer_id, state in self.changes.items() if state]
+        left = [peer_id for peer_id, state in self.changes.items() if not state]
+        self.changes = {}
+        previous = self.version
+        self.version += 1
+        self.history.append((self.version, joined, left))
+        self.stats['deltas'] += 1
+        body = DELTA_HEADER.pack(previous, self.version, len(joined)) + encode_ids(joined) + encode_ids(left)
+        for subscriber in self.subscribers:
+            if subscriber.syncing:
+                continue
+            writer = subscriber.writer
+            if subscriber.version == previous and writer.transport.get_write_buffer_size() <= self.high_water:
+                writer.write(FRAME.pack(len(body), PRESENCE, subscriber.request_id) + body)
+                subscriber.version = self.version
+            else:
+                self.start_sync(subscriber)
+
+    def since(self, version):
+        '''
+        (joined, left) between version and now, or None if the history no
+        longer goes back that far.
+        '''
+        if version == self.version:
+            return [], []
+        if not self.history or self.history[0][0] > version + 1 or version > self.version:
+            return None
+        changes = {}
+        for batch_version, joined, left in self.history:
+            if batch_version <= version:
+                continue
+            for peer_id in joined:
+                merge(changes, peer_id, True)
+            for peer_id in left:
+                merge(changes, peer_id, False)
+        return ([peer_id for peer_id, state in changes.items() if state],
+                [peer_id for peer_id, state in changes.items() if not state])
+
+    def subscribe(self, writer, request_id, epoch, version):
+        subscriber = Subscriber(writer, request_id, version if epoch == self.epoch else None)
+        self.subscribers.add(subscriber)
+        self.start_sync(subscriber, confirm=True)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        self.subscribers.discard(subscriber)
+
+    def start_sync(self, subscriber, confirm=False):
+        subscriber.syncing = True
+        task = asyncio.create_task(self.sync(subscriber, confirm))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def sync(self, subscriber, confirm):
+        '''
+        Brings subscriber up to the current version. With confirm it is sent
+        a delta even if it is up to date already, so a client that
+        subscribes always hears back.
+        '''
+        writer = subscriber.writer
+        try:
+            while subscriber in self.subscribers and not writer.is_closing():
+                await writer.drain()
+                if subscriber.version == self.version and not confirm:
+                    break
+                confirm = False
+                changes = self.since(subscriber.version) if subscriber.version is not None else None
+                if changes is None:
+                    self.stats['snapshots'] += 1
+                    await self.send_snapshot(subscriber)
+                    continue
+                self.stats['catch_ups'] += 1
+                joined, left = changes
+                writer.write(encode_frame(PRESENCE, subscriber.request_id, DELTA_HEADER.pack(
+                    subscriber.version, self.version, len(joined)) + encode_ids(joined) + encode_ids(left)))
+                subscriber.version = self.version
+        except OSError:
+            pass
+        finally:
+            subscriber.syncing = False
+
+    def ids_at_version(self):
+        '''
+        The IDs as of self.version: without the joins and with the leaves
+        still waiting for the next delta, which would otherwise tell the
+        subscriber about them again, or, if a join and a leave cancel out
+        in it, not tell it that a peer it was shown has gone.
+        '''
+        changes = self.changes
+        ids = [peer_id for peer_id in self.registry.ids() if changes.get(peer_id) is not True]
+        ids.extend(peer_id for peer_id, state in changes.items() if not state)
+        return ids
+
+    async def send_snapshot(self, subscriber):
+        # A copy: peers may come and go while earlier pages are sent.
+        ids = self.ids_at_version()
+        version = self.version
+        for start in range(0, max(len(ids), 1), self.page):
+            flags = LAST_PAGE if start + self.page >= len(ids) else 0
+            subscriber.writer.write(encode_frame(SNAPSHOT, subscriber.request_id, SNAPSHOT_HEADER.pack(
+                self.epoch, version, flags) + encode_ids(ids[start:start + self.page])))
+            await subscriber.writer.drain()
+        subscriber.version = version
@@ -0,0 +1,108 @@
+import socket
+import struct
+
+# Every message is a frame: the length of the body, the message type and a
+# request ID the reply carries back, so a client can have several requests
+# outstanding and match the replies up; then the body.
+FRAME = struct.Struct('!IBI')
+MAX_BODY = 1 << 20
+
+# Client to server.
+HELLO = 1     # DATA_PORT, then greeting text
+LOOKUP = 2    # one or more peer IDs
+LIST = 3      # page size, or 0 for the server's default
+SUBSCRIBE = 4  # SUBSCRIPTION: the epoch and version to go on from, or zeros
+# Server to client.
+WELCOME = 64  # client ID, then public IP text
+PEERS = 65    # flags, then up to a page of peer IDs
+ADDRESSES = 66  # an ADDRESS for each ID looked up, in order
+SNAPSHOT = 67  # SNAPSHOT_HEADER, then up to a page of the IDs of all peers
+PRESENCE = 68  # DELTA_HEADER, then the IDs that joined, then those that left
+# Peer to peer, on the data connections of transfer.py.
+OPEN = 16     # file name
+GET = 17      # CHUNK_INDEX
+MANIFEST = 80  # MANIFEST_HEADER, then the SHA-256 of every chunk
+CHUNK = 81    # the bytes of the chunk asked for
+ERROR = 127   # error text
+
+ID = struct.Struct('!I')
+# The port the peer accepts data connections on, or 0 for none: lookups
+# then give the address of its connection to the server.
+DATA_PORT = struct.Struct('!H')
+PAGE_FLAGS = struct.Struct('!B')
+LAST_PAGE = 1
+# An unknown ID comes back as 0.0.0.0 port 0.
+ADDRESS = struct.Struct('!I4sH')
+DEFAULT_PAGE = 1024
+# Epoch (which server process the versions are of) and version.
+SUBSCRIPTION = struct.Struct('!QQ')
+# Epoch, version, flags.
+SNAPSHOT_HEADER = struct.Struct('!QQB')
+# Version before, version after, number of IDs that joined.
+DELTA_HEADER = struct.Struct('!QQI')
+# File size, chunk size.
+MANIFEST_HEADER = struct.Struct('!QI')
+CHUNK_INDEX = struct.Struct('!I')
+
+
+class ProtocolError(Exception):
+    pass
+
+
+def encode_frame(kind, request_id, body=b''):
+    return FRAME.pack(len(body), kind, request_id) + body
+
+
+def encode_ids(ids):
+    return struct.pack(f'!{len(ids)}I', *ids)
+
+
+def decode_ids(body, offset=0):
+    count = (len(body) - offset) // ID.size
+    return list(struct.unpack_from(f'!{count}I', body, offset))
+
+
+def encode_address(peer_id, addr):
+    if addr is None:
+        return ADDRESS.pack(peer_id, bytes(4), 0)
+    return ADDRESS.pack(peer_id, socket.inet_aton(addr[0]), addr[1])
+
+
+def decode_addresses(body):
+    '''
+    (ID, (host, port) or None) for each address in an ADDRESSES body.
+    '''
+    addresses = []
+    for peer_id, host, port in ADDRESS.iter_unpack(body):
+        addresses.append((peer_id, (socket.inet_ntoa(host), port) if port else None))
+    return addresses
+
+
+class FrameReader:
+    '''
+    Cuts a byte stream into frames however it arrives: feed() it what was
+    received and it returns the (type, request ID, body) of every frame
+    completed. Raises ProtocolError for a body longer than MAX_BODY.
+    '''
+
+    def __init__(self, max_body=MAX_BODY):
+        self.buffer = bytearray()
+        self.max_body = max_body
+
+    def feed(self, data):
+        self.buffer += data
+        frames = []
+        offset = 0
+        buffer = self.buffer
+        while len(buffer) - offset >= FRAME.size:
+            length, kind, request_id = FRAME.unpack_from(buffer, offset)
+            if length > self.max_body:
+                raise ProtocolError(f"frame of {length} bytes")
+            end = offset + FRAME.size + length
+            if len(buffer) < end:
+                break
+            frames.append((kind, request_id, bytes(buffer[offset + FRAME.size:end])))
+            offset = end
+        if offset:
+            del buffer[:offset]
+        return frames
@@ -1,88 +1,297 @@
+import argparse
+import asyncio
+import resource
+import shutil
+import signal
 import socket
-import threading
+import tempfile
 
-clients = {}
-client_count = 0
+from presence import PresenceHub
+from protocol import (ADDRESSES, DATA_PORT, DEFAULT_PAGE, ERROR, HELLO, ID, LAST_PAGE, LIST, LOOKUP, MAX_BODY, PAGE_FLAGS, PEERS,
+                      SUBSCRIBE, SUBSCRIPTION, WELCOME, FrameReader, ProtocolError, decode_ids, encode_address,
+                      encode_frame, encode_ids)
+from shards import ShardLinks, supervise
 
+# Seconds a stopping server waits for the replies it already wrote to reach
+# its clients before it drops their connections.
+CLOSE_TIMEOUT = 1.0
 
-def handle_client_messages(client_socket, addr, client_id):
+
+class Peer:
+    __slots__ = ('id', 'addr', 'writer', 'source')
+
+    def __init__(self, peer_id, addr, writer=None, source=None):
+        self.id = peer_id
+        self.addr = addr
+        # The control connection, for peers registered on this process.
+        self.writer = writer
+        # The link a replica came over from another worker, else None.
+        self.source = source
+
+
+class PeerRegistry:
     '''
-    This function checks the receiving messages from clients and if the message starts with connect
-    it means that a client has requested to connect to another client, thus the IP and port of the
-    requested client will be sent back to it.
+    The registered peers by ID. Everything runs on one event loop and none
+    of these methods awaits, so a register, lookup or unregister never sees
+    another one half done and no lock is needed; a lookup is one dict access
+    however many peers there are.
+
+    With several workers, worker shard of shards hands out the IDs
+    shard + 1, shard + 1 + shards, ... so they never clash, and also holds
+    replicas of the peers registered on the others (see ShardLinks).
+
+    Every ID that appears or goes is passed on to presence (a PresenceHub),
+    if set.
     '''
-    try:
-        while True:
-            message = client_socket.recv(1024).decode('utf-8')
 
-            if message.startswith("connect"):
-                requested_id = int(message.split()[1])
+    def __init__(self, shard=0, shards=1):
+        self.peers = {}
+        self.shards = shards
+        self.next_id = shard + 1
+        self.presence = None
 
-                if requested_id in clients:
-                    requested_client_socket, requested_client_addr = clients[requested_id]
-                    client_socket.send(f"{requested_client_addr[0]}:{requested_client_addr[1]}".encode('utf-8'))
-                else:
-                    client_socket.send("Invalid client ID".encode('utf-8'))
+    def __len__(self):
+        return len(self.peers)
 
-            elif not message:
-                break
+    def register(self, addr, writer):
+        peer = Peer(self.next_id, addr, writer)
+        self.next_id += self.shards
+        self.add(peer)
+        return peer
 
-            print(f"Received from {addr} (ID {client_id}): {message}")
+    def unregister(self, peer):
+        if self.peers.get(peer.id) is peer:
+            self.remove(peer.id)
 
-    except Exception as e:
-        print(f"Error handling messages from {addr}: {e}")
-    finally:
-        del clients[client_id]
-        client_socket.close()
+    def add(self, peer):
+        if peer.id not in self.peers and self.presence is not None:
+            self.presence.changed(peer.id, True)
+        self.peers[peer.id] = peer
+
+    def remove(self, peer_id):
+        del self.peers[peer_id]
+        if self.presence is not None:
+            self.presence.changed(peer_id, False)
+
+    def lookup(self, peer_id):
+        return self.peers.get(peer_id)
+
+    def ids(self):
+        return self.peers.keys()
+
+    def local_peers(self):
+        return [peer for peer in self.peers.values() if peer.source is None]
+
+    def add_replica(self, peer_id, addr, source):
+        if peer_id in self.peers and self.peers[peer_id].source is None:
+            return
+        self.add(Peer(peer_id, addr, source=source))
+
+    def remove_replica(self, peer_id, source):
+        peer = self.peers.get(peer_id)
+        if peer is not None and peer.source is source:
+            self.remove(peer_id)
 
+    def drop_source(self, source):
+        for peer_id in [peer.id for peer in self.peers.values() if peer.source is source]:
+            self.remove(peer_id)
 
-def accept_clients(server_socket):
+
+class RendezvousServer:
     '''
-    here in this function an ID will be assigned to each new client
-    and their messages will be shown and all the available clients
-    and their equivalent IDs will be sent to the new arriving clients.
+    Serves every client from one event loop, in the framed protocol of
+    protocol.py. A client says HELLO with the port it takes data connections
+    on (which lookups give with its public IP) and a greeting, and gets its
+    ID and public IP back; after that it may LOOKUP the addresses of peers and LIST
+    the IDs of the others, or SUBSCRIBE to be told of every peer that joins
+    or leaves from then on (see PresenceHub). Requests may be pipelined: all the frames that
+    arrive together are answered in order in one write, except that a LIST
+    is streamed a page at a time so a large directory is never built up in
+    one buffer.
     '''
-    global client_count
-    while True:
-        try:
-            client_socket, addr = server_socket.accept()
 
-            client_count += 1
-            client_id = client_count
+    def __init__(self, registry, presence, links=None, verbose=True):
+        self.registry = registry
+        self.presence = presence
+        self.links = links
+        self.verbose = verbose
+        # Open client connections, and the tasks serving them.
+        self.connections = {}
 
-            input_string = client_socket.recv(1024).decode('utf-8')
-            print(f"Received from {addr} (ID {client_id}): {input_string}")
+    def log(self, message):
+        if self.verbose:
+            print(message)
 
-            client_socket.send(str(client_id).encode('utf-8'))
-            client_socket.send(str(addr[0]).encode('utf-8'))
+    def addresses(self, body):
+        replies = []
+        for peer_id in decode_ids(body):
+            peer = self.registry.lookup(peer_id)
+            replies.append(encode_address(peer_id, peer.addr if peer is not None else None))
+        return b''.join(replies)
 
-            clients[client_id] = (client_socket, addr)
+    async def send_directory(self, writer, request_id, body, own_id):
+        page = ID.unpack(body)[0] if len(body) == ID.size else 0
+        page = min(page or DEFAULT_PAGE, MAX_BODY // ID.size - 1)
+        # A copy: peers may come and go while earlier pages are sent.
+        ids = [peer_id for peer_id in self.registry.ids() if peer_id != own_id]
+        for start in range(0, max(len(ids), 1), page):
+            chunk = ids[start:start + page]
+            flags = LAST_PAGE if start + page >= len(ids) else 0
+            writer.write(encode_frame(PEERS, request_id, PAGE_FLAGS.pack(flags) + encode_ids(chunk)))
+            await writer.drain()
 
-            other_clients_ids = [str(other_client_id) for other_client_id in clients if other_client_id != client_id]
-            client_socket.send(','.join(other_clients_ids).encode('utf-8'))
+    async def handle_client(self, reader, writer):
+        addr = writer.get_extra_info('peername')[:2]
+        frames = FrameReader()
+        peer = None
+        subscription = None
+        self.connections[writer] = asyncio.current_task()
+        try:
+            while True:
+                data = await reader.read(65536)
+                if not data:
+                    break
+                replies = bytearray()
+                for kind, request_id, body in frames.feed(data):
+                    if kind == HELLO and peer is None and len(body) < DATA_PORT.size:
+                        replies += encode_frame(ERROR, request_id, b"malformed HELLO")
+                    elif kind == HELLO and peer is None:
+                        data_port, = DATA_PORT.unpack_from(body)
+                        body = body[DATA_PORT.size:]
+                        peer = self.registry.register((addr[0], data_port) if data_port else addr, writer)
+                        if self.links is not None:
+                            self.links.announce_join(peer)
+                        self.log(f"Received from {addr} (ID {peer.id}): {body.decode('utf-8', 'replace')}")
+                        replies += encode_frame(WELCOME, request_id, ID.pack(peer.id) + addr[0].encode())
+                    elif peer is None:
+                        replies += encode_frame(ERROR, request_id, b"HELLO first")
+                    elif kind == LOOKUP:
+                        replies += encode_frame(ADDRESSES, request_id, self.addresses(body))
+                    elif kind == LIST:
+                        writer.write(replies)
+                        replies = bytearray()
+                        await self.send_directory(writer, request_id, body, peer.id)
+                    elif kind == SUBSCRIBE and len(body) != SUBSCRIPTION.size:
+                        replies += encode_frame(ERROR, request_id, b"malformed SUBSCRIBE")
+                    elif kind == SUBSCRIBE:
+                        # After the replies so far, which the snapshot or
+                        # delta must not overtake.
+                        writer.write(replies)
+                        replies = bytearray()
+                        if subscription is not None:
+                            self.presence.unsubscribe(subscription)
+                        subscription = self.presence.subscribe(writer, request_id, *SUBSCRIPTION.unpack(body))
+                    else:
+                        replies += encode_frame(ERROR, request_id, f"unexpected message type {kind}".encode())
+                if replies:
+                    writer.write(replies)
+                    await writer.drain()
+        except ProtocolError as e:
+            self.log(f"Error handling messages from {addr}: {e}")
+            writer.write(encode_frame(ERROR, 0, str(e).encode()))
+        except OSError as e:
+            self.log(f"Error handling messages from {addr}: {e}")
+        finally:
+            if subscription is not None:
+                self.presence.unsubscribe(subscription)
+            if peer is not None:
+                # Announced to the subscribers with the next delta.
+                self.registry.unregister(peer)
+                if self.links is not None:
+                    self.links.announce_leave(peer)
+            del self.connections[writer]
+            writer.close()
 
-            threading.Thread(target=handle_client_messages, args=(client_socket, addr, client_id)).start()
+    async def close(self, timeout=CLOSE_TIMEOUT):
+        '''
+        Closes every client connection and waits for the tasks serving
+        them to finish. Peers stay connected for as long as they run, so
+        there is nothing to drain: only what was already written is given
+        up to timeout seconds to go out. A client that is not reading would
+        hold its task in drain() for good, so the connections still open
+        after that are aborted.
+        '''
+        for writer in self.connections:
+            writer.close()
+        if not self.connections:
+            return
+        _, pending = await asyncio.wait(set(self.connections.values()), timeout=timeout)
+        for writer in self.connections:
+            writer.transport.abort()
+        await asyncio.gather(*pending, return_exceptions=True)
 
-        except Exception as e:
-            print(f"Error accepting connection from client: {e}")
 
+def raise_file_limit():
+    '''
+    Every peer holds a socket open: lift the soft limit on open files to the
+    hard one.
+    '''
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
 
-def main():
-    host = '127.0.0.1'
-    port = 11112
 
-    server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    server_socket.bind((host, port))
-    server_socket.listen(5)
+def create_listening_socket(host, port, backlog, reuse_port):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    sock.setblocking(False)
+    return sock
+
 
-    print(f"Server listening on {host}:{port}")
+async def serve(args, shard=0, shards=1, directory=None):
+    registry = PeerRegistry(shard, shards)
+    registry.presence = presence = PresenceHub(registry, args.presence_interval)
+    links = None
+    if shards > 1:
+        links = ShardLinks(registry, directory, shard, shards)
+        await links.start()
+    server = RendezvousServer(registry, presence, links, verbose=not args.quiet)
+    sock = create_listening_socket(args.host, args.port, args.backlog, reuse_port=shards > 1)
+    listener = await asyncio.start_server(server.handle_client, sock=sock)
+    if shard == 0:
+        print(f"Server listening on {args.host}:{args.port}")
 
-    threading.Thread(target=accept_clients, args=(server_socket,)).start()
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, stop.set)
+    await stop.wait()
+    listener.close()
+    await server.close()
+    if links is not None:
+        await links.close()
 
-    while True:
-        pass
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="P2P rendezvous server")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=11112)
+    parser.add_argument('--backlog', type=int, default=4096,
+                        help="connections the kernel queues before they are accepted")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="processes sharing the port with SO_REUSEPORT; more than 1 starts a supervisor")
+    parser.add_argument('--presence-interval', type=float, default=0.02,
+                        help="seconds joins and leaves are collected for before subscribers are told")
+    parser.add_argument('--quiet', action='store_true', help="do not print every message received")
+    return parser.parse_args(argv)
+
+
+def main():
+    args = parse_args()
+    raise_file_limit()
+    if args.workers <= 1:
+        asyncio.run(serve(args))
+        return
+    directory = tempfile.mkdtemp(prefix='p2p-shards-')
+    try:
+        supervise(lambda index: asyncio.run(serve(args, index, args.workers, directory)), args.workers)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
 
 
 if __name__ == "__main__":
     main()
-
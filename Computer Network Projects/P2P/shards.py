@@ -0,0 +1,179 @@
+import asyncio
+import os
+import signal
+import time
+
+
+class ShardLinks:
+    '''
+    Keeps the registries of the worker processes in step, so every worker
+    can answer a lookup for any peer from its own dict. Each worker listens
+    on a Unix socket in directory and connects to every other worker's.
+    Down those connections it sends a line for each peer that registers on
+    it ("join <id> <host> <port>") or leaves ("leave <id>"), starting with
+    every peer it has when the connection is made. What arrives from the
+    others goes into the registry as replicas.
+
+    When a worker exits the connections from it close and its peers are
+    dropped, since their control connections died with it. The replicas are
+    only eventually consistent: a peer may be looked up on another worker a
+    moment before its join arrives there.
+    '''
+
+    def __init__(self, registry, directory, shard, shards, retry=0.2):
+        self.registry = registry
+        self.directory = directory
+        self.shard = shard
+        self.shards = shards
+        self.retry = retry
+        self.writers = {}
+        self.server = None
+        self.tasks = []
+        # Connections from the other workers, and the tasks reading them.
+        self.incoming = {}
+
+    def path(self, shard):
+        return os.path.join(self.directory, f'shard-{shard}.sock')
+
+    async def start(self):
+        path = self.path(self.shard)
+        if os.path.exists(path):
+            # Left by the worker this one replaces.
+            os.unlink(path)
+        self.server = await asyncio.start_unix_server(self.handle_shard, path)
+        self.tasks = [asyncio.create_task(self.connect(other)) for other in range(self.shards) if other != self.shard]
+
+    async def close(self):
+        self.server.close()
+        for task in self.tasks:
+            task.cancel()
+        for writer in self.incoming:
+            writer.close()
+        await asyncio.gather(*self.tasks, *self.incoming.values(), return_exceptions=True)
+
+    async def connect(self, other):
+        while True:
+            try:
+                reader, writer = await asyncio.open_unix_connection(self.path(other))
+            except OSError:
+                await asyncio.sleep(self.retry)
+                continue
+            lines = [f'hello {self.shard}\n']
+            lines.extend(self.join_line(peer) for peer in self.registry.local_peers())
+            writer.write(''.join(lines).encode())
+            self.writers[other] = writer
+            try:
+                # Nothing is sent the other way: this only returns once the
+                # other worker has gone.
+                await reader.read()
+            except OSError:
+                pass
+            finally:
+                del self.writers[other]
+                writer.close()
+
+    def join_line(self, peer):
+        return f'join {peer.id} {peer.addr[0]} {peer.addr[1]}\n'
+
+    def broadcast(self, line):
+        data = line.encode()
+        for writer in self.writers.values():
+            writer.write(data)
+
+    def announce_join(self, peer):
+        if self.writers:
+            self.broadcast(self.join_line(peer))
+
+    def announce_leave(self, peer):
+        if self.writers:
+            self.broadcast(f'leave {peer.id}\n')
+
+    async def handle_shard(self, reader, writer):
+        # Replicas are tagged with the connection they came over, so peers
+        # from a worker that has just been replaced are not dropped along
+        # with those of the one before it.
+        source = writer
+        self.incoming[writer] = asyncio.current_task()
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                fields = line.split()
+                if fields[0] == b'join':
+                    self.registry.add_replica(int(fields[1]), (fields[2].decode(), int(fields[3])), source)
+                elif fields[0] == b'leave':
+                    self.registry.remove_replica(int(fields[1]), source)
+        except (OSError, ValueError, IndexError):
+            pass
+        finally:
+            self.registry.drop_source(source)
+            del self.incoming[writer]
+            writer.close()
+
+
+def spawn_worker(run, worker_index):
+    pid = os.fork()
+    if pid:
+        return pid
+
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    code = 0
+    try:
+        run(worker_index)
+    except SystemExit as e:
+        code = e.code if isinstance(e.code, int) else 1
+    except BaseException as e:
+        print(f"Worker {os.getpid()} crashed:", e)
+        code = 1
+    finally:
+        os._exit(code)
+
+
+def supervise(run, count):
+    '''
+    Runs count worker processes, each calling run(worker_index), and
+    restarts any that exit. The index is the worker's shard: its
+    replacement takes over the same Unix socket, and the other workers'
+    links reconnect to it. The peers of a worker that exits lose their
+    control connections with it, and the other workers drop their replicas
+    once its links close, so those peers have to register again. SIGTERM
+    and SIGINT stop the workers, which close their client connections
+    rather than wait for them to finish (see RendezvousServer.close()).
+    '''
+    shutting_down = False
+    workers = {}
+
+    def request_shutdown(signum, frame):
+        nonlocal shutting_down
+        shutting_down = True
+        for pid in workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, request_shutdown)
+    signal.signal(signal.SIGINT, request_shutdown)
+
+    for index in range(count):
+        workers[spawn_worker(run, index)] = (index, time.monotonic())
+    print(f"Supervisor {os.getpid()} started {count} workers")
+
+    while workers:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        worker = workers.pop(pid, None)
+        if worker is None or shutting_down:
+            continue
+        index, started = worker
+
+        print(f"Worker {pid} exited with status {os.waitstatus_to_exitcode(status)}, restarting")
+        if time.monotonic() - started < 1.0:
+            # Crashing straight after start: do not fork in a tight loop.
+            time.sleep(1.0)
+        if not shutting_down:
+            workers[spawn_worker(run, index)] = (index, time.monotonic())
@@ -0,0 +1,135 @@
+import asyncio
+import unittest
+
+from client import PeerDirectory
+from presence import PresenceHub
+from protocol import DELTA_HEADER, PRESENCE, SNAPSHOT, FrameReader, decode_ids
+from server import PeerRegistry
+
+
+class Writer:
+    '''
+    Keeps what is written; while blocked it reports a full write buffer and
+    drain() waits.
+    '''
+
+    def __init__(self):
+        self.frames = FrameReader()
+        self.received = []
+        self.transport = self
+        self.drained = asyncio.Event()
+        self.drained.set()
+
+    def write(self, data):
+        self.received += self.frames.feed(data)
+
+    async def drain(self):
+        await self.drained.wait()
+
+    def is_closing(self):
+        return False
+
+    def get_write_buffer_size(self):
+        return 0 if self.drained.is_set() else 1 << 30
+
+    def take(self):
+        received, self.received = self.received, []
+        return received
+
+
+class PresenceTest(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.registry = PeerRegistry()
+        self.hub = self.registry.presence = PresenceHub(self.registry, interval=0.01, history=4, page=3)
+
+    async def settle(self):
+        await asyncio.sleep(0.05)
+
+    def apply(self, directory, writer):
+        for kind, request_id, body in writer.take():
+            self.assertEqual(request_id, 7)
+            directory.apply(kind, body)
+        self.assertEqual(directory.ids, set(self.registry.ids()))
+
+    async def subscribe(self, directory):
+        writer = Writer()
+        subscriber = self.hub.subscribe(writer, 7, directory.epoch, directory.version)
+        await self.settle()
+        return writer, subscriber
+
+    async def test_new_subscriber_gets_a_paged_snapshot(self):
+        for index in range(7):
+            self.registry.register(('192.0.2.1', 4000 + index), None)
+        await self.settle()
+        directory = PeerDirectory()
+        writer, _ = await self.subscribe(directory)
+        self.assertEqual([kind for kind, _, _ in writer.received], [SNAPSHOT] * 3)
+        self.apply(directory, writer)
+        self.assertTrue(directory.ready())
+        self.assertEqual(directory.version, self.hub.version)
+
+    async def test_changes_go_out_as_one_delta(self):
+        directory = PeerDirectory()
+        writer, _ = await self.subscribe(directory)
+        self.apply(directory, writer)
+        staying = [self.registry.register(('192.0.2.1', 4000 + index), None) for index in range(50)]
+        passing = self.registry.register(('192.0.2.2', 4000), None)
+        self.registry.unregister(passing)
+        await self.settle()
+        self.assertEqual([kind for kind, _, _ in writer.received], [PRESENCE])
+        self.assertEqual(self.hub.stats['coalesced'], 1)
+        ids = decode_ids(writer.received[0][2], DELTA_HEADER.size)
+        self.assertEqual(sorted(ids), sorted(peer.id for peer in staying))
+        self.apply(directory, writer)
+
+        self.registry.unregister(staying[0])
+        await self.settle()
+        self.apply(directory, writer)
+
+    async def test_resubscribing_gets_what_changed_since(self):
+        directory = PeerDirectory()
+        writer, subscriber = await self.subscribe(directory)
+        self.apply(directory, writer)
+        self.hub.unsubscribe(subscriber)
+        peers = [self.registry.register(('192.0.2.1', 4000 + index), None) for index in range(3)]
+        await self.settle()
+        self.registry.unregister(peers[1])
+        await self.settle()
+
+        writer, _ = await self.subscribe(directory)
+        self.assertEqual([kind for kind, _, _ in writer.received], [PRESENCE])
+        self.apply(directory, writer)
+        self.assertEqual(self.hub.stats['snapshots'], 1)
+
+        # The history has only the last four deltas; further back, or
+        # another epoch, and it takes a snapshot.
+        for index in range(5):
+            self.registry.register(('192.0.2.3', 4000 + index), None)
+            await self.settle()
+        self.assertIsNone(self.hub.since(directory.version))
+        for epoch in (directory.epoch, directory.epoch + 2):
+            stale = PeerDirectory()
+            stale.ids, stale.epoch, stale.version = set(directory.ids), epoch, directory.version
+            writer, _ = await self.subscribe(stale)
+            self.assertEqual({kind for kind, _, _ in writer.received}, {SNAPSHOT})
+            self.apply(stale, writer)
+
+    async def test_slow_subscriber_is_caught_up_once_it_drains(self):
+        directory = PeerDirectory()
+        writer, _ = await self.subscribe(directory)
+        self.apply(directory, writer)
+        writer.drained.clear()
+        for index in range(3):
+            self.registry.register(('192.0.2.1', 4000 + index), None)
+            await self.settle()
+        self.assertEqual(writer.received, [])
+        writer.drained.set()
+        await self.settle()
+        self.assertEqual([kind for kind, _, _ in writer.received], [PRESENCE])
+        self.apply(directory, writer)
+        self.assertEqual((self.hub.stats['snapshots'], self.hub.stats['catch_ups']), (1, 1))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,41 @@
+import unittest
+
+from protocol import (FRAME, HELLO, LOOKUP, FrameReader, ProtocolError, decode_addresses, decode_ids,
+                      encode_address, encode_frame, encode_ids)
+
+
+class FrameReaderTest(unittest.TestCase):
+
+    def test_frames_are_cut_out_however_the_stream_arrives(self):
+        stream = encode_frame(HELLO, 1, b'\x00\x00hello') + encode_frame(LOOKUP, 2) + encode_frame(LOOKUP, 3, b'x' * 100)
+        expected = [(HELLO, 1, b'\x00\x00hello'), (LOOKUP, 2, b''), (LOOKUP, 3, b'x' * 100)]
+        for size in (1, 2, FRAME.size, 7, len(stream)):
+            reader = FrameReader()
+            frames = []
+            for start in range(0, len(stream), size):
+                frames += reader.feed(stream[start:start + size])
+            self.assertEqual(frames, expected, size)
+            self.assertEqual(reader.buffer, b'')
+
+    def test_oversized_frame(self):
+        reader = FrameReader(max_body=10)
+        self.assertEqual(reader.feed(encode_frame(LOOKUP, 1, bytes(10))), [(LOOKUP, 1, bytes(10))])
+        # Refused from its header alone, before the body is buffered.
+        with self.assertRaises(ProtocolError):
+            reader.feed(encode_frame(LOOKUP, 2, bytes(11))[:FRAME.size])
+
+
+class BodyTest(unittest.TestCase):
+
+    def test_ids(self):
+        self.assertEqual(decode_ids(encode_ids([1, 2 ** 32 - 1])), [1, 2 ** 32 - 1])
+        self.assertEqual(decode_ids(b'\x07' + encode_ids([5]), 1), [5])
+        self.assertEqual(decode_ids(b''), [])
+
+    def test_addresses(self):
+        body = encode_address(1, ('192.0.2.1', 4000)) + encode_address(2, None)
+        self.assertEqual(decode_addresses(body), [(1, ('192.0.2.1', 4000)), (2, None)])
+
+
+if __name__ == '__main__':
+    unittest.main()
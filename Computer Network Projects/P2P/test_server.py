@@ -0,0 +1,152 @@
+import asyncio
+import socket
+import tempfile
+import time
+import unittest
+
+from protocol import (ADDRESSES, DATA_PORT, ERROR, HELLO, ID, LAST_PAGE, LIST, LOOKUP, PAGE_FLAGS, PEERS, WELCOME,
+                      FrameReader, decode_addresses, decode_ids, encode_frame, encode_ids)
+from server import PeerRegistry, RendezvousServer
+from shards import ShardLinks
+
+
+async def until(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError("condition not met in time")
+        await asyncio.sleep(0.01)
+
+
+class ProtocolTest(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.registry = PeerRegistry()
+        self.server = RendezvousServer(self.registry, None, verbose=False)
+        listener = await asyncio.start_server(self.server.handle_client, '127.0.0.1', 0)
+        self.addCleanup(listener.close)
+        self.address = listener.sockets[0].getsockname()
+
+    async def connect(self):
+        reader, writer = await asyncio.open_connection(*self.address)
+        self.addCleanup(writer.close)
+        return reader, writer, FrameReader()
+
+    async def receive(self, reader, frames, count):
+        received = []
+        while len(received) < count:
+            data = await asyncio.wait_for(reader.read(65536), 5)
+            self.assertTrue(data, "connection closed")
+            received += frames.feed(data)
+        return received
+
+    async def test_pipelined_requests_are_answered_in_order(self):
+        others = [self.registry.register(('192.0.2.1', 4000 + index), None) for index in range(5)]
+        reader, writer, frames = await self.connect()
+        writer.write(encode_frame(HELLO, 1, DATA_PORT.pack(5000) + b'hi')
+                     + encode_frame(LOOKUP, 2, encode_ids([others[0].id, 999]))
+                     + encode_frame(LIST, 3, ID.pack(2)))
+        welcome, addresses, *pages = await self.receive(reader, frames, 5)
+
+        self.assertEqual(welcome[:2], (WELCOME, 1))
+        own_id = ID.unpack_from(welcome[2])[0]
+        self.assertEqual(welcome[2][ID.size:], b'127.0.0.1')
+        self.assertEqual(self.registry.lookup(own_id).addr, ('127.0.0.1', 5000))
+        self.assertEqual(addresses[:2], (ADDRESSES, 2))
+        self.assertEqual(decode_addresses(addresses[2]), [(others[0].id, ('192.0.2.1', 4000)), (999, None)])
+        # Five other peers, two to a page.
+        self.assertEqual([(kind, request_id) for kind, request_id, _ in pages], [(PEERS, 3)] * 3)
+        self.assertEqual([PAGE_FLAGS.unpack_from(body)[0] for _, _, body in pages], [0, 0, LAST_PAGE])
+        listed = [peer_id for _, _, body in pages for peer_id in decode_ids(body, PAGE_FLAGS.size)]
+        self.assertEqual(sorted(listed), sorted(peer.id for peer in others))
+
+    async def test_errors(self):
+        reader, writer, frames = await self.connect()
+        writer.write(encode_frame(LOOKUP, 1, encode_ids([1])) + encode_frame(HELLO, 2, b'\x00')
+                     + encode_frame(HELLO, 3, DATA_PORT.pack(0)) + encode_frame(99, 4))
+        replies = await self.receive(reader, frames, 4)
+        self.assertEqual([(kind, request_id) for kind, request_id, _ in replies],
+                         [(ERROR, 1), (ERROR, 2), (WELCOME, 3), (ERROR, 4)])
+        self.assertEqual(replies[0][2], b"HELLO first")
+
+    async def test_oversized_frame_closes_the_connection(self):
+        reader, writer, frames = await self.connect()
+        writer.write(encode_frame(HELLO, 1, DATA_PORT.pack(0)))
+        self.assertEqual((await self.receive(reader, frames, 1))[0][0], WELCOME)
+        writer.write(bytes([0xFF] * 4) + bytes(5))
+        self.assertEqual((await self.receive(reader, frames, 1))[0][:2], (ERROR, 0))
+        self.assertEqual(await asyncio.wait_for(reader.read(), 5), b'')
+        await until(lambda: not self.server.connections)
+        self.assertEqual(len(self.registry), 0)
+
+
+class CloseTest(unittest.IsolatedAsyncioTestCase):
+
+    async def test_close_drops_a_client_that_is_not_reading(self):
+        server = RendezvousServer(PeerRegistry(), None, verbose=False)
+        listener = await asyncio.start_server(server.handle_client, '127.0.0.1', 0)
+        self.addCleanup(listener.close)
+        client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        client.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+        client.connect(listener.sockets[0].getsockname())
+        self.addCleanup(client.close)
+        client.setblocking(False)
+        client.send(encode_frame(HELLO, 1, DATA_PORT.pack(0) + b'hi'))
+        # Lookups whose replies the client never reads, until the server
+        # cannot write any more.
+        lookup = encode_frame(LOOKUP, 2, encode_ids(range(1, 1000)))
+        blocked = 0
+        while blocked < 20:
+            try:
+                client.send(lookup)
+            except BlockingIOError:
+                blocked += 1
+                await asyncio.sleep(0.01)
+        await until(lambda: server.connections)
+
+        started = time.monotonic()
+        await asyncio.wait_for(server.close(timeout=0.2), 5)
+        self.assertLess(time.monotonic() - started, 2)
+        self.assertFalse(server.connections)
+
+
+class ShardLinksTest(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.registries = [PeerRegistry(shard, 2) for shard in range(2)]
+        self.links = [ShardLinks(registry, directory.name, shard, 2, retry=0.01)
+                      for shard, registry in enumerate(self.registries)]
+        for links in self.links:
+            await links.start()
+
+    async def asyncTearDown(self):
+        for links in self.links:
+            if links.server.is_serving():
+                await links.close()
+
+    async def test_joins_and_leaves_reach_the_other_worker(self):
+        first, second = self.registries
+        await until(lambda: all(links.writers for links in self.links))
+        peer = first.register(('192.0.2.1', 4000), None)
+        self.links[0].announce_join(peer)
+        await until(lambda: second.lookup(peer.id) is not None)
+        self.assertEqual(second.lookup(peer.id).addr, ('192.0.2.1', 4000))
+        self.assertEqual(peer.id % 2, 1)
+
+        first.unregister(peer)
+        self.links[0].announce_leave(peer)
+        await until(lambda: second.lookup(peer.id) is None)
+
+    async def test_peers_of_a_worker_that_stops_are_dropped(self):
+        first, second = self.registries
+        peer = first.register(('192.0.2.1', 4000), None)
+        self.links[0].announce_join(peer)
+        await until(lambda: second.lookup(peer.id) is not None)
+        await self.links[0].close()
+        await until(lambda: second.lookup(peer.id) is None)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,159 @@
+import os
+import tempfile
+import threading
+import unittest
+
+from protocol import CHUNK, CHUNK_INDEX, FRAME, GET, ProtocolError, encode_frame
+from transfer import ChunkQueue, FileShare, ShareHandler, download, open_file, recv_frame
+
+CHUNK_SIZE = 64 * 1024
+
+
+class CorruptingHandler(ShareHandler):
+    '''
+    Sends every chunk in corrupt with its bytes flipped, once per chunk.
+    '''
+
+    def send_chunk(self, sock, file, request_id, offset, length):
+        if request_id in self.server.corrupt:
+            self.server.corrupt.discard(request_id)
+            sock.sendall(FRAME.pack(length, CHUNK, request_id) + bytes(255 - byte for byte in os.pread(
+                file.fileno(), length, offset)))
+            return
+        super().send_chunk(sock, file, request_id, offset, length)
+
+
+class FailingHandler(ShareHandler):
+    '''
+    Drops the connection instead of sending any chunk past the first limit.
+    '''
+
+    def send_chunk(self, sock, file, request_id, offset, length):
+        if request_id >= self.server.limit:
+            raise ConnectionError("gone")
+        super().send_chunk(sock, file, request_id, offset, length)
+
+
+class TransferTest(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.shared = os.path.join(directory.name, 'shared')
+        self.downloads = os.path.join(directory.name, 'downloads')
+        os.mkdir(self.shared)
+        os.mkdir(self.downloads)
+        self.data = os.urandom(10 * CHUNK_SIZE + 123)
+        with open(os.path.join(self.shared, 'file.bin'), 'wb') as file:
+            file.write(self.data)
+        self.share = FileShare(('127.0.0.1', 0), self.shared, CHUNK_SIZE)
+        self.share.start()
+        self.addCleanup(self.share.server_close)
+        self.addCleanup(self.share.shutdown)
+        self.address = ('127.0.0.1', self.share.port)
+
+    def fetch(self, connections=2, **options):
+        destination = os.path.join(self.downloads, 'file.bin')
+        stats = download(self.address, 'file.bin', destination, connections, **options)
+        with open(destination, 'rb') as file:
+            self.assertEqual(file.read(), self.data)
+        self.assertFalse(os.path.exists(destination + '.part.state'))
+        return stats
+
+    def test_download(self):
+        stats = self.fetch()
+        self.assertEqual((stats['chunks'], stats['fetched'], stats['corrupt']), (11, 11, 0))
+
+    def test_corrupted_chunk_is_fetched_again(self):
+        self.share.RequestHandlerClass = CorruptingHandler
+        self.share.corrupt = {3, 10}
+        stats = self.fetch(connections=3)
+        self.assertEqual((stats['fetched'], stats['corrupt']), (11, 2))
+
+    def test_chunk_that_keeps_failing_gives_up(self):
+        self.share.RequestHandlerClass = CorruptingHandler
+        self.share.corrupt = {4}
+        with self.assertRaises(Exception):
+            self.fetch(connections=1, retries=0)
+
+    def test_interrupted_download_resumes(self):
+        self.share.RequestHandlerClass = FailingHandler
+        self.share.limit = 6
+        with self.assertRaises(OSError):
+            self.fetch(connections=1, depth=1)
+        self.share.RequestHandlerClass = ShareHandler
+        stats = self.fetch()
+        self.assertEqual((stats['resumed'], stats['fetched']), (6, 5))
+
+    def test_changed_file_starts_over(self):
+        self.share.RequestHandlerClass = FailingHandler
+        self.share.limit = 6
+        with self.assertRaises(OSError):
+            self.fetch(connections=1, depth=1)
+        self.data = self.data[::-1]
+        with open(os.path.join(self.shared, 'file.bin'), 'wb') as file:
+            file.write(self.data)
+        self.share.RequestHandlerClass = ShareHandler
+        self.assertEqual(self.fetch()['resumed'], 0)
+
+    def test_names_outside_the_share_are_refused(self):
+        outside = os.path.join(self.downloads, 'secret')
+        with open(outside, 'w') as file:
+            file.write('secret')
+        os.symlink(outside, os.path.join(self.shared, 'link'))
+        os.mkdir(os.path.join(self.shared, 'sub'))
+        os.symlink(os.path.join(self.shared, 'file.bin'), os.path.join(self.shared, 'sub', 'inside'))
+        for name in ('../downloads/secret', outside, 'link', 'sub/../../downloads/secret'):
+            with self.assertRaises(PermissionError):
+                self.share.open(name)
+        self.assertEqual(self.share.open('sub/inside')[0], os.path.realpath(os.path.join(self.shared, 'file.bin')))
+
+    def test_unusable_names_get_an_error(self):
+        for name in ('a\x00b', 'missing', '../downloads'):
+            with self.assertRaises(ProtocolError, msg=name):
+                open_file(self.address, name, 5)
+        # The share still serves other connections.
+        sock, manifest = open_file(self.address, 'file.bin', 5)
+        sock.close()
+        self.assertEqual(manifest.size, len(self.data))
+
+    def test_file_that_shrinks_drops_the_connection(self):
+        sock, manifest = open_file(self.address, 'file.bin', 5)
+        self.addCleanup(sock.close)
+        os.truncate(os.path.join(self.shared, 'file.bin'), CHUNK_SIZE)
+        sock.sendall(encode_frame(GET, 1, CHUNK_INDEX.pack(manifest.count - 1)))
+        # At once, rather than after the receiver's timeout.
+        with self.assertRaises(ConnectionError):
+            recv_frame(sock)
+
+
+class ChunkQueueTest(unittest.TestCase):
+
+    def test_chunk_in_flight_is_not_handed_out_twice(self):
+        chunks = ChunkQueue([0, 1])
+        self.assertEqual(chunks.take(), 0)
+        self.assertEqual(chunks.take(), 1)
+        self.assertIsNone(chunks.take())
+        chunks.settle(0, again=True)
+        chunks.settle(0, again=True)
+        self.assertEqual(chunks.take(), 0)
+        self.assertIsNone(chunks.take())
+
+    def test_idle_connection_waits_for_chunks_in_flight(self):
+        chunks = ChunkQueue([0])
+        self.assertEqual(chunks.take(), 0)
+        taken = []
+        waiter = threading.Thread(target=lambda: taken.append(chunks.take(wait=True)))
+        waiter.start()
+        waiter.join(0.05)
+        self.assertTrue(waiter.is_alive())
+        chunks.settle(0, again=True)
+        waiter.join(5)
+        self.assertEqual(taken, [0])
+        # Nothing waiting and nothing in flight: done.
+        chunks.settle(0)
+        self.assertIsNone(chunks.take(wait=True))
+
+
+if __name__ == '__main__':
+    unittest.main()
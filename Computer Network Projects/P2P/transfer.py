@@ -0,0 +1,416 @@
+import hashlib
+import os
+import socket
+import socketserver
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from protocol import (CHUNK, CHUNK_INDEX, ERROR, FRAME, GET, MANIFEST, MANIFEST_HEADER, MAX_BODY, OPEN, ProtocolError,
+                      encode_frame)
+
+DEFAULT_CHUNK = 1 << 20
+DIGEST_SIZE = hashlib.sha256().digest_size
+
+
+class Manifest:
+    '''
+    What a receiver needs to know of a file before fetching it: its size,
+    the size of its chunks and the SHA-256 of each, to check every chunk
+    as it arrives.
+    '''
+
+    def __init__(self, size, chunk_size, digests):
+        self.size = size
+        self.chunk_size = chunk_size
+        self.digests = digests
+
+    @property
+    def count(self):
+        return len(self.digests)
+
+    def span(self, index):
+        '''
+        (offset, length) of chunk index in the file.
+        '''
+        offset = index * self.chunk_size
+        return offset, min(self.chunk_size, self.size - offset)
+
+    def encode(self):
+        return MANIFEST_HEADER.pack(self.size, self.chunk_size) + b''.join(self.digests)
+
+    @classmethod
+    def decode(cls, body):
+        size, chunk_size = MANIFEST_HEADER.unpack_from(body)
+        digests = body[MANIFEST_HEADER.size:]
+        count = -(-size // chunk_size) if chunk_size else 0
+        if chunk_size == 0 or len(digests) != count * DIGEST_SIZE:
+            raise ProtocolError("malformed manifest")
+        return cls(size, chunk_size, [digests[i:i + DIGEST_SIZE] for i in range(0, len(digests), DIGEST_SIZE)])
+
+    @classmethod
+    def compute(cls, path, chunk_size=DEFAULT_CHUNK, threads=4):
+        size = os.path.getsize(path)
+        # Chunks large enough for the digests to fit in one frame.
+        limit = (MAX_BODY - MANIFEST_HEADER.size) // DIGEST_SIZE
+        chunk_size = max(chunk_size, -(-size // limit))
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            def digest(offset):
+                return hashlib.sha256(os.pread(fd, chunk_size, offset)).digest()
+            # hashlib lets go of the GIL on large buffers, so the chunks are
+            # hashed in parallel.
+            with ThreadPoolExecutor(threads) as pool:
+                digests = list(pool.map(digest, range(0, size, chunk_size)))
+        finally:
+            os.close(fd)
+        return cls(size, chunk_size, digests)
+
+
+def recv_exactly(sock, view):
+    '''
+    Fills the memoryview view from sock.
+    '''
+    while view:
+        received = sock.recv_into(view)
+        if not received:
+            raise ConnectionError("peer closed the connection")
+        view = view[received:]
+
+
+def recv_frame(sock, max_body=MAX_BODY):
+    '''
+    (type, request ID, body) of the next frame, or None at end of stream.
+    '''
+    header = bytearray(FRAME.size)
+    received = sock.recv_into(header)
+    if not received:
+        return None
+    recv_exactly(sock, memoryview(header)[received:])
+    length, kind, request_id = FRAME.unpack(header)
+    if length > max_body:
+        raise ProtocolError(f"frame of {length} bytes")
+    body = bytearray(length)
+    recv_exactly(sock, memoryview(body))
+    return kind, request_id, bytes(body)
+
+
+class ShareHandler(socketserver.BaseRequestHandler):
+    '''
+    Serves one data connection: OPEN a file by name, then GET its chunks in
+    any order. Requests are answered in the order they come, so a receiver
+    can send several ahead.
+    '''
+
+    def handle(self):
+        sock = self.request
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        file = manifest = None
+        try:
+            while True:
+                frame = recv_frame(sock)
+                if frame is None:
+                    break
+                kind, request_id, body = frame
+                if kind == OPEN:
+                    if file is not None:
+                        file.close()
+                        file = None
+                    try:
+                        path, manifest = self.server.open(body.decode('utf-8'))
+                        file = open(path, 'rb')
+                    # ValueError: a name with a NUL byte in it.
+                    except (OSError, UnicodeDecodeError, ValueError) as e:
+                        sock.sendall(encode_frame(ERROR, request_id, f"cannot open: {e}".encode()))
+                        continue
+                    sock.sendall(encode_frame(MANIFEST, request_id, manifest.encode()))
+                elif kind == GET and file is not None and len(body) == CHUNK_INDEX.size:
+                    index, = CHUNK_INDEX.unpack(body)
+                    if index >= manifest.count:
+                        sock.sendall(encode_frame(ERROR, request_id, b"no such chunk"))
+                        continue
+                    self.send_chunk(sock, file, request_id, *manifest.span(index))
+                else:
+                    sock.sendall(encode_frame(ERROR, request_id, b"OPEN a file, then GET its chunks"))
+        except (OSError, ProtocolError):
+            pass
+        finally:
+            if file is not None:
+                file.close()
+
+    def send_chunk(self, sock, file, request_id, offset, length):
+        sock.sendall(FRAME.pack(length, CHUNK, request_id))
+        # Straight from the page cache to the socket.
+        if sock.sendfile(file, offset, length) < length:
+            # The file shrank after its manifest was made. The frame cannot
+            # be completed, so the connection is dropped and the receiver
+            # tries again on a new one rather than waiting for the rest.
+            raise ConnectionError("file shrank while it was being sent")
+
+
+class FileShare(socketserver.ThreadingTCPServer):
+    '''
+    Lets other peers fetch the files in directory, with a thread for each
+    data connection. Manifests are kept until the file changes, so a
+    file is hashed once however many connections and receivers ask for it.
+    Only files under directory are served: a name that leads outside it,
+    through '..', an absolute path or a symbolic link, is refused.
+    '''
+
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 64
+
+    def __init__(self, address, directory, chunk_size=DEFAULT_CHUNK):
+        super().__init__(address, ShareHandler)
+        self.directory = directory
+        self.root = os.path.realpath(directory)
+        self.chunk_size = chunk_size
+        self.manifests = {}
+        self.lock = threading.Lock()
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def open(self, name):
+        '''
+        (path, Manifest) of the shared file called name.
+        '''
+        path = os.path.realpath(os.path.join(self.root, name))
+        if os.path.commonpath([self.root, path]) != self.root:
+            raise PermissionError(f"{name!r} is not in the shared directory")
+        if not os.path.isfile(path):
+            raise FileNotFoundError(f"no file {name!r} shared")
+        stat = os.stat(path)
+        key = (stat.st_mtime_ns, stat.st_size)
+        with self.lock:
+            cached = self.manifests.get(path)
+            if cached is None or cached[0] != key:
+                cached = self.manifests[path] = (key, Manifest.compute(path, self.chunk_size))
+        return path, cached[1]
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return thread
+
+
+class ResumeState:
+    '''
+    Which chunks of a download are in the partial file, kept next to it: the
+    SHA-256 of the manifest, then a byte for each chunk, set once the chunk
+    has been checked and written. A download that starts again with the
+    same manifest fetches only the chunks not set; one for a changed file
+    starts over.
+    '''
+
+    def __init__(self, path, manifest):
+        self.path = path
+        identity = hashlib.sha256(manifest.encode()).digest()
+        self.offset = len(identity)
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        state = os.pread(self.fd, self.offset + manifest.count, 0)
+        if state[:self.offset] == identity and len(state) == self.offset + manifest.count:
+            self.done = bytearray(state[self.offset:])
+        else:
+            self.done = bytearray(manifest.count)
+            os.ftruncate(self.fd, 0)
+            os.pwrite(self.fd, identity + self.done, 0)
+
+    def missing(self):
+        return [index for index, done in enumerate(self.done) if not done]
+
+    def mark(self, index):
+        self.done[index] = 1
+        os.pwrite(self.fd, b'\x01', self.offset + index)
+
+    def close(self):
+        os.close(self.fd)
+
+
+def open_file(address, name, timeout):
+    '''
+    A data connection to the peer at address with name opened, and the
+    file's Manifest.
+    '''
+    sock = socket.create_connection(address, timeout)
+    try:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.sendall(encode_frame(OPEN, 0, name.encode('utf-8')))
+        frame = recv_frame(sock)
+        if frame is None:
+            raise ConnectionError("peer closed the connection")
+        kind, _, body = frame
+        if kind == ERROR:
+            raise ProtocolError(body.decode('utf-8', 'replace'))
+        if kind != MANIFEST:
+            raise ProtocolError(f"unexpected reply type {kind}")
+        return sock, Manifest.decode(body)
+    except BaseException:
+        sock.close()
+        raise
+
+
+class ChunkQueue:
+    '''
+    The chunks of a download still to fetch, shared by its connections. A
+    chunk is in flight from take() until settle(), and is never handed out
+    again meanwhile: only settle(index, again=True) puts it back, for
+    another try. A connection with nothing in flight waits in take() while
+    others have chunks in flight, since they may come back.
+    '''
+
+    def __init__(self, indexes):
+        self.waiting = deque(indexes)
+        self.in_flight = set()
+        self.condition = threading.Condition()
+
+    def take(self, wait=False):
+        '''
+        The next chunk to fetch, or None if there is none (with wait, once
+        no chunk is in flight either).
+        '''
+        with self.condition:
+            while not self.waiting:
+                if not wait or not self.in_flight:
+                    return None
+                self.condition.wait()
+            index = self.waiting.popleft()
+            self.in_flight.add(index)
+            return index
+
+    def settle(self, index, again=False):
+        with self.condition:
+            if index not in self.in_flight:
+                return
+            self.in_flight.remove(index)
+            if again:
+                self.waiting.append(index)
+            self.condition.notify_all()
+
+
+class Download:
+    '''
+    Fetches one shared file from a peer into destination over connections
+    parallel data connections. Each connection takes chunks from a shared
+    ChunkQueue and keeps depth of them requested ahead, so it is never idle
+    for a round trip between chunks. A chunk is read straight into a
+    buffer of the connection's, checked against the manifest and written
+    at its offset in destination + '.part', which is renamed to
+    destination once every chunk is in.
+
+    A chunk that fails its check goes back on the queue, up to retries
+    times; so do the chunks of a connection that fails, for the others to
+    fetch. If the connections fail, run() raises and the chunks already
+    written stay, so running the same download again resumes it.
+    '''
+
+    def __init__(self, address, name, destination, connections=4, depth=2, retries=3, timeout=30.0):
+        self.address = address
+        self.name = name
+        self.destination = destination
+        self.connections = connections
+        self.depth = depth
+        self.retries = retries
+        self.timeout = timeout
+        self.stats = {'size': 0, 'chunks': 0, 'resumed': 0, 'fetched': 0, 'bytes': 0, 'corrupt': 0, 'seconds': 0.0}
+
+    def run(self):
+        started = time.perf_counter()
+        sock, manifest = open_file(self.address, self.name, self.timeout)
+        part = self.destination + '.part'
+        state = ResumeState(part + '.state', manifest)
+        fd = os.open(part, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            os.ftruncate(fd, manifest.size)
+            missing = state.missing()
+            self.stats.update(size=manifest.size, chunks=manifest.count, resumed=manifest.count - len(missing))
+            if missing:
+                self.fetch(sock, manifest, state, fd, missing)
+            else:
+                sock.close()
+        finally:
+            os.close(fd)
+            state.close()
+        os.replace(part, self.destination)
+        os.unlink(state.path)
+        self.stats['seconds'] = time.perf_counter() - started
+        return self.stats
+
+    def fetch(self, sock, manifest, state, fd, missing):
+        chunks = ChunkQueue(missing)
+        failures = {}
+        lock = threading.Lock()
+        errors = []
+
+        def worker(sock):
+            try:
+                if sock is None:
+                    sock, _ = open_file(self.address, self.name, self.timeout)
+                with sock:
+                    self.receive(sock, manifest, state, fd, chunks, failures, lock)
+            except (OSError, ProtocolError) as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=worker, args=(sock if i == 0 else None,))
+                   for i in range(min(self.connections, len(missing)))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        left = state.missing()
+        if left:
+            raise errors[0] if errors else ProtocolError(f"{len(left)} chunks failed their checks")
+
+    def receive(self, sock, manifest, state, fd, chunks, failures, lock):
+        buffer = memoryview(bytearray(manifest.chunk_size))
+        header = memoryview(bytearray(FRAME.size))
+        requested = []
+        try:
+            while True:
+                while len(requested) < self.depth:
+                    index = chunks.take(wait=not requested)
+                    if index is None:
+                        break
+                    requested.append(index)
+                    sock.sendall(encode_frame(GET, index, CHUNK_INDEX.pack(index)))
+                if not requested:
+                    return
+                recv_exactly(sock, header)
+                length, kind, request_id = FRAME.unpack(header)
+                index = requested[0]
+                offset, expected = manifest.span(index)
+                if kind != CHUNK or request_id != index or length != expected:
+                    raise ProtocolError(f"unexpected reply type {kind} for chunk {index}")
+                view = buffer[:length]
+                recv_exactly(sock, view)
+                if hashlib.sha256(view).digest() != manifest.digests[index]:
+                    with lock:
+                        self.stats['corrupt'] += 1
+                        failures[index] = failures.get(index, 0) + 1
+                        again = failures[index] <= self.retries
+                    requested.pop(0)
+                    chunks.settle(index, again)
+                    continue
+                os.pwrite(fd, view, offset)
+                state.mark(index)
+                requested.pop(0)
+                chunks.settle(index)
+                with lock:
+                    self.stats['fetched'] += 1
+                    self.stats['bytes'] += length
+        finally:
+            # Another connection may still fetch them.
+            for index in requested:
+                chunks.settle(index, again=True)
+
+
+def download(address, name, destination, connections=4, **options):
+    '''
+    Fetches the file name shared by the peer at address into destination,
+    going on from where an earlier download of it stopped. Returns the
+    stats of the Download.
+    '''
+    return Download(address, name, destination, connections, **options).run()
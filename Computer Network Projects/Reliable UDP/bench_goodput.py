@@ -0,0 +1,268 @@
+import argparse
+import multiprocessing
+import select
+import socket
+import struct
+import time
+
+from eventloop import EventLoop
+from lossy_link import LossyLink
+from rudp import ReliableConnection
+from udp1 import Relay, ThreadedRelay
+
+
+class LegacyConnection:
+    '''
+    What udp1.py did before ReliableConnection: every datagram is sent once
+    with a sequence number, nothing is ever retransmitted, and the receiver
+    only passes on the datagram it expects next, so delivery stops at the
+    first loss.
+    '''
+
+    def __init__(self, output, deliver, **options):
+        self.output = output
+        self.deliver = deliver
+        self.next_seq = 0
+        self.rcv_next = 0
+        self.timer_deadline = None
+        self.stats = {'sent': 0, 'retransmitted': 0, 'timeouts': 0, 'delivered': 0}
+
+    def send(self, payload):
+        self.output(struct.pack('!I', self.next_seq) + payload)
+        self.next_seq += 1
+        self.stats['sent'] += 1
+
+    def datagram_received(self, data):
+        if struct.unpack_from('!I', data)[0] == self.rcv_next:
+            self.rcv_next += 1
+            self.stats['delivered'] += 1
+            self.deliver(data[4:])
+
+    def timeout(self):
+        return None
+
+    def deadline(self):
+        return None
+
+    def on_timer(self):
+        pass
+
+    def info(self):
+        return {}
+
+
+VARIANTS = {
+    'legacy': (LegacyConnection, {}),
+    'fixed': (ReliableConnection, {'congestion': 'fixed'}),
+    'newreno': (ReliableConnection, {'congestion': 'newreno'}),
+    'cubic': (ReliableConnection, {'congestion': 'cubic'}),
+}
+
+
+def run_relay(pipe, variant, app_address, tunnel_address, options, io='loop'):
+    '''
+    One relay in its own process, on an event loop or with threads (io).
+    app_address and tunnel_address are (host, port, connect?) tuples; the
+    bound ports are sent back through the pipe, and the connection's stats
+    and the CPU time the process has used whenever the pipe asks for them.
+    '''
+    sockets = []
+    for host, port, connect in (app_address, tunnel_address):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+        if connect:
+            sock.connect((host, port))
+        else:
+            sock.bind((host, port))
+        sockets.append(sock)
+    connection_class, variant_options = VARIANTS[variant]
+    if connection_class is LegacyConnection:
+        options = {}
+    options = dict(options, connection_class=connection_class, **variant_options)
+    pipe.send([sock.getsockname()[1] for sock in sockets])
+
+    def stats():
+        return dict(relay.connection.stats, cpu=time.process_time(), **relay.connection.info())
+
+    if io == 'loop':
+        loop = EventLoop()
+        relay = Relay(loop, *sockets, **options)
+
+        def pipe_readable():
+            if pipe.recv() != 'stats':
+                raise SystemExit
+            pipe.send(stats())
+
+        loop.add_reader(pipe, pipe_readable)
+        loop.run_forever()
+    else:
+        relay = ThreadedRelay(*sockets, **options)
+        relay.start()
+        while pipe.recv() == 'stats':
+            with relay.condition:
+                pipe.send(stats())
+
+
+def run_link(pipe, target, seed, impairments):
+    '''
+    A lossy link in its own process, forwarding to target with impairments
+    (keyword arguments of LossyLink). Its port is sent back through the
+    pipe, and its stats whenever the pipe asks for them.
+    '''
+    link = LossyLink((target[0], 0), target, seed=seed, **impairments)
+    pipe.send(link.port())
+    link.run(pipe)
+
+
+def start(target, *args):
+    parent, child = multiprocessing.Pipe()
+    process = multiprocessing.Process(target=target, args=(child,) + args, daemon=True)
+    process.start()
+    return process, parent, parent.recv()
+
+
+# Sequence number and the time the datagram was sent.
+STAMP = struct.Struct('!Id')
+
+
+def percentile(values, fraction):
+    '''
+    The value a fraction of the sorted values are at or below.
+    '''
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def run_transfer(variant, impairments, args):
+    '''
+    Pushes args.count datagrams of args.size bytes through client relay ->
+    lossy link -> server relay, keeping at most args.ahead of them
+    undelivered, and returns what arrived in order, how long it took and
+    how long each datagram took from the sender to the receiver. The link
+    gets impairments, keyword arguments of LossyLink. Everything binds to
+    args.host.
+    '''
+    host = args.host
+    receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    receiver.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+    receiver.bind((host, 0))
+    options = {'window': args.window, 'min_rto': args.min_rto, 'pacing': args.pacing, 'checksum': args.checksum}
+    server, server_pipe, (_, server_port) = start(
+        run_relay, variant, (host, receiver.getsockname()[1], True), (host, 0, False), options, args.io)
+    link, link_pipe, link_port = start(run_link, (host, server_port), args.seed, impairments)
+    client, client_pipe, (client_port, _) = start(
+        run_relay, variant, (host, 0, False), (host, link_port, True), options, args.io)
+    processes = [server, link, client]
+
+    sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sender.connect((host, client_port))
+    filler = b'x' * (args.size - STAMP.size)
+    latencies = []
+    sent = delivered = misordered = 0
+    started = last_progress = time.perf_counter()
+    try:
+        while delivered < args.count:
+            while sent < args.count and sent - delivered < args.ahead:
+                sender.send(STAMP.pack(sent, time.perf_counter()) + filler)
+                sent += 1
+            readable, _, _ = select.select([receiver], [], [], 0.05)
+            now = time.perf_counter()
+            if readable:
+                while True:
+                    try:
+                        data = receiver.recv(65535, socket.MSG_DONTWAIT)
+                    except BlockingIOError:
+                        break
+                    seq, stamp = STAMP.unpack_from(data)
+                    if seq != delivered or len(data) != args.size:
+                        misordered += 1
+                    latencies.append(time.perf_counter() - stamp)
+                    delivered += 1
+                last_progress = now
+            elif now - last_progress > args.stall:
+                break
+        elapsed = (last_progress if delivered < args.count else time.perf_counter()) - started
+        client_pipe.send('stats')
+        stats = client_pipe.recv()
+        server_pipe.send('stats')
+        cpu = stats['cpu'] + server_pipe.recv()['cpu']
+        link_pipe.send('stats')
+        link_stats = link_pipe.recv()
+    finally:
+        for process in processes:
+            process.terminate()
+        receiver.close()
+        sender.close()
+
+    latencies.sort()
+    megabytes = delivered * args.size / 1e6
+    return {
+        'delivered': delivered,
+        'misordered': misordered,
+        'seconds': elapsed,
+        'goodput': megabytes / elapsed if elapsed else 0.0,
+        'retransmitted': stats['retransmitted'],
+        'retransmission_ratio': stats['retransmitted'] / stats['sent'] if stats['sent'] else 0.0,
+        'timeouts': stats['timeouts'],
+        'sent': stats['sent'],
+        'cwnd': stats.get('cwnd'),
+        'srtt': stats.get('srtt'),
+        'cpu': cpu,
+        'cpu_per_mb': cpu / megabytes if megabytes else None,
+        'latency': {f'p{round(100 * fraction)}': percentile(latencies, fraction) for fraction in (0.5, 0.9, 0.99)},
+        'link': link_stats,
+    }
+
+
+def format_ms(seconds):
+    return f"{1000 * seconds:7.1f} ms" if seconds is not None else "      - ms"
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Goodput of the relay over an emulated lossy link, for each congestion controller "
+                    "and for the old relay without retransmission")
+    parser.add_argument('--variants', nargs='+', choices=VARIANTS, default=list(VARIANTS))
+    parser.add_argument('--loss', nargs='+', type=float, default=[0.0, 0.01, 0.05])
+    parser.add_argument('--delay', type=float, default=0.005, help="one-way delay of the link in seconds")
+    parser.add_argument('--rate', type=float, default=None, help="link speed in bytes per second (default: unlimited)")
+    parser.add_argument('--queue', type=int, default=100, help="datagrams the link queues with --rate")
+    parser.add_argument('--count', type=int, default=5000, help="datagrams to transfer")
+    parser.add_argument('--size', type=int, default=1000, help="bytes per datagram")
+    parser.add_argument('--ahead', type=int, default=None,
+                        help="datagrams the sender may be ahead of delivery (default: the window)")
+    parser.add_argument('--window', type=int, default=64)
+    parser.add_argument('--no-pacing', dest='pacing', action='store_false')
+    parser.add_argument('--min-rto', type=float, default=0.2)
+    parser.add_argument('--no-checksum', dest='checksum', action='store_false')
+    parser.add_argument('--stall', type=float, default=3.0, help="give up after this many seconds without progress")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--io', choices=['loop', 'threads'], default='loop', help="how the relays wait for I/O")
+    parser.add_argument('--host', default='127.0.0.1', help="address the relays, the link and the receiver bind to")
+    args = parser.parse_args()
+    if args.ahead is None:
+        args.ahead = args.window
+
+    multiprocessing.set_start_method('fork')
+    rate = f", {args.rate / 1e6:g} MB/s" if args.rate else ""
+    print(f"{args.count} datagrams of {args.size} bytes, {1000 * args.delay:.0f} ms one-way delay{rate}, "
+          f"window {args.window}")
+    for variant in args.variants:
+        for loss in args.loss:
+            impairments = {'loss': loss, 'delay': args.delay, 'rate': args.rate, 'queue_limit': args.queue}
+            result = run_transfer(variant, impairments, args)
+            line = (f"{variant:>8} loss {100 * loss:4.1f}%: delivered {result['delivered']:>6}/{args.count}"
+                    f" in {result['seconds']:6.2f}s  {result['goodput']:7.3f} MB/s"
+                    f"  retransmitted {result['retransmitted']:>5}  timeouts {result['timeouts']:>3}"
+                    f"  relay CPU {result['cpu']:5.2f}s"
+                    f"  latency p50 {format_ms(result['latency']['p50'])} p99 {format_ms(result['latency']['p99'])}")
+            if result['cwnd'] is not None:
+                line += f"  cwnd {result['cwnd']:6.1f}  srtt {1000 * (result['srtt'] or 0):6.1f} ms"
+            if result['misordered']:
+                line += f"  OUT OF ORDER {result['misordered']}"
+            print(line, flush=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+import argparse
+import json
+import multiprocessing
+
+from bench_goodput import VARIANTS, format_ms, run_transfer
+from lossy_link import PROFILES
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Goodput, retransmissions, latency and CPU of the relay over the lossy link, for every "
+                    "congestion controller under every impairment profile of lossy_link.py")
+    parser.add_argument('--profiles', nargs='+', choices=PROFILES, default=list(PROFILES))
+    parser.add_argument('--variants', nargs='+', choices=VARIANTS, default=['fixed', 'newreno', 'cubic'])
+    parser.add_argument('--delay', type=float, default=0.005,
+                        help="one-way delay of the link in seconds, unless the profile sets one")
+    parser.add_argument('--count', type=int, default=5000, help="datagrams to transfer")
+    parser.add_argument('--size', type=int, default=1000, help="bytes per datagram")
+    parser.add_argument('--ahead', type=int, default=None,
+                        help="datagrams the sender may be ahead of delivery (default: the window)")
+    parser.add_argument('--window', type=int, default=64)
+    parser.add_argument('--no-pacing', dest='pacing', action='store_false')
+    parser.add_argument('--min-rto', type=float, default=0.2)
+    parser.add_argument('--no-checksum', dest='checksum', action='store_false')
+    parser.add_argument('--stall', type=float, default=3.0, help="give up after this many seconds without progress")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--io', choices=['loop', 'threads'], default='loop', help="how the relays wait for I/O")
+    parser.add_argument('--host', default='127.0.0.1', help="address the relays, the link and the receiver bind to")
+    parser.add_argument('--json', help="also write every result to this file, to compare runs")
+    args = parser.parse_args()
+    if args.ahead is None:
+        args.ahead = args.window
+
+    multiprocessing.set_start_method('fork')
+    print(f"{args.count} datagrams of {args.size} bytes, {1000 * args.delay:.0f} ms one-way delay, "
+          f"window {args.window}")
+    print(f"{'profile':>12} {'variant':>8} {'delivered':>11} {'MB/s':>8} {'retx':>6} {'p50':>10} {'p90':>10} "
+          f"{'p99':>10} {'CPU/MB':>8}  link")
+    results = []
+    for profile in args.profiles:
+        impairments = dict({'delay': args.delay}, **PROFILES[profile])
+        for variant in args.variants:
+            result = run_transfer(variant, impairments, args)
+            results.append(dict(result, profile=profile, variant=variant, impairments=impairments))
+            latency = result['latency']
+            link = ' '.join(f"{name} {count}" for name, count in result['link'].items()
+                            if count and name != 'forwarded')
+            cpu_per_mb = f"{result['cpu_per_mb']:6.3f}s" if result['cpu_per_mb'] is not None else '      -'
+            line = (f"{profile:>12} {variant:>8} {result['delivered']:>5}/{args.count:<5} {result['goodput']:8.3f}"
+                    f" {100 * result['retransmission_ratio']:5.1f}% {format_ms(latency['p50'])}"
+                    f" {format_ms(latency['p90'])} {format_ms(latency['p99'])} {cpu_per_mb}  {link}")
+            if result['misordered']:
+                line += f"  OUT OF ORDER {result['misordered']}"
+            print(line, flush=True)
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump({'options': vars(args), 'results': results}, file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
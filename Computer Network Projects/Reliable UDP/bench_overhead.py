@@ -0,0 +1,124 @@
+import argparse
+import multiprocessing
+import os
+import resource
+import select
+import socket
+import struct
+import subprocess
+import sys
+import time
+
+from bench_goodput import run_relay, start
+
+
+def legacy_idle_cpu(seconds):
+    '''
+    CPU seconds udp.py uses while sitting idle for seconds.
+    '''
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'udp.py')
+    before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    # On ports of its own, so it does not clash with relays already running.
+    process = subprocess.Popen([sys.executable, script, '--client', '127.0.0.1:0', '--server', '127.0.0.1:0'])
+    time.sleep(seconds)
+    process.terminate()
+    process.wait()
+    after = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return after.ru_utime + after.ru_stime - before.ru_utime - before.ru_stime
+
+
+def start_relays(receiver_port, io, options):
+    '''
+    A client relay and a server relay talking straight to each other, each
+    in its own process. Returns the processes, their pipes and the port the
+    client relay takes datagrams on.
+    '''
+    server, server_pipe, (_, server_port) = start(
+        run_relay, 'newreno', ('127.0.0.1', receiver_port, True), ('127.0.0.1', 0, False), options, io)
+    client, client_pipe, (client_port, _) = start(
+        run_relay, 'newreno', ('127.0.0.1', 0, False), ('127.0.0.1', server_port, True), options, io)
+    return [server, client], [server_pipe, client_pipe], client_port
+
+
+def relay_cpu(pipes):
+    total = 0.0
+    for pipe in pipes:
+        pipe.send('stats')
+        total += pipe.recv()['cpu']
+    return total
+
+
+def measure(io, args):
+    '''
+    CPU seconds both relays use while idle for args.idle seconds, then CPU
+    microseconds per datagram while args.count datagrams go through them.
+    '''
+    receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    receiver.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+    receiver.bind(('127.0.0.1', 0))
+    options = {'window': args.window, 'min_rto': 0.2, 'pacing': False, 'checksum': args.checksum}
+    processes, pipes, client_port = start_relays(receiver.getsockname()[1], io, options)
+    sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sender.connect(('127.0.0.1', client_port))
+    filler = b'x' * (args.size - 4)
+    try:
+        started = relay_cpu(pipes)
+        time.sleep(args.idle)
+        idle = relay_cpu(pipes) - started
+
+        sent = delivered = 0
+        started = relay_cpu(pipes)
+        wall = time.perf_counter()
+        while delivered < args.count:
+            while sent < args.count and sent - delivered < args.window:
+                sender.send(struct.pack('!I', sent) + filler)
+                sent += 1
+            if not select.select([receiver], [], [], 3.0)[0]:
+                break
+            while True:
+                try:
+                    receiver.recv(65535, socket.MSG_DONTWAIT)
+                except BlockingIOError:
+                    break
+                delivered += 1
+        wall = time.perf_counter() - wall
+        busy = relay_cpu(pipes) - started
+    finally:
+        for process in processes:
+            process.terminate()
+        receiver.close()
+        sender.close()
+    return {
+        'idle': idle,
+        'delivered': delivered,
+        'per_datagram': 1e6 * busy / delivered if delivered else float('nan'),
+        'rate': delivered / wall,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="CPU the relays use while idle and per datagram while busy, on an event loop and with threads")
+    parser.add_argument('--io', nargs='+', choices=['loop', 'threads'], default=['loop', 'threads'])
+    parser.add_argument('--idle', type=float, default=3.0, help="seconds to sit idle")
+    parser.add_argument('--count', type=int, default=20000, help="datagrams to send through")
+    parser.add_argument('--size', type=int, default=1000, help="bytes per datagram")
+    parser.add_argument('--window', type=int, default=64)
+    parser.add_argument('--no-checksum', dest='checksum', action='store_false')
+    parser.add_argument('--legacy', action='store_true',
+                        help="also measure udp.py while idle")
+    args = parser.parse_args()
+
+    multiprocessing.set_start_method('fork')
+    if args.legacy:
+        cpu = legacy_idle_cpu(args.idle)
+        print(f"{'udp.py':>8}: idle CPU {100 * cpu / args.idle:5.1f}%", flush=True)
+    for io in args.io:
+        result = measure(io, args)
+        print(f"{io:>8}: idle CPU {100 * result['idle'] / args.idle:5.1f}%"
+              f"  {result['per_datagram']:6.1f} us CPU per datagram"
+              f"  ({result['delivered']}/{args.count} delivered, {result['rate']:8.0f} datagrams/s)", flush=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+import argparse
+import asyncio
+import multiprocessing
+import os
+import time
+
+from bench_goodput import run_link, start
+from stream import open_connection
+
+
+async def transfer(link, receiver_options, sender_options, chunks, stall):
+    '''
+    Writes chunks from a stream connected to a lossy link to the stream the
+    link forwards to, and returns the bytes that arrived, the seconds that
+    took and the sender's stats. link is the (seed, impairments) to start
+    run_link() with.
+    '''
+    reader, receiver = await open_connection(('127.0.0.1', 0), **receiver_options)
+    process, _, port = start(run_link, ('127.0.0.1', receiver.get_extra_info('sockname')[1]), *link)
+    _, writer = await open_connection(('127.0.0.1', 0), ('127.0.0.1', port), **sender_options)
+    total = sum(len(chunk) for chunk in chunks)
+
+    async def send():
+        for chunk in chunks:
+            writer.write(chunk)
+            await writer.drain()
+
+    async def receive():
+        received = 0
+        while received < total:
+            data = await asyncio.wait_for(reader.read(1 << 20), stall)
+            if not data:
+                break
+            received += len(data)
+        return received
+
+    started = time.perf_counter()
+    try:
+        _, received = await asyncio.gather(send(), receive())
+    except asyncio.TimeoutError:
+        received = None
+    finally:
+        process.terminate()
+    elapsed = time.perf_counter() - started
+    stats = writer.get_extra_info('connection').stats
+    writer.abort()
+    receiver.abort()
+    return received, total, elapsed, stats
+
+
+def report(label, result):
+    received, total, elapsed, stats = result
+    line = (f"{label:>28}: {received if received is not None else 'STALLED':>9}/{total} bytes in {elapsed:6.2f}s"
+            f"  {(received or 0) / elapsed / 1e6:7.3f} MB/s  writes {stats['writes']:>6}"
+            f"  datagrams {stats['sent']:>6}  retransmitted {stats['retransmitted']:>5}")
+    print(line, flush=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Throughput of the stream API over an emulated lossy link, for bulk transfers and for "
+                    "many small writes with and without coalescing")
+    parser.add_argument('--loss', nargs='+', type=float, default=[0.0, 0.01, 0.05])
+    parser.add_argument('--delay', type=float, default=0.005, help="one-way delay of the link in seconds")
+    parser.add_argument('--bytes', type=int, default=10_000_000, help="size of the bulk transfer")
+    parser.add_argument('--chunk', type=int, default=65536, help="bytes per write in the bulk transfer")
+    parser.add_argument('--writes', type=int, default=20000, help="small writes to make")
+    parser.add_argument('--write-size', type=int, default=50, help="bytes per small write")
+    parser.add_argument('--mtu', type=int, default=1500)
+    parser.add_argument('--window', type=int, default=256)
+    parser.add_argument('--stall', type=float, default=5.0, help="give up after this many seconds without progress")
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    multiprocessing.set_start_method('fork')
+    options = {'window': args.window, 'mtu': args.mtu}
+    blob = os.urandom(args.chunk)
+    bulk = [blob] * (args.bytes // args.chunk)
+    small = [blob[:args.write_size]] * args.writes
+    print(f"{1000 * args.delay:.0f} ms one-way delay, mtu {args.mtu}, window {args.window}")
+    for loss in args.loss:
+        link = (args.seed, {'loss': loss, 'delay': args.delay})
+        report(f"bulk, loss {100 * loss:4.1f}%",
+               asyncio.run(transfer(link, options, options, bulk, args.stall)))
+        for delay in (0.0, 0.005):
+            label = f"small, delay {1000 * delay:g} ms, loss {100 * loss:4.1f}%"
+            report(label, asyncio.run(transfer(link, options, dict(options, delay=delay), small, args.stall)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+import math
+
+
+class Fixed:
+    '''
+    No congestion control: a constant window, which is what the relay had
+    before. Useful as a baseline.
+    '''
+    name = 'fixed'
+
+    def __init__(self, initial_window=10, max_window=64):
+        self.cwnd = max_window
+        self.ssthresh = max_window
+
+    def on_ack(self, acked, now, rtt):
+        pass
+
+    def on_loss(self, now, in_flight):
+        pass
+
+    def on_timeout(self, now, in_flight):
+        pass
+
+    def pacing_gain(self):
+        return 1.25
+
+
+class NewReno:
+    '''
+    AIMD: slow start up to ssthresh, then one segment more per round trip;
+    the window is halved once per loss episode (the connection only calls
+    on_loss for the first loss before recovery ends) and falls back to one
+    segment after a timeout.
+    '''
+    name = 'newreno'
+
+    def __init__(self, initial_window=10, max_window=64):
+        self.cwnd = initial_window
+        self.ssthresh = float('inf')
+
+    def on_ack(self, acked, now, rtt):
+        if self.cwnd < self.ssthresh:
+            self.cwnd += acked
+        else:
+            self.cwnd += acked / self.cwnd
+
+    def on_loss(self, now, in_flight):
+        self.ssthresh = max(in_flight / 2, 2)
+        self.cwnd = self.ssthresh
+
+    def on_timeout(self, now, in_flight):
+        self.ssthresh = max(in_flight / 2, 2)
+        self.cwnd = 1
+
+    def pacing_gain(self):
+        return 2.0 if self.cwnd < self.ssthresh else 1.25
+
+
+class Cubic(NewReno):
+    '''
+    CUBIC (RFC 9438): after a loss the window grows along a cubic curve
+    centred on the window where the loss happened, so it gets back there
+    quickly and then probes beyond it, independent of the round-trip time.
+    It never grows slower than NewReno would.
+    '''
+    name = 'cubic'
+    C = 0.4
+    BETA = 0.7
+
+    def __init__(self, initial_window=10, max_window=64):
+        super().__init__(initial_window, max_window)
+        self.w_max = 0.0
+        self.k = 0.0
+        self.epoch_start = None
+        self.w_est = 0.0
+
+    def on_ack(self, acked, now, rtt):
+        if self.cwnd < self.ssthresh:
+            self.cwnd += acked
+            return
+        if self.epoch_start is None:
+            self.epoch_start = now
+            self.w_max = max(self.w_max, self.cwnd)
+            self.k = math.cbrt((self.w_max - self.cwnd) / self.C)
+            self.w_est = self.cwnd
+        elapsed = now - self.epoch_start
+        target = self.C * (elapsed + (rtt or 0.0) - self.k) ** 3 + self.w_max
+        self.w_est += 3 * (1 - self.BETA) / (1 + self.BETA) * acked / self.cwnd
+        target = max(target, self.w_est)
+        if target > self.cwnd:
+            self.cwnd += min(target - self.cwnd, self.cwnd / 2) * acked / self.cwnd
+        else:
+            self.cwnd += acked / (100 * self.cwnd)
+
+    def reduce(self):
+        # Fast convergence: give up bandwidth sooner when the previous loss
+        # happened at a larger window.
+        if self.cwnd < self.w_max:
+            self.w_max = self.cwnd * (1 + self.BETA) / 2
+        else:
+            self.w_max = self.cwnd
+        self.epoch_start = None
+
+    def on_loss(self, now, in_flight):
+        self.reduce()
+        self.ssthresh = max(self.cwnd * self.BETA, 2)
+        self.cwnd = self.ssthresh
+
+    def on_timeout(self, now, in_flight):
+        self.reduce()
+        self.ssthresh = max(self.cwnd * self.BETA, 2)
+        self.cwnd = 1
+
+
+CONGESTION_CONTROLS = {controller.name: controller for controller in (Fixed, NewReno, Cubic)}
@@ -0,0 +1,167 @@
+import math
+import selectors
+import time
+
+
+class Timer:
+    __slots__ = ('when', 'tick', 'callback')
+
+    def __init__(self, when, tick, callback):
+        self.when = when
+        self.tick = tick
+        self.callback = callback
+
+    def cancel(self):
+        self.callback = None
+
+
+class TimerWheel:
+    '''
+    A hashed timing wheel: each timer goes in one of slots lists, picked by
+    the tick (tick seconds long) it falls due in, so scheduling and
+    cancelling cost the same however many timers there are. A bitmap of
+    the slots that hold timers lets expiring and finding the next deadline
+    go straight from one occupied slot to the next instead of walking the
+    empty ones. A timer more than one turn of the wheel away waits in its
+    slot for a later turn. Cancelled timers are dropped when their slot is
+    next looked at.
+    '''
+
+    def __init__(self, tick=0.001, slots=1024, clock=time.monotonic):
+        self.tick = tick
+        self.slots = [[] for _ in range(slots)]
+        # Bit i is set while slots[i] is not empty.
+        self.occupied = 0
+        self.current = int(clock() / tick)
+        # The earliest tick that may have a timer due; it can be too early
+        # (the timer was cancelled) but never too late.
+        self.next_tick = None
+        self.pending = 0
+
+    def schedule(self, when, callback):
+        # Rounded up: a timer never fires before when.
+        tick = max(math.ceil(when / self.tick), self.current)
+        timer = Timer(when, tick, callback)
+        index = tick % len(self.slots)
+        self.slots[index].append(timer)
+        self.occupied |= 1 << index
+        self.pending += 1
+        if self.next_tick is None or tick < self.next_tick:
+            self.next_tick = tick
+        return timer
+
+    def occupied_ticks(self, start, count):
+        '''
+        The ticks among the count from start on whose slots hold timers, in
+        order. count is at most the number of slots.
+        '''
+        wheel = len(self.slots)
+        offset = start % wheel
+        # The bitmap turned so that the slot of start is bit 0.
+        bits = (self.occupied >> offset | self.occupied << (wheel - offset)) & ((1 << count) - 1)
+        while bits:
+            lowest = bits & -bits
+            yield start + lowest.bit_length() - 1
+            bits ^= lowest
+
+    def timeout(self, now):
+        '''
+        Seconds until a timer may be due, or None when there are none.
+        '''
+        if self.next_tick is None:
+            return None
+        return max(0.0, self.next_tick * self.tick - now)
+
+    def expire(self, now):
+        '''
+        Calls the callbacks of the timers due by now, earliest first.
+        '''
+        target = int(now / self.tick)
+        if self.next_tick is None or target < self.next_tick:
+            return
+        wheel = len(self.slots)
+        due = []
+        first = max(self.current, self.next_tick)
+        # After a long wait one turn of the wheel covers every slot.
+        for tick in self.occupied_ticks(first, min(target - first + 1, wheel)):
+            index = tick % wheel
+            slot = self.slots[index]
+            later = []
+            for timer in slot:
+                if timer.callback is None:
+                    self.pending -= 1
+                elif timer.tick <= target:
+                    self.pending -= 1
+                    due.append(timer)
+                else:
+                    later.append(timer)
+            slot[:] = later
+            if not later:
+                self.occupied &= ~(1 << index)
+        self.current = target + 1
+        self.find_next_tick()
+        due.sort(key=lambda timer: timer.when)
+        for timer in due:
+            # An earlier callback may have cancelled it.
+            if timer.callback is not None:
+                timer.callback()
+
+    def find_next_tick(self):
+        self.next_tick = None
+        if not self.pending:
+            return
+        wheel = len(self.slots)
+        for tick in self.occupied_ticks(self.current, wheel):
+            index = tick % wheel
+            slot = self.slots[index]
+            live = [timer for timer in slot if timer.callback is not None]
+            if len(live) < len(slot):
+                # Each cancelled timer is dropped once, so slots holding
+                # nothing else are not looked at again.
+                self.pending -= len(slot) - len(live)
+                slot[:] = live
+                if not live:
+                    self.occupied &= ~(1 << index)
+                    continue
+            for timer in live:
+                if timer.tick == tick:
+                    self.next_tick = tick
+                    return
+        if self.pending:
+            # Only timers due in a later turn.
+            self.next_tick = self.current + wheel
+
+
+class EventLoop:
+    '''
+    Runs callbacks in the calling thread when a socket (or anything else
+    with a fileno()) becomes readable and when a timer falls due. With no
+    timers it blocks in select() until a datagram arrives.
+    '''
+
+    def __init__(self, tick=0.001, clock=time.monotonic):
+        self.clock = clock
+        self.selector = selectors.DefaultSelector()
+        self.timers = TimerWheel(tick, clock=clock)
+
+    def add_reader(self, fileobj, callback):
+        self.selector.register(fileobj, selectors.EVENT_READ, callback)
+
+    def remove_reader(self, fileobj):
+        self.selector.unregister(fileobj)
+
+    def call_at(self, when, callback):
+        '''
+        Calls callback() at when (on clock's scale, rounded up to the next
+        tick). Returns a Timer with a cancel() method.
+        '''
+        return self.timers.schedule(when, callback)
+
+    def run_once(self):
+        for key, _ in self.selector.select(self.timers.timeout(self.clock())):
+            key.data()
+        self.timers.expire(self.clock())
+
+    def run_forever(self):
+        while True:
+            self.run_once()
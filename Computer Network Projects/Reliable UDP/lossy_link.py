@@ -0,0 +1,215 @@
+import argparse
+import heapq
+import random
+import select
+import socket
+import time
+
+
+def parse_address(text):
+    host, _, port = text.rpartition(':')
+    return host, int(port)
+
+
+# Impairments to run the relay through, as keyword arguments of LossyLink.
+# Each one adds something to the one-way --delay the benchmarks give.
+PROFILES = {
+    'clean': {},
+    'lossy': {'loss': 0.02},
+    # Short bursts of loss: about 3% of the time the link is in a bad
+    # state that drops everything, for 3 datagrams on average.
+    'bursty': {'loss': 0.001, 'burst_enter': 0.01, 'burst_exit': 0.3},
+    'jittery': {'jitter': 0.005},
+    'reordering': {'reorder': 0.05, 'reorder_delay': 0.002},
+    'duplicating': {'duplicate': 0.05},
+    'corrupting': {'corrupt': 0.01},
+    'bottleneck': {'rate': 2_000_000, 'queue_limit': 50},
+    'wifi': {'loss': 0.005, 'burst_enter': 0.005, 'burst_exit': 0.5, 'jitter': 0.003, 'duplicate': 0.01},
+}
+
+
+class LossyLink:
+    '''
+    A stand-in for lossy_link-linux: forwards datagrams arriving at listen
+    to target, and target's replies back to whoever last sent to listen,
+    dropping each one with probability loss and holding each for delay
+    seconds. With a rate (bytes per second) each direction also behaves like
+    a link of that speed with a queue of queue_limit datagrams, dropping
+    what does not fit.
+
+    Both directions can be impaired further:
+    - jitter adds a random extra delay of up to that many seconds to each
+      datagram, so datagrams close together may swap places;
+    - reorder is the probability that a datagram is held back
+      reorder_delay seconds longer, for those after it to overtake;
+    - duplicate is the probability that a datagram is sent twice, and
+      corrupt that one of its bits is flipped;
+    - burst_enter and burst_exit make losses come in bursts (the
+      Gilbert-Elliott model): the link goes from its good state to a bad
+      one with probability burst_enter before each datagram and back with
+      probability burst_exit, and in the bad state it drops datagrams with
+      probability burst_loss rather than loss.
+    '''
+
+    def __init__(self, listen, target, loss=0.0, delay=0.0, seed=None, rate=None, queue_limit=100, jitter=0.0,
+                 reorder=0.0, reorder_delay=0.001, duplicate=0.0, corrupt=0.0, burst_enter=0.0, burst_exit=1.0,
+                 burst_loss=1.0):
+        self.front = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.front.bind(listen)
+        self.back = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.back.connect(target)
+        self.loss = loss
+        self.delay = delay
+        self.rate = rate
+        self.queue_limit = queue_limit
+        self.jitter = jitter
+        self.reorder = reorder
+        self.reorder_delay = reorder_delay
+        self.duplicate = duplicate
+        self.corrupt = corrupt
+        self.burst_enter = burst_enter
+        self.burst_exit = burst_exit
+        self.burst_loss = burst_loss
+        # Per direction: when the link is free again, the departure times
+        # of the datagrams queued for it, and whether it is in its bad state.
+        self.free_at = {self.front: 0.0, self.back: 0.0}
+        self.departures = {self.front: [], self.back: []}
+        self.bad = {self.front: False, self.back: False}
+        self.random = random.Random(seed)
+        self.client = None
+        self.queue = []
+        self.counter = 0
+        self.stats = {'forwarded': 0, 'dropped': 0, 'overflowed': 0, 'bursts': 0, 'reordered': 0, 'duplicated': 0,
+                      'corrupted': 0}
+
+    def port(self):
+        return self.front.getsockname()[1]
+
+    def lost(self, sock):
+        if self.burst_enter:
+            if self.bad[sock]:
+                self.bad[sock] = self.random.random() >= self.burst_exit
+            elif self.random.random() < self.burst_enter:
+                self.bad[sock] = True
+                self.stats['bursts'] += 1
+        return self.random.random() < (self.burst_loss if self.bad[sock] else self.loss)
+
+    def schedule(self, sock, data, addr):
+        if self.lost(sock):
+            self.stats['dropped'] += 1
+            return
+        copies = 1
+        if self.duplicate and self.random.random() < self.duplicate:
+            self.stats['duplicated'] += 1
+            copies = 2
+        for _ in range(copies):
+            self.enqueue(sock, data, addr)
+
+    def enqueue(self, sock, data, addr):
+        now = time.monotonic()
+        due = now
+        if self.rate:
+            departures = self.departures[sock]
+            while departures and departures[0] <= now:
+                heapq.heappop(departures)
+            if len(departures) >= self.queue_limit:
+                self.stats['overflowed'] += 1
+                return
+            due = self.free_at[sock] = max(now, self.free_at[sock]) + len(data) / self.rate
+            heapq.heappush(departures, due)
+        due += self.delay
+        if self.jitter:
+            due += self.random.uniform(0.0, self.jitter)
+        if self.reorder and self.random.random() < self.reorder:
+            self.stats['reordered'] += 1
+            due += self.reorder_delay
+        # An empty datagram has no bit to flip.
+        if self.corrupt and data and self.random.random() < self.corrupt:
+            self.stats['corrupted'] += 1
+            data = bytearray(data)
+            bit = self.random.randrange(8 * len(data))
+            data[bit // 8] ^= 1 << bit % 8
+        if due > now:
+            self.counter += 1
+            heapq.heappush(self.queue, (due, self.counter, sock, data, addr))
+        else:
+            self.send(sock, data, addr)
+
+    def send(self, sock, data, addr):
+        self.stats['forwarded'] += 1
+        try:
+            if addr is None:
+                sock.send(data)
+            else:
+                sock.sendto(data, addr)
+        except OSError:
+            pass
+
+    def run(self, pipe=None):
+        '''
+        Forwards datagrams forever. pipe, if given, is a multiprocessing
+        connection that is answered with the stats whenever anything
+        arrives on it.
+        '''
+        readers = [self.front, self.back] + ([pipe] if pipe is not None else [])
+        while True:
+            timeout = None
+            if self.queue:
+                timeout = max(0.0, self.queue[0][0] - time.monotonic())
+            readable, _, _ = select.select(readers, [], [], timeout)
+            if self.front in readable:
+                try:
+                    data, self.client = self.front.recvfrom(65535)
+                    self.schedule(self.back, data, None)
+                except OSError:
+                    pass
+            if self.back in readable:
+                try:
+                    data = self.back.recv(65535)
+                    if self.client is not None:
+                        self.schedule(self.front, data, self.client)
+                except OSError:
+                    pass
+            if pipe is not None and pipe in readable:
+                pipe.recv()
+                pipe.send(dict(self.stats))
+            now = time.monotonic()
+            while self.queue and self.queue[0][0] <= now:
+                _, _, sock, data, addr = heapq.heappop(self.queue)
+                self.send(sock, data, addr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Forwards UDP datagrams between two addresses, losing, delaying "
+                                                 "and otherwise impairing some")
+    parser.add_argument('listen', type=parse_address, help="host:port to receive on, e.g. 127.0.0.1:12345")
+    parser.add_argument('target', type=parse_address, help="host:port to forward to, e.g. 127.0.0.1:54321")
+    parser.add_argument('--profile', choices=PROFILES, help="start from these impairments; the options below "
+                                                            "change them")
+    parser.add_argument('--loss', type=float, help="probability of dropping each datagram (default: 0.1 without "
+                                                   "a --profile)")
+    parser.add_argument('--delay', type=float, help="seconds added to each datagram")
+    parser.add_argument('--jitter', type=float, help="up to this many more seconds, at random")
+    parser.add_argument('--rate', type=float, help="bytes per second in each direction (default: unlimited)")
+    parser.add_argument('--queue', dest='queue_limit', type=int, help="datagrams queued in each direction with --rate "
+                                                                      "(default: 100)")
+    parser.add_argument('--reorder', type=float, help="probability of holding a datagram back")
+    parser.add_argument('--reorder-delay', type=float, help="seconds it is held back (default: 0.001)")
+    parser.add_argument('--duplicate', type=float, help="probability of sending a datagram twice")
+    parser.add_argument('--corrupt', type=float, help="probability of flipping a bit of a datagram")
+    parser.add_argument('--burst-enter', type=float, help="probability of a burst of loss starting")
+    parser.add_argument('--burst-exit', type=float, help="probability of a burst ending, after each datagram in it")
+    parser.add_argument('--burst-loss', type=float, help="probability of dropping a datagram in a burst "
+                                                         "(default: 1)")
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args()
+    options = dict(PROFILES[args.profile]) if args.profile else {'loss': 0.1}
+    for name in ('loss', 'delay', 'jitter', 'rate', 'queue_limit', 'reorder', 'reorder_delay', 'duplicate', 'corrupt',
+                 'burst_enter', 'burst_exit', 'burst_loss'):
+        if getattr(args, name) is not None:
+            options[name] = getattr(args, name)
+    LossyLink(args.listen, args.target, seed=args.seed, **options).run()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,742 @@
+import struct
+import time
+import zlib
+from bisect import insort
+from collections import OrderedDict, deque
+
+from congestion import CONGESTION_CONTROLS
+
+# checksum (CRC-32 of everything after it, or 0 for none as in UDP), flags,
+# number of SACK blocks, receive window (segments the sender may send past
+# the ack), sequence number, cumulative ack (next sequence number expected),
+# echo (the data segment this ACK answers); then the SACK blocks and the
+# payload. Sequence numbers on the wire are the low 32 bits of the
+# connection's own, which never wrap.
+HEADER = struct.Struct('!IBBHIII')
+FIELDS = struct.Struct('!BBHIII')
+SACK_BLOCK = struct.Struct('!II')
+CHECKSUM = struct.Struct('!I')
+
+SEQ_MASK = 0xFFFFFFFF
+SEQ_HALF = 0x80000000
+
+FLAG_DATA = 1
+FLAG_ACK = 2
+# The echo field is set.
+FLAG_ECHO = 4
+
+MAX_SACK_BLOCKS = 4
+# Largest payload a UDP datagram over IPv4 can carry.
+MAX_PAYLOAD = 65507
+MAX_PACKET = HEADER.size + MAX_SACK_BLOCKS * SACK_BLOCK.size + MAX_PAYLOAD
+DUP_THRESH = 3
+INITIAL_WINDOW = 10
+# Segments that may go out back to back after the sender was idle, instead
+# of one pacing interval apart.
+PACING_BURST = 4
+# Shortest tail loss probe timeout, in seconds.
+MIN_PROBE_TIMEOUT = 0.01
+# Loss episodes after the reordering window last grew before it shrinks back
+# to a quarter of the shortest round trip (RFC 8985).
+REO_WND_PERSIST = 16
+
+
+def unwrap(value, near):
+    '''
+    The sequence number closest to near whose low 32 bits are value: serial
+    number arithmetic (RFC 1982), so numbers keep working across the wrap
+    as long as both ends stay within 2**31 of each other.
+    '''
+    return near + ((value - near + SEQ_HALF) & SEQ_MASK) - SEQ_HALF
+
+
+def encode_packet_into(view, flags, seq, ack, echo, window, sack_blocks, payload=b'', checksum=True):
+    '''
+    Writes a packet into view (a memoryview of a bytearray of at least
+    MAX_PACKET bytes) and returns its length.
+    '''
+    FIELDS.pack_into(view, CHECKSUM.size, flags, len(sack_blocks), window, seq & SEQ_MASK, ack & SEQ_MASK,
+                     echo & SEQ_MASK)
+    index = HEADER.size
+    for start, end in sack_blocks:
+        SACK_BLOCK.pack_into(view, index, start & SEQ_MASK, end & SEQ_MASK)
+        index += SACK_BLOCK.size
+    length = index + len(payload)
+    view[index:length] = payload
+    CHECKSUM.pack_into(view, 0, zlib.crc32(view[CHECKSUM.size:length]) if checksum else 0)
+    return length
+
+
+def encode_packet(flags, seq, ack, echo, window, sack_blocks, payload=b'', checksum=True):
+    view = memoryview(bytearray(HEADER.size + len(sack_blocks) * SACK_BLOCK.size + len(payload)))
+    encode_packet_into(view, flags, seq, ack, echo, window, sack_blocks, payload, checksum)
+    return view.tobytes()
+
+
+def decode_packet(data):
+    '''
+    Returns (flags, seq, ack, echo, window, sack blocks, payload), with the
+    sequence numbers as they are on the wire and the payload a slice of
+    data (a view, if data is a memoryview). Raises ValueError for a packet
+    that is too short or fails the checksum.
+    '''
+    try:
+        received, flags, count, window, seq, ack, echo = HEADER.unpack_from(data)
+        if received and zlib.crc32(memoryview(data)[CHECKSUM.size:]) != received:
+            raise ValueError("bad checksum")
+        index = HEADER.size
+        sack_blocks = []
+        for _ in range(count):
+            sack_blocks.append(SACK_BLOCK.unpack_from(data, index))
+            index += SACK_BLOCK.size
+    except struct.error:
+        raise ValueError("packet too short")
+    return flags, seq, ack, echo, window, sack_blocks, data[index:]
+
+
+class RttEstimator:
+    '''
+    Smoothed round-trip time and retransmission timeout as in RFC 6298. The
+    RTO starts at initial_rto, doubles on every timeout and is recomputed
+    from the next sample, or reset() once the peer acknowledges something
+    new.
+    '''
+
+    def __init__(self, min_rto=0.2, max_rto=60.0, initial_rto=1.0, granularity=0.001):
+        self.min_rto = min_rto
+        self.max_rto = max_rto
+        self.granularity = granularity
+        self.srtt = None
+        self.rttvar = None
+        self.min_rtt = None
+        self.rto = initial_rto
+
+    def sample(self, rtt):
+        if self.min_rtt is None or rtt < self.min_rtt:
+            self.min_rtt = rtt
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        self.reset()
+
+    def back_off(self):
+        self.rto = min(self.rto * 2, self.max_rto)
+
+    def reset(self):
+        '''
+        Undoes back_off(): the RTO follows the estimate again.
+        '''
+        if self.srtt is not None:
+            self.rto = min(max(self.srtt + max(self.granularity, 4 * self.rttvar), self.min_rto), self.max_rto)
+
+
+class Segment:
+    __slots__ = ('seq', 'payload', 'sent_at', 'transmissions', 'sacked', 'retransmitted')
+
+    def __init__(self, seq, payload):
+        self.seq = seq
+        self.payload = payload
+        self.sent_at = 0.0
+        self.transmissions = 0
+        self.sacked = False
+        # Already retransmitted since the last timeout: left to RACK and the
+        # timer rather than sent again on every SACK.
+        self.retransmitted = False
+
+
+class ReliableConnection:
+    '''
+    Selective-repeat reliable, ordered delivery of datagrams over a lossy
+    path. It does no I/O itself: packets to put on the wire go to
+    output(packet), payloads received in order go to deliver(payload), and
+    the caller feeds it datagram_received() and calls on_timer() once
+    timeout() seconds have passed. Packets are built in one buffer that is
+    reused, and payloads may be views of the datagram passed in, so neither
+    output() nor deliver() may keep what it is given after returning.
+    Both ends must start from the same initial_seq. With checksum=False
+    packets go out without a CRC and only the UDP checksum protects them;
+    those that carry one are checked either way.
+
+    The receiver buffers segments that arrive out of order and reports them
+    in SACK blocks; a segment is sent again when DUP_THRESH later segments
+    have been SACKed or the oldest one gets DUP_THRESH duplicate ACKs that
+    each SACK something new (fast retransmit, RFC 6675), when a segment
+    sent after it arrived more than a round trip and a reordering window
+    ago (RACK, RFC 8985, which also finds lost retransmissions), or when
+    the RFC 6298 retransmission timer runs out. Once the path is seen to
+    reorder, only RACK and the timer are used. Two round trips without an
+    ACK send a tail loss probe first, so a loss at the end of a burst is
+    found by SACK as well rather than by the timer.
+
+    A segment that arrives again after it was acknowledged is reported in
+    a D-SACK block (RFC 2883) below the ack. When every segment sent again
+    in a loss episode comes back that way, none was lost: the window
+    reduction is undone, and each round trip with such news widens the
+    reordering window by another quarter of the shortest round trip.
+
+    How much is in flight is the smallest of three limits: the congestion
+    window of the congestion controller (see congestion.py), the receive
+    window the peer advertises in every packet, and window, the size of the
+    receive buffer at both ends. With pacing, new segments are spread over
+    the round trip instead of leaving in bursts.
+    '''
+
+    def __init__(self, output, deliver, window=64, min_rto=0.2, max_rto=60.0, congestion='newreno',
+                 pacing=True, clock=time.monotonic, initial_seq=0, checksum=True):
+        self.output = output
+        self.deliver = deliver
+        self.window = window
+        self.clock = clock
+        self.rtt = RttEstimator(min_rto, max_rto)
+        self.cc = CONGESTION_CONTROLS[congestion](INITIAL_WINDOW, window)
+        self.pacing = pacing
+        self.next_send_at = 0.0
+        self.pace_deadline = None
+        self.packet = memoryview(bytearray(MAX_PACKET))
+        self.checksum = checksum
+
+        self.next_seq = initial_seq
+        self.unacked = OrderedDict()
+        self.pending = deque()
+        self.timer_deadline = None
+        self.last_ack = initial_seq
+        self.dupacks = 0
+        self.peer_edge = initial_seq + window
+        self.sacked = 0
+        # Block start -> how far that block has been looked at already, so
+        # the same SACK blocks repeated in every ACK are not walked again.
+        self.sack_scanned = {}
+        # The DUP_THRESH highest SACKed sequence numbers, ascending: every
+        # segment below the first of them has DUP_THRESH SACKed after it.
+        self.high_sacked = []
+        self.loss_scan = 0
+        # While below recovery_point the window is not reduced again; during
+        # fast recovery (but not the slow start after a timeout) it does not
+        # grow either.
+        self.recovery_point = None
+        self.fast_recovery = False
+        # Segments in the order they were last sent, and when the last sent
+        # of those known to have arrived went out (RACK).
+        self.send_order = OrderedDict()
+        self.rack_sent_at = None
+        self.reorder_deadline = None
+        # The highest segment known to have arrived; one sent only once
+        # arriving below it shows the path reorders.
+        self.high_delivered = None
+        self.reordering_seen = False
+        self.reo_wnd_mult = 1
+        self.reo_wnd_persist = REO_WND_PERSIST
+        self.reo_wnd_round = initial_seq
+        # The window before the current loss episode cut it, and the
+        # segments sent again in that episode not yet known to be needless.
+        self.undo_window = None
+        self.undo_retransmits = set()
+        self.probe_deadline = None
+        self.probing = False
+
+        self.rcv_next = initial_seq
+        self.reorder = {}
+        self.held = deque()
+        self.reading_paused = False
+        self.advertised = window
+        self.last_received = None
+        self.last_arrived = None
+        self.ack_needed = False
+        self.dsack = None
+
+        self.stats = {
+            'sent': 0,
+            'retransmitted': 0,
+            'fast_retransmits': 0,
+            'timeouts': 0,
+            'tail_probes': 0,
+            'spurious_retransmits': 0,
+            'undone': 0,
+            'window_probes': 0,
+            'acks_sent': 0,
+            'received': 0,
+            'delivered': 0,
+            'duplicates': 0,
+            'out_of_order': 0,
+            'beyond_window': 0,
+            'malformed': 0,
+        }
+
+    def send(self, payload):
+        self.pending.append(payload)
+        self.transmit_pending()
+
+    def send_base(self):
+        return next(iter(self.unacked)) if self.unacked else self.next_seq
+
+    def pipe(self):
+        '''
+        Segments believed to be in the network: sent, not yet acknowledged
+        and not SACKed.
+        '''
+        return len(self.unacked) - self.sacked
+
+    def transmit_pending(self):
+        while self.pending:
+            if self.next_seq >= self.peer_edge or self.next_seq >= self.send_base() + self.window:
+                if not self.unacked and self.timer_deadline is None:
+                    # Zero window: probe it once the timer runs out, in case
+                    # the update opening it again is lost.
+                    self.timer_deadline = self.clock() + self.rtt.rto
+                return
+            if self.pipe() >= self.cc.cwnd:
+                return
+            if self.pacing and self.rtt.srtt:
+                now = self.clock()
+                if now < self.next_send_at:
+                    self.pace_deadline = self.next_send_at
+                    return
+                interval = self.rtt.srtt / (self.cc.cwnd * self.cc.pacing_gain())
+                self.next_send_at = max(self.next_send_at, now - PACING_BURST * interval) + interval
+            self.send_new_segment()
+
+    def send_new_segment(self):
+        segment = Segment(self.next_seq, self.pending.popleft())
+        self.unacked[segment.seq] = segment
+        self.next_seq += 1
+        self.transmit(segment)
+
+    def transmit(self, segment):
+        now = self.clock()
+        segment.sent_at = now
+        segment.transmissions += 1
+        if not segment.sacked:
+            self.send_order[segment.seq] = segment
+            self.send_order.move_to_end(segment.seq)
+        self.stats['sent'] += 1
+        if segment.transmissions > 1:
+            self.stats['retransmitted'] += 1
+        self.advertised = self.receive_window()
+        length = encode_packet_into(self.packet, FLAG_DATA | FLAG_ACK | self.echo_flag(), segment.seq,
+                                    self.rcv_next, self.last_arrived or 0, self.advertised, self.sack_blocks(),
+                                    segment.payload, self.checksum)
+        self.output(self.packet[:length])
+        self.ack_needed = False
+        self.dsack = None
+        if self.timer_deadline is None:
+            self.timer_deadline = now + self.rtt.rto
+        if segment.transmissions == 1:
+            self.arm_probe(now)
+
+    def arm_probe(self, now):
+        '''
+        Sets the tail loss probe timer two round trips out, unless a probe is
+        already out. Unlike TCP it also probes during recovery, as QUIC does
+        (RFC 9002): a lost retransmission is then found by RACK instead of
+        the retransmission timer.
+        '''
+        self.probe_deadline = None
+        if not self.unacked or self.probing or self.rtt.srtt is None:
+            return
+        deadline = now + max(2 * self.rtt.srtt, MIN_PROBE_TIMEOUT)
+        if self.timer_deadline is None or deadline < self.timer_deadline:
+            self.probe_deadline = deadline
+
+    def send_ack(self):
+        self.stats['acks_sent'] += 1
+        self.advertised = self.receive_window()
+        length = encode_packet_into(self.packet, FLAG_ACK | self.echo_flag(), 0, self.rcv_next,
+                                    self.last_arrived or 0, self.advertised, self.sack_blocks(), b'',
+                                    self.checksum)
+        self.output(self.packet[:length])
+        self.ack_needed = False
+        self.dsack = None
+
+    def echo_flag(self):
+        # Only an ACK sent straight after a data segment arrived answers it;
+        # echoing it again later would give the sender too long a round trip.
+        return FLAG_ECHO if self.ack_needed else 0
+
+    def receive_window(self):
+        return max(0, self.window - len(self.held))
+
+    def sack_blocks(self):
+        '''
+        Up to MAX_SACK_BLOCKS [start, end) ranges of the segments held out of
+        order, the block with the most recently received segment first as
+        RFC 2018 asks. A segment that arrived again after it was handed over
+        comes before them all, in a D-SACK block (RFC 2883).
+        '''
+        dsack = [] if self.dsack is None else [(self.dsack, self.dsack + 1)]
+        if not self.reorder:
+            return dsack
+        blocks = []
+        start = end = None
+        for seq in sorted(self.reorder):
+            if seq == end:
+                end += 1
+                continue
+            if start is not None:
+                blocks.append((start, end))
+            start, end = seq, seq + 1
+        blocks.append((start, end))
+        blocks.reverse()
+        for index, (start, end) in enumerate(blocks):
+            if start <= self.last_received < end:
+                blocks.insert(0, blocks.pop(index))
+                break
+        return (dsack + blocks)[:MAX_SACK_BLOCKS]
+
+    def datagram_received(self, data):
+        try:
+            flags, seq, ack, echo, window, sack_blocks, payload = decode_packet(data)
+        except ValueError:
+            self.stats['malformed'] += 1
+            return
+        if flags & FLAG_DATA:
+            self.data_received(unwrap(seq, self.rcv_next), payload)
+        if flags & FLAG_ACK:
+            ack = unwrap(ack, self.last_ack)
+            echo = unwrap(echo, self.last_ack) if flags & FLAG_ECHO else None
+            if sack_blocks:
+                sack_blocks = [(unwrap(start, ack), unwrap(end, ack)) for start, end in sack_blocks]
+            self.ack_received(ack, echo, window, sack_blocks, not flags & FLAG_DATA)
+        if self.ack_needed:
+            self.send_ack()
+
+    def data_received(self, seq, payload):
+        self.stats['received'] += 1
+        self.ack_needed = True
+        self.last_arrived = seq
+        if seq < self.rcv_next or seq in self.reorder:
+            self.stats['duplicates'] += 1
+            if seq < self.rcv_next:
+                self.dsack = seq
+            return
+        if seq >= self.rcv_next + self.receive_window():
+            self.stats['beyond_window'] += 1
+            return
+        self.last_received = seq
+        if seq != self.rcv_next:
+            self.stats['out_of_order'] += 1
+            # A copy: payload may be a view of a buffer the caller reuses.
+            self.reorder[seq] = bytes(payload)
+            return
+        self.rcv_next += 1
+        self.hand_over(payload)
+        while self.rcv_next in self.reorder:
+            self.hand_over(self.reorder.pop(self.rcv_next))
+            self.rcv_next += 1
+
+    def hand_over(self, payload):
+        self.stats['delivered'] += 1
+        if self.reading_paused:
+            self.held.append(bytes(payload))
+        else:
+            self.deliver(payload)
+
+    def pause_reading(self):
+        '''
+        Stops deliver() being called. Segments received in order meanwhile
+        are held and shrink the advertised window, so a slow reader slows
+        the sender down instead of losing data.
+        '''
+        self.reading_paused = True
+
+    def resume_reading(self):
+        self.reading_paused = False
+        while self.held and not self.reading_paused:
+            self.deliver(self.held.popleft())
+        if self.advertised < self.window // 2 <= self.receive_window():
+            # The sender may be waiting for this window update.
+            self.send_ack()
+
+    def ack_received(self, ack, echo, window, sack_blocks, pure_ack):
+        if ack > self.next_seq:
+            return
+        now = self.clock()
+        pipe = self.pipe()
+        if ack >= self.last_ack:
+            self.peer_edge = ack + window
+        # The round trip is measured on the segment this ACK was sent for, if
+        # it is news and (Karn's algorithm) that segment was sent only once.
+        # Others it acknowledges may have arrived long ago, their own ACKs
+        # lost.
+        sample = self.unacked.get(echo) if echo is not None else None
+        if sample is not None and (sample.transmissions > 1 or sample.sacked):
+            sample = None
+
+        acked = None
+        newly_delivered = 0
+        while self.unacked and next(iter(self.unacked)) < ack:
+            _, acked = self.unacked.popitem(last=False)
+            if acked.sacked:
+                self.sacked -= 1
+            else:
+                newly_delivered += 1
+                self.delivered(acked, now)
+        if acked is not None:
+            self.dupacks = 0
+            self.last_ack = ack
+            if self.recovery_point is not None and ack >= self.recovery_point:
+                self.recovery_point = None
+                self.fast_recovery = False
+            if self.sack_scanned:
+                self.sack_scanned = {start: end for start, end in self.sack_scanned.items() if end > ack}
+        if sack_blocks and sack_blocks[0][1] <= ack:
+            self.dsack_received(sack_blocks[0][0])
+
+        newly_sacked = 0
+        for start, end in sack_blocks:
+            end = min(end, self.next_seq)
+            first = max(start, ack, self.sack_scanned.get(start, start))
+            if first >= end:
+                continue
+            self.sack_scanned[start] = end
+            for seq in range(first, end):
+                segment = self.unacked.get(seq)
+                if segment is None or segment.sacked:
+                    continue
+                segment.sacked = True
+                self.sacked += 1
+                newly_sacked += 1
+                self.note_sacked(seq)
+                self.delivered(segment, now)
+        if sample is not None and (sample.sacked or sample.seq < ack):
+            self.rtt.sample(now - sample.sent_at)
+        newly_delivered += newly_sacked
+        if newly_delivered:
+            # As in QUIC (RFC 9002), any progress ends the backoff: with
+            # retransmissions giving no RTT samples it could otherwise
+            # grow for as long as segments keep being lost.
+            self.rtt.reset()
+        if acked is not None:
+            self.timer_deadline = now + self.rtt.rto if self.unacked else None
+
+        # Only grow the window while it is what limits the sender, not while
+        # the application has little to send.
+        if newly_delivered and not self.fast_recovery and 2 * pipe >= self.cc.cwnd:
+            self.cc.on_ack(newly_delivered, now, self.rtt.srtt)
+            self.cc.cwnd = min(self.cc.cwnd, self.window)
+
+        if acked is not None and self.recovery_point is not None and self.unacked:
+            # A partial ACK (NewReno): the segment it stops at was lost too.
+            oldest = next(iter(self.unacked.values()))
+            if not oldest.sacked and not oldest.retransmitted:
+                self.fast_retransmit(oldest)
+        elif acked is None and pure_ack and newly_sacked and self.unacked and ack == self.last_ack:
+            # Only an ACK that SACKs something new counts (RFC 6675): the
+            # network may send an ACK twice, or the peer ACK a copy of a
+            # segment it already had.
+            self.dupacks += 1
+            if self.dupacks == DUP_THRESH:
+                oldest = next(iter(self.unacked.values()))
+                if not oldest.sacked and not oldest.retransmitted and not self.reordering_seen:
+                    self.fast_retransmit(oldest)
+        if newly_sacked and not self.reordering_seen:
+            self.detect_losses()
+        if newly_delivered:
+            self.rack_detect_losses(now)
+            self.probing = False
+            self.arm_probe(now)
+        self.transmit_pending()
+
+    def delivered(self, segment, now):
+        self.send_order.pop(segment.seq, None)
+        if self.high_delivered is None or segment.seq > self.high_delivered:
+            self.high_delivered = segment.seq
+        elif segment.transmissions == 1:
+            self.reordering_seen = True
+        # An ACK sooner than any round trip seen is for an earlier copy of a
+        # retransmitted segment, not for the last one sent.
+        if segment.transmissions > 1 and now - segment.sent_at < (self.rtt.min_rtt or 0.0):
+            return
+        if self.rack_sent_at is None or segment.sent_at > self.rack_sent_at:
+            self.rack_sent_at = segment.sent_at
+
+    def dsack_received(self, seq):
+        '''
+        The peer got seq twice. If it is a segment sent again in the last
+        loss episode, sending it again was needless: the reordering window
+        grows, at most once a round trip, and once every segment sent again
+        in the episode has turned out so the window is restored. Other
+        copies were made by the network.
+        '''
+        if seq not in self.undo_retransmits:
+            return
+        self.undo_retransmits.discard(seq)
+        self.stats['spurious_retransmits'] += 1
+        self.reo_wnd_persist = REO_WND_PERSIST
+        if self.last_ack >= self.reo_wnd_round:
+            self.reo_wnd_mult += 1
+            self.reo_wnd_round = self.next_seq
+        if not self.undo_retransmits and self.undo_window is not None:
+            cwnd, ssthresh = self.undo_window
+            self.undo_window = None
+            self.cc.cwnd = max(self.cc.cwnd, cwnd)
+            self.cc.ssthresh = max(self.cc.ssthresh, ssthresh)
+            self.recovery_point = None
+            self.fast_recovery = False
+            self.stats['undone'] += 1
+
+    def reorder_window(self):
+        '''
+        How long past a round trip a segment may arrive after one sent later
+        before it counts as lost: a quarter of the shortest round trip for
+        every D-SACK round, never more than a round trip (RFC 8985).
+        '''
+        return min(self.reo_wnd_mult * self.rtt.min_rtt / 4, self.rtt.srtt)
+
+    def rack_detect_losses(self, now):
+        '''
+        Sends again every segment sent before one that has arrived, once a
+        round trip and the reordering window have passed without it being
+        acknowledged; for the others sets the timer to check again.
+        '''
+        self.reorder_deadline = None
+        if self.rack_sent_at is None or self.rtt.srtt is None:
+            return
+        wait = self.rtt.srtt + self.reorder_window()
+        while self.send_order:
+            segment = next(iter(self.send_order.values()))
+            if segment.sent_at >= self.rack_sent_at:
+                break
+            if segment.sent_at + wait > now:
+                self.reorder_deadline = segment.sent_at + wait
+                break
+            self.fast_retransmit(segment)
+
+    def note_sacked(self, seq):
+        high = self.high_sacked
+        if len(high) < DUP_THRESH:
+            insort(high, seq)
+        elif seq > high[0]:
+            high[0] = seq
+            high.sort()
+
+    def detect_losses(self):
+        '''
+        Sends again every segment with DUP_THRESH SACKed segments after it
+        that has not been retransmitted yet.
+        '''
+        if len(self.high_sacked) < DUP_THRESH:
+            return
+        limit = self.high_sacked[0]
+        for seq in range(max(self.loss_scan, self.send_base()), limit):
+            segment = self.unacked.get(seq)
+            if segment is not None and not segment.sacked and not segment.retransmitted:
+                self.fast_retransmit(segment)
+        self.loss_scan = max(self.loss_scan, limit)
+
+    def fast_retransmit(self, segment):
+        if self.recovery_point is None:
+            # One window reduction per loss episode, however many segments
+            # of that window were lost (NewReno).
+            self.recovery_point = self.next_seq
+            self.fast_recovery = True
+            self.undo_window = (self.cc.cwnd, self.cc.ssthresh)
+            self.undo_retransmits = set()
+            self.reo_wnd_persist -= 1
+            if not self.reo_wnd_persist:
+                self.reo_wnd_mult = 1
+                self.reo_wnd_persist = REO_WND_PERSIST
+            self.cc.on_loss(self.clock(), len(self.unacked))
+        if self.undo_window is not None:
+            self.undo_retransmits.add(segment.seq)
+        segment.retransmitted = True
+        self.stats['fast_retransmits'] += 1
+        self.transmit(segment)
+
+    def deadline(self):
+        '''
+        When on_timer() should be called next, or None.
+        '''
+        deadlines = [deadline for deadline in (self.pace_deadline, self.reorder_deadline, self.probe_deadline,
+                                               self.timer_deadline) if deadline is not None]
+        return min(deadlines) if deadlines else None
+
+    def timeout(self):
+        '''
+        Seconds until on_timer() should be called, or None when nothing is
+        waiting for an acknowledgment or for its turn to be sent.
+        '''
+        deadline = self.deadline()
+        if deadline is None:
+            return None
+        return max(0.0, deadline - self.clock())
+
+    def on_timer(self):
+        now = self.clock()
+        if self.pace_deadline is not None and now >= self.pace_deadline:
+            self.pace_deadline = None
+            self.transmit_pending()
+        if self.reorder_deadline is not None and now >= self.reorder_deadline:
+            self.rack_detect_losses(now)
+        if self.probe_deadline is not None and now >= self.probe_deadline:
+            self.send_probe()
+        if self.timer_deadline is None or now < self.timer_deadline:
+            return
+        self.timer_deadline = None
+        self.probe_deadline = None
+        self.reorder_deadline = None
+        zero_window = self.peer_edge <= self.send_base()
+        if not self.unacked:
+            if self.pending and zero_window:
+                self.stats['window_probes'] += 1
+                self.rtt.back_off()
+                self.send_new_segment()
+            return
+
+        self.rtt.back_off()
+        self.dupacks = 0
+        if zero_window:
+            # A probe the peer had no room for, not a sign of congestion.
+            self.stats['window_probes'] += 1
+        else:
+            self.stats['timeouts'] += 1
+            self.cc.on_timeout(now, len(self.unacked))
+            self.recovery_point = self.next_seq
+            self.fast_recovery = False
+            self.undo_window = None
+        for segment in self.unacked.values():
+            segment.retransmitted = False
+        self.loss_scan = 0
+        oldest = next((segment for segment in self.unacked.values() if not segment.sacked), None)
+        if oldest is None:
+            oldest = next(iter(self.unacked.values()))
+        # A probe the peer dropped for lack of room is sent again as soon as
+        # SACKs show it missing once the window opens.
+        oldest.retransmitted = not zero_window
+        self.transmit(oldest)
+        # Retransmissions that were lost as well need not wait for a timeout
+        # each: everything SACK shows missing goes out again now.
+        self.detect_losses()
+        self.timer_deadline = now + self.rtt.rto
+
+    def send_probe(self):
+        '''
+        Tail loss probe (RFC 8985): one new segment if the windows allow,
+        else the last one sent again, to get an ACK whose SACK blocks show
+        what is missing.
+        '''
+        self.probe_deadline = None
+        if not self.send_order:
+            return
+        self.probing = True
+        self.stats['tail_probes'] += 1
+        if self.pending and self.next_seq < min(self.peer_edge, self.send_base() + self.window):
+            self.send_new_segment()
+        else:
+            self.transmit(max(self.send_order.values(), key=lambda segment: segment.seq))
+
+    def in_flight(self):
+        return len(self.unacked) + len(self.pending)
+
+    def info(self):
+        return {
+            'congestion': self.cc.name,
+            'cwnd': round(self.cc.cwnd, 1),
+            'ssthresh': self.cc.ssthresh,
+            'srtt': self.rtt.srtt,
+            'rto': self.rtt.rto,
+            'peer_window': self.peer_edge - self.last_ack,
+            'in_flight': self.pipe(),
+        }
@@ -0,0 +1,332 @@
+import asyncio
+import struct
+
+from rudp import HEADER, MAX_SACK_BLOCKS, SACK_BLOCK, ReliableConnection
+
+# IPv4 and UDP headers.
+IP_UDP_OVERHEAD = 28
+MESSAGE_LENGTH = struct.Struct('!I')
+
+
+def segment_size(mtu):
+    '''
+    Payload bytes per datagram that keep a packet with the most SACK blocks
+    within mtu.
+    '''
+    return mtu - IP_UDP_OVERHEAD - HEADER.size - MAX_SACK_BLOCKS * SACK_BLOCK.size
+
+
+class StreamConnection(ReliableConnection):
+    '''
+    A byte stream over ReliableConnection. write() cuts what it is given
+    into segments that fit mtu and coalesces small writes: a segment that is
+    not full goes out straight away only when nothing sent is still waiting
+    for an acknowledgment (Nagle's algorithm), and otherwise when it fills
+    up, when everything in flight has been acknowledged or at the latest
+    after delay seconds. delay=0 sends every write at once.
+
+    deliver(data) gets the stream in the chunks it arrives in, not in the
+    pieces it was written in. write_eof() ends the stream in this direction
+    with an empty segment (never otherwise sent), and the peer's
+    eof_received() is called once everything before it has been delivered.
+    '''
+
+    def __init__(self, output, deliver, eof_received=None, mtu=1500, delay=0.005, **options):
+        super().__init__(output, self.segment_received, **options)
+        self.data_received_callback = deliver
+        self.eof_received_callback = eof_received
+        self.mss = segment_size(mtu)
+        self.delay = delay
+        self.write_buffer = bytearray()
+        self.flush_deadline = None
+        self.pending_bytes = 0
+        self.eof_sent = False
+        self.eof_received = False
+        self.stats['writes'] = 0
+        self.stats['coalesced'] = 0
+
+    def write(self, data):
+        if self.eof_sent:
+            raise RuntimeError("write after write_eof()")
+        self.stats['writes'] += 1
+        view = memoryview(data)
+        if self.write_buffer:
+            room = self.mss - len(self.write_buffer)
+            self.write_buffer += view[:room]
+            view = view[room:]
+            self.stats['coalesced'] += 1
+            if len(self.write_buffer) < self.mss:
+                self.maybe_flush()
+                return
+            self.flush()
+        # Full segments are cut straight from data, without going through
+        # the buffer.
+        while len(view) >= self.mss:
+            self.queue_segment(view[:self.mss].tobytes())
+            view = view[self.mss:]
+        self.transmit_pending()
+        if view:
+            self.write_buffer += view
+            self.maybe_flush()
+
+    def maybe_flush(self):
+        if not self.unacked or not self.delay:
+            self.flush()
+        elif self.flush_deadline is None:
+            self.flush_deadline = self.clock() + self.delay
+
+    def flush(self):
+        '''
+        Sends what write() is holding back now.
+        '''
+        self.flush_deadline = None
+        if self.write_buffer:
+            self.queue_segment(bytes(self.write_buffer))
+            self.write_buffer.clear()
+        self.transmit_pending()
+
+    def write_eof(self):
+        if self.eof_sent:
+            return
+        self.flush()
+        self.eof_sent = True
+        self.send(b'')
+
+    def queue_segment(self, payload):
+        self.pending_bytes += len(payload)
+        self.pending.append(payload)
+
+    def send_new_segment(self):
+        self.pending_bytes -= len(self.pending[0])
+        super().send_new_segment()
+
+    def buffered(self):
+        '''
+        Bytes written that have not been sent for the first time yet.
+        '''
+        return self.pending_bytes + len(self.write_buffer)
+
+    def all_acknowledged(self):
+        return self.eof_sent and not self.unacked and not self.pending
+
+    def segment_received(self, payload):
+        if not payload:
+            self.eof_received = True
+            if self.eof_received_callback is not None:
+                self.eof_received_callback()
+        else:
+            self.data_received_callback(payload)
+
+    def ack_received(self, ack, echo, window, sack_blocks, pure_ack):
+        super().ack_received(ack, echo, window, sack_blocks, pure_ack)
+        if self.write_buffer and not self.unacked:
+            self.flush()
+
+    def deadline(self):
+        deadline = super().deadline()
+        if self.flush_deadline is not None and (deadline is None or self.flush_deadline < deadline):
+            return self.flush_deadline
+        return deadline
+
+    def on_timer(self):
+        if self.flush_deadline is not None and self.clock() >= self.flush_deadline:
+            self.flush()
+        super().on_timer()
+
+
+class StreamProtocol(asyncio.DatagramProtocol):
+    '''
+    Runs a StreamConnection on an asyncio datagram transport, feeding what
+    arrives to an asyncio.StreamReader. A reader whose buffer is full pauses
+    the connection, which closes the receive window so the peer slows down.
+    With no remote address the protocol answers whoever sent to it last.
+
+    Once both directions have ended the transport is closed after linger
+    seconds, long enough for a lost final ACK to be asked for again.
+    '''
+
+    def __init__(self, reader, remote=None, linger=1.0, **options):
+        self.reader = reader
+        self.remote = remote
+        self.answer_sender = remote is None
+        self.linger = linger
+        self.loop = asyncio.get_running_loop()
+        self.transport = None
+        self.timer = None
+        self.closing = None
+        self.drain_waiters = []
+        self.closed = self.loop.create_future()
+        self.high_water = 0
+        self.connection = StreamConnection(self.output, reader.feed_data, self.eof_received,
+                                           clock=self.loop.time, **options)
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.reader.set_transport(self)
+
+    def connection_lost(self, exc):
+        if self.timer is not None:
+            self.timer.cancel()
+        if not self.connection.eof_received:
+            if exc is None:
+                self.reader.feed_eof()
+            else:
+                self.reader.set_exception(exc)
+        self.wake_writers(exc or ConnectionResetError("connection closed"))
+        if not self.closed.done():
+            self.closed.set_result(None)
+
+    def error_received(self, exc):
+        # Nobody listening at the other end yet: the packet counts as lost
+        # and is sent again.
+        pass
+
+    def output(self, packet):
+        if self.transport is None or self.transport.is_closing():
+            return
+        if self.remote is not None:
+            self.transport.sendto(packet, self.remote)
+
+    def datagram_received(self, data, addr):
+        if self.answer_sender:
+            self.remote = addr
+        self.connection.datagram_received(data)
+        self.progress()
+
+    def eof_received(self):
+        self.reader.feed_eof()
+
+    def pause_reading(self):
+        self.connection.pause_reading()
+
+    def resume_reading(self):
+        self.connection.resume_reading()
+        self.progress()
+
+    def progress(self):
+        '''
+        Called after anything that may have changed the connection: moves
+        the timer, wakes writers waiting in drain() and closes the transport
+        once everything is done.
+        '''
+        if self.connection.buffered() <= self.high_water:
+            self.wake_writers()
+        if self.connection.eof_received and self.connection.all_acknowledged() and self.closing is None:
+            self.closing = self.loop.call_later(self.linger, self.transport.close)
+        deadline = self.connection.deadline()
+        if deadline is None or (self.timer is not None and self.timer.when() <= deadline):
+            return
+        if self.timer is not None:
+            self.timer.cancel()
+        self.timer = self.loop.call_at(deadline, self.timer_expired)
+
+    def timer_expired(self):
+        self.timer = None
+        self.connection.on_timer()
+        self.progress()
+
+    def wake_writers(self, exc=None):
+        waiters, self.drain_waiters = self.drain_waiters, []
+        for waiter in waiters:
+            if waiter.done():
+                continue
+            if exc is None:
+                waiter.set_result(None)
+            else:
+                waiter.set_exception(exc)
+
+    async def wait_for_room(self):
+        while self.connection.buffered() > self.high_water:
+            if self.transport.is_closing():
+                raise ConnectionResetError("connection closed")
+            waiter = self.loop.create_future()
+            self.drain_waiters.append(waiter)
+            await waiter
+
+
+class StreamWriter:
+    '''
+    The sending half, shaped like asyncio.StreamWriter: write() never
+    blocks, and drain() waits until no more than high_water bytes are
+    waiting to be sent for the first time.
+    '''
+
+    def __init__(self, protocol, high_water=64 * 1024):
+        self.protocol = protocol
+        protocol.high_water = high_water
+
+    @property
+    def transport(self):
+        return self.protocol.transport
+
+    def write(self, data):
+        self.protocol.connection.write(data)
+        self.protocol.progress()
+
+    def writelines(self, data):
+        for chunk in data:
+            self.protocol.connection.write(chunk)
+        self.protocol.progress()
+
+    def write_message(self, data):
+        '''
+        Writes data as one message for read_message(): a 4-byte length, then
+        data.
+        '''
+        self.protocol.connection.write(MESSAGE_LENGTH.pack(len(data)))
+        self.write(data)
+
+    def can_write_eof(self):
+        return True
+
+    def write_eof(self):
+        self.protocol.connection.write_eof()
+        self.protocol.progress()
+
+    async def drain(self):
+        await self.protocol.wait_for_room()
+
+    def close(self):
+        '''
+        Ends this direction; the transport closes once the peer has ended
+        its own and everything has been acknowledged.
+        '''
+        self.write_eof()
+
+    def abort(self):
+        self.protocol.transport.close()
+
+    def is_closing(self):
+        return self.protocol.connection.eof_sent or self.protocol.transport.is_closing()
+
+    async def wait_closed(self):
+        await self.protocol.closed
+
+    def get_extra_info(self, name, default=None):
+        if name == 'connection':
+            return self.protocol.connection
+        return self.protocol.transport.get_extra_info(name, default)
+
+
+async def read_message(reader):
+    '''
+    Reads one message written with StreamWriter.write_message(). Raises
+    asyncio.IncompleteReadError if the stream ends part way through one.
+    '''
+    length, = MESSAGE_LENGTH.unpack(await reader.readexactly(MESSAGE_LENGTH.size))
+    return await reader.readexactly(length)
+
+
+async def open_connection(local=('0.0.0.0', 0), remote=None, limit=2 ** 16, high_water=64 * 1024, **options):
+    '''
+    A (reader, writer) pair for a stream over UDP between local and remote.
+    Without remote the first peer to send becomes the other end. Both ends
+    need the same options that shape the connection (initial_seq,
+    checksum); the rest (window, congestion, pacing, mtu, delay, ...) may
+    differ.
+    '''
+    loop = asyncio.get_running_loop()
+    reader = asyncio.StreamReader(limit=limit)
+    _, protocol = await loop.create_datagram_endpoint(
+        lambda: StreamProtocol(reader, remote, **options), local_addr=local)
+    return reader, StreamWriter(protocol, high_water)
@@ -0,0 +1,89 @@
+import unittest
+
+from congestion import CONGESTION_CONTROLS, Cubic, Fixed, NewReno
+
+
+class NewRenoTest(unittest.TestCase):
+
+    def test_slow_start_then_one_segment_per_round_trip(self):
+        cc = NewReno(initial_window=10)
+        cc.on_ack(10, 0.0, 0.1)
+        self.assertEqual(cc.cwnd, 20)
+        self.assertEqual(cc.pacing_gain(), 2.0)
+        cc.ssthresh = 20
+        for _ in range(20):
+            cc.on_ack(1, 0.0, 0.1)
+        self.assertAlmostEqual(cc.cwnd, 21, delta=0.05)
+        self.assertEqual(cc.pacing_gain(), 1.25)
+
+    def test_loss_halves_and_timeout_collapses_the_window(self):
+        cc = NewReno()
+        cc.on_loss(0.0, 30)
+        self.assertEqual((cc.cwnd, cc.ssthresh), (15, 15))
+        cc.on_timeout(0.0, 2)
+        self.assertEqual((cc.cwnd, cc.ssthresh), (1, 2))
+
+
+class CubicTest(unittest.TestCase):
+
+    def grow(self, cc, start, seconds, rtt=0.1):
+        '''
+        Acknowledges a window's worth of segments every rtt for seconds.
+        '''
+        now = start
+        while now < start + seconds:
+            cc.on_ack(int(cc.cwnd), now, rtt)
+            now += rtt
+        return now
+
+    def test_window_returns_to_where_it_was_lost_then_probes_beyond(self):
+        cc = Cubic()
+        cc.cwnd = 100
+        cc.ssthresh = 100
+        cc.on_loss(0.0, 100)
+        self.assertEqual(cc.cwnd, 70)
+        self.assertEqual(cc.w_max, 100)
+        # K = cbrt(100 * 0.3 / 0.4), about 4.2 seconds.
+        now = self.grow(cc, 0.0, 3.0)
+        self.assertLess(cc.cwnd, 100)
+        self.assertGreater(cc.cwnd, 90)
+        now = self.grow(cc, now, 1.0)
+        self.assertAlmostEqual(cc.cwnd, 100, delta=2)
+        self.grow(cc, now, 4.0)
+        self.assertGreater(cc.cwnd, 115)
+
+    def test_short_round_trips_grow_like_reno(self):
+        cc = Cubic()
+        cc.cwnd = 20
+        cc.on_loss(0.0, 20)
+        # 200 round trips in 0.2 seconds: the cubic curve has barely moved,
+        # the Reno-friendly estimate has grown by about 0.53 per round trip.
+        self.grow(cc, 0.0, 0.2, rtt=0.001)
+        self.assertGreater(cc.cwnd, 14 + 0.5 * 200)
+
+    def test_fast_convergence(self):
+        cc = Cubic()
+        cc.cwnd = 100
+        cc.on_loss(0.0, 100)
+        cc.on_loss(0.0, 70)
+        # Lost again below the previous maximum: it gives up more.
+        self.assertAlmostEqual(cc.w_max, 70 * 1.7 / 2)
+        cc.on_timeout(0.0, 49)
+        self.assertEqual(cc.cwnd, 1)
+
+
+class FixedTest(unittest.TestCase):
+
+    def test_window_never_changes(self):
+        cc = Fixed(max_window=32)
+        cc.on_ack(10, 0.0, 0.1)
+        cc.on_loss(0.0, 32)
+        cc.on_timeout(0.0, 32)
+        self.assertEqual(cc.cwnd, 32)
+
+    def test_names(self):
+        self.assertEqual(set(CONGESTION_CONTROLS), {'fixed', 'newreno', 'cubic'})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+import unittest
+
+from eventloop import TimerWheel
+
+
+class TimerWheelTest(unittest.TestCase):
+
+    def setUp(self):
+        # Starts at tick 0 with 1 ms ticks and a 16 slot wheel.
+        self.wheel = TimerWheel(tick=0.001, slots=16, clock=lambda: 0.0)
+        self.fired = []
+
+    def schedule(self, when, name):
+        return self.wheel.schedule(when, lambda: self.fired.append(name))
+
+    def test_timers_fire_in_order(self):
+        self.schedule(0.005, 'b')
+        self.schedule(0.0021, 'a')
+        self.schedule(0.010, 'c')
+        self.wheel.expire(0.001)
+        self.assertEqual(self.fired, [])
+        self.wheel.expire(0.006)
+        self.assertEqual(self.fired, ['a', 'b'])
+        self.assertAlmostEqual(self.wheel.timeout(0.006), 0.004)
+        self.wheel.expire(0.010)
+        self.assertEqual(self.fired, ['a', 'b', 'c'])
+        self.assertIsNone(self.wheel.timeout(0.010))
+        self.assertEqual(self.wheel.occupied, 0)
+
+    def test_next_deadline_skips_empty_slots(self):
+        self.schedule(0.001, 'a')
+        self.schedule(0.012, 'b')
+        self.wheel.expire(0.001)
+        self.assertEqual(self.fired, ['a'])
+        self.assertEqual(self.wheel.next_tick, 12)
+        self.assertEqual(list(self.wheel.occupied_ticks(self.wheel.current, 16)), [12])
+
+    def test_cancelled_timers_are_dropped(self):
+        first = self.schedule(0.002, 'a')
+        self.schedule(0.007, 'b')
+        first.cancel()
+        self.wheel.find_next_tick()
+        self.assertEqual(self.wheel.next_tick, 7)
+        self.assertEqual(self.wheel.pending, 1)
+        self.assertEqual(list(self.wheel.occupied_ticks(0, 16)), [7])
+        self.wheel.expire(0.008)
+        self.assertEqual(self.fired, ['b'])
+        self.assertEqual(self.wheel.pending, 0)
+
+    def test_timers_more_than_one_turn_away(self):
+        self.schedule(0.040, 'far')
+        self.schedule(0.003, 'near')
+        self.wheel.expire(0.003)
+        self.assertEqual(self.fired, ['near'])
+        # Its slot comes round twice before it is due.
+        for now in range(4, 40):
+            self.wheel.expire(now / 1000)
+            self.assertEqual(self.fired, ['near'])
+            self.assertLessEqual(self.wheel.next_tick, 40)
+        self.wheel.expire(0.040)
+        self.assertEqual(self.fired, ['near', 'far'])
+
+    def test_long_wait_expires_everything_due(self):
+        for when in (0.001, 0.009, 0.015, 0.030):
+            self.schedule(when, when)
+        self.wheel.expire(0.100)
+        self.assertEqual(self.fired, [0.001, 0.009, 0.015, 0.030])
+        self.assertEqual(self.wheel.pending, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,71 @@
+import socket
+import time
+import unittest
+
+from lossy_link import PROFILES, LossyLink
+
+
+class LossyLinkTest(unittest.TestCase):
+
+    def link(self, **options):
+        self.target = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.target.bind(('127.0.0.1', 0))
+        self.target.settimeout(1.0)
+        self.addCleanup(self.target.close)
+        link = LossyLink(('127.0.0.1', 0), self.target.getsockname(), seed=1, **options)
+        self.addCleanup(link.front.close)
+        self.addCleanup(link.back.close)
+        return link
+
+    def test_profiles_are_valid_options(self):
+        for name, options in PROFILES.items():
+            self.assertIsInstance(self.link(**options), LossyLink, name)
+
+    def test_bursts_of_loss(self):
+        link = self.link(burst_enter=0.01, burst_exit=0.3)
+        losses = [link.lost(link.back) for _ in range(200000)]
+        bursts = link.stats['bursts']
+        # In the bad state 0.01 / (0.01 + 0.3) of the time, for 1 / 0.3
+        # datagrams at a time, and losing datagrams only then.
+        self.assertAlmostEqual(sum(losses) / len(losses), 0.01 / 0.31, delta=0.005)
+        self.assertAlmostEqual(sum(losses) / bursts, 1 / 0.3, delta=0.3)
+        self.assertFalse(link.bad[link.front])
+
+    def test_duplicate_and_corrupt(self):
+        link = self.link(duplicate=1.0, corrupt=1.0)
+        data = bytes(100)
+        link.schedule(link.back, data, None)
+        copies = [self.target.recv(200) for _ in range(2)]
+        for copy in copies:
+            self.assertEqual(len(copy), 100)
+            self.assertEqual(sum(bin(byte).count('1') for byte in copy), 1)
+        self.assertEqual((link.stats['duplicated'], link.stats['corrupted'], link.stats['forwarded']), (1, 2, 2))
+
+    def test_empty_datagram_is_not_corrupted(self):
+        link = self.link(corrupt=1.0)
+        link.schedule(link.back, b'', None)
+        self.assertEqual(self.target.recv(200), b'')
+        self.assertEqual((link.stats['corrupted'], link.stats['forwarded']), (0, 1))
+
+    def test_rate_and_queue_limit(self):
+        link = self.link(rate=1000, queue_limit=2)
+        now = time.monotonic()
+        for _ in range(5):
+            link.schedule(link.back, bytes(100), None)
+        self.assertEqual(link.stats['overflowed'], 3)
+        # Each datagram takes 0.1 seconds to go through the link.
+        due = sorted(entry[0] - now for entry in link.queue)
+        self.assertEqual(len(due), 2)
+        self.assertAlmostEqual(due[0], 0.1, delta=0.01)
+        self.assertAlmostEqual(due[1], 0.2, delta=0.01)
+
+    def test_reorder_holds_datagrams_back(self):
+        link = self.link(delay=0.01, reorder=1.0, reorder_delay=0.05)
+        now = time.monotonic()
+        link.schedule(link.back, b'late', None)
+        self.assertEqual(link.stats['reordered'], 1)
+        self.assertAlmostEqual(link.queue[0][0] - now, 0.06, delta=0.01)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,208 @@
+import heapq
+import random
+import unittest
+
+from collections import Counter
+
+from congestion import CONGESTION_CONTROLS
+from rudp import (DUP_THRESH, FLAG_ACK, FLAG_DATA, HEADER, PACING_BURST, ReliableConnection, decode_packet,
+                  encode_packet, unwrap)
+
+
+class Path:
+    '''
+    Two connections joined by a simulated path on a virtual clock: every
+    datagram takes delay seconds plus up to jitter more, a loss fraction of
+    them is dropped, and every duplicate-th one arrives a second time,
+    copy_delay seconds later. The times the sender's datagrams leave at are
+    kept in departures.
+    '''
+
+    def __init__(self, delay=0.005, jitter=0.0, loss=0.0, duplicate=0, copy_delay=0.001, seed=1, **options):
+        self.now = 0.0
+        self.delay = delay
+        self.jitter = jitter
+        self.loss = loss
+        self.duplicate = duplicate
+        self.copy_delay = copy_delay
+        self.random = random.Random(seed)
+        self.queue = []
+        self.sent = 0
+        self.received = []
+        self.departures = []
+        self.sender = ReliableConnection(self.depart, lambda payload: None, clock=lambda: self.now, **options)
+        self.receiver = ReliableConnection(lambda packet: self.put(self.sender, packet),
+                                           lambda payload: self.received.append(bytes(payload)),
+                                           clock=lambda: self.now, **options)
+
+    def depart(self, packet):
+        self.departures.append(self.now)
+        self.put(self.receiver, packet)
+
+    def put(self, to, packet):
+        self.sent += 1
+        if self.loss and self.random.random() < self.loss:
+            return
+        arrival = self.now + self.delay + self.random.uniform(0, self.jitter)
+        heapq.heappush(self.queue, (arrival, self.sent, to, bytes(packet)))
+        if self.duplicate and self.sent % self.duplicate == 0:
+            heapq.heappush(self.queue, (arrival + self.copy_delay, self.sent, to, bytes(packet)))
+
+    def run(self, count, limit=60.0):
+        for index in range(count):
+            self.sender.send(b'%d' % index)
+        return self.until(count, limit)
+
+    def until(self, count, limit=60.0):
+        '''
+        Runs the path until count payloads have been delivered or the clock
+        reaches limit.
+        '''
+        while len(self.received) < count and self.now < limit:
+            times = [connection.deadline() for connection in (self.sender, self.receiver)]
+            if self.queue:
+                times.append(self.queue[0][0])
+            self.now = max(self.now, min(time for time in times if time is not None))
+            while self.queue and self.queue[0][0] <= self.now:
+                _, _, to, packet = heapq.heappop(self.queue)
+                to.datagram_received(packet)
+            for connection in (self.sender, self.receiver):
+                deadline = connection.deadline()
+                if deadline is not None and deadline <= self.now:
+                    connection.on_timer()
+        return self.received
+
+
+class Corrupting(Path):
+    '''
+    A path that flips a byte in every corrupt-th datagram.
+    '''
+
+    def __init__(self, corrupt, **options):
+        super().__init__(**options)
+        self.corrupt = corrupt
+
+    def put(self, to, packet):
+        if self.sent % self.corrupt == self.corrupt - 1:
+            packet = bytearray(packet)
+            packet[-1] ^= 0xFF
+        super().put(to, packet)
+
+
+class PacketTest(unittest.TestCase):
+
+    def test_round_trip(self):
+        data = encode_packet(FLAG_DATA | FLAG_ACK, 2 ** 32 + 5, 7, 6, 64, [(9, 12), (14, 15)], b'payload')
+        self.assertEqual(len(data), HEADER.size + 2 * 8 + 7)
+        self.assertEqual(decode_packet(data), (FLAG_DATA | FLAG_ACK, 5, 7, 6, 64, [(9, 12), (14, 15)], b'payload'))
+
+    def test_payload_is_a_view_of_the_datagram(self):
+        data = bytearray(encode_packet(FLAG_DATA, 1, 0, 0, 64, [], b'abc'))
+        payload = decode_packet(memoryview(data))[6]
+        data[-1:] = b'd'
+        self.assertEqual(bytes(payload), b'abd')
+
+    def test_malformed_packets(self):
+        data = encode_packet(FLAG_DATA, 1, 0, 0, 64, [(2, 3)], b'payload')
+        for broken in (data[:HEADER.size - 1], data[:-1], data[:4] + b'\x03' + data[5:]):
+            with self.assertRaises(ValueError, msg=broken):
+                decode_packet(broken)
+        # Without a checksum nothing but the length is checked.
+        unchecked = encode_packet(FLAG_DATA, 1, 0, 0, 64, [], b'payload', checksum=False)
+        self.assertEqual(unchecked[:4], bytes(4))
+        self.assertEqual(decode_packet(unchecked[:-1] + b'X')[6], b'payloaX')
+
+    def test_unwrap(self):
+        self.assertEqual(unwrap(5, 2 ** 32 - 3), 2 ** 32 + 5)
+        self.assertEqual(unwrap(2 ** 32 - 3, 2 ** 32 + 5), 2 ** 32 - 3)
+        self.assertEqual(unwrap(10, 3 * 2 ** 32), 3 * 2 ** 32 + 10)
+
+    def test_sequence_numbers_wrap(self):
+        path = Corrupting(50, loss=0.05, initial_seq=2 ** 32 - 100)
+        self.assertEqual(path.run(1000), [b'%d' % index for index in range(1000)])
+        self.assertGreater(path.sender.next_seq, 2 ** 32)
+        self.assertGreater(path.receiver.stats['malformed'] + path.sender.stats['malformed'], 0)
+
+
+class LossRecoveryTest(unittest.TestCase):
+
+    def test_duplicating_path_causes_no_retransmissions(self):
+        path = Path(duplicate=5)
+        self.assertEqual(path.run(2000), [b'%d' % index for index in range(2000)])
+        self.assertGreater(path.receiver.stats['duplicates'], 0)
+        self.assertEqual(path.sender.stats['retransmitted'], 0)
+        self.assertEqual(path.sender.stats['fast_retransmits'], 0)
+
+    def test_duplicate_acks_count_only_with_new_sack_blocks(self):
+        sender = ReliableConnection(lambda packet: None, lambda payload: None, pacing=False)
+        for _ in range(10):
+            sender.send(b'x')
+        # The same ACK over and over, as a link that duplicates sends it.
+        for _ in range(2 * DUP_THRESH):
+            sender.datagram_received(encode_packet(FLAG_ACK, 0, 0, 0, 64, []))
+        self.assertEqual(sender.stats['fast_retransmits'], 0)
+        for index in range(DUP_THRESH):
+            sender.datagram_received(encode_packet(FLAG_ACK, 0, 0, 0, 64, [(2, 3 + index)]))
+        self.assertTrue(sender.unacked[0].retransmitted)
+
+    def test_copy_of_a_delivered_segment_is_reported_in_a_dsack_block(self):
+        packets = []
+        receiver = ReliableConnection(packets.append, lambda payload: None)
+        data = encode_packet(1, 0, 0, 0, 64, [], b'x')
+        receiver.datagram_received(data)
+        self.assertEqual(decode_packet(bytes(packets[-1]))[5], [])
+        receiver.datagram_received(data)
+        _, _, ack, _, _, sack_blocks, _ = decode_packet(bytes(packets[-1]))
+        self.assertEqual((ack, sack_blocks), (1, [(0, 1)]))
+        # Only the next ACK carries it.
+        receiver.send_ack()
+        self.assertEqual(decode_packet(bytes(packets[-1]))[5], [])
+
+    def test_reordering_window_grows_on_needless_retransmissions(self):
+        path = Path(jitter=0.005)
+        self.assertEqual(path.run(3000), [b'%d' % index for index in range(3000)])
+        stats = path.sender.stats
+        self.assertTrue(path.sender.reordering_seen)
+        self.assertGreater(path.sender.reo_wnd_mult, 1)
+        self.assertGreater(stats['spurious_retransmits'], 0)
+        self.assertLess(stats['retransmitted'], 0.02 * 3000)
+        self.assertEqual(stats['timeouts'], 0)
+
+
+class FlowControlTest(unittest.TestCase):
+
+    def test_slow_reader_closes_the_window(self):
+        path = Path(window=32)
+        path.receiver.pause_reading()
+        self.assertEqual(path.run(200, limit=5.0), [])
+        self.assertEqual(len(path.receiver.held), 32)
+        self.assertEqual(path.receiver.receive_window(), 0)
+        self.assertEqual(path.sender.peer_edge, path.sender.last_ack)
+        self.assertGreater(path.sender.stats['window_probes'], 0)
+        self.assertEqual(path.sender.stats['timeouts'], 0)
+        self.assertEqual(path.sender.stats['fast_retransmits'], 0)
+        # The window update sent on resuming gets the sender going again.
+        path.receiver.resume_reading()
+        self.assertEqual(path.until(200, limit=10.0), [b'%d' % index for index in range(200)])
+
+    def test_pacing_spreads_segments_over_the_round_trip(self):
+        bursts = {}
+        for pacing in (False, True):
+            path = Path(delay=0.02, pacing=pacing)
+            path.run(500)
+            # Departures after the first round trip, once the RTT is known.
+            bursts[pacing] = max(Counter(when for when in path.departures if when > 0).values())
+        self.assertLessEqual(bursts[True], PACING_BURST + 1)
+        self.assertGreater(bursts[False], 2 * PACING_BURST)
+
+    def test_every_congestion_control_recovers_from_loss(self):
+        for congestion in CONGESTION_CONTROLS:
+            path = Path(loss=0.02, congestion=congestion)
+            self.assertEqual(path.run(2000), [b'%d' % index for index in range(2000)], congestion)
+            self.assertGreater(path.sender.stats['retransmitted'], 0)
+            if congestion != 'fixed':
+                self.assertLess(path.sender.cc.ssthresh, path.sender.window)
+
+
+if __name__ == '__main__':
+    unittest.main()
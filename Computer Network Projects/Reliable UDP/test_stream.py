@@ -0,0 +1,136 @@
+import asyncio
+import os
+import unittest
+
+from rudp import decode_packet
+from stream import StreamConnection, open_connection, read_message, segment_size
+
+
+class Pair:
+    '''
+    Two StreamConnections on a virtual clock, joined by a path that takes
+    latency seconds and never loses anything. Payloads of the data segments
+    the first one sends are kept in segments.
+    '''
+
+    def __init__(self, latency=0.001, **options):
+        self.now = 0.0
+        self.latency = latency
+        self.queue = []
+        self.segments = []
+        self.received = bytearray()
+        self.eof = False
+        self.client = StreamConnection(self.client_output, lambda data: None, clock=lambda: self.now, **options)
+        self.server = StreamConnection(lambda packet: self.queue.append((self.now + latency, self.client, bytes(packet))),
+                                       self.received.extend, self.eof_received, clock=lambda: self.now, **options)
+
+    def client_output(self, packet):
+        payload = decode_packet(bytes(packet))[6]
+        if payload or packet[4] & 1:
+            self.segments.append(bytes(payload))
+        self.queue.append((self.now + self.latency, self.server, bytes(packet)))
+
+    def eof_received(self):
+        self.eof = True
+
+    def run(self, until):
+        while self.now < until:
+            times = [when for when, _, _ in self.queue]
+            times += [deadline for deadline in (self.client.deadline(), self.server.deadline())
+                      if deadline is not None]
+            if not times:
+                break
+            self.now = max(self.now, min(times))
+            arrived = [item for item in self.queue if item[0] <= self.now]
+            self.queue = [item for item in self.queue if item[0] > self.now]
+            for _, to, packet in arrived:
+                to.datagram_received(packet)
+            for connection in (self.client, self.server):
+                deadline = connection.deadline()
+                if deadline is not None and deadline <= self.now:
+                    connection.on_timer()
+
+
+class StreamConnectionTest(unittest.TestCase):
+
+    def test_writes_are_cut_into_segments_that_fit_the_mtu(self):
+        pair = Pair(mtu=1000)
+        mss = segment_size(1000)
+        data = os.urandom(5 * mss + 10)
+        pair.client.write(data)
+        pair.run(1.0)
+        self.assertEqual(bytes(pair.received), data)
+        self.assertEqual([len(segment) for segment in pair.segments], [mss] * 5 + [10])
+
+    def test_small_writes_are_coalesced_while_data_is_in_flight(self):
+        pair = Pair()
+        for _ in range(100):
+            pair.client.write(b'x' * 10)
+        pair.run(1.0)
+        self.assertEqual(bytes(pair.received), b'x' * 1000)
+        # The first write goes at once, the rest wait for it to be
+        # acknowledged, which happens before the delay runs out.
+        self.assertEqual([len(segment) for segment in pair.segments], [10, 990])
+        self.assertLess(pair.now, 0.005)
+        self.assertEqual(pair.client.stats['coalesced'], 98)
+
+    def test_delay_bounds_how_long_a_write_is_held_back(self):
+        pair = Pair(latency=1.0)
+        pair.client.write(b'first')
+        pair.client.write(b'second')
+        self.assertEqual(pair.segments, [b'first'])
+        self.assertEqual(pair.client.deadline(), 0.005)
+        pair.run(0.005)
+        self.assertEqual(pair.segments, [b'first', b'second'])
+
+    def test_no_delay_sends_every_write(self):
+        pair = Pair(delay=0)
+        for word in (b'a', b'b', b'c'):
+            pair.client.write(word)
+        self.assertEqual(pair.segments, [b'a', b'b', b'c'])
+
+    def test_eof(self):
+        pair = Pair()
+        pair.client.write(b'data')
+        pair.client.write_eof()
+        with self.assertRaises(RuntimeError):
+            pair.client.write(b'more')
+        pair.run(1.0)
+        self.assertEqual((bytes(pair.received), pair.eof), (b'data', True))
+        self.assertEqual(pair.segments[-1], b'')
+        self.assertTrue(pair.client.all_acknowledged())
+
+
+class OpenConnectionTest(unittest.IsolatedAsyncioTestCase):
+
+    async def test_messages_both_ways(self):
+        server_reader, server_writer = await open_connection(('127.0.0.1', 0), linger=0.05)
+        address = server_writer.get_extra_info('sockname')
+        client_reader, client_writer = await open_connection(('127.0.0.1', 0), address, linger=0.05)
+        messages = [os.urandom(size) for size in (0, 1, 1400, 100000, 1 << 20)]
+
+        async def echo():
+            while True:
+                try:
+                    message = await read_message(server_reader)
+                except asyncio.IncompleteReadError:
+                    break
+                server_writer.write_message(message[::-1])
+                await server_writer.drain()
+            server_writer.close()
+        echoing = asyncio.create_task(echo())
+
+        for message in messages:
+            client_writer.write_message(message)
+            await client_writer.drain()
+        client_writer.close()
+        for message in messages:
+            self.assertEqual(await asyncio.wait_for(read_message(client_reader), 10), message[::-1])
+        self.assertEqual(await client_reader.read(), b'')
+        await asyncio.wait_for(echoing, 10)
+        await asyncio.wait_for(client_writer.wait_closed(), 10)
+        await asyncio.wait_for(server_writer.wait_closed(), 10)
+
+
+if __name__ == '__main__':
+    unittest.main()
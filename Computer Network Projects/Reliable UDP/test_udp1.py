@@ -0,0 +1,69 @@
+import errno
+import socket
+import unittest
+
+from eventloop import EventLoop
+from udp1 import Relay, ThreadedRelay
+
+
+class FailingSocket:
+    '''
+    A socket whose reads raise the given errors, the last one for good.
+    '''
+
+    def __init__(self, *errors):
+        self.errors = list(errors)
+        self.reads = 0
+
+    def getpeername(self):
+        raise OSError(errno.ENOTCONN, 'not connected')
+
+    def fileno(self):
+        return self.peer.fileno()
+
+    def setblocking(self, flag):
+        pass
+
+    def recvfrom(self, size):
+        self.reads += 1
+        raise self.errors.pop(0) if len(self.errors) > 1 else self.errors[0]
+
+    def recvfrom_into(self, buffer):
+        return self.recvfrom(len(buffer))
+
+
+class ReadErrorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tunnel = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.tunnel.bind(('127.0.0.1', 0))
+        self.addCleanup(self.tunnel.close)
+        self.broken = FailingSocket(ConnectionRefusedError(), InterruptedError(), OSError(errno.EBADF, 'bad'))
+        self.broken.peer = self.tunnel
+
+    def test_threaded_relay_stops_reading_a_broken_socket(self):
+        relay = ThreadedRelay(self.broken, self.tunnel)
+        # Returns instead of spinning on the error.
+        relay.receive_from_app()
+        self.assertEqual(self.broken.reads, 3)
+        self.assertEqual(relay.error.errno, errno.EBADF)
+
+    def test_threaded_relay_tunnel_side(self):
+        relay = ThreadedRelay(self.tunnel, self.broken)
+        relay.receive_from_tunnel()
+        self.assertEqual(self.broken.reads, 3)
+        self.assertEqual(relay.error.errno, errno.EBADF)
+
+    def test_relay_removes_a_broken_socket_from_the_loop(self):
+        loop = EventLoop()
+        app = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.addCleanup(app.close)
+        relay = Relay(loop, app, self.broken)
+        relay.tunnel_readable()
+        self.assertEqual(self.broken.reads, 3)
+        self.assertEqual(relay.error.errno, errno.EBADF)
+        self.assertEqual([key.fileobj for key in loop.selector.get_map().values()], [app])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,61 +1,65 @@
+import argparse
 import socket
 import threading
 import queue
 
+from lossy_link import parse_address
+
 client_sequence_num = 0
 server_sequence_num = 0
-client_window_size = 4
-server_window_size = 4
+# The receiving threads number the datagrams; the lock keeps two of them
+# from getting the same number.
+sequence_lock = threading.Lock()
 
 client_queue = queue.Queue()
 server_queue = queue.Queue()
 
-client_unacked_packets = []
-server_unacked_packets = []
-
 
 def receive_from_client(client_socket):
     global server_sequence_num
     while True:
         data, _ = client_socket.recvfrom(1024)
-        client_queue.put((server_sequence_num, data))
-        server_sequence_num += 1
+        with sequence_lock:
+            seq = server_sequence_num
+            server_sequence_num += 1
+        client_queue.put((seq, data))
 
 
 def receive_from_server(server_socket):
     global client_sequence_num
     while True:
         data, _ = server_socket.recvfrom(1024)
-        server_queue.put((client_sequence_num, data))
-        client_sequence_num += 1
+        with sequence_lock:
+            seq = client_sequence_num
+            client_sequence_num += 1
+        server_queue.put((seq, data))
 
 
 def send_to_server(destination_socket):
-    global client_sequence_num, client_window_size
     while True:
-        while client_sequence_num < len(client_unacked_packets) + client_window_size and not client_queue.empty():
-            seq, data = client_queue.get()
-            client_unacked_packets.append((seq, data))
+        # Sleeps until there is something to send.
+        seq, data = client_queue.get()
+        try:
             destination_socket.send(data)
-            client_sequence_num += 1
+        except OSError:
+            pass
 
 
 def send_to_client(destination_socket):
-    global server_sequence_num, server_window_size
     while True:
-        while server_sequence_num < len(server_unacked_packets) + server_window_size and not server_queue.empty():
-            seq, data = server_queue.get()
-            server_unacked_packets.append((seq, data))
+        seq, data = server_queue.get()
+        try:
             destination_socket.send(data)
-            server_sequence_num += 1
+        except OSError:
+            pass
 
 
-def run_my_server():
+def run_my_server(address=('127.0.0.1', 54321), destination=('127.0.0.1', 54322)):
     with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as server_socket:
-        server_socket.bind(('127.0.0.1', 54321))
+        server_socket.bind(address)
 
         with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as destination_socket:
-            destination_socket.connect(('127.0.0.1', 54322))
+            destination_socket.connect(destination)
 
             client_receiver = threading.Thread(target=receive_from_client, args=(server_socket,))
             server_sender = threading.Thread(target=send_to_client, args=(destination_socket,))
@@ -67,12 +71,12 @@ def run_my_server():
             server_sender.join()
 
 
-def run_my_client():
+def run_my_client(address=('127.0.0.1', 1111), link=('127.0.0.1', 12345)):
     with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as client_socket:
-        client_socket.bind(('127.0.0.1', 1111))
+        client_socket.bind(address)
 
         with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as destination_socket:
-            destination_socket.connect(('127.0.0.1', 12345))
+            destination_socket.connect(link)
 
             server_receiver = threading.Thread(target=receive_from_server, args=(client_socket,))
             client_sender = threading.Thread(target=send_to_server, args=(destination_socket,))
@@ -85,8 +89,15 @@ def run_my_client():
 
 
 if __name__ == "__main__":
-    intermediary_server = threading.Thread(target=run_my_server)
-    intermediary_client = threading.Thread(target=run_my_client)
+    parser = argparse.ArgumentParser(description="UDP relay between ncat and a lossy link, without retransmission")
+    parser.add_argument('--client', type=parse_address, default=('127.0.0.1', 1111))
+    parser.add_argument('--link', type=parse_address, default=('127.0.0.1', 12345))
+    parser.add_argument('--server', type=parse_address, default=('127.0.0.1', 54321))
+    parser.add_argument('--destination', type=parse_address, default=('127.0.0.1', 54322))
+    args = parser.parse_args()
+
+    intermediary_server = threading.Thread(target=run_my_server, args=(args.server, args.destination))
+    intermediary_client = threading.Thread(target=run_my_client, args=(args.client, args.link))
 
     intermediary_server.start()
     intermediary_client.start()
@@ -1,123 +1,292 @@
+import argparse
 import socket
 import threading
-import queue
-import time
-
-client_sequence_num = 0
-server_sequence_num = 0
-client_window_size = 4
-server_window_size = 4
-
-client_queue = queue.Queue()
-server_queue = queue.Queue()
 
-client_unacked_packets = {}
-server_unacked_packets = {}
+from congestion import CONGESTION_CONTROLS
+from eventloop import EventLoop
+from lossy_link import parse_address
+from rudp import MAX_PACKET, ReliableConnection
 
-client_ack_queue = queue.Queue()
-server_ack_queue = queue.Queue()
+CLIENT_ADDRESS = ('127.0.0.1', 1111)
+LINK_ADDRESS = ('127.0.0.1', 12345)
+SERVER_ADDRESS = ('127.0.0.1', 54321)
+DESTINATION_ADDRESS = ('127.0.0.1', 54322)
+# Errors a read may give that say nothing about the socket itself. A
+# connected UDP socket reports an ICMP port unreachable for an earlier send
+# once, on the next read: the peer is not up yet.
+TRANSIENT_ERRORS = (InterruptedError, ConnectionRefusedError)
 
 
-def receive_from_client(client_socket):
-    global server_sequence_num
-    while True:
-        data, _ = client_socket.recvfrom(1024)
-        seq, ack = int(data[:4]), int(data[4:8])
-        if seq == server_sequence_num:
-            server_queue.put((seq, data[8:]))
-            server_ack_queue.put(seq)
-            server_sequence_num += 1
-        elif seq > server_sequence_num:
-            client_queue.put((seq, ack, data[8:]))
-            client_ack_queue.put(ack)
+def is_connected(sock):
+    try:
+        sock.getpeername()
+        return True
+    except OSError:
+        return False
 
 
-def receive_from_server(server_socket):
-    global client_sequence_num
-    while True:
-        data, _ = server_socket.recvfrom(1024)
-        seq, ack = int(data[:4]), int(data[4:8])
-        if seq == client_sequence_num:
-            client_queue.put((seq, ack, data[8:]))
-            client_ack_queue.put(ack)
-            client_sequence_num += 1
-        elif seq > client_sequence_num:
-            server_queue.put((seq, data[8:]))
-            server_ack_queue.put(seq)
+class RelayBase:
+    '''
+    Carries the datagrams an application sends to app_socket reliably and
+    in order through tunnel_socket, and passes what arrives through the
+    tunnel on to the application. A socket that is not connected answers
+    whoever last sent to it. options go to the connection (window,
+    congestion, pacing, ...).
 
+    Packets from the tunnel are read into one buffer with recvfrom_into()
+    and handed to the connection as a view of it, so the payloads it
+    delivers in order are never copied. What the application sends is read
+    with recvfrom(): the connection keeps it until it is acknowledged, so it
+    needs a bytes object of its own anyway.
 
-def send_to_server(destination_socket):
-    global client_sequence_num, client_window_size
-    while True:
-        while client_sequence_num < len(client_unacked_packets) + client_window_size and not client_queue.empty():
-            seq, ack, data = client_queue.get()
-            client_unacked_packets[seq] = data
-            packet = f"{seq:04}{ack:04}{data}"
-            destination_socket.send(packet.encode())
-            client_sequence_num += 1
+    Any other error reading a socket than one of TRANSIENT_ERRORS means it
+    is closed or broken for good: the relay stops reading it and keeps the
+    error in error, instead of trying again and again.
+    '''
 
-        while not server_ack_queue.empty():
-            ack = server_ack_queue.get()
-            if ack in client_unacked_packets:
-                del client_unacked_packets[ack]
+    def __init__(self, app_socket, tunnel_socket, connection_class=ReliableConnection, **options):
+        self.app_socket = app_socket
+        self.tunnel_socket = tunnel_socket
+        self.app_peer = None
+        self.tunnel_peer = None
+        self.app_connected = is_connected(app_socket)
+        self.tunnel_connected = is_connected(tunnel_socket)
+        self.packet = bytearray(MAX_PACKET)
+        self.packet_view = memoryview(self.packet)
+        self.connection = connection_class(self.output, self.deliver, **options)
+        self.error = None
 
+    def output(self, packet):
+        try:
+            if self.tunnel_connected:
+                self.tunnel_socket.send(packet)
+            elif self.tunnel_peer is not None:
+                self.tunnel_socket.sendto(packet, self.tunnel_peer)
+        except OSError:
+            # Nobody listening at the other end yet: the packet counts as
+            # lost and is sent again.
+            pass
 
-def send_to_client(destination_socket):
-    global server_sequence_num, server_window_size
-    while True:
-        while server_sequence_num < len(server_unacked_packets) + server_window_size and not server_queue.empty():
-            seq, data = server_queue.get()
-            server_unacked_packets[seq] = data
-            packet = f"{seq:04}{0:04}{data}"
-            destination_socket.send(packet.encode())
-            server_sequence_num += 1
+    def deliver(self, payload):
+        try:
+            if self.app_connected:
+                self.app_socket.send(payload)
+            elif self.app_peer is not None:
+                self.app_socket.sendto(payload, self.app_peer)
+        except OSError:
+            pass
 
-        while not client_ack_queue.empty():
-            ack = client_ack_queue.get()
-            if ack in server_unacked_packets:
-                del server_unacked_packets[ack]
 
+class Relay(RelayBase):
+    '''
+    A relay driven by an EventLoop: no threads and no locks. When a socket
+    is readable up to batch datagrams are read from it in one go, and the
+    connection's next deadline is kept as one timer on the loop's timer
+    wheel. The timer is only moved when the deadline comes sooner; one that
+    fires early finds nothing due and is set again, which is cheaper than
+    moving it on every ACK.
+    '''
 
-def run_my_server():
-    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as server_socket:
-        server_socket.bind(('127.0.0.1', 54321))
+    def __init__(self, loop, app_socket, tunnel_socket, connection_class=ReliableConnection, batch=64, **options):
+        super().__init__(app_socket, tunnel_socket, connection_class, **options)
+        self.loop = loop
+        self.batch = batch
+        self.timer = None
+        for sock in (app_socket, tunnel_socket):
+            sock.setblocking(False)
+        loop.add_reader(app_socket, self.app_readable)
+        loop.add_reader(tunnel_socket, self.tunnel_readable)
 
-        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as destination_socket:
-            destination_socket.connect(('127.0.0.1', 54322))
+    def app_readable(self):
+        for _ in range(self.batch):
+            try:
+                data, self.app_peer = self.app_socket.recvfrom(65535)
+            except BlockingIOError:
+                break
+            except TRANSIENT_ERRORS:
+                continue
+            except OSError as error:
+                self.error = error
+                self.loop.remove_reader(self.app_socket)
+                break
+            self.connection.send(data)
+        self.schedule_timer()
 
-            client_receiver = threading.Thread(target=receive_from_client, args=(server_socket,))
-            server_sender = threading.Thread(target=send_to_client, args=(destination_socket,))
+    def tunnel_readable(self):
+        for _ in range(self.batch):
+            try:
+                length, self.tunnel_peer = self.tunnel_socket.recvfrom_into(self.packet)
+            except BlockingIOError:
+                break
+            except TRANSIENT_ERRORS:
+                continue
+            except OSError as error:
+                self.error = error
+                self.loop.remove_reader(self.tunnel_socket)
+                break
+            self.connection.datagram_received(self.packet_view[:length])
+        self.schedule_timer()
 
-            client_receiver.start()
-            server_sender.start()
+    def schedule_timer(self):
+        deadline = self.connection.deadline()
+        if deadline is None or (self.timer is not None and self.timer.when <= deadline):
+            return
+        if self.timer is not None:
+            self.timer.cancel()
+        self.timer = self.loop.call_at(deadline, self.timer_expired)
 
-            client_receiver.join()
-            server_sender.join()
+    def timer_expired(self):
+        self.timer = None
+        self.connection.on_timer()
+        self.schedule_timer()
 
 
-def run_my_client():
-    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as client_socket:
-        client_socket.bind(('127.0.0.1', 1111))
+class ThreadedRelay(RelayBase):
+    '''
+    A relay with a thread for each direction, each blocking on the socket
+    it reads from, and a third that sleeps on a condition variable until
+    the connection's next deadline; the connection is only touched with the
+    condition held.
+    '''
 
-        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as destination_socket:
-            destination_socket.connect(('127.0.0.1', 12345))
+    def __init__(self, app_socket, tunnel_socket, connection_class=ReliableConnection, **options):
+        super().__init__(app_socket, tunnel_socket, connection_class, **options)
+        self.condition = threading.Condition()
+        self.timer_waiting_until = None
+        self.threads = [threading.Thread(target=target, daemon=True)
+                        for target in (self.receive_from_app, self.receive_from_tunnel, self.run_timer)]
 
-            server_receiver = threading.Thread(target=receive_from_server, args=(client_socket,))
-            client_sender = threading.Thread(target=send_to_server, args=(destination_socket,))
+    def start(self):
+        for thread in self.threads:
+            thread.start()
 
-            server_receiver.start()
-            client_sender.start()
+    def join(self):
+        for thread in self.threads:
+            thread.join()
 
-            server_receiver.join()
-            client_sender.join()
+    def wake_timer(self):
+        deadline = self.connection.deadline()
+        if deadline is not None and (self.timer_waiting_until is None or deadline < self.timer_waiting_until):
+            self.condition.notify()
 
+    def receive_from_app(self):
+        while True:
+            try:
+                data, addr = self.app_socket.recvfrom(65535)
+            except TRANSIENT_ERRORS:
+                continue
+            except OSError as error:
+                self.error = error
+                return
+            with self.condition:
+                self.app_peer = addr
+                self.connection.send(data)
+                self.wake_timer()
 
-if __name__ == "__main__":
-    intermediary_server = threading.Thread(target=run_my_server)
-    intermediary_client = threading.Thread(target=run_my_client)
+    def receive_from_tunnel(self):
+        while True:
+            try:
+                length, addr = self.tunnel_socket.recvfrom_into(self.packet)
+            except TRANSIENT_ERRORS:
+                continue
+            except OSError as error:
+                self.error = error
+                return
+            with self.condition:
+                self.tunnel_peer = addr
+                self.connection.datagram_received(self.packet_view[:length])
+                self.wake_timer()
+
+    def run_timer(self):
+        with self.condition:
+            while True:
+                timeout = self.connection.timeout()
+                self.timer_waiting_until = self.connection.deadline()
+                self.condition.wait(timeout)
+                self.connection.on_timer()
+
+
+def server_sockets(address=SERVER_ADDRESS, destination=DESTINATION_ADDRESS):
+    '''
+    The intermediary server's (application, tunnel) sockets: it passes on
+    to destination what reaches address through the lossy link.
+    '''
+    server_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    server_socket.bind(address)
+    destination_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    destination_socket.connect(destination)
+    return destination_socket, server_socket
+
+
+def client_sockets(address=CLIENT_ADDRESS, link=LINK_ADDRESS):
+    '''
+    The intermediary client's (application, tunnel) sockets: what reaches
+    address goes into the lossy link at link.
+    '''
+    client_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    client_socket.bind(address)
+    destination_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    destination_socket.connect(link)
+    return client_socket, destination_socket
+
+
+def run_relays(socket_pairs, io='loop', **options):
+    '''
+    Runs a relay between each (application, tunnel) socket pair until
+    interrupted: all of them on one event loop, or each with its own
+    threads.
+    '''
+    if io == 'loop':
+        loop = EventLoop()
+        for app_socket, tunnel_socket in socket_pairs:
+            Relay(loop, app_socket, tunnel_socket, **options)
+        loop.run_forever()
+    else:
+        relays = [ThreadedRelay(app_socket, tunnel_socket, **options) for app_socket, tunnel_socket in socket_pairs]
+        for relay in relays:
+            relay.start()
+        for relay in relays:
+            relay.join()
 
-    intermediary_server.start()
-    intermediary_client.start()
 
-    intermediary_server.join()
-    intermediary_client.join()
+def run_my_server(address=SERVER_ADDRESS, destination=DESTINATION_ADDRESS, io='loop', **options):
+    run_relays([server_sockets(address, destination)], io, **options)
+
+
+def run_my_client(address=CLIENT_ADDRESS, link=LINK_ADDRESS, io='loop', **options):
+    run_relays([client_sockets(address, link)], io, **options)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Reliable UDP relay between ncat and a lossy link")
+    parser.add_argument('--client', type=parse_address, default=CLIENT_ADDRESS,
+                        help="host:port the intermediary client takes datagrams on (default: 127.0.0.1:1111)")
+    parser.add_argument('--link', type=parse_address, default=LINK_ADDRESS,
+                        help="host:port of the lossy link (default: 127.0.0.1:12345)")
+    parser.add_argument('--server', type=parse_address, default=SERVER_ADDRESS,
+                        help="host:port the intermediary server takes packets from the link on "
+                             "(default: 127.0.0.1:54321)")
+    parser.add_argument('--destination', type=parse_address, default=DESTINATION_ADDRESS,
+                        help="host:port the server passes the datagrams on to (default: 127.0.0.1:54322)")
+    parser.add_argument('--window', type=int, default=64,
+                        help="receive buffer in datagrams; also the most that can be in flight")
+    parser.add_argument('--congestion', choices=sorted(CONGESTION_CONTROLS), default='newreno')
+    parser.add_argument('--no-pacing', dest='pacing', action='store_false',
+                        help="send new datagrams as soon as the window allows")
+    parser.add_argument('--min-rto', type=float, default=0.2, help="lower bound of the retransmission timeout")
+    parser.add_argument('--no-checksum', dest='checksum', action='store_false',
+                        help="send packets without a CRC-32, relying on the UDP checksum")
+    parser.add_argument('--io', choices=['loop', 'threads'], default='loop',
+                        help="one event loop for both relays, or threads per relay")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    options = {'window': args.window, 'congestion': args.congestion, 'pacing': args.pacing, 'min_rto': args.min_rto,
+               'checksum': args.checksum}
+    try:
+        run_relays([server_sockets(args.server, args.destination), client_sockets(args.client, args.link)], args.io,
+                   **options)
+    except KeyboardInterrupt:
+        pass